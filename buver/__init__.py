@@ -19,9 +19,28 @@ __copyright__ = """Copyright 2006 Ken Lowrie"""
 __license__ = """Apache 2.0"""
 
 from . import buver
+from . import carchive
 from . import cbuconfig
 from . import cbuver
+from . import ccatalog
+from . import cchunkstore
+from . import ccopytree
+from . import cdaemon
+from . import cdelta
+from . import cdiff
 from . import cfolders
+from . import cjournal
 from . import clogger
+from . import cmanifest
+from . import cpgzip
+from . import creaper
+from . import crestore
+from . import cscheduler
 from . import csemaphore
+from . import cstats
+from . import cstorage
+from . import cthrottle
 from . import cversions
+from . import cverify
+from . import cwalker
+from . import cwatcher
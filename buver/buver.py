@@ -9,25 +9,97 @@ Written by: Ken Lowrie
 
 usage: 
 
-    buver <-i | -b> tgt_loc
+    buver [--lock=mode] [--lock-timeout=n] <-i | -b> tgt_loc
+    buver [--lock=mode] [--lock-timeout=n] --jobs [--workers=n] [--per-device=n] jobs_file
+    buver --list catalog_file
+    buver --restore --dest=dir [--version=n] [--path=p ...] [--threads=n] tgt_loc
+    buver --watch tgt_loc
+    buver --verify [--version=n] [--threads=n] [--max-read-bps=r] tgt_loc
+    buver --diff [--version=n] [--to=n] [--threads=n] tgt_loc
+    buver --daemon [--socket=path] [--workers=n] [--lock=mode] [--lock-timeout=n]
+    buver --submit [--socket=path] tgt_loc
     
 where:
 
     -i (--init) - initialize the 'tgt_loc' area for first use
     -b (--bu)   - perform a versioned backup
+    -j (--jobs) - perform the backups for every tgt_loc listed in jobs_file,
+                  running several of them at once from this process
+    -l (--list) - list the versions of every tgt_loc recorded in the catalog
+                  database catalog_file (see the 'catalog' directive)
+    -r (--restore) - restore a version, or some paths from it, into the
+                  directory given by --dest (see crestore.py)
+    -w (--watch) - watch the src_dir of tgt_loc and keep a journal of what
+                  changes, so the backups only look at those paths (see
+                  cwatcher.py). Runs until it is sent SIGTERM or SIGINT
+    -v (--verify) - check the versions (or just one) against the content
+                  hashes recorded when they were made, and report any
+                  missing or corrupt files (see cverify.py)
+    -d (--diff) - show what was added, removed and modified between two
+                  versions, or between a version and the src_dir as it is
+                  now (see cdiff.py)
+    -D (--daemon) - run the backups asked for over a Unix domain socket,
+                  keeping the config and versions of each tgt_loc cached in
+                  memory between runs (see cdaemon.py). Runs until it is
+                  sent SIGTERM or SIGINT
+    -s (--submit) - ask the daemon to back up tgt_loc, wait for it, and exit
+                  with its result
+    
+    --workers=n    - with --jobs or --daemon, the number of backups run at once (default 4)
+    --per-device=n - with --jobs, the number of backups that may use the same
+                     device at once (default 1)
+    --lock=mode    - how the tgt_loc is locked: 'file' (the default) retries a
+                     lock file once a second, 'flock' queues the waiters and
+                     hands the lock over immediately (see csemaphore.py)
+    --lock-timeout=n - how many seconds to wait for the lock (default 120)
+    --dest=dir     - with --restore, where to restore to (required)
+    --version=n    - with --restore, the version to restore (default the latest),
+                     with --verify, the version to verify (default all of them),
+                     with --diff, the version to compare from (default the latest,
+                     or the one before --to)
+    --to=n         - with --diff, the version to compare to (default the src_dir)
+    --socket=path  - with --daemon or --submit, the daemon's socket (default ~/.buver.sock)
+    --path=p       - with --restore, a path (relative to src_dir) to restore,
+                     along with everything under it. May be given more than
+                     once. The default is to restore everything
+    --threads=n    - with --restore, the number of copy threads, with --verify,
+                     the number of hashing processes, with --diff, the number of
+                     hashing threads (default 8)
+    --max-read-bps=r - with --verify, the most bytes per second to read, with
+                     an optional K, M or G (default no limit)
     
     tgt_loc - the target location where versions are kept
               and the configuration data is kept.
               
+    jobs_file - a file with one tgt_loc per line, see cscheduler.py
+    
+    catalog_file - the SQLite catalog named in buver.conf, see ccatalog.py
+              
 example:
 
     buver -b /home/ken/bu/job_a
+    buver --jobs --workers=8 /home/ken/bu/jobs.list
+    buver --list /home/ken/bu/catalog.db
+    buver --restore --dest=/tmp/r --version=3 --path=docs/notes.txt /home/ken/bu/job_a
+    buver --watch /home/ken/bu/job_a &
+    buver --verify --max-read-bps=50M /home/ken/bu/job_a
+    buver --diff --version=7 --to=8 /home/ken/bu/job_a
+    buver --daemon --workers=8 &
+    buver --submit /home/ken/bu/job_a
 """
 
 import os
 import sys
 
 from buver.cbuver import C_buver
+from buver.cscheduler import C_scheduler
+from buver.ccatalog import C_catalog
+from buver.crestore import C_restore
+from buver.cwatcher import C_watcher
+from buver.cverify import C_verify
+from buver.cdiff import C_diff
+from buver.cdaemon import C_daemon, C_client
+from buver.cthrottle import parse_rate
 
 def message(msgstr): print('buver: %s' % (msgstr))
 
@@ -37,10 +109,67 @@ def parse_args(args):
     tgt_loc = '.'   # default directory is current directory, seems reasonable as default
     found_mode = False
     found_tgtloc = False
+    workers = 4
+    per_device = 1
+    lock = 'file'
+    lock_timeout = 120
+    dest = None
+    version = None
+    to = None
+    paths = []
+    threads = 8
+    read_bps = 0
+    socket_name = None
     
     for arg in args:
         if arg.lower() in ['--help', '-?', '-h', '/h', '/?']: usage()   # be nice, support command line help options
         
+        # the options that take a value are given as --option=value
+        opt, sep, val = arg.partition('=')
+        if sep and opt.lower() == '--lock':
+            if val not in ['file', 'flock']:
+                message('%s must be file or flock' % opt)
+                usage()
+            lock = val
+            continue
+            
+        if sep and opt.lower() in ['--workers', '--per-device', '--lock-timeout', '--version', '--to', '--threads']:
+            if not val.isdigit() or int(val) < 1:
+                message('%s must be a positive number' % opt)
+                usage()
+            if opt.lower() == '--workers':
+                workers = int(val)
+            elif opt.lower() == '--per-device':
+                per_device = int(val)
+            elif opt.lower() == '--version':
+                version = int(val)
+            elif opt.lower() == '--to':
+                to = int(val)
+            elif opt.lower() == '--threads':
+                threads = int(val)
+            else:
+                lock_timeout = int(val)
+            continue
+            
+        if sep and opt.lower() == '--max-read-bps':
+            if not parse_rate(val):
+                message('%s must be a positive number (with an optional K, M or G)' % opt)
+                usage()
+            read_bps = parse_rate(val)
+            continue
+            
+        if sep and opt.lower() in ['--dest', '--path', '--socket']:
+            if val == '':
+                message('%s needs a value' % opt)
+                usage()
+            if opt.lower() == '--dest':
+                dest = val
+            elif opt.lower() == '--socket':
+                socket_name = val
+            else:
+                paths.append(val)
+            continue
+            
         # as we parse, the last switch wins (when ambiguous switches are specified)
         # also, remember if they don't select a mode or target loc, and tell them we defaulted
         if arg.lower() in ['--init', '-i']:
@@ -49,15 +178,87 @@ def parse_args(args):
         elif arg.lower() in ['--bu', '-b']:
             mode = 1
             found_mode = True
+        elif arg.lower() in ['--jobs', '-j']:
+            mode = 2
+            found_mode = True
+        elif arg.lower() in ['--list', '-l']:
+            mode = 3
+            found_mode = True
+        elif arg.lower() in ['--restore', '-r']:
+            mode = 4
+            found_mode = True
+        elif arg.lower() in ['--watch', '-w']:
+            mode = 5
+            found_mode = True
+        elif arg.lower() in ['--verify', '-v']:
+            mode = 6
+            found_mode = True
+        elif arg in ['--daemon', '-D']:
+            # before --diff, since that one does not care about the case
+            mode = 8
+            found_mode = True
+        elif arg.lower() in ['--diff', '-d']:
+            mode = 7
+            found_mode = True
+        elif arg.lower() in ['--submit', '-s']:
+            mode = 9
+            found_mode = True
         else:
             tgt_loc = arg
             found_tgtloc = True
             
     if not found_mode:   message('mode not specified, defaulting to backup ...')
+    
+    # the jobs mode gets a scheduler instead, which builds a buver object for each job
+    if mode == 2:
+        if not found_tgtloc:
+            message('jobs_file not specified ...')
+            usage()
+        return C_scheduler(message,tgt_loc,workers,per_device,lock,lock_timeout)
+        
+    # the list mode only reads the catalog
+    if mode == 3:
+        if not found_tgtloc:
+            message('catalog_file not specified ...')
+            usage()
+        return C_catalog(message,tgt_loc)
+        
+    # the restore mode gets a restore object, which only reads the tgt_loc
+    if mode == 4:
+        if dest is None:
+            message('--dest not specified ...')
+            usage()
+        if not found_tgtloc: message('tgt_loc not specified, defaulting to current directory ...')
+        return C_restore(message,tgt_loc,dest,version,paths,threads)
+        
+    # the watch mode gets a watcher, which runs until it is stopped
+    if mode == 5:
+        if not found_tgtloc: message('tgt_loc not specified, defaulting to current directory ...')
+        return C_watcher(message,tgt_loc)
+        
+    # the verify mode gets a verifier, which only reads the tgt_loc
+    if mode == 6:
+        if not found_tgtloc: message('tgt_loc not specified, defaulting to current directory ...')
+        return C_verify(message,tgt_loc,version,threads,read_bps)
+        
+    # the diff mode gets a differ, which only reads the tgt_loc (and the src_dir)
+    if mode == 7:
+        if not found_tgtloc: message('tgt_loc not specified, defaulting to current directory ...')
+        return C_diff(message,tgt_loc,version,to,threads)
+        
+    # the daemon mode serves backup requests until it is stopped
+    if mode == 8:
+        return C_daemon(message,socket_name,workers,lock,lock_timeout)
+        
+    # the submit mode asks the daemon for a backup. The daemon has its own working directory
+    if mode == 9:
+        if not found_tgtloc: message('tgt_loc not specified, defaulting to current directory ...')
+        return C_client(message,'backup %s' % os.path.abspath(tgt_loc),socket_name)
+        
     if not found_tgtloc: message('tgt_loc not specified, defaulting to current directory ...')
 
     # call the class factor for the buver object and give it back to the caller
-    return C_buver(mode,tgt_loc)
+    return C_buver(mode,tgt_loc,None,lock,lock_timeout)
 
 def buver_entry():
     # assume we have no arguments, but if we do, pass them along
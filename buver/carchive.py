@@ -0,0 +1,350 @@
+import os
+import stat
+import tarfile
+import time
+
+from buver.cpgzip import C_pgzip, C_pgzip_reader, INDEPENDENT_BLOCK_SIZE
+from buver.cmanifest import _escape, _unescape, _open, new_hash, C_hashing_file
+from buver.cwalker import C_walker
+
+"""
+This module contains the code for the archive class.
+
+The purpose of this module is to build the 'tar' and 'gzip' backups
+in-process, when the 'engine' directive is set to 'builtin', instead of
+running 'tar_cmd' or 'gzip_cmd'.
+
+The default 'gzip_cmd' writes the whole uncompressed tar archive to disk,
+then reads it back to compress it, on a single core. Here, the archive is
+built with the tarfile module and streamed straight into a C_pgzip writer
+(see cpgzip.py), which compresses it on several cores as it goes. The
+uncompressed archive never touches the disk, so a 'gzip' backup writes
+only the compressed data once, and reads nothing back. The compressor can
+also be bz2 or lzma, and it does not spend time on data that will not
+compress, see the 'codec' directive in cbuconfig.py.
+
+The member names are relative to the src_dir, the same as running
+'tar cvf backup.tar *' from within the src_dir (except that dot files
+at the top level are included, which the shell wildcard would skip).
+
+Next to the archive, a member index called 'members' is written. It has
+one line per member with the offset of its header in the (uncompressed)
+tar stream, its size and its name:
+
+    offset size path
+
+so a restore (see crestore.py) can go straight to the members it needs
+instead of reading every header in the archive.
+
+The 'bgzf' type is compressed in independent blocks (see cpgzip.py), and
+a block index called 'blocks' is written as well. It has one line per
+block with the offset of the block in the compressed file and the offset
+of its data in the tar stream:
+
+    compressed_offset uncompressed_offset
+
+Between the two, any member can be read by decompressing only the blocks
+that hold it. The archive itself is an ordinary 'backup.tar.gz', which
+'tar xzf' and 'gzip -d' read as usual.
+
+The size of each member is written in its header before its data. If a
+file shrinks (or cannot be read any further) while it is being archived,
+the rest of the member is filled with zeros, as GNU tar does, so the
+members after it are still where their headers say. The file is reported
+and counted as an error, and gets no hash in the manifest.
+
+If a 'throttle' is given (see cthrottle.py), the reads of the src_dir, the
+writes of the archive and the files per second are held to its limits.
+
+run() - build the archive, returns 0 on success or 1 if anything failed
+load_members() - read the member index of a version
+load_blocks() - read the block index of a version
+open_archive() - read the tar stream of an archive back
+"""
+
+MEMBERS_NAME = 'members'
+MEMBERS_HEADER = '# buver members 1\n'
+
+def load_members(version):
+    """Return the member index of 'version' as a list of (offset, size, path)
+    in archive order, or None if the version does not have a usable one."""
+
+    members = []
+    try:
+        f = _open(os.path.join(version,MEMBERS_NAME),'r')
+        try:
+            if f.readline() != MEMBERS_HEADER: return None
+
+            for line in f:
+                x = line.rstrip('\n').split('\t',2)
+                if len(x) != 3: continue
+                members.append((int(x[0]),int(x[1]),_unescape(x[2])))
+        finally:
+            f.close()
+    except (IOError,OSError,ValueError):
+        return None
+
+    return members
+
+BLOCKS_NAME = 'blocks'
+BLOCKS_HEADER = '# buver blocks 1\n'
+
+def load_blocks(version):
+    """Return the block index of 'version' as a list of (compressed offset,
+    uncompressed offset), or None if the version does not have a usable one."""
+
+    blocks = []
+    try:
+        f = open(os.path.join(version,BLOCKS_NAME),'r')
+        try:
+            if f.readline() != BLOCKS_HEADER: return None
+
+            for line in f:
+                x = line.split()
+                if len(x) != 2: continue
+                blocks.append((int(x[0]),int(x[1])))
+        finally:
+            f.close()
+    except (IOError,OSError,ValueError):
+        return None
+
+    return blocks or None
+
+def open_archive(archive,blocks=None):
+    """Return a file object that reads the tar stream of 'archive' from the
+    start, going by the suffix of its name. With 'blocks' (see load_blocks()),
+    it is a C_pgzip_reader, which can seek to any offset cheaply. The others
+    have to decompress from the start again to seek backwards, so read them
+    in order. The gzip, bz2 and lzma modules read every member (or stream)
+    of a file, which the streaming mode of tarfile does not, and the archives
+    that C_pgzip writes in blocks are made of several of them."""
+
+    import gzip
+    import bz2
+    import lzma
+
+    if blocks: return C_pgzip_reader(open(archive,'rb'),blocks)
+    if archive.endswith('.gz'): return gzip.open(archive,'rb')
+    if archive.endswith('.bz2'): return bz2.open(archive,'rb')
+    if archive.endswith('.xz'): return lzma.open(archive,'rb')
+
+    return open(archive,'rb')
+
+class C_padded_file:
+    """A file object that reads exactly 'size' bytes from 'f', and zeros for
+    whatever it could not read. 'missing' is how many bytes were zeros, and
+    'error' the read error that stopped it (or None)."""
+
+    def __init__(self,f,size):
+        self.f = f
+        self.left = size
+        self.missing = 0
+        self.error = None
+
+    def read(self,size=-1):
+        if size < 0 or size > self.left: size = self.left
+        self.left = self.left - size
+
+        data = b''
+        if not self.missing:
+            try:
+                data = self.f.read(size)
+                while data and len(data) < size:
+                    more = self.f.read(size - len(data))
+                    if not more: break
+                    data = data + more
+            except (IOError,OSError) as e:
+                self.error = e
+                data = b''
+
+        if len(data) < size:
+            self.missing = self.missing + size - len(data)
+            data = data + bytes(size - len(data))
+
+        return data
+
+    def close(self):
+        self.f.close()
+
+class C_archive:
+    def __init__(self,msg,src_dir,archive,compress=False,threads=1,manifest=None,independent=False,
+                 codec='zlib',level=6,throttle=None,hashing=False):
+        """Constructor for the C_archive class. Initialize the
+        variables that we need to have in order for the class to
+        operate:
+
+        msgout   - the generic message handler for printing output
+        src_dir  - the directory tree we are archiving
+        archive  - the name of the archive to create
+        compress - whether to gzip the archive
+        independent - compress in independent blocks, and write the block index
+        codec    - the compression codec, 'zlib', 'bz2' or 'lzma' (see cpgzip.py)
+        level    - the compression level of the codec
+        threads  - the number of compression threads
+        manifest - the manifest of the new version (or None)
+        throttle - the C_throttle that limits the I/O (or None)
+        hashing  - whether to hash the files for the manifest
+        files    - the number of files archived
+        errors   - the number of items we could not process
+        stored_blocks - the number of blocks that did not compress"""
+
+        self.msgout = msg
+        self.src_dir = os.path.abspath(src_dir)
+        self.archive = archive
+        self.compress = compress
+        self.threads = max(1,int(threads))
+        self.manifest = manifest
+        self.throttle = throttle
+        if throttle and not throttle.active(): self.throttle = None
+        self.hashing = hashing
+        self.files = 0
+        self.errors = 0
+        self.stored_blocks = 0
+        self.independent = independent
+        self.codec = codec
+        self.level = level
+        self.members = os.path.join(os.path.dirname(os.path.abspath(archive)),MEMBERS_NAME)
+        self.blocks = os.path.join(os.path.dirname(os.path.abspath(archive)),BLOCKS_NAME)
+        self.index = None
+
+    def add_tree(self,tar):
+        """Add everything in the src_dir to the open tarfile 'tar'."""
+
+        # symbolic links to directories are listed with the names, so they are kept as links
+        for root, subdirs, names in C_walker(self.msgout).walk(self.src_dir):
+            # sort the names, so the archive is the same from run to run
+            subdirs.sort()
+            names.sort()
+            if root == self.src_dir: names.insert(0,'')
+
+            for name in names:
+                path = os.path.join(root,name) if name else root
+                rel = os.path.relpath(path,self.src_dir)
+                try:
+                    st = os.lstat(path)
+                    if not (stat.S_ISDIR(st.st_mode) or stat.S_ISLNK(st.st_mode) or stat.S_ISREG(st.st_mode)):
+                        self.msgout('Skipping special file <%s>' % path)
+                        continue
+
+                    # the top directory itself is recorded, but is not an archive member
+                    hash = None
+                    if rel != '.':
+                        if self.throttle: self.throttle.files()
+                        offset = tar.offset
+                        hash = self.add_member(tar,path,rel)
+                        if self.index: self.index.write('%d\t%d\t%s\n' % (offset,tar.offset - offset,_escape(rel)))
+                    if self.manifest: self.manifest.add(rel,st,hash)
+                    if stat.S_ISREG(st.st_mode): self.files = self.files + 1
+
+                except (IOError,OSError) as e:
+                    self.msgout('Unable to archive <%s>: %s' % (path,e))
+                    self.errors = self.errors + 1
+
+    def add_member(self,tar,path,rel):
+        """Add the item at 'path' to the open tarfile 'tar' as 'rel'. This
+        is tar.add(), except that the file is read through the throttle, and
+        hashed on the way if 'hashing' is set. A file that shrinks meanwhile
+        is padded with zeros, see C_padded_file. Returns the hash (or None)."""
+
+        tarinfo = tar.gettarinfo(path,rel)
+        if not tarinfo.isreg():
+            tar.addfile(tarinfo)
+            return None
+
+        h = None
+        f = open(path,'rb')
+        try:
+            if self.throttle: f = self.throttle.reader(f)
+            # once the header is written, the member has to get all the data it promises
+            f = padded = C_padded_file(f,tarinfo.size)
+            if self.hashing:
+                h = new_hash()
+                f = C_hashing_file(f,h)
+            tar.addfile(tarinfo,f)
+        finally:
+            f.close()
+
+        if padded.missing:
+            self.msgout('File <%s> changed while being archived, padded %d bytes with zeros%s' %
+                        (path,padded.missing,': %s' % padded.error if padded.error else ''))
+            self.errors = self.errors + 1
+            return None
+
+        if h: return h.hexdigest()
+        return None
+
+    def run(self):
+        """Build the archive. Returns 0 on success or 1 if anything failed."""
+
+        if not os.path.isdir(self.src_dir):
+            self.msgout('Directory <%s> does not exist' % self.src_dir)
+            return 1
+
+        start = time.time()
+        try:
+            out = open(self.archive,'wb')
+        except IOError:
+            self.msgout('Unable to create the archive <%s>' % self.archive)
+            return 1
+
+        if self.throttle: out = self.throttle.writer(out)
+
+        stream = out
+        if self.independent:
+            stream = C_pgzip(out,self.level,self.threads,INDEPENDENT_BLOCK_SIZE,True)
+        elif self.compress:
+            stream = C_pgzip(out,self.level,self.threads,codec=self.codec)
+
+        # the member index is only a shortcut for restores, so it is not fatal if it cannot be written
+        try:
+            self.index = _open('%s.tmp' % self.members,'w')
+            self.index.write(MEMBERS_HEADER)
+        except (IOError,OSError):
+            self.msgout('Unable to create the member index <%s>' % self.members)
+            self.index = None
+
+        written = False
+        try:
+            tar = tarfile.open(fileobj=stream,mode='w|',format=tarfile.PAX_FORMAT)
+            self.add_tree(tar)
+            tar.close()
+            if stream is not out: stream.close()
+            out.close()
+            written = True
+        except (IOError,OSError,tarfile.TarError) as e:
+            self.msgout('Failed writing the archive <%s>: %s' % (self.archive,e))
+            return 1
+        finally:
+            # whatever went wrong, do not leave the compressing threads running or the files open
+            if stream is not out: stream.abort()
+            out.close()
+            if self.index and not written: self.index.close()
+
+        if self.index:
+            try:
+                self.index.close()
+                os.rename('%s.tmp' % self.members,self.members)
+            except (IOError,OSError):
+                self.msgout('Unable to write the member index <%s>' % self.members)
+
+        # without the block index, a 'bgzf' archive can still be read from the start
+        if self.independent:
+            try:
+                f = open('%s.tmp' % self.blocks,'w')
+                f.write(BLOCKS_HEADER)
+                for block in stream.blocks: f.write('%d\t%d\n' % block)
+                f.close()
+                os.rename('%s.tmp' % self.blocks,self.blocks)
+            except (IOError,OSError):
+                self.msgout('Unable to write the block index <%s>' % self.blocks)
+
+        elapsed = max(time.time() - start,0.001)
+        size = os.path.getsize(self.archive)
+        self.msgout('Archived %d files into <%s> (%d bytes), %d errors' % (self.files,self.archive,size,self.errors))
+        if stream is not out:
+            self.stored_blocks = stream.stored_blocks
+            self.msgout('Compressed %d bytes to %d bytes with %s at %.2f MB/sec using %d threads, %d blocks did not compress' %
+                        (stream.size,size,stream.codec,stream.size / elapsed / (1 << 20),self.threads,stream.stored_blocks))
+
+        if self.errors: return 1
+        return 0
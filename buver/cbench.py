@@ -0,0 +1,451 @@
+#!/usr/bin/env python
+
+"""
+This module implements the buver benchmark suite.
+
+The purpose of the benchmarks is to show whether a change makes buver
+faster or slower. Everything runs against synthetic data that is generated
+from a fixed seed, so two runs on the same machine measure the same work:
+
+    tiny   - many tiny files in a shallow tree
+    huge   - a few large files
+    deep   - a deeply nested tree with a few files at every level
+    sparse - large files that are mostly holes
+
+The suite measures:
+
+    backup - for each data set and each backup type (and engine), the time
+             to initialize a tgt_loc, the first (full) backup, and a second
+             backup after a few files have changed. The per-phase timings
+             that C_buver records (see cstats.py) are kept as well.
+    prune  - the time for sanify() and prune() with 1 to 1000 versions on
+             disk, and for the reaper to empty the trash afterwards.
+    lock   - how long C_semaphore takes to hand the lock from one process to
+             the next (release to acquire) when several processes contend for
+             the same tgt_loc, in each mode.
+
+The results are written as JSON. If a baseline (the JSON from an earlier
+run) is given, each result is compared with it, and the ones that got
+slower by more than the threshold are reported as regressions.
+
+usage:
+
+    buver-bench [--out=file] [--baseline=file] [--threshold=pct]
+                [--scale=n] [--only=group,...] [--workdir=dir]
+
+where:
+
+    --out       - where to write the results (default bench.json)
+    --baseline  - the results of an earlier run to compare against
+    --threshold - how much slower (in percent) counts as a regression (default 10)
+    --scale     - multiply the size of the data sets by n (default 1)
+    --only      - run only these groups (backup, prune, lock)
+    --workdir   - where to build the data sets (default a temporary directory)
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import platform
+import tempfile
+
+from buver.cbuver import C_buver
+from buver.cbuconfig import C_buconfig
+from buver.cversions import C_versions
+from buver.creaper import C_reaper
+from buver.csemaphore import C_semaphore
+
+def message(msgstr): print('buver-bench: %s' % (msgstr))
+
+# The backup types to measure, as (name, type, engine)
+BACKUP_TYPES = [('tree_cmd','tree','cmd'),
+                ('tree_builtin','tree','builtin'),
+                ('link','link','builtin'),
+                ('tar_cmd','tar','cmd'),
+                ('tar_builtin','tar','builtin'),
+                ('gzip_cmd','gzip','cmd'),
+                ('gzip_builtin','gzip','builtin'),
+                ('dedup','dedup','builtin')]
+
+# The number of versions on disk for the prune benchmark
+PRUNE_VERSIONS = [1,10,100,1000]
+
+# The lock contention benchmark: processes, acquisitions by each, and how
+# long (in seconds) each holds the lock, so the others are waiting for it
+LOCK_PROCS = 4
+LOCK_ROUNDS = 25
+LOCK_HOLD = 0.005
+
+class quiet:
+    """A context manager that sends stdout (including that of the commands
+    we run) to /dev/null, so the benchmark output stays readable."""
+
+    def __enter__(self):
+        sys.stdout.flush()
+        self.saved = os.dup(1)
+        self.null = os.open(os.devnull,os.O_WRONLY)
+        os.dup2(self.null,1)
+        return self
+
+    def __exit__(self,exc_type,exc_value,tb):
+        sys.stdout.flush()
+        os.dup2(self.saved,1)
+        os.close(self.saved)
+        os.close(self.null)
+        return False
+
+def _lock_worker(path,mode,rounds,start,holder,released,handoffs):
+    # runs in a child process of the lock benchmark. 'start' lets all of them
+    # go at once, 'holder' and 'released' are who last held the lock and when
+    # they let go of it. When we take it over from another process, the time
+    # from there to our acquire goes in 'handoffs'.
+    sem = C_semaphore(path,'buver.lock',mode)
+    latencies = []
+    failed = 0
+    start.wait()
+    for i in range(rounds):
+        if sem.wait(120):
+            failed = 1
+            break
+        acquired = time.monotonic()
+        if holder.value and holder.value != os.getpid(): latencies.append(acquired - released.value)
+        time.sleep(LOCK_HOLD)
+        holder.value = os.getpid()
+        released.value = time.monotonic()
+        sem.signal()
+    handoffs.put(None if failed else latencies)
+
+    # os._exit() skips the queue's feeder thread, so flush it first
+    handoffs.close()
+    handoffs.join_thread()
+    os._exit(failed)
+
+class C_bench:
+    def __init__(self,msg,workdir=None,scale=1,only=None):
+        """Constructor for the C_bench class. Initialize the
+        variables that we need to have in order for the class to
+        operate:
+
+        msgout  - the generic message handler for printing output
+        workdir - where the data sets and tgt_locs are built
+        scale   - the multiplier for the size of the data sets
+        only    - the list of groups to run (None runs them all)
+        results - the measurements, keyed by name (seconds, or a rate)"""
+
+        self.msgout = msg
+        self.own_workdir = workdir is None
+        self.workdir = os.path.abspath(workdir or tempfile.mkdtemp(prefix='buver-bench.'))
+        self.scale = max(1,int(scale))
+        self.only = only
+        self.results = {}
+        self.phases = {}
+        self.rng = random.Random(0x62656e63)
+
+    def want(self,group):
+        return not self.only or group in self.only
+
+    def data(self,size):
+        """Return 'size' bytes of repeatable data that compresses somewhat."""
+
+        words = [b'alpha',b'bravo',b'charlie',b'delta',b'echo',b'foxtrot',b'golf',b'hotel']
+        out = bytearray()
+        while len(out) < size:
+            out.extend(self.rng.choice(words))
+            out.extend(bytes([self.rng.randrange(256) for i in range(8)]))
+        return bytes(out[:size])
+
+    def make_tree(self,name):
+        """Build the data set 'name' and return its path."""
+
+        top = os.path.join(self.workdir,'src',name)
+        if os.path.isdir(top): shutil.rmtree(top)
+        os.makedirs(top)
+
+        if name == 'tiny':
+            blob = self.data(4096)
+            for d in range(50 * self.scale):
+                sub = os.path.join(top,'d%03d' % d)
+                os.mkdir(sub)
+                for f in range(100):
+                    size = self.rng.randrange(1,2048)
+                    open(os.path.join(sub,'f%03d' % f),'wb').write(blob[:size])
+
+        elif name == 'huge':
+            blob = self.data(1 << 20)
+            for f in range(3):
+                out = open(os.path.join(top,'huge%d' % f),'wb')
+                for i in range(16 * self.scale):
+                    out.write(blob)
+                out.close()
+
+        elif name == 'deep':
+            blob = self.data(1024)
+            path = top
+            for d in range(64 * self.scale):
+                path = os.path.join(path,'level%d' % d)
+                os.mkdir(path)
+                for f in range(8):
+                    open(os.path.join(path,'f%d' % f),'wb').write(blob)
+
+        elif name == 'sparse':
+            blob = self.data(4096)
+            for f in range(2):
+                out = open(os.path.join(top,'sparse%d' % f),'wb')
+                size = (64 << 20) * self.scale
+                for offset in range(0,size,size // 8):
+                    out.seek(offset)
+                    out.write(blob)
+                out.truncate(size)
+                out.close()
+
+        return top
+
+    def modify_tree(self,top):
+        """Change a few files in the data set, for the second backup."""
+
+        names = []
+        for root, dirs, files in os.walk(top):
+            dirs.sort()
+            for f in sorted(files): names.append(os.path.join(root,f))
+
+        for path in names[::max(1,len(names) // 10)]:
+            out = open(path,'r+b')
+            out.seek(0)
+            out.write(b'changed %f' % time.time())
+            out.close()
+
+    def configure(self,tgt_loc,directives):
+        """Set the given directives in the buver.conf of tgt_loc."""
+
+        name = C_buconfig(lambda msg: 0,tgt_loc).name()
+        lines = []
+        for line in open(name,'r').read().splitlines():
+            key, sep, val = line.partition('=')
+            if key in directives: line = '%s=%s' % (key,directives[key])
+            lines.append(line)
+
+        open(name,'w').write('\n'.join(lines) + '\n')
+
+    def run_buver(self,mode,tgt_loc):
+        """Run one buver job quietly. Returns the elapsed time and the C_buver object."""
+
+        start = time.time()
+        with quiet():
+            buv = C_buver(mode,tgt_loc)
+            rc = buv.execute()
+            # or these would all print a message when the benchmark exits
+            buv.close()
+        elapsed = time.time() - start
+
+        if rc: self.msgout('buver returned %s for <%s>' % (rc,tgt_loc))
+        return elapsed, buv
+
+    def bench_backup(self):
+        """Measure initialize and backup for every data set and type."""
+
+        for data_set in ['tiny','huge','deep','sparse']:
+            src = self.make_tree(data_set)
+
+            for name, backup_type, engine in BACKUP_TYPES:
+                key = 'backup.%s.%s' % (data_set,name)
+                tgt = os.path.join(self.workdir,'tgt',data_set,name)
+                if os.path.isdir(tgt): shutil.rmtree(tgt)
+                os.makedirs(os.path.dirname(tgt),exist_ok=True)
+
+                self.results['%s.init' % key], buv = self.run_buver(0,tgt)
+
+                self.configure(tgt,{'src_dir':src,'type':backup_type,'engine':engine,'mailto':''})
+
+                self.results['%s.full' % key], buv = self.run_buver(1,tgt)
+                self.phases['%s.full' % key] = buv.stats.phases
+
+                self.modify_tree(src)
+                self.results['%s.incremental' % key], buv = self.run_buver(1,tgt)
+                self.phases['%s.incremental' % key] = buv.stats.phases
+
+                self.msgout('%-36s full %8.3fs  incremental %8.3fs' %
+                            (key,self.results['%s.full' % key],self.results['%s.incremental' % key]))
+
+                shutil.rmtree(tgt)
+
+            shutil.rmtree(src)
+
+    def bench_prune(self):
+        """Measure sanify(), prune() and the reaper with many versions."""
+
+        for count in PRUNE_VERSIONS:
+            tgt = os.path.join(self.workdir,'prune')
+            if os.path.isdir(tgt): shutil.rmtree(tgt)
+            verdir = os.path.join(tgt,'versions')
+            os.makedirs(verdir)
+
+            for v in range(1,count + 1):
+                path = os.path.join(verdir,str(v))
+                os.mkdir(path)
+                for f in range(10):
+                    open(os.path.join(path,'f%d' % f),'w').write('version %d\n' % v)
+
+            logical = [str(v) for v in range(1,count + 1)]
+
+            start = time.time()
+            versions = C_versions(lambda msg: 0,verdir)
+            versions.sanify(2,logical)
+            sanify = time.time() - start
+
+            start = time.time()
+            versions.prune()
+            prune = time.time() - start
+
+            start = time.time()
+            C_reaper(lambda msg: 0,versions.trash,8).run()
+            reap = time.time() - start
+
+            self.results['prune.%d.sanify' % count] = sanify
+            self.results['prune.%d.prune' % count] = prune
+            self.results['prune.%d.reap' % count] = reap
+            self.msgout('prune with %4d versions: sanify %.4fs  prune %.4fs  reap %.4fs' % (count,sanify,prune,reap))
+
+            shutil.rmtree(tgt)
+
+    def bench_lock(self):
+        """Measure the lock handoff latency (from one process releasing the
+        lock to the next one acquiring it) with several contending processes."""
+
+        import multiprocessing
+
+        for mode in ['file','flock']:
+            path = os.path.join(self.workdir,'lock.%s' % mode)
+            os.makedirs(path,exist_ok=True)
+
+            start = multiprocessing.Event()
+            holder = multiprocessing.Value('i',0,lock=False)
+            released = multiprocessing.Value('d',0.0,lock=False)
+            handoffs = multiprocessing.Queue()
+            procs = [multiprocessing.Process(target=_lock_worker,args=(path,mode,LOCK_ROUNDS,start,holder,released,handoffs))
+                     for i in range(LOCK_PROCS)]
+            for p in procs: p.start()
+            start.set()
+
+            # drain the queue before joining, or a child can block putting its results
+            latencies = []
+            failed = 0
+            for p in procs:
+                got = handoffs.get()
+                if got is None: failed = failed + 1
+                else: latencies.extend(got)
+            for p in procs: p.join()
+            failed = max(failed,len([p for p in procs if p.exitcode]))
+
+            key = 'lock.%s' % mode
+            if not latencies:
+                self.msgout('lock %-5s: no handoffs measured, %d failed' % (mode,failed))
+                continue
+            latencies.sort()
+            median = latencies[len(latencies) // 2]
+            p95 = latencies[min(len(latencies) - 1,int(len(latencies) * 0.95))]
+            self.results['%s.handoff_median' % key] = median
+            self.results['%s.handoff_p95' % key] = p95
+            self.results['%s.handoff_max' % key] = latencies[-1]
+            self.msgout('lock %-5s: %d procs x %d rounds, %d handoffs, median %.2fms  p95 %.2fms  max %.2fms, %d failed' %
+                        (mode,LOCK_PROCS,LOCK_ROUNDS,len(latencies),median * 1000,p95 * 1000,latencies[-1] * 1000,failed))
+
+    def run(self):
+        """Run the selected benchmark groups."""
+
+        try:
+            if self.want('backup'): self.bench_backup()
+            if self.want('prune'): self.bench_prune()
+            if self.want('lock'): self.bench_lock()
+        finally:
+            if self.own_workdir: shutil.rmtree(self.workdir,ignore_errors=True)
+
+        return 0
+
+    def save(self,name):
+        """Write the results to the JSON file 'name'. Returns 0 on success or 1 otherwise."""
+
+        doc = {'meta':{'time':time.strftime('%Y-%m-%dT%H:%M:%S'),
+                       'host':platform.node(),
+                       'python':platform.python_version(),
+                       'platform':platform.platform(),
+                       'cpus':os.cpu_count(),
+                       'scale':self.scale},
+               'results':self.results,
+               'phases':self.phases}
+        try:
+            out = open(name,'w')
+            json.dump(doc,out,indent=1,sort_keys=True)
+            out.close()
+        except IOError:
+            self.msgout('Unable to write the results to <%s>' % name)
+            return 1
+
+        return 0
+
+    def compare(self,name,threshold):
+        """Compare the results with the baseline in the JSON file 'name'.
+        Returns the number of regressions."""
+
+        try:
+            baseline = json.load(open(name,'r'))['results']
+        except (IOError,ValueError,KeyError):
+            self.msgout('Unable to read the baseline <%s>' % name)
+            return 1
+
+        regressions = 0
+        for key in sorted(self.results):
+            if key not in baseline or not baseline[key]: continue
+
+            # rates get better as they go up, times as they go down
+            change = (self.results[key] - baseline[key]) / baseline[key] * 100.0
+            if key.endswith('_per_sec'): change = -change
+
+            flag = ''
+            if change > threshold:
+                flag = '  REGRESSION'
+                regressions = regressions + 1
+            self.msgout('%-48s %12.4f %12.4f %+8.1f%%%s' % (key,baseline[key],self.results[key],change,flag))
+
+        self.msgout('%d regressions (threshold %d%%)' % (regressions,threshold))
+        return regressions
+
+def bench_entry():
+    out = 'bench.json'
+    baseline = None
+    threshold = 10
+    scale = 1
+    only = None
+    workdir = None
+
+    for arg in sys.argv[1:]:
+        if arg.lower() in ['--help', '-?', '-h', '/h', '/?']: usage()
+
+        opt, sep, val = arg.partition('=')
+        if not sep: usage()
+        try:
+            if opt == '--out': out = val
+            elif opt == '--baseline': baseline = val
+            elif opt == '--threshold': threshold = int(val)
+            elif opt == '--scale': scale = int(val)
+            elif opt == '--only': only = val.split(',')
+            elif opt == '--workdir': workdir = val
+            else: usage()
+        except ValueError:
+            usage()
+
+    bench = C_bench(message,workdir,scale,only)
+    bench.run()
+    rc = bench.save(out)
+    if baseline: rc = rc or bench.compare(baseline,threshold)
+
+    sys.exit(rc and 1)
+
+def usage():
+    print(__doc__)  # just print out the modules' docstring
+    sys.exit(1)     # bail with non-zero exit code
+
+if __name__ == '__main__':
+    sys.exit(bench_entry())
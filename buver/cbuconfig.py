@@ -1,6 +1,11 @@
 
 import os
 
+from buver.cthrottle import parse_rate, ionice_args
+from buver.cstorage import BACKENDS, storage_scheme
+from buver.cmanifest import HASHES
+from buver.cversions import MAX_VERSIONS, parse_age
+
 """
 This module contains the code for the backup version config.
 
@@ -23,10 +28,31 @@ The supported directives are:
   -------------------------------------------------------------------------------
     'src_dir'            ''       The src_dir (what we are protecting)
     'num_versions'       '10'     The number of versions to keep.
-    'type'               'tree'   The backup type (tree, tar, gzip)
+    'type'               'tree'   The backup type (tree, tar, gzip, link, dedup, bgzf)
     'mailto'             ''       The 'mailto' command
     'ver_dirs'           '[]'     The logical versions we know about
     'nice'               '10'     The 'nice' value to be used during backup
+    'engine'             'cmd'    How tree, tar and gzip backups are made (cmd, builtin)
+    'threads'            '8'      The number of copy threads for the builtin engine
+    'prom_file'          ''       Where to write Prometheus metrics for each run
+    'catalog'            ''       The SQLite catalog database shared by the tgt_locs
+    'codec'              'zlib'   How the builtin 'gzip' type compresses (zlib, bz2, lzma)
+    'codec_level'        ''       The compression level (0-9, default 6, or 9 for bz2)
+    'max_read_bps'       ''       The most bytes per second read from src_dir (blank is no limit)
+    'max_write_bps'      ''       The most bytes per second written to tgt_loc (blank is no limit)
+    'max_files_ps'       ''       The most files per second backed up or reaped (blank is no limit)
+    'ionice'             ''       The I/O scheduling class (idle, best-effort[:0-7], realtime[:0-7])
+    'storage'            ''       Where each new version is pushed to (a storage URL)
+    'delta_min_size'     ''       The smallest changed file stored as a delta by 'link' (blank is off)
+    'delta_max_chain'    '7'      How many deltas in a row before a full copy again
+    'delta_partial_tree' ''       'yes' accepts that delta files are NOT in the version tree (see below)
+    'hash'               ''       The content hash recorded in the manifest (blake2b, blank is none)
+    'keep_within'        ''       Keep every version newer than this (e.g. 36h, 14d, 8w, 6m, 1y)
+    'keep_hourly'        ''       Keep the newest version of this many hours
+    'keep_daily'         ''       Keep the newest version of this many days
+    'keep_weekly'        ''       Keep the newest version of this many weeks
+    'keep_monthly'       ''       Keep the newest version of this many months
+    'ver_times'          '{}'     When each of the logical versions was made
     
     'tree_cmd'           '<os specific>'    The 'copytree' command line (xcopy on windows)
     'tar_cmd'            '<os specific>'    The tar command line
@@ -47,6 +73,86 @@ The supported directives are:
         
     Commands are run with the default working directory set to '$dest_dir'
     
+    Every backup run appends a JSON record of its timings and I/O to
+    'logs/stats.jsonl' (see cstats.py). If 'prom_file' is set, the same
+    figures are also written there for the Prometheus textfile collector.
+    
+    If 'catalog' is set, each run also records the job, its versions (with
+    their sizes) and the run itself in that SQLite database, which can be
+    shared by any number of tgt_locs (see ccatalog.py). The catalog is updated
+    in the same step that rewrites 'ver_dirs' here, and 'buver --list' prints
+    what is in it. 'ver_dirs' stays the authority for each tgt_loc.
+    
+    The 'link' type does not use a command. It copies the src_dir in-process,
+    hard linking files that have not changed since the previous version (see
+    ccopytree.py), so each version looks like a full 'tree' copy but only the
+    changed files take up space.
+    
+    The 'dedup' type does not use a command either. It splits the files into
+    content defined chunks, stores each unique chunk once in 'tgt_loc/chunks'
+    and writes only a recipe into the version directory (see cchunkstore.py).
+    
+    The 'bgzf' type is always built in-process too. It writes a 'backup.tar.gz'
+    that is compressed in independent blocks, with an index of the blocks and
+    of the tar members next to it, so a restore only has to decompress the
+    blocks that hold the files it wants (see carchive.py). The archive is
+    still an ordinary gzip file, for 'tar xzf' and 'gzip -d'.
+    
+    With the builtin engine, 'codec' picks the compressor of the 'gzip' type:
+    'zlib' writes 'backup.tar.gz', 'bz2' writes 'backup.tar.bz2' and 'lzma'
+    writes 'backup.tar.xz', at 'codec_level'. Whatever the codec, blocks of
+    the archive that turn out not to compress (media files, mostly) are not
+    worked on at that level, which saves the CPU time (see cpgzip.py). The
+    'bgzf' type always uses zlib, but 'codec_level' applies to it.
+    
+    'max_read_bps', 'max_write_bps' and 'max_files_ps' limit how hard the
+    builtin engines (and the reaper) work the disks, so a backup has a steady,
+    predictable cost for whatever else runs on the machine (see cthrottle.py).
+    The byte rates take a K, M or G suffix. They do not apply to the commands
+    of the 'cmd' engine, which only have 'nice' and 'ionice'. 'ionice' sets
+    the I/O scheduling class, the same way ionice(1) does, of the commands
+    and of the builtin engines. It only has an effect on Linux.
+    
+    If 'storage' is set, each new version is also pushed to that storage
+    backend, and the versions that are pruned here are deleted from it (see
+    cstorage.py). It is a URL, 'file:///path' (or just a path) for a local or
+    mounted directory. Big files go up as multipart uploads, with 'threads'
+    parts at once. A push that fails is reported, but does not fail the
+    backup. 'dedup' versions cannot be pushed, they need the chunk store.
+    
+    If 'delta_min_size' is set, the 'link' type stores a changed file of at
+    least that size (with an optional K, M or G) as the blocks that changed
+    since the previous version, instead of a full copy (see cdelta.py). After
+    'delta_max_chain' deltas in a row against the same full copy, the file
+    is copied in full again, so the deltas do not keep growing.
+    
+    WARNING: a file stored as a delta is not in the tree of its version, so
+    the version no longer looks like a full tree, and copying it back with
+    'cp' leaves those files out. Only 'buver --restore' puts them back. So
+    'delta_min_size' is ignored unless 'delta_partial_tree' is set to 'yes'.
+    
+    If 'hash' is set, the builtin engines hash the content of each file as
+    they back it up, and record the hash in the manifest of the version, so
+    'buver --verify' can tell later whether the version is still intact (see
+    cverify.py). Hashing means the data has to pass through buver, so the
+    copy engine no longer clones files or has the kernel copy them, which is
+    why it is not set by default.
+    
+    'num_versions' keeps the newest versions, up to 100000 of them. The
+    'keep_*' directives keep more on top of those, grandfather-father-son
+    style: 'keep_daily=7' with 'keep_weekly=4' and 'keep_monthly=12' keeps
+    the newest version of each of the last 7 days, 4 weeks and 12 months
+    that have one, however often the backups run (see cversions.py). A
+    version is kept if any of them keeps it. 'ver_times' is kept up to date
+    by buver, like 'ver_dirs', and the 'keep_*' rules go by it.
+    
+    When 'engine' is 'builtin', the 'tree' type uses the same in-process copy
+    engine (with 'threads' workers) instead of running 'tree_cmd'. The 'tar'
+    and 'gzip' types build the archive in-process instead of running 'tar_cmd'
+    or 'gzip_cmd', and 'gzip' streams it straight into a compressor that uses
+    'threads' cores (see carchive.py). If 'engine' is missing or set to 'cmd',
+    the commands are used as before.
+    
 NOTE:
 
     This class assumes that you have properly locked the semaphore 
@@ -64,10 +170,12 @@ class C_buconfig:
         msgout    - the generic message handler
         config    - the dictionary to store the attributes
         conf_name - stores the fully qualified path for the buver.conf
+        version_times - when each logical version was made (from 'ver_times')
         """
         self.tgt_loc = tgt_loc
         self.conf_name = os.path.join(tgt_loc,'buver.conf')
         self.config = {}
+        self.version_times = {}
         self.msgout = msg
         
     def name(self):     # Return the name of the buver.conf file (fully qualified)
@@ -101,12 +209,24 @@ class C_buconfig:
         
         return cmd
         
-    def opt_type(self):             # Returns the backup type (tree, tar, gzip)
+    def opt_type(self):             # Returns the backup type (tree, tar, gzip, link, dedup, bgzf)
         return self._get_attr('type')
         
     def opt_nice(self):             # Returns the 'nice' value to be used during backup
         return self._get_attr('nice')
         
+    def opt_engine(self):           # Returns how tree, tar and gzip backups are made (cmd, builtin)
+        engine = self._get_attr('engine')
+        if engine in ['', None]: return 'cmd'
+        
+        return engine
+        
+    def opt_threads(self):          # Returns the number of copy/compression threads for the builtin engine
+        threads = self._get_attr('threads')
+        if threads in ['', None]: return 8
+        
+        return int(threads)
+        
     def opt_src_dir(self):          # Returns the src_dir (what we are protecting)
         return self._get_attr('src_dir')
         
@@ -122,6 +242,60 @@ class C_buconfig:
         
         return cmd
         
+    def opt_prom_file(self):        # Returns where to write the Prometheus metrics (or '')
+        return self._get_attr('prom_file')
+        
+    def opt_catalog(self):          # Returns the name of the catalog database (or '')
+        return self._get_attr('catalog')
+        
+    def opt_codec(self):            # Returns the compressor of the builtin 'gzip' type (zlib, bz2, lzma)
+        codec = self._get_attr('codec')
+        if codec in ['', None]: return 'zlib'
+        
+        return codec
+        
+    def opt_codec_level(self):      # Returns the compression level of the codec
+        level = self._get_attr('codec_level')
+        if level in ['', None]:
+            if self.opt_codec() == 'bz2': return 9
+            return 6
+            
+        return int(level)
+        
+    def opt_max_read_bps(self):     # Returns the most bytes per second read from src_dir (0 is no limit)
+        return parse_rate(self._get_attr('max_read_bps')) or 0
+        
+    def opt_max_write_bps(self):    # Returns the most bytes per second written to tgt_loc (0 is no limit)
+        return parse_rate(self._get_attr('max_write_bps')) or 0
+        
+    def opt_max_files_ps(self):     # Returns the most files per second backed up or reaped (0 is no limit)
+        return parse_rate(self._get_attr('max_files_ps')) or 0
+        
+    def opt_ionice(self):           # Returns the ionice(1) arguments for the I/O scheduling class ([] leaves it alone)
+        return ionice_args(self._get_attr('ionice')) or []
+        
+    def opt_storage(self):          # Returns the URL of the storage the versions are pushed to (or '')
+        return self._get_attr('storage')
+        
+    def opt_delta_min_size(self):   # Returns the smallest changed file stored as a delta (0 is off)
+        if self._get_attr('delta_partial_tree') != 'yes': return 0
+        return parse_rate(self._get_attr('delta_min_size')) or 0
+        
+    def opt_delta_max_chain(self):  # Returns how many deltas in a row before a full copy again
+        val = self._get_attr('delta_max_chain')
+        if not val.isdigit() or int(val) < 1: return 7
+        return int(val)
+        
+    def opt_hash(self):             # Returns the content hash recorded in the manifest (or '')
+        return self._get_attr('hash')
+        
+    def opt_keep_policy(self):      # Returns the 'keep_*' retention rules, as a dictionary for C_versions.sanify()
+        policy = {'within':parse_age(self._get_attr('keep_within')) or 0}
+        for period in ['hourly', 'daily', 'weekly', 'monthly']:
+            val = self._get_attr('keep_%s' % period)
+            if val.isdigit(): policy[period] = int(val)
+        return policy
+        
     def opt_ver_dirs(self):         # Returns the logical versions we know about
         return self._get_attr('ver_dirs')
         
@@ -130,6 +304,13 @@ class C_buconfig:
         # we know about. Do this before invoking save(), so that we remember them
         # the next time we run.
         self.config['ver_dirs'] = new_dirs
+        self.logical_versions = list(new_dirs)
+        
+    def set_ver_times(self,new_times):  # Allows the version times directive to be updated
+        # Just like set_ver_dirs(), this records when each of the logical versions
+        # was made, so the 'keep_*' rules know how old they are the next time we run.
+        self.version_times = dict([(version,int(when)) for version, when in new_times.items()])
+        self.config['ver_times'] = str(self.version_times)
         
     def validate(self):
         """This method validates the values of each directive in 
@@ -152,9 +333,9 @@ class C_buconfig:
                 self.config[key] = os.path.abspath(val)
 
             elif key.lower() == 'num_versions':
-                # Right now, support between 1 and 10 versions. If out of range, fix it. :)
-                if val == '' or int(val) < 1 or int(val) > 10:
-                    self.msgout('%s key is not specified or out of range (1,10). Setting to 10 ...' % key)
+                # Support between 1 and MAX_VERSIONS versions. If out of range, fix it. :)
+                if not val.isdigit() or int(val) < 1 or int(val) > MAX_VERSIONS:
+                    self.msgout('%s key is not specified or out of range (1,%d). Setting to 10 ...' % (key,MAX_VERSIONS))
                     self.config[key] = '10'
                     
             elif key.lower() == 'nice':
@@ -164,14 +345,103 @@ class C_buconfig:
                     self.config[key] = '10'
                     
             elif key.lower() == 'type':
-                # We know about tree, tar and gzip. If anything invalid is there, put
+                # We know about tree, tar, gzip, link and dedup. If anything invalid is there, put
                 # it back to 'tree' so we won't fail later on. tar or gzip might be better
                 # choices for the default...
-                if val == '' or val not in ['tree','tar','gzip']:
-                    self.msgout('%s key is not specified or not in range (tree,tar,gzip). Setting to tree ...' % key)
+                if val == '' or val not in ['tree','tar','gzip','link','dedup','bgzf']:
+                    self.msgout('%s key is not specified or not in range (tree,tar,gzip,link,dedup,bgzf). Setting to tree ...' % key)
                     self.config[key] = 'tree'
                     
-            elif key.lower() in ['mailto']:
+            elif key.lower() == 'engine':
+                # Either run the tree_cmd, or use the builtin copy engine
+                if val not in ['cmd','builtin']:
+                    self.msgout('%s key is not specified or not in range (cmd,builtin). Setting to cmd ...' % key)
+                    self.config[key] = 'cmd'
+                    
+            elif key.lower() == 'threads':
+                # Support between 1 and 64 copy threads
+                if val == '' or not val.isdigit() or int(val) < 1 or int(val) > 64:
+                    self.msgout('%s key is not specified or out of range (1,64). Setting to 8 ...' % key)
+                    self.config[key] = '8'
+                    
+            elif key.lower() == 'codec':
+                # The compressors in the standard library
+                if val not in ['zlib','bz2','lzma']:
+                    self.msgout('%s key is not specified or not in range (zlib,bz2,lzma). Setting to zlib ...' % key)
+                    self.config[key] = 'zlib'
+                    
+            elif key.lower() == 'codec_level':
+                # Blank means the default of the codec, otherwise between 0 and 9
+                if val != '' and (not val.isdigit() or int(val) > 9):
+                    self.msgout('%s key is out of range (0,9). Setting to the default ...' % key)
+                    self.config[key] = ''
+                    
+            elif key.lower() in ['max_read_bps', 'max_write_bps', 'max_files_ps']:
+                # Blank (or 0) means no limit, otherwise a number with an optional K, M or G
+                if parse_rate(val) is None:
+                    self.msgout('%s key is not a number (with an optional K, M or G). Setting to no limit ...' % key)
+                    self.config[key] = ''
+                    
+            elif key.lower() == 'ionice':
+                # Blank means leave the I/O scheduling class alone
+                if ionice_args(val) is None:
+                    self.msgout('%s key is not in range (idle,best-effort[:0-7],realtime[:0-7]). Setting to blank ...' % key)
+                    self.config[key] = ''
+                    
+            elif key.lower() == 'storage':
+                # Blank means do not push, otherwise it has to be a URL we have a backend for
+                if val != '' and storage_scheme(val) not in BACKENDS:
+                    self.msgout('%s key has no backend for <%s> (%s). Setting to blank ...' % (key,val,','.join(sorted(BACKENDS))))
+                    self.config[key] = ''
+                    
+            elif key.lower() == 'delta_min_size':
+                # Blank (or 0) means no deltas, otherwise a size with an optional K, M or G
+                if parse_rate(val) is None:
+                    self.msgout('%s key is not a number (with an optional K, M or G). Setting to off ...' % key)
+                    self.config[key] = ''
+                elif parse_rate(val) and self._get_attr('delta_partial_tree') != 'yes':
+                    self.msgout('%s key is ignored, since delta files are left out of the version tree. Set delta_partial_tree=yes to accept that ...' % key)
+                    
+            elif key.lower() == 'delta_partial_tree':
+                if val not in ['','yes']:
+                    self.msgout('%s key is not blank or yes. Setting to blank ...' % key)
+                    self.config[key] = ''
+                    
+            elif key.lower() == 'delta_max_chain':
+                if not val.isdigit() or int(val) < 1 or int(val) > 100:
+                    self.msgout('%s key is out of range (1,100). Setting to 7 ...' % key)
+                    self.config[key] = '7'
+                    
+            elif key.lower() == 'hash':
+                # Blank means no hashes
+                if val != '' and val not in HASHES:
+                    self.msgout('%s key is not in range (%s). Setting to blank ...' % (key,','.join(HASHES)))
+                    self.config[key] = ''
+                    
+            elif key.lower() == 'keep_within':
+                # Blank means the rule is not used
+                if parse_age(val) is None:
+                    self.msgout('%s key is not a number followed by h, d, w, m or y. Setting to blank ...' % key)
+                    self.config[key] = ''
+                    
+            elif key.lower() in ['keep_hourly', 'keep_daily', 'keep_weekly', 'keep_monthly']:
+                # Blank means the rule is not used
+                if val != '' and (not val.isdigit() or int(val) > MAX_VERSIONS):
+                    self.msgout('%s key is out of range (0,%d). Setting to blank ...' % (key,MAX_VERSIONS))
+                    self.config[key] = ''
+                    
+            elif key.lower() == 'ver_times':
+                # Like 'ver_dirs', this must conform to Python Dictionary syntax. If it is
+                # no good, the versions go by the time of their directories instead
+                try:
+                    self.version_times = eval(val)
+                    if not isinstance(self.version_times,dict): raise ValueError
+                except:
+                    self.msgout('Error evaluting the ver_times keyword. Resetting to {} ...')
+                    self.version_times = {}
+                    self.config[key] = '{}'
+                    
+            elif key.lower() in ['mailto', 'prom_file', 'catalog']:
                 pass        # these keys are optional ...
 
             elif key.lower() == 'ver_dirs':
@@ -239,7 +509,26 @@ class C_buconfig:
                     'num_versions':'10',
                     'type':'tree',
                     'ver_dirs':'[]',
-                    'nice':'10'
+                    'nice':'10',
+                    'engine':'cmd',
+                    'threads':'8',
+                    'codec':'zlib',
+                    'codec_level':'',
+                    'max_read_bps':'',
+                    'max_write_bps':'',
+                    'max_files_ps':'',
+                    'ionice':'',
+                    'storage':'',
+                    'delta_min_size':'',
+                    'delta_max_chain':'7',
+                    'delta_partial_tree':'',
+                    'hash':'',
+                    'keep_within':'',
+                    'keep_hourly':'',
+                    'keep_daily':'',
+                    'keep_weekly':'',
+                    'keep_monthly':'',
+                    'ver_times':'{}'
                    }
 
         # The remaining keys must be initialized according to platform
@@ -271,6 +560,7 @@ class C_buconfig:
         It will load and then validate the contents of the buver.conf."""
         
         self.config = {}    # if we have one already, throw it out
+        self.version_times = {}
         
         # If the file doesn't exist, bail now.
         if not os.path.isfile(self.conf_name): return 1
@@ -304,11 +594,13 @@ class C_buconfig:
         # config is in a sane state ...
         return self.validate()
 
-    def save(self,create=0):
+    def save(self,create=0,catalog=None):
         """writes the contents of the dictionary to a file.
 
         name - the file to write the line to.
         dict - the dictionary to write
+        catalog - if given, the C_catalog object whose queued changes
+                  are committed once the file has been written
 
         return values:
             0 - Success
@@ -334,6 +626,11 @@ class C_buconfig:
         except IOError:
             rc = 1
 
+        # the catalog is only updated if the buver.conf was, so they agree.
+        # A catalog that cannot be written does not fail the save
+        if rc == 0 and catalog is not None and catalog.commit(self):
+            self.msgout('Unable to update the catalog, it will be out of date ...')
+
         return rc
 
     def dump(self):
@@ -341,7 +638,7 @@ class C_buconfig:
         
         self.msgout('Dumping the configuration dictionary')
         # print each key=value pair in the dictionary ...
-        items = ['type', 'nice', 'num_versions', 'mailto', 'src_dir', 'tree_cmd', 'tar_cmd', 'gzip_cmd']
+        items = ['type', 'nice', 'num_versions', 'mailto', 'src_dir', 'engine', 'threads', 'codec', 'codec_level', 'max_read_bps', 'max_write_bps', 'max_files_ps', 'ionice', 'storage', 'delta_min_size', 'delta_max_chain', 'delta_partial_tree', 'hash', 'keep_within', 'keep_hourly', 'keep_daily', 'keep_weekly', 'keep_monthly', 'tree_cmd', 'tar_cmd', 'gzip_cmd']
         
         for item in items:
             self.msgout('  %s=<%s>' % (item,self._get_attr(item)))
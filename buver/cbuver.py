@@ -9,9 +9,17 @@ This includes the following:
     mkdir      - A helper method to create a new directory
     check_dir  - A helper method to validate the tgt_loc
     initialize - The code that runs the --init logic of buver
+    tree_dir   - A helper that returns where a tree lives inside a version
+    backup_copy - The code that performs an in-process 'tree' or 'link' backup
+    backup_dedup - The code that performs a 'dedup' backup into the chunk store
+    backup_archive - The code that builds a 'tar', 'gzip' or 'bgzf' backup in-process
     backup_version - The code that performs a single backup
+    claim_journal - The code that claims the change journal of the src_dir
+    push       - The code that pushes the new version to the storage backend
     backup     - The code that runs the --bu logic of buver
+    reap       - The code that empties the trash of pruned versions
     mailer     - The code that sends an email upon job completion
+    emit_stats - The code that writes out the timings of the run
     execute    - The code that figures out whether to run initialize or backup
 
 Each method has additional documentation in-line.
@@ -23,19 +31,38 @@ class (and it's underlying classes).
 """
 
 import os
-import sys
+import subprocess
 
 from buver.cbuconfig import C_buconfig
 from buver.cversions import C_versions
 from buver.csemaphore import C_semaphore
 from buver.clogger import C_logger
+from buver.ccopytree import C_copytree
+from buver.cdelta import C_deltas
+from buver.carchive import C_archive
+from buver.creaper import C_reaper
+from buver.cstats import C_stats
+from buver.cchunkstore import C_chunkstore
+from buver.cmanifest import C_manifest
+from buver.ccatalog import C_catalog
+from buver.cjournal import C_journal
+from buver.cpgzip import CODEC_SUFFIX
+from buver.cwalker import C_walker
+from buver.cthrottle import C_throttle, ionice, ionice_command
+from buver.cstorage import open_storage
 
 class C_buver:
-    def __init__(self,mode,tgt_loc):
+    def __init__(self,mode,tgt_loc,tag=None,lock='file',lock_timeout=120,cache=None):
         """Constructor for the C_buver class.
         
         mode    - 0 or 1 for initialize or backup
-        tgt_loc - the tgt_loc area"""
+        tgt_loc - the tgt_loc area
+        tag     - an optional name shown on the console messages, so the
+                  output of several jobs in one process can be told apart
+        lock    - how the tgt_loc is locked, 'file' or 'flock' (see csemaphore.py)
+        lock_timeout - how many seconds to wait for the lock
+        cache   - an optional C_cache (see cdaemon.py) that keeps the config
+                  and the versions view of the tgt_loc from one run to the next"""
 
         # validate and correct the mode if necessary (default is backup)
         if mode < 0 or mode > 1: mode = 1
@@ -54,11 +81,20 @@ class C_buver:
         self.tgt_versions = os.path.join(self.tgt_loc,'versions')
         
         # Construct a logger object for printing messages
-        self.logger = C_logger(self.tgt_logs)
+        self.logger = C_logger(self.tgt_logs,tag)
         self.message = self.logger.message
         
+        # Construct a stats object for measuring where the time of the run goes
+        self.stats = C_stats(self.tgt_loc,self.mode_str)
+        
         # Construct a semaphore object for implementing a mutex on tgt_loc
-        self.semaphore = C_semaphore(tgt_loc,'buver.lock')
+        self.semaphore = C_semaphore(tgt_loc,'buver.lock',lock)
+        self.lock_timeout = lock_timeout
+        self.cache = cache
+        
+        # The versions object is made once the semaphore is held, so it is not there
+        # when the semaphore could not be had (or the config could not be loaded)
+        self.versions = None
         
         # Register our atexit routines to clean up things ...
         import atexit
@@ -72,6 +108,18 @@ class C_buver:
         self.message('Clean up procedure for object has been called')
         if hasattr(self,'semaphore'): self.semaphore.signal()
 
+    def close(self):
+        """Do what the atexit routines would do, now, and take them back out.
+        For callers that run many jobs in one process (see cscheduler.py and
+        cdaemon.py), which would otherwise keep every log file open and every
+        object registered until the process exits."""
+        
+        import atexit
+        self.tgt_clean()
+        self.logger.closelog()
+        atexit.unregister(self.tgt_clean)
+        atexit.unregister(self.logger.closelog)
+
     def mkdir(self,dir):
         """Create directory.  Handles exceptions.
         Returns 0 on success or 1 otherwise."""
@@ -91,21 +139,11 @@ class C_buver:
         
         if not os.path.isdir(dir): return -1,-1     # -1,-1 means it doesn't exist
         
-        dircount  = 0
-        filecount = 0
-        for f in os.listdir(dir):   # process each item in the tgt_loc directory
-            if os.path.isdir(os.path.join(dir,f)):
-                # '.' and '..' do not count!
-                if f == '.' or f == '..': continue
-                
-                # we found a directory
-                dircount = dircount + 1
-            else:
-                # we found a file
-                filecount = filecount + 1
+        # process each item in the tgt_loc directory, splitting the directories from the files
+        subdirs, files = C_walker().listdir(dir,True)
 
         # return the directory and file counts
-        return dircount,filecount
+        return len(subdirs),len(files)
 
     def initialize(self):
         """This method implements the logic for the -i command line switch.
@@ -129,7 +167,7 @@ class C_buver:
             return 2
             
         # Ok, the directory exists and we want to initialize it. Get the mutex ...
-        if self.semaphore.wait(): 
+        if self.semaphore.wait(self.lock_timeout): 
             self.message('Unable to acquire the semaphore ... exiting ...')
             return 3
             
@@ -154,12 +192,203 @@ class C_buver:
         
         return rc
         
+    def tree_dir(self,version):
+        """Return where the copy of src_dir lives inside 'version'. This
+        matches what 'cp -r src_dir dest_dir' does when dest_dir exists,
+        so in-process copies have the same layout as the tree_cmd ones."""
+        
+        return os.path.join(version,os.path.basename(self.config.opt_src_dir()))
+        
+    def renice(self):
+        """The builtin engines do not run under 'nice -n $nice' like the
+        commands do, so lower our own priority instead (never raise it).
+        The same goes for the I/O scheduling class set by 'ionice'."""
+        
+        if ionice(self.config.opt_ionice()):
+            self.message('Unable to set the I/O scheduling class, continuing without it ...')
+        
+        if not hasattr(os,'setpriority'): return
+        
+        try:
+            nice = int(self.config.opt_nice())
+            if os.getpriority(os.PRIO_PROCESS,0) < nice: os.setpriority(os.PRIO_PROCESS,0,nice)
+        except (OSError,ValueError):
+            pass
+        
+    def backup_copy(self,link=False):
+        """This method implements the in-process copy of the src_dir, which
+        is used by the 'link' type, and by the 'tree' type when the builtin
+        engine is selected. For 'link', files that did not change since the
+        previous version are hard linked to it rather than copied again."""
+        
+        link_dest = None
+        prev_ver = self.versions.prev_version()
+        if link and prev_ver: link_dest = self.tree_dir(prev_ver)
+        
+        self.renice()
+        manifest = C_manifest(self.versions.new_version())
+        if manifest.create(): manifest = None
+        
+        # big files that changed can be stored as deltas against the previous version
+        deltas = None
+        if link_dest and self.config.opt_delta_min_size():
+            deltas = C_deltas(self.message,self.versions.new_version(),prev_ver,link_dest,
+                              self.config.opt_delta_min_size(),self.config.opt_delta_max_chain())
+        
+        journal, prev = self.journal_prev()
+        copier = C_copytree(self.message,self.config.opt_src_dir(),self.tree_dir(self.versions.new_version()),
+                            link_dest,self.config.opt_threads(),manifest,prev,journal,self.throttle,deltas,
+                            bool(self.config.opt_hash()))
+        rc = copier.run()
+        if deltas:
+            rc = rc or deltas.close()
+            self.stats.count('files_delta',deltas.files)
+            self.stats.count('bytes_delta',deltas.nbytes)
+        
+        self.stats.count('files_copied',copier.files)
+        self.stats.count('files_linked',copier.links)
+        self.stats.count('bytes_copied',copier.nbytes)
+        self.stats.count('bytes_cloned',copier.cloned)
+        self.stats.count('bytes_holes',copier.holes)
+        for strategy, files in copier.strategies.items(): self.stats.count('files_%s' % strategy,files)
+        self.stats.count('errors',copier.errors)
+        self.close_manifest(manifest)
+        return rc
+        
+    def journal_prev(self):
+        """Return the journal to back up with (None unless it can be trusted)
+        and the loaded manifest of the previous version. The journal already
+        has the manifest loaded, so it is not loaded twice."""
+        
+        if self.journal and self.journal.valid: return self.journal, self.journal.prev
+        return None, self.versions.prev_manifest()
+        
+    def claim_journal(self):
+        """If a watcher keeps a journal of the changes to the src_dir (see
+        cjournal.py and cwatcher.py), claim it, so the watcher starts a new
+        one for the next backup. The 'tree' (builtin), 'link' and 'dedup'
+        types use it to skip what did not change; the others still scan the
+        whole src_dir, but claiming it keeps it from growing without bound."""
+        
+        self.journal = C_journal(self.message,self.tgt_loc)
+        if not self.journal.exists():
+            self.journal = None
+            return
+        
+        with self.stats.phase('journal'):
+            if self.journal.claim(self.config.opt_src_dir(),self.versions.prev_manifest()):
+                self.stats.count('journal_entries',len(self.journal.entries))
+        
+    def push(self):
+        """This method pushes the new version to the storage backend named by
+        the 'storage' directive, and deletes the versions that are no longer
+        kept from it (see cstorage.py). The version is still good on the
+        tgt_loc if this fails, so the failure is reported but does not fail
+        the backup."""
+        
+        if self.config.opt_type() == 'dedup':
+            self.message('Not pushing <%s>, dedup versions cannot be used without the chunk store' % self.versions.new_version())
+            return 1
+        
+        storage = open_storage(self.message,self.config.opt_storage())
+        if storage is None: return 1
+        
+        version = os.path.basename(self.versions.new_version())
+        try:
+            # the unchanged files of a 'link' version are copied from the previous one
+            prev = self.versions.prev_version()
+            prev_prefix = 'versions/%s' % os.path.basename(prev) if prev else None
+            objects, nbytes = storage.push_tree('versions/%s' % version,self.versions.new_version(),self.config.opt_threads(),
+                                                prev_prefix=prev_prefix,prev_top=prev)
+            self.message('Pushed %d objects (%d bytes) to <%s>' % (objects,nbytes,storage.url))
+            self.stats.count('objects_pushed',objects)
+            self.stats.count('bytes_pushed',nbytes)
+            
+            # the versions that are no longer on the tgt_loc go from the storage as well
+            pushed = set([key.split('/')[1] for key in storage.list('versions/')])
+            for old in sorted(pushed - set(self.versions.new_ver_dirs())):
+                self.message('Deleted %d objects of version <%s> from <%s>' % (storage.delete_prefix('versions/%s/' % old),old,storage.url))
+        except (IOError,OSError) as e:
+            self.message('Failed pushing version <%s> to <%s>: %s' % (version,storage.url,e))
+            return 1
+        
+        return 0
+        
+    def close_manifest(self,manifest):
+        """Finish the manifest of the new version. A missing manifest only
+        costs the next backup some time, so it is not treated as a failure."""
+        
+        if manifest is None or manifest.close():
+            self.message('Unable to write the manifest for <%s>' % self.versions.new_version())
+        else:
+            self.message('Recorded %d items in the manifest' % manifest.count)
+            self.stats.count('manifest_items',manifest.count)
+        
+    def backup_dedup(self):
+        """This method implements the 'dedup' backup type. The src_dir is
+        split into chunks which are stored once in the chunk store, and
+        the new version only gets the recipe for putting it back together."""
+        
+        self.renice()
+        manifest = C_manifest(self.versions.new_version())
+        if manifest.create(): manifest = None
+        
+        journal, prev = self.journal_prev()
+        rc = self.chunks.backup(self.config.opt_src_dir(),self.versions.new_version(),manifest,prev,journal,
+                                bool(self.config.opt_hash()))
+        
+        self.stats.count('chunks_new',self.chunks.new_chunks)
+        self.stats.count('bytes_copied',self.chunks.new_bytes)
+        self.stats.count('bytes_deduplicated',self.chunks.dup_bytes)
+        self.close_manifest(manifest)
+        return rc
+        
+    def backup_archive(self,compress=False,independent=False):
+        """This method builds the 'tar' or 'gzip' archive in-process, when
+        the builtin engine is selected. For 'gzip', the archive is compressed
+        as it is written, so the uncompressed archive never hits the disk.
+        For 'bgzf', it is compressed in independent blocks, so it can be read
+        starting at any block."""
+        
+        # the 'bgzf' type has to be gzip, so it can be read a block at a time
+        codec = self.config.opt_codec()
+        if independent: codec = 'zlib'
+        
+        archive = os.path.join(self.versions.new_version(),'backup.tar')
+        if compress: archive = '%s%s' % (archive,CODEC_SUFFIX[codec])
+        
+        self.renice()
+        manifest = C_manifest(self.versions.new_version())
+        if manifest.create(): manifest = None
+        
+        archiver = C_archive(self.message,self.config.opt_src_dir(),archive,compress,self.config.opt_threads(),
+                             manifest,independent,codec,self.config.opt_codec_level(),self.throttle,
+                             bool(self.config.opt_hash()))
+        rc = archiver.run()
+        
+        self.stats.count('files_copied',archiver.files)
+        self.stats.count('errors',archiver.errors)
+        self.stats.count('blocks_uncompressible',archiver.stored_blocks)
+        if os.path.isfile(archive): self.stats.count('bytes_written',os.path.getsize(archive))
+        self.close_manifest(manifest)
+        return rc
+        
     def backup_version(self):
         """This method implements the actual backup version
         logic for both the Windows and POSIX platforms."""
 
-        # make sure we set the current directory to the src_dir
-        if os.chdir(self.config.opt_src_dir()):
+        # the link type is always done in-process, there is no command to run
+        if self.config.opt_type() == 'link': return self.backup_copy(True)
+        if self.config.opt_type() == 'tree' and self.config.opt_engine() == 'builtin': return self.backup_copy()
+        if self.config.opt_type() == 'dedup': return self.backup_dedup()
+        if self.config.opt_type() == 'bgzf': return self.backup_archive(True,True)
+        if self.config.opt_engine() == 'builtin':
+            if self.config.opt_type() == 'tar': return self.backup_archive()
+            if self.config.opt_type() == 'gzip': return self.backup_archive(True)
+
+        # make sure the src_dir is there, the command runs with it as the current directory.
+        # We do not chdir() ourselves, because other jobs may be running in this process
+        if not os.path.isdir(self.config.opt_src_dir()):
             self.message('Failed changing to the source directory <%s>' % self.config.opt_src_dir())
             return 9999
        
@@ -185,7 +414,12 @@ class C_buver:
         
         # Ok, let's go ahead an execute this command
         self.message('EXECUTE <%s>' % cmd_str)
-        return os.system(cmd_str)
+        
+        # run the whole shell under ionice if it is set, so every command in the line gets the class
+        prefix = ionice_command(self.config.opt_ionice())
+        if prefix: return subprocess.call(prefix + ['/bin/sh','-c',cmd_str],cwd=self.config.opt_src_dir())
+        
+        return subprocess.call(cmd_str,shell=True,cwd=self.config.opt_src_dir())
         
     def backup(self):
         """This is the method that implements the -b command line switch. -b
@@ -194,62 +428,156 @@ class C_buver:
         directory contains all the versions currently being stored there."""
         
         # The first thing we have to do is obtain the semaphore for the tgt_loc
-        if self.semaphore.wait(): 
+        with self.stats.phase('lock'):
+            failed = self.semaphore.wait(self.lock_timeout)
+        if failed: 
             self.message('Unable to acquire the semaphore ... exiting ...')
             return 1
         
-        # Next, create a config object that holds what we need to know about the tgt_loc
-        self.config = C_buconfig(self.message, self.tgt_loc)
-
-        # Now, load the config file and validate the contents
-        if self.config.load():
+        # Next, create a config object that holds what we need to know about the tgt_loc,
+        # load the config file and validate the contents. If there is a cache, it has the
+        # config from the last run, unless the file has changed since
+        with self.stats.phase('config'):
+            if self.cache:
+                self.config, failed = self.cache.load_config(self.message)
+            else:
+                self.config = C_buconfig(self.message, self.tgt_loc)
+                failed = self.config.load()
+        if failed:
             self.message('Failed loading the configuration file <%s> ... exiting ...' % self.config.name())
             self.semaphore.signal()
             return 2
 
         # dump the contents to the screen 
         self.config.dump()
+        
+        # The limits on the I/O of the builtin engines and the reaper (see cthrottle.py)
+        self.throttle = C_throttle(self.config.opt_max_read_bps(),self.config.opt_max_write_bps(),self.config.opt_max_files_ps())
+
+        # If there is a catalog, open it. It is optional, so carry on without it if it fails
+        self.catalog = None
+        if self.config.opt_catalog():
+            self.catalog = C_catalog(self.message,self.config.opt_catalog())
+            if self.catalog.open():
+                self.message('Continuing without the catalog ...')
+                self.catalog = None
+            elif self.catalog.check(self.tgt_loc,self.config.logical_versions,self.tgt_versions,self.config.version_times):
+                self.message('The catalog does not agree with ver_dirs, it will be brought up to date ...')
 
         # Now construct the versions object so we can see what is on-disk
-        self.versions = C_versions(self.message,self.tgt_versions)
+        with self.stats.phase('sanify'):
+            if self.cache:
+                self.versions = self.cache.load_versions(self.message,self.tgt_versions)
+            else:
+                self.versions = C_versions(self.message,self.tgt_versions)
     
-        # Make sure that everything looks sane ...
-        if self.versions.sanify(int(self.config.opt_num_versions()),self.config.logical_versions):
+            # Make sure that everything looks sane ...
+            failed = self.versions.sanify(int(self.config.opt_num_versions()),self.config.logical_versions,
+                                          self.config.opt_keep_policy(),self.config.version_times)
+        if failed:
             self.message('Sanification has failed ... exiting ...')
+            if self.catalog: self.catalog.close()
             return 3
         
+        # If there is a chunk store, it has to be used for 'dedup' backups, and
+        # it has to be told about the 'dedup' versions that are being pruned
+        self.chunks = C_chunkstore(self.message,self.tgt_loc,self.throttle)
+        if self.config.opt_type() == 'dedup' or self.chunks.exists():
+            if self.chunks.load():
+                self.message('Failed loading the chunk store ... exiting ...')
+                if self.catalog: self.catalog.close()
+                return 4
+        else:
+            self.chunks = None
+        
         # Prune old directories according the policy set in buver.conf
-        if self.versions.prune():
+        with self.stats.phase('prune'):
+            failed = self.versions.prune(self.chunks,self.catalog)
+        if failed:
             self.message('prune process has failed cleaning old versions ... exiting ...')
+            if self.versions.moved:
+                # the ones already in the trash are gone, the config must say so
+                remaining = self.versions.unmoved(self.config.logical_versions)
+                self.config.set_ver_dirs(remaining)
+                self.config.set_ver_times(dict([(version,when) for version, when in self.config.version_times.items()
+                                                if version in remaining]))
+                if self.config.save(0,self.catalog): self.message('Failed updating the config file ...')
+            if self.catalog: self.catalog.close()
             return 4
         
         # Add a new version to the tree 
         if self.mkdir(self.versions.new_version()):
             self.message('create version directory has failed ... exiting ...')
+            if self.catalog: self.catalog.close()
             return 5
             
+        # If there is a journal of what changed in the src_dir, take it now, before we start reading
+        self.claim_journal()
+        
         # do the backup
-        if self.backup_version():
+        with self.stats.phase('backup'):
+            failed = self.backup_version()
+        backed_up = not failed
+        if failed:
             self.message('failed during backup_version ... exiting ...')
             # fall through so we update the config file, since we made the directory ...
+        
+        # Send a copy of the new version to the storage backend, if there is one
+        if backed_up and self.config.opt_storage():
+            with self.stats.phase('push'):
+                self.push()
             
         # Update the config file and write it out
         self.config.set_ver_dirs(self.versions.new_ver_dirs())
+        self.config.set_ver_times(self.versions.new_ver_times())
+        
+        # Tell the catalog about the new version, it is written along with the config file
+        if self.catalog:
+            self.catalog.add_version(self.versions.new_version(),self.stats.start)
+            self.catalog.add_run(self.versions.new_version(),self.stats.start,
+                                 self.stats.phases['backup']['wall'],failed or 0)
 
         # MAKE SURE WE DO THE, EVEN IF THE BACKUP FAILS, 
         # OTHERWISE, WE'LL INVALIDATE THE VERSIONS AREA!
-        if self.config.save():
+        with self.stats.phase('save'):
+            failed = self.config.save(0,self.catalog)
+        if self.catalog: self.catalog.close()
+        if failed:
             self.message('Failed updating the config file ... exiting ...')
             return 6
         
+        # The cache can keep what we just wrote, we still hold the semaphore so nobody changed it
+        if self.cache: self.cache.update(self.config,self.versions)
+        
+        # The next backup can trust the journal, since this one is complete
+        if self.journal and backed_up: self.journal.commit()
+        
         # Be a good process, and release the semaphore in case someone else needs it
         if self.semaphore.signal(): self.message('Unable to release the semaphore ...')
         
+        # Now that the next job can have the tgt_loc, free the space of the pruned versions
+        with self.stats.phase('reap'):
+            self.reap()
+        
+        # how long the throttle held the backup and the reaper back
+        if self.throttle.active(): self.stats.count('throttle_seconds',round(self.throttle.waited(),3))
+        
+        # The versions area is consistent again, but the run still failed if the backup did
+        if not backed_up: return 7
+        return 0
+        
+    def reap(self):
+        """This method removes the pruned versions that prune() moved to the
+        trash. It runs without the semaphore, so it does not hold up other
+        jobs. Anything left over by a run that died is removed here too."""
+        
+        return C_reaper(self.message,self.versions.trash,self.config.opt_threads(),self.throttle).run()
+        
     def mailer(self):
         """This method sends an email on the results of the backup job,
         if a mailto: address has been specified in the buver.conf."""
         
-        new_ver = self.versions.new_version()
+        new_ver = self.versions.new_version() if self.versions else None
         log_fil = self.logger.getlogpath()
         
         if not new_ver or not log_fil: 
@@ -287,5 +615,22 @@ class C_buver:
         rc = self.backup()
         
         # Send an email if we need to based on buver.conf:mailto directive
-        self.mailer()
+        with self.stats.phase('mailer'):
+            self.mailer()
+            
+        # Write out where the time went
+        self.emit_stats(rc)
         return rc
+        
+    def emit_stats(self,rc):
+        """This method writes the statistics of the run to logs/stats.jsonl,
+        and to the Prometheus file if buver.conf:prom_file is set."""
+        
+        backup_type = ''
+        prom_file = ''
+        if hasattr(self,'config'):
+            backup_type = self.config.opt_type()
+            prom_file = self.config.opt_prom_file()
+            
+        if self.stats.emit(self.tgt_logs,rc or 0,backup_type,prom_file):
+            self.message('Unable to write the statistics for this run')
@@ -0,0 +1,287 @@
+import os
+import json
+import time
+
+from buver.cmanifest import C_manifest
+from buver.cwalker import C_walker
+
+"""
+This module contains the code for the catalog class.
+
+Each tgt_loc keeps its list of versions in the 'ver_dirs' directive of its
+buver.conf, so finding out which versions exist across all the jobs, and
+how big they are, means reading every buver.conf and walking every
+versions directory. The catalog is an optional SQLite database, shared by
+any number of tgt_locs, that records this as each backup runs. It is
+enabled by setting the 'catalog' directive in buver.conf to the name of
+the database file (see cbuconfig.py).
+
+The database holds three tables:
+
+    jobs     - one row per tgt_loc, with its src_dir, type, num_versions
+               and the same list of versions as 'ver_dirs'
+    versions - one row per version ever made: when it was made, its size
+               and number of files, and when it was pruned (NULL if it is
+               still on disk)
+    runs     - one row per backup run: when it started, how long the
+               backup took and its return code
+
+The versions are indexed by job and version number, by timestamp and by
+size, and the runs by job and start time, so listing and reconciliation
+queries across the whole fleet do not have to touch the tgt_locs at all.
+
+A backup can run for hours, and SQLite only allows one writer at a time,
+so nothing is written while the backup runs. C_versions.prune() and
+C_buver queue their changes here, and C_buconfig.save() applies them all,
+in one transaction, at the same time as it rewrites the buver.conf. If
+the run fails before that, neither the buver.conf nor the catalog change.
+
+The catalog is never required for a backup. If it cannot be opened or
+written, a message is logged and the backup carries on without it.
+
+open()    - open (and if necessary create) the database
+prune()   - queue a version being pruned
+add_version() - queue the new version
+add_run() - queue the record of this run
+commit()  - write everything queued, in one transaction
+execute() - print the versions in the catalog (the --list mode)
+"""
+
+try:
+    import sqlite3
+except ImportError:
+    sqlite3 = None      # python was built without sqlite, there is no catalog
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id INTEGER PRIMARY KEY,
+    tgt_loc TEXT NOT NULL UNIQUE,
+    src_dir TEXT,
+    type TEXT,
+    num_versions INTEGER,
+    ver_dirs TEXT,
+    updated REAL
+);
+CREATE TABLE IF NOT EXISTS versions (
+    job_id INTEGER NOT NULL REFERENCES jobs(id),
+    version INTEGER NOT NULL,
+    created REAL,
+    size INTEGER,
+    files INTEGER,
+    pruned REAL,
+    PRIMARY KEY (job_id, version)
+);
+CREATE INDEX IF NOT EXISTS versions_created ON versions(created);
+CREATE INDEX IF NOT EXISTS versions_size ON versions(size);
+CREATE TABLE IF NOT EXISTS runs (
+    id INTEGER PRIMARY KEY,
+    job_id INTEGER NOT NULL REFERENCES jobs(id),
+    version INTEGER,
+    start REAL,
+    wall REAL,
+    rc INTEGER
+);
+CREATE INDEX IF NOT EXISTS runs_job ON runs(job_id, start);
+"""
+
+class C_catalog:
+    def __init__(self,msg,db_name,timeout=60):
+        """Constructor for the C_catalog class. Initialize the
+        variables that we need to have in order for the class to
+        operate:
+
+        msgout  - the generic message handler for printing output
+        db_name - the name of the SQLite database file
+        timeout - how many seconds to wait for another writer
+        conn    - the database connection (None until open() is called)
+        pending - the changes waiting for commit(), each one a SQL
+                  statement and its parameters (':job' is the job id)"""
+
+        self.msgout = msg
+        self.db_name = os.path.abspath(os.path.expanduser(db_name))
+        self.timeout = timeout
+        self.conn = None
+        self.pending = []
+
+    def open(self):
+        """Open the database, creating the tables if they are not there.
+        Returns 0 on success or 1 otherwise."""
+
+        if sqlite3 is None:
+            self.msgout('The sqlite3 module is not available, cannot use the catalog')
+            return 1
+
+        try:
+            # we do our own transactions, see commit()
+            self.conn = sqlite3.connect(self.db_name,timeout=self.timeout,isolation_level=None)
+            self.conn.execute('PRAGMA journal_mode=WAL')
+            self.conn.executescript(SCHEMA)
+        except sqlite3.Error as e:
+            self.msgout('Unable to open the catalog <%s>: %s' % (self.db_name,e))
+            self.conn = None
+            return 1
+
+        return 0
+
+    def close(self):
+        if self.conn is not None: self.conn.close()
+        self.conn = None
+
+    def queue(self,sql,params):
+        self.pending.append((sql,params))
+
+    def prune(self,version):
+        """Queue marking the version directory 'version' as pruned."""
+
+        self.queue('UPDATE versions SET pruned=:now WHERE job_id=:job AND version=:version',
+                   {'now':time.time(),'version':int(os.path.basename(version))})
+
+    def version_size(self,version):
+        """Return the size and number of files in the version directory
+        'version'. The manifest has the answer if there is one, otherwise
+        the directory is walked."""
+
+        manifest = C_manifest(version)
+        if not manifest.load():
+            size = 0
+            files = 0
+            for rec in manifest.records():
+                if rec.type != 'f': continue
+                size = size + rec.size
+                files = files + 1
+            return size, files
+
+        size = 0
+        files = 0
+        for entry in C_walker().scan(version):
+            if entry.type == 'd' or entry.rel == 'manifest': continue
+            try:
+                st = os.lstat(entry.path)
+            except OSError:
+                continue
+            size = size + st.st_size
+            files = files + 1
+
+        return size, files
+
+    def add_version(self,version,created):
+        """Queue the new version directory 'version', made at 'created'."""
+
+        size, files = self.version_size(version)
+        self.queue('INSERT OR REPLACE INTO versions (job_id,version,created,size,files,pruned) '
+                   'VALUES (:job,:version,:created,:size,:files,NULL)',
+                   {'version':int(os.path.basename(version)),'created':created,'size':size,'files':files})
+
+    def add_run(self,version,start,wall,rc):
+        """Queue the record of the backup run that made 'version'."""
+
+        self.queue('INSERT INTO runs (job_id,version,start,wall,rc) VALUES (:job,:version,:start,:wall,:rc)',
+                   {'version':int(os.path.basename(version)),'start':start,'wall':wall,'rc':rc})
+
+    def check(self,tgt_loc,ver_dirs,verdir,ver_times=None):
+        """Compare the versions the catalog has for tgt_loc with 'ver_dirs'
+        from the buver.conf. They can drift apart if a run could not write
+        the catalog. The versions that are missing from the catalog are
+        queued to be added (from the versions directory 'verdir', made at
+        the times in 'ver_times'), and the ones that are no longer there are
+        queued to be marked as pruned, so the next commit() brings the catalog
+        up to date. Returns the number of differences (0 means they match)."""
+
+        try:
+            rows = self.conn.execute('SELECT version FROM versions JOIN jobs ON jobs.id=versions.job_id '
+                                     'WHERE jobs.tgt_loc=? AND versions.pruned IS NULL',(tgt_loc,)).fetchall()
+        except sqlite3.Error as e:
+            self.msgout('Unable to read the catalog <%s>: %s' % (self.db_name,e))
+            return 1
+
+        cataloged = set([str(row[0]) for row in rows])
+        ver_dirs = set(ver_dirs)
+        missing = sorted(ver_dirs - cataloged,key=int)
+        extra = sorted(cataloged - ver_dirs,key=int)
+
+        # a tgt_loc that is new to the catalog is not a mismatch, but its versions are still added
+        if rows:
+            for version in extra:
+                self.msgout('Version <%s> is in the catalog, but not in the config file' % version)
+            for version in missing:
+                self.msgout('Version <%s> is in the config file, but not in the catalog' % version)
+
+        for version in missing:
+            created = (ver_times or {}).get(version)
+            if created is None:
+                try:
+                    created = os.stat(os.path.join(verdir,version)).st_mtime
+                except OSError:
+                    created = None
+            self.add_version(os.path.join(verdir,version),created)
+        for version in extra:
+            self.prune(version)
+
+        if not rows: return 0
+        return len(missing) + len(extra)
+
+    def commit(self,config):
+        """Write the job row (from the C_buconfig object 'config') and all
+        the queued changes, in one transaction. Returns 0 on success or 1
+        otherwise, in which case nothing is written."""
+
+        if self.conn is None: return 1
+
+        tgt_loc = os.path.abspath(config.tgt_loc)
+
+        try:
+            self.conn.execute('BEGIN IMMEDIATE')
+            self.conn.execute('INSERT OR IGNORE INTO jobs (tgt_loc) VALUES (?)',(tgt_loc,))
+            self.conn.execute('UPDATE jobs SET src_dir=?, type=?, num_versions=?, ver_dirs=?, updated=? WHERE tgt_loc=?',
+                              (config.opt_src_dir(),config.opt_type(),int(config.opt_num_versions()),
+                               json.dumps(config.logical_versions),time.time(),tgt_loc))
+            job = self.conn.execute('SELECT id FROM jobs WHERE tgt_loc=?',(tgt_loc,)).fetchone()[0]
+
+            for sql, params in self.pending:
+                params = dict(params)
+                params['job'] = job
+                self.conn.execute(sql,params)
+
+            self.conn.execute('COMMIT')
+        except sqlite3.Error as e:
+            self.msgout('Unable to update the catalog <%s>: %s' % (self.db_name,e))
+            if self.conn.in_transaction: self.conn.execute('ROLLBACK')
+            return 1
+
+        self.pending = []
+        return 0
+
+    def execute(self):
+        """List every job in the catalog, with its versions, sizes and
+        totals. Returns 0 on success or 1 otherwise."""
+
+        if not os.path.isfile(self.db_name):
+            self.msgout('The catalog <%s> does not exist' % self.db_name)
+            return 1
+        if self.open(): return 1
+
+        try:
+            jobs = self.conn.execute('SELECT id, tgt_loc, type, ver_dirs FROM jobs ORDER BY tgt_loc').fetchall()
+
+            total_size = 0
+            total_versions = 0
+            self.msgout('%-8s %-19s %14s %9s  %s' % ('VERSION','CREATED','SIZE','FILES','TGT_LOC'))
+            for job, tgt_loc, backup_type, ver_dirs in jobs:
+                rows = self.conn.execute('SELECT version, created, size, files FROM versions '
+                                         'WHERE job_id=? AND pruned IS NULL ORDER BY version',(job,)).fetchall()
+                for version, created, size, files in rows:
+                    self.msgout('%-8s %-19s %14d %9d  %s' % (version,time.strftime('%Y-%m-%d %H:%M:%S',time.localtime(created)),
+                                                             size,files,tgt_loc))
+                    total_size = total_size + size
+                    total_versions = total_versions + 1
+
+                if sorted([str(row[0]) for row in rows]) != sorted(json.loads(ver_dirs or '[]')):
+                    self.msgout('WARNING: the versions of <%s> do not match its ver_dirs %s' % (tgt_loc,ver_dirs))
+        except (sqlite3.Error,ValueError) as e:
+            self.msgout('Unable to read the catalog <%s>: %s' % (self.db_name,e))
+            return 1
+        finally:
+            self.close()
+
+        self.msgout('%d jobs, %d versions, %d bytes' % (len(jobs),total_versions,total_size))
+        return 0
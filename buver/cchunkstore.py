@@ -0,0 +1,647 @@
+import os
+import stat
+import hashlib
+import json
+import random
+import struct
+import heapq
+import mmap
+
+try:
+    import numpy
+except ImportError:
+    numpy = None        # the chunks are cut in pure Python, which is a lot slower
+
+from buver.cwalker import C_walker
+from buver.cmanifest import new_hash, C_hashing_file, _key, RUN_RECORDS
+
+"""
+This module contains the code for the chunk store class.
+
+The chunk store is used by the 'dedup' backup type. Instead of keeping a
+full copy of every file in every version, each file is split into chunks
+and every unique chunk is stored exactly once, in the 'chunks' directory
+of the tgt_loc, where all the versions share it:
+
+    tgt_loc/chunks/<xx>/<chunk id>  - the chunk data
+    tgt_loc/chunks/refs             - the reference count of every chunk
+    tgt_loc/versions/<n>/recipe     - how to rebuild version <n>
+
+The chunk boundaries are content defined. A rolling 'gear' hash is run
+over the data, and a chunk ends wherever the low bits of the hash are all
+zero (subject to a minimum and maximum chunk size). Because the boundaries
+depend on the data and not on the offset, inserting or removing a few bytes
+in a file only changes the chunks around the edit, and the rest of the file
+still deduplicates against the previous versions. The chunk id is the
+BLAKE2b hash of the chunk data.
+
+The hash is run over the whole file, so it has to be fast. If numpy is
+installed, it is computed for a stretch of the data at once, otherwise one
+byte at a time in Python, which is more than an order of magnitude slower.
+Both cut the chunks in the same places. numpy comes with the 'dedup' extra
+('pip install buver[dedup]'), and a backup without it says so once.
+
+The recipe is a text file with one JSON record per line. The first line
+is a header, and every other line describes one directory, symbolic link
+or file from the src_dir. File records list the chunk ids, in order. The
+records are sorted the same way as the manifest (see cmanifest.py), which
+puts every directory before what is in it, and C_recipe looks a path up
+with a binary search over the memory-mapped file. The next backup gets the
+chunk lists of the files that did not change that way, without reading
+the whole recipe into memory. Recipes from before they were sorted (their
+header does not say 'sorted') are read into a dictionary instead.
+
+The reference counts are what allow versions to be pruned. Each time a
+version is stored, the count of every chunk it uses is incremented. When
+a version is pruned, release() decrements the counts of the chunks in its
+recipe, and collect() removes the chunks whose count has dropped to zero.
+If the refs file is ever lost, rebuild() recreates it from the recipes.
+While a backup or a prune is changing the chunks on disk, a 'refs.dirty'
+mark is left next to the refs file. If a run dies before it writes the
+refs file (and removes the mark), the next load() finds the mark and
+rebuilds the counts, so the chunks written by the run that died are
+collected instead of being left behind forever.
+
+When the manifest of the previous version is available, files whose stat()
+results have not changed are not read at all. Their chunk list is taken
+from the previous recipe, and only the reference counts are updated. If
+a claimed journal is given as well (see cjournal.py), the items that did
+not change are not even looked at; the src_dir is walked with journal.walk()
+and the items are looked at with journal.stat().
+
+If a 'throttle' is given (see cthrottle.py), the files read, the chunks
+written and the files per second are held to its limits.
+
+NOTE:
+
+This class assumes that you have properly locked the semaphore
+before invoking any of the methods herein. It is not safe if
+multiple processes attempt to invoke the methods!
+"""
+
+# The chunk size limits and the mask that sets the average chunk size (256KB)
+MIN_CHUNK = 64 * 1024
+MAX_CHUNK = 1024 * 1024
+CHUNK_BITS = 18
+CHUNK_MASK = (1 << CHUNK_BITS) - 1
+
+# How much of a file we read at a time
+READ_SIZE = 4 * 1024 * 1024
+
+# The table used by the gear hash. It is seeded so that the chunk boundaries
+# never change between runs (or releases), otherwise nothing would dedup.
+_rng = random.Random(0x62757665)
+GEAR = [_rng.getrandbits(32) for i in range(256)]
+del _rng
+if numpy: GEAR_ARRAY = numpy.array(GEAR,dtype=numpy.uint32)
+
+# How much of the data the numpy version hashes at a time, looking for the end of a chunk
+CUT_STEP = 64 * 1024
+
+# How a record is written to a run, before the runs are merged: the lengths of its key and its line
+RUN_REC = struct.Struct('<II')
+
+def _read_run(name):
+    # Return the (key, line) pairs of a run that was spilled to the file 'name'
+    f = open(name,'rb')
+    try:
+        while True:
+            fixed = f.read(RUN_REC.size)
+            if not fixed: break
+            key_len, line_len = RUN_REC.unpack(fixed)
+            key = f.read(key_len)
+            yield key, f.read(line_len)
+    finally:
+        f.close()
+
+class C_recipe:
+    def __init__(self,version):
+        """Constructor for the C_recipe class. Initialize the
+        variables that we need to have in order for the class to
+        operate:
+
+        name     - the name of the recipe in the 'version' directory
+        tmp_name - the name it is written under until close() is called
+        map      - the memory-mapped recipe, once it is loaded
+        start    - where the first record starts in the map
+        recs     - the records of a loaded recipe that is not sorted, by path
+        run      - the records added since the last spill, with their keys
+        runs     - the files the earlier runs were spilled to"""
+
+        self.name = os.path.join(version,'recipe')
+        self.tmp_name = '%s.tmp' % self.name
+        self.map = None
+        self.start = 0
+        self.recs = None
+        self.run = []
+        self.runs = []
+        self.outfile = None
+
+    def load(self):
+        """Load the recipe. Returns 0 on success or 1 if there is no usable recipe."""
+
+        try:
+            f = open(self.name,'rb')
+            try:
+                header = json.loads(f.readline())
+                if not header.get('sorted'):
+                    self.recs = {}
+                    for line in f:
+                        rec = json.loads(line)
+                        self.recs[rec['path']] = rec
+                    return 0
+                self.start = f.tell()
+                if self.start < os.fstat(f.fileno()).st_size:
+                    self.map = mmap.mmap(f.fileno(),0,access=mmap.ACCESS_READ)
+            finally:
+                f.close()
+        except (IOError,OSError,ValueError,KeyError):
+            return 1
+
+        return 0
+
+    def get(self,path):
+        """Return the record for 'path', or None if it is not in the recipe."""
+
+        if self.recs is not None: return self.recs.get(path)
+        if self.map is None: return None
+
+        # lo and hi are always where a line starts. The lines before lo sort
+        # before 'path', and the ones from hi on do not
+        m = self.map
+        key = _key(path)
+        lo = self.start
+        hi = len(m)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            line_start = m.rfind(b'\n',lo,mid) + 1
+            if line_start == 0: line_start = lo
+            line_end = m.find(b'\n',line_start)
+            rec = json.loads(m[line_start:line_end])
+            if _key(rec['path']) < key:
+                lo = line_end + 1
+            else:
+                hi = line_start
+
+        if lo >= len(m): return None
+        rec = json.loads(m[lo:m.find(b'\n',lo)])
+        if rec['path'] != path: return None
+
+        return rec
+
+    def create(self,src_dir):
+        """Start writing a new recipe for 'src_dir'. Raises IOError if it cannot be created."""
+
+        self.outfile = open(self.tmp_name,'wb')
+        self.outfile.write(('%s\n' % json.dumps({'src_dir':src_dir,'sorted':True})).encode('utf-8'))
+        self.run = []
+        self.runs = []
+
+    def add(self,rec):
+        """Record 'rec', which has the path first."""
+
+        self.run.append((_key(rec['path']),('%s\n' % json.dumps(rec)).encode('utf-8')))
+        if len(self.run) >= RUN_RECORDS: self.spill()
+
+    def spill(self):
+        """Sort the records added since the last spill and write them to a file of their own."""
+
+        name = '%s.%d' % (self.tmp_name,len(self.runs))
+        self.run.sort()
+        f = open(name,'wb')
+        try:
+            for key, line in self.run: f.write(RUN_REC.pack(len(key),len(line)) + key + line)
+        finally:
+            f.close()
+        self.runs.append(name)
+        self.run = []
+
+    def close(self):
+        """Finish the recipe: merge the runs into it, in order. Raises IOError if it fails."""
+
+        try:
+            self.run.sort()
+            for key, line in heapq.merge(*([_read_run(name) for name in self.runs] + [iter(self.run)])):
+                self.outfile.write(line)
+            self.outfile.close()
+            os.rename(self.tmp_name,self.name)
+        finally:
+            self.outfile.close()
+            self.run = []
+            for name in self.runs:
+                try:
+                    os.remove(name)
+                except OSError:
+                    pass
+            self.runs = []
+
+class C_chunkstore:
+    def __init__(self,msg,tgt_loc,throttle=None):
+        """Constructor for the C_chunkstore class. Initialize the
+        variables that we need to have in order for the class to
+        operate:
+
+        msgout    - the generic message handler for printing output
+        chunk_dir - the absolute path of the chunks folder
+        refs_name - the file that holds the reference counts
+        refs      - the dictionary of chunk id to reference count
+        loaded    - whether the reference counts have been loaded
+        dirty     - whether we left the mark that the refs file is out of date
+        warned    - whether we said that the chunks are cut without numpy
+        throttle  - the C_throttle that limits the I/O of backup() (or None)"""
+
+        self.msgout = msg
+        self.throttle = throttle
+        if throttle and not throttle.active(): self.throttle = None
+        self.chunk_dir = os.path.join(os.path.abspath(tgt_loc),'chunks')
+        self.refs_name = os.path.join(self.chunk_dir,'refs')
+        self.dirty_name = os.path.join(self.chunk_dir,'refs.dirty')
+        self.refs = {}
+        self.loaded = False
+        self.dirty = False
+        self.warned = False
+        self.new_chunks = 0
+        self.new_bytes = 0
+        self.dup_bytes = 0
+
+    def exists(self):
+        """Return True if this tgt_loc has a chunk store."""
+
+        return os.path.isdir(self.chunk_dir)
+
+    def chunk_path(self,cid):
+        """Return the path of the file that holds chunk 'cid'."""
+
+        return os.path.join(self.chunk_dir,cid[:2],cid)
+
+    def load(self):
+        """Load the reference counts. Create the chunk store if it does not exist.
+        Returns 0 on success or 1 otherwise."""
+
+        self.refs = {}
+
+        try:
+            if not os.path.isdir(self.chunk_dir): os.mkdir(self.chunk_dir)
+
+            if not os.path.isfile(self.refs_name):
+                # a brand new store, or someone removed the refs file
+                self.loaded = True
+                if C_walker().read(self.chunk_dir): return self.rebuild()
+                return 0
+
+            if os.path.isfile(self.dirty_name):
+                # a backup or a prune died before it wrote the refs file
+                self.msgout('The chunk reference counts were not saved by the last run')
+                self.loaded = True
+                return self.rebuild()
+
+            refs = open(self.refs_name,'r')
+            for line in refs:
+                x = line.split()
+                if len(x) == 2: self.refs[x[0]] = int(x[1])
+            refs.close()
+
+        except (IOError,OSError,ValueError):
+            self.msgout('Unable to load the chunk reference counts <%s>' % self.refs_name)
+            return 1
+
+        self.loaded = True
+        return 0
+
+    def save(self):
+        """Write out the reference counts. The file is replaced atomically,
+        so a crash leaves either the old counts or the new ones.
+        Returns 0 on success or 1 otherwise."""
+
+        if not self.loaded: return 1
+
+        tmp_name = '%s.%d' % (self.refs_name,os.getpid())
+        try:
+            refs = open(tmp_name,'w')
+            for cid in sorted(self.refs):
+                refs.write('%s %d\n' % (cid,self.refs[cid]))
+            refs.close()
+            os.rename(tmp_name,self.refs_name)
+            if os.path.isfile(self.dirty_name): os.remove(self.dirty_name)
+        except (IOError,OSError):
+            self.msgout('Unable to write the chunk reference counts <%s>' % self.refs_name)
+            return 1
+
+        self.dirty = False
+        return 0
+
+    def mark_dirty(self):
+        """Leave the mark that the refs file is about to be out of date, before
+        the chunks on disk are changed. save() removes it. Returns 0 on success
+        or 1 otherwise."""
+
+        if self.dirty: return 0
+
+        try:
+            open(self.dirty_name,'w').close()
+        except (IOError,OSError):
+            self.msgout('Unable to create <%s>' % self.dirty_name)
+            return 1
+
+        self.dirty = True
+        return 0
+
+    def cut(self,buf):
+        """Return where the first chunk in 'buf' ends, using the gear hash."""
+
+        n = len(buf)
+        if n <= MIN_CHUNK: return n
+
+        end = min(n,MAX_CHUNK)
+        if numpy is None:
+            if not self.warned:
+                self.msgout('numpy is not installed, so the chunks are cut in pure Python, which is a lot slower (pip install buver[dedup])')
+                self.warned = True
+            return self.cut_python(buf,end)
+
+        # The low CHUNK_BITS bits of the hash at a byte only depend on that many bytes,
+        # up to and including it: the sum of the gear value of the byte k back, shifted
+        # up by k. Each pass of the loop doubles the number of terms in the sums, and the
+        # ones that are left are added one at a time. The arrays all end at 'stop'.
+        for start in range(MIN_CHUNK,end,CUT_STEP):
+            stop = min(start + CUT_STEP,end)
+            size = stop - start
+            lo = start - CHUNK_BITS + 1
+            gear = GEAR_ARRAY[numpy.frombuffer(buf,numpy.uint8,stop - lo,lo)]
+
+            sums = gear
+            terms = 1
+            while terms * 2 <= CHUNK_BITS:
+                sums = sums[terms:] + (sums[:-terms] << numpy.uint32(terms))
+                terms = terms * 2
+            sums = sums[len(sums) - size:]
+            for k in range(terms,CHUNK_BITS):
+                sums = sums + (gear[len(gear) - size - k:len(gear) - k] << numpy.uint32(k))
+
+            hits = numpy.flatnonzero((sums & CHUNK_MASK) == 0)
+            if len(hits): return start + int(hits[0]) + 1
+
+        return end
+
+    def cut_python(self,buf,end):
+        """The same as cut(), one byte at a time, for when there is no numpy."""
+
+        gear = GEAR
+        h = 0
+        for i in range(MIN_CHUNK - 32,end):    # the hash only depends on the last 32 bytes
+            h = ((h << 1) + gear[buf[i]]) & 0xFFFFFFFF
+            if not h & CHUNK_MASK and i >= MIN_CHUNK: return i + 1
+
+        return end
+
+    def split(self,f):
+        """A generator that reads the open file 'f' and yields its chunks."""
+
+        buf = bytearray()
+        pos = 0         # where the data that is not in a chunk yet starts
+        while True:
+            data = f.read(READ_SIZE)
+            if data:
+                # drop the chunks we already yielded, so the buffer is never more than a read and a chunk
+                del buf[:pos]
+                pos = 0
+                buf.extend(data)
+
+            # only cut once we have a full chunk, or we are at the end of the file
+            view = memoryview(buf)
+            try:
+                while len(buf) - pos >= MAX_CHUNK or (pos < len(buf) and not data):
+                    n = self.cut(view[pos:])
+                    yield bytes(view[pos:pos + n])
+                    pos = pos + n
+            finally:
+                view.release()
+
+            if not data: break
+
+    def put(self,chunk):
+        """Store a chunk (if we do not have it already) and take a reference
+        to it. Returns the chunk id."""
+
+        cid = hashlib.blake2b(chunk,digest_size=20).hexdigest()
+
+        if cid in self.refs:
+            self.refs[cid] = self.refs[cid] + 1
+            self.dup_bytes = self.dup_bytes + len(chunk)
+            return cid
+
+        path = self.chunk_path(cid)
+        if not os.path.isdir(os.path.dirname(path)): os.mkdir(os.path.dirname(path))
+
+        # write it under a temporary name, so a partial chunk is never visible
+        tmp_name = '%s.%d' % (path,os.getpid())
+        if self.throttle: self.throttle.write(len(chunk))
+        out = open(tmp_name,'wb')
+        out.write(chunk)
+        out.close()
+        os.rename(tmp_name,path)
+
+        self.refs[cid] = 1
+        self.new_chunks = self.new_chunks + 1
+        self.new_bytes = self.new_bytes + len(chunk)
+        return cid
+
+    def get(self,cid):
+        """Return the data for chunk 'cid'."""
+
+        f = open(self.chunk_path(cid),'rb')
+        try:
+            return f.read()
+        finally:
+            f.close()
+
+    def store_file(self,path,h=None):
+        """Split a file into chunks and store them, adding the data to the
+        hash 'h' if one is given. Returns the list of chunk ids."""
+
+        f = open(path,'rb')
+        try:
+            if self.throttle: f = self.throttle.reader(f)
+            if h: f = C_hashing_file(f,h)
+            return [self.put(chunk) for chunk in self.split(f)]
+        finally:
+            f.close()
+
+    def reuse(self,rel,st,prev,prev_recipe):
+        """Return the chunk list of 'rel' from the previous version if the
+        file has not changed since then (and all its chunks are still in the
+        store), taking a new reference to each chunk. Otherwise return None."""
+
+        if not prev or not prev.unchanged(rel,st): return None
+
+        rec = prev_recipe.get(rel)
+        if rec is None or 'chunks' not in rec: return None
+        chunks = rec['chunks']
+        for cid in chunks:
+            if cid not in self.refs: return None
+
+        for cid in chunks:
+            self.refs[cid] = self.refs[cid] + 1
+
+        return chunks
+
+    def backup(self,src_dir,version,manifest=None,prev=None,journal=None,hashing=False):
+        """Store the src_dir as a new version. The chunks go in the chunk
+        store, and the recipe goes in the 'version' directory. Every item
+        is also recorded in 'manifest' if one is given. 'prev' is the loaded
+        manifest of the previous version, used to skip unchanged files, and
+        'journal' the claimed journal of the src_dir, used to skip looking
+        at them at all. With 'hashing', the files are hashed for the manifest
+        as they are split. Returns 0 on success or 1 if anything failed."""
+
+        if not self.loaded and self.load(): return 1
+        if self.mark_dirty(): return 1
+
+        src_dir = os.path.abspath(src_dir)
+        errors = 0
+        files = 0
+        reused = 0
+
+        # the chunk lists (and link targets) from the previous version, for the items that did not change
+        prev_recipe = C_recipe(os.path.dirname(prev.name)) if prev else None
+        if prev_recipe and prev_recipe.load(): prev_recipe = None
+        if prev_recipe is None: prev = None
+
+        walker = C_walker(self.msgout).walk(src_dir)
+        if journal: walker = journal.walk(src_dir)
+
+        recipe = C_recipe(version)
+        recipe.create(src_dir)
+
+        # symbolic links to directories are listed with the names, so they are kept as links
+        for root, subdirs, names in walker:
+            for name in [''] + names:
+                if self.throttle: self.throttle.files()
+                path = os.path.join(root,name) if name else root
+                rel = os.path.relpath(path,src_dir)
+                try:
+                    if journal:
+                        st = journal.stat(path,rel)
+                    else:
+                        st = os.lstat(path)
+                    rec = {'path':rel,'mode':st.st_mode,'uid':st.st_uid,'gid':st.st_gid,'mtime':st.st_mtime}
+                    hash = None
+
+                    if stat.S_ISDIR(st.st_mode):
+                        rec['type'] = 'd'
+                    elif stat.S_ISLNK(st.st_mode):
+                        rec['type'] = 'l'
+                        prev_rec = None
+                        if journal and journal.clean(rel) and prev_recipe: prev_rec = prev_recipe.get(rel)
+                        if prev_rec and 'target' in prev_rec:
+                            rec['target'] = prev_rec['target']
+                        else:
+                            rec['target'] = os.readlink(path)
+                    elif stat.S_ISREG(st.st_mode):
+                        rec['type'] = 'f'
+                        rec['size'] = st.st_size
+                        rec['chunks'] = self.reuse(rel,st,prev,prev_recipe)
+                        if rec['chunks'] is None:
+                            h = None
+                            if hashing: h = new_hash()
+                            rec['chunks'] = self.store_file(path,h)
+                            if h: hash = h.hexdigest()
+                        else:
+                            hash = prev.get(rel).hash
+                            reused = reused + 1
+                        files = files + 1
+                    else:
+                        self.msgout('Skipping special file <%s>' % path)
+                        continue
+
+                    recipe.add(rec)
+                    if manifest: manifest.add(rel,st,hash)
+
+                except (IOError,OSError) as e:
+                    self.msgout('Unable to store <%s>: %s' % (path,e))
+                    errors = errors + 1
+
+        try:
+            recipe.close()
+        except (IOError,OSError) as e:
+            self.msgout('Unable to write the recipe <%s>: %s' % (recipe.name,e))
+            errors = errors + 1
+
+        self.msgout('Stored %d files (%d unchanged), %d new chunks (%d bytes), %d bytes deduplicated' %
+                    (files,reused,self.new_chunks,self.new_bytes,self.dup_bytes))
+
+        # the version is only usable if the reference counts cover it
+        if self.save(): return 1
+
+        if errors: return 1
+        return 0
+
+    def recipe(self,version):
+        """A generator that yields the records of the recipe in 'version'.
+        The header is skipped. Yields nothing if there is no recipe."""
+
+        name = os.path.join(version,'recipe')
+        if not os.path.isfile(name): return
+
+        f = open(name,'r')
+        try:
+            f.readline()
+            for line in f:
+                yield json.loads(line)
+        finally:
+            f.close()
+
+    def release(self,version):
+        """Drop the references held by the recipe in 'version'. This is
+        called by the prune process before a version is removed."""
+
+        if not self.loaded and self.load(): return 1
+        if self.mark_dirty(): return 1
+
+        for rec in self.recipe(version):
+            for cid in rec.get('chunks',[]):
+                if cid in self.refs: self.refs[cid] = self.refs[cid] - 1
+
+        return 0
+
+    def collect(self):
+        """Remove every chunk that is no longer referenced by any version,
+        then save the reference counts. Returns 0 on success or 1 otherwise."""
+
+        if not self.loaded: return 0
+
+        removed = 0
+        for cid in [cid for cid in self.refs if self.refs[cid] <= 0]:
+            try:
+                os.remove(self.chunk_path(cid))
+                removed = removed + 1
+            except OSError:
+                pass    # already gone, that is what we wanted anyway
+            del self.refs[cid]
+
+        if removed: self.msgout('Removed %d unreferenced chunks' % removed)
+
+        return self.save()
+
+    def rebuild(self):
+        """Recreate the reference counts from the recipes of all the versions.
+        This is used when the refs file is missing. Chunks that no version
+        uses are left with a count of zero for the next collect()."""
+
+        self.msgout('Rebuilding the chunk reference counts ...')
+
+        self.refs = {}
+
+        # start every chunk on disk at zero, so collect() can remove the orphans
+        for entry in C_walker().scan(self.chunk_dir):
+            if entry.type == 'f' and entry.rel != entry.name and '.' not in entry.name: self.refs[entry.name] = 0
+
+        verdir = os.path.join(os.path.dirname(self.chunk_dir),'versions')
+        if os.path.isdir(verdir):
+            for v in C_walker().listdir(verdir)[0]:
+                for rec in self.recipe(os.path.join(verdir,v)):
+                    for cid in rec.get('chunks',[]):
+                        self.refs[cid] = self.refs.get(cid,0) + 1
+
+        self.loaded = True
+        return self.save()
@@ -0,0 +1,506 @@
+import errno
+import os
+import shutil
+import stat
+import sys
+import threading
+import time
+
+from buver.cwalker import C_walker
+from buver.cmanifest import new_hash
+
+"""
+This module contains the code for the copytree class.
+
+The purpose of this module is to copy a directory tree (the src_dir) into
+a new version directory from within the process, instead of shelling out
+to 'cp' or 'xcopy'. It is used by the 'link' backup type, and by the
+'tree' type when the 'engine' directive is set to 'builtin'.
+
+The copy is done by a pool of worker threads. The main thread walks the
+src_dir (see cwalker.py) and creates the directories, and hands the files in each directory
+to the pool in batches. The file data is copied by the kernel where the
+platform allows it, so it never passes through Python, and the worker
+threads spend their time waiting in system calls rather than holding the
+interpreter lock. Each file is copied with the first strategy that works:
+
+    clone     - on a copy-on-write filesystem (btrfs, XFS, ...), when the
+                src_dir and dest_dir are on the same one, the FICLONE ioctl
+                shares the data of the file instead of copying it, which
+                costs the same whatever the size of the file
+    sparse    - a file with holes in it has only its data copied, found
+                with SEEK_DATA and SEEK_HOLE, so the holes stay holes
+                instead of being written out as zeros
+    copy_file_range, sendfile - the kernel copies the data (which may also
+                be a clone, depending on the filesystem)
+    readwrite - a plain read/write loop, as a last resort
+
+If 'hashing' is set, the data is hashed on its way through (see
+cmanifest.py), and the hash is recorded in the manifest. The data has to
+pass through Python for that, so only the sparse and readwrite strategies
+are used then. The holes of a sparse file are hashed as the zeros they read
+as, without reading them.
+
+A strategy that fails is not tried again for the rest of the copy. The
+number of files copied with each strategy is kept in 'strategies', and the
+bytes that did not need copying in 'cloned' and 'holes'. Source files are
+opened with O_NOATIME where possible, so the backup does not dirty the
+inodes of the files it reads. Modes, times and ownership are preserved
+the same way 'cp -p' does.
+
+When a 'link_dest' directory is given (normally the tree from the previous
+version), each file is compared against the file with the same relative
+path in 'link_dest'. If the size, modification time, mode and ownership
+all match, the new version gets a hard link to the old file instead of a
+fresh copy. Otherwise, the file is copied. This is the same idea as the
+'rsync --link-dest' option, and it means that:
+
+    1. Every version still looks like a complete copy of the src_dir
+    2. Unchanged files only cost a directory entry, not the data
+    3. Removing an old version (rm -rf) never affects the newer ones,
+       because the data is only freed when the last link goes away.
+
+If a 'manifest' is given, every item that is copied or linked is recorded
+in it (see cmanifest.py). If the manifest of the previous version is given
+in 'prev', it is used to decide whether a file is unchanged, instead of
+looking at the file in 'link_dest', which saves a stat() per file.
+
+If a 'journal' is given (see cjournal.py), the src_dir is walked with
+journal.walk(), and the items are looked at with journal.stat(). Anything
+the watcher did not see change since the previous version then comes from
+the previous manifest instead of the src_dir, so only the changed paths
+are read from the disk.
+
+If a 'throttle' is given (see cthrottle.py), the bytes copied and the files
+copied or linked are held to its limits.
+
+If 'deltas' is given (see cdelta.py), a big file that changed since
+link_dest is stored as a delta against it where that is worth it, and a file
+that did not change, but is a delta in link_dest, has its delta linked. A
+file stored as a delta is not in dest_dir, only in the deltas of its version.
+
+run() - copy the tree, returns 0 on success or 1 if anything failed
+"""
+
+# The number of files handed to a worker thread at a time
+BATCH_SIZE = 64
+
+# The largest request we make of copy_file_range() or sendfile() in one call
+CHUNK_SIZE = 1 << 30
+
+# O_NOATIME is Linux only, and only allowed on files we own (or as root)
+O_NOATIME = getattr(os,'O_NOATIME',0)
+
+# Whether we can set the mode, owner and times through an open file handle
+FD_METADATA = hasattr(os,'fchmod') and hasattr(os,'fchown') and os.utime in os.supports_fd
+
+# The ioctl that clones a whole file, from <linux/fs.h>
+FICLONE = 0x40049409
+
+class C_copytree:
+    def __init__(self,msg,src_dir,dest_dir,link_dest=None,threads=1,manifest=None,prev=None,journal=None,throttle=None,deltas=None,hashing=False):
+        """Constructor for the C_copytree class. Initialize the
+        variables that we need to have in order for the class to
+        operate:
+
+        msgout    - the generic message handler for printing output
+        src_dir   - the directory tree we are copying
+        dest_dir  - where the copy is made (must not exist yet)
+        link_dest - the previous copy to hard link against (or None)
+        threads   - the number of worker threads doing the copies
+        manifest  - the manifest of the new version (or None)
+        prev      - the loaded manifest of link_dest's version (or None)
+        journal   - the claimed C_journal of the src_dir (or None)
+        throttle  - the C_throttle that limits the I/O (or None)
+        deltas    - the C_deltas of the new version (or None)
+        hashing   - whether to hash the files for the manifest
+        files     - the number of files copied
+        links     - the number of files hard linked
+        nbytes    - the number of bytes copied
+        cloned    - the number of bytes cloned instead of copied
+        holes     - the number of bytes of holes that were not copied
+        strategies - the number of files copied with each strategy
+        errors    - the number of items we could not process"""
+
+        self.msgout = msg
+        self.src_dir = os.path.abspath(src_dir)
+        self.dest_dir = os.path.abspath(dest_dir)
+        self.link_dest = None
+        if link_dest and os.path.isdir(link_dest): self.link_dest = os.path.abspath(link_dest)
+        self.threads = max(1,int(threads))
+        self.manifest = manifest
+        self.prev = prev
+        self.journal = journal
+        self.throttle = throttle
+        if throttle and not throttle.active(): self.throttle = None
+        self.deltas = deltas
+        if not self.link_dest: self.deltas = None
+        self.hashing = hashing
+        self.files = 0
+        self.links = 0
+        self.nbytes = 0
+        self.cloned = 0
+        self.holes = 0
+        self.strategies = {}
+        self.errors = 0
+        self.lock = threading.Lock()
+
+        # Remember which kernel copy methods work, so we do not keep retrying them
+        self.use_clone = sys.platform.startswith('linux')
+        self.use_seek_data = hasattr(os,'SEEK_DATA') and hasattr(os,'SEEK_HOLE')
+        self.use_copy_file_range = hasattr(os,'copy_file_range')
+        self.use_sendfile = hasattr(os,'sendfile') and os.name == 'posix'
+
+    def count(self,files=0,links=0,nbytes=0,errors=0,strategy=None,cloned=0,holes=0):
+        """Update the statistics. This is called from the worker threads."""
+
+        with self.lock:
+            self.files = self.files + files
+            self.links = self.links + links
+            self.nbytes = self.nbytes + nbytes
+            self.errors = self.errors + errors
+            if strategy: self.strategies[strategy] = self.strategies.get(strategy,0) + 1
+            self.cloned = self.cloned + cloned
+            self.holes = self.holes + holes
+
+    def lstat(self,path,rel):
+        """os.lstat() an item of the src_dir, through the journal if there is one."""
+
+        if self.journal: return self.journal.stat(path,rel)
+        return os.lstat(path)
+
+    def unchanged(self,st,rel):
+        """Return True if the file at 'rel' in link_dest looks exactly like
+        the source file described by 'st', so it can be linked instead of copied."""
+
+        if not self.link_dest: return False
+
+        # the manifest from last time can answer this without touching link_dest
+        if self.prev: return stat.S_ISREG(st.st_mode) and self.prev.unchanged(rel,st)
+
+        try:
+            old = os.lstat(os.path.join(self.link_dest,rel))
+        except OSError:
+            return False    # not in the previous version, so it is new
+
+        return (stat.S_ISREG(old.st_mode) and
+                old.st_size == st.st_size and
+                old.st_mtime == st.st_mtime and
+                old.st_mode == st.st_mode and
+                old.st_uid == st.st_uid and
+                old.st_gid == st.st_gid)
+
+    def open_src(self,src):
+        """Open a source file for reading without updating its access time."""
+
+        if O_NOATIME:
+            try:
+                return os.open(src,os.O_RDONLY|O_NOATIME)
+            except OSError:
+                pass    # EPERM if we do not own the file, so open it normally
+
+        return os.open(src,os.O_RDONLY)
+
+    def clone(self,fin,fout):
+        """Try to clone the whole of fin into fout. Returns True if it worked."""
+
+        import fcntl
+
+        try:
+            fcntl.ioctl(fout,FICLONE,fin)
+            return True
+        except OSError as e:
+            # EXDEV (src_dir is on another filesystem), EOPNOTSUPP, ENOTTY, ...
+            if e.errno != errno.EINVAL: self.use_clone = False
+            return False
+
+    def extents(self,fin,size):
+        """Return the (offset, length) of each run of data in fin, skipping the holes."""
+
+        extents = []
+        offset = 0
+        while offset < size:
+            try:
+                start = os.lseek(fin,offset,os.SEEK_DATA)
+            except OSError as e:
+                if e.errno == errno.ENXIO: break    # only a hole from here to the end
+                raise
+            end = min(os.lseek(fin,start,os.SEEK_HOLE),size)
+            extents.append((start,end - start))
+            offset = end
+
+        return extents
+
+    def hash_zeros(self,h,size):
+        """Add 'size' zeros (a hole) to the hash 'h'."""
+
+        zeros = bytes(min(size,1 << 20))
+        while size > 0:
+            h.update(zeros[:size])
+            size = size - len(zeros)
+
+    def copy_contents(self,fin,fout,size,h=None):
+        """Copy the data of fin to fout with the first strategy that works,
+        adding it to the hash 'h' if one is given. Returns the number of bytes
+        copied (holes and clones do not count)."""
+
+        if size and self.use_clone and h is None and self.clone(fin,fout):
+            self.count(strategy='clone',cloned=size)
+            return 0
+
+        # st_blocks is in 512 byte units, whatever the block size of the filesystem
+        if size and self.use_seek_data and os.fstat(fin).st_blocks * 512 < size:
+            try:
+                extents = self.extents(fin,size)
+            except OSError:
+                self.use_seek_data = False      # the filesystem does not know where its holes are
+                extents = None
+
+            if extents is not None:
+                done = 0
+                pos = 0
+                for offset, length in extents:
+                    if h and offset > pos: self.hash_zeros(h,offset - pos)
+                    os.lseek(fin,offset,os.SEEK_SET)
+                    os.lseek(fout,offset,os.SEEK_SET)
+                    done = done + self.copy_data(fin,fout,length,offset,h)[0]
+                    pos = offset + length
+                if h and size > pos: self.hash_zeros(h,size - pos)
+                os.ftruncate(fout,size)     # the file may end in a hole
+                self.count(strategy='sparse',holes=size - done)
+                return done
+
+        done, strategy = self.copy_data(fin,fout,size,0,h)
+        self.count(strategy=strategy)
+        return done
+
+    def copy_data(self,fin,fout,size,offset=0,h=None):
+        """Copy 'size' bytes from fin (at 'offset', where it must be positioned)
+        to fout. Use the fastest method that works, and fall back to a plain
+        read/write loop if nothing else does (or if the data is to be added to
+        the hash 'h'). Returns the number of bytes copied and the method that
+        did it."""
+
+        done = 0
+        chunk = CHUNK_SIZE
+        if self.throttle: chunk = self.throttle.chunk(CHUNK_SIZE)
+
+        if self.use_copy_file_range and h is None:
+            try:
+                while done < size:
+                    self.pace(min(chunk,size - done))
+                    n = os.copy_file_range(fin,fout,min(chunk,size - done))
+                    if n == 0: break
+                    done = done + n
+                return done, 'copy_file_range'
+            except OSError:
+                if done: raise
+                self.use_copy_file_range = False    # EXDEV, ENOSYS, ... try something else
+
+        if self.use_sendfile and h is None:
+            try:
+                while done < size:
+                    self.pace(min(chunk,size - done))
+                    n = os.sendfile(fout,fin,offset + done,min(chunk,size - done))
+                    if n == 0: break
+                    done = done + n
+                return done, 'sendfile'
+            except OSError:
+                if done: raise
+                self.use_sendfile = False
+
+        while done < size:
+            buf = os.read(fin,min(chunk,1 << 20,size - done))
+            if not buf: break
+            self.pace(len(buf))
+            if h: h.update(buf)
+            os.write(fout,buf)
+            done = done + len(buf)
+
+        return done, 'readwrite'
+
+    def pace(self,nbytes,written=None):
+        """Wait until the throttle (if any) allows nbytes to be read and
+        written (or 'written' bytes to be written, if that is different)."""
+
+        if not self.throttle: return
+        if written is None: written = nbytes
+
+        chunk = self.throttle.chunk(CHUNK_SIZE)
+        for i in range(0,nbytes,chunk): self.throttle.read(min(chunk,nbytes - i))
+        for i in range(0,written,chunk): self.throttle.write(min(chunk,written - i))
+
+    def copy_regular(self,src,dst,st):
+        """Copy a regular file, preserving its mode, times and ownership.
+        Returns the number of bytes copied and the hash of the file (or None)."""
+
+        h = None
+        if self.hashing: h = new_hash()
+
+        fin = self.open_src(src)
+        try:
+            fout = os.open(dst,os.O_WRONLY|os.O_CREAT|os.O_EXCL|getattr(os,'O_BINARY',0),0o600)
+            try:
+                nbytes = self.copy_contents(fin,fout,st.st_size,h)
+                if FD_METADATA:
+                    # set the metadata through the open handle, saving three path lookups
+                    self.chown(fout,st)
+                    os.fchmod(fout,stat.S_IMODE(st.st_mode))
+                    os.utime(fout,ns=(st.st_atime_ns,st.st_mtime_ns))
+            finally:
+                os.close(fout)
+        finally:
+            os.close(fin)
+
+        if not FD_METADATA:
+            self.chown(dst,st)
+            os.chmod(dst,stat.S_IMODE(st.st_mode))
+            os.utime(dst,(st.st_atime,st.st_mtime))
+
+        if h: return nbytes, h.hexdigest()
+        return nbytes, None
+
+    def copy_file(self,src,dst,rel,st):
+        """Copy (or link) a single non-directory item."""
+
+        if stat.S_ISLNK(st.st_mode):
+            # recreate symbolic links, do not follow them
+            os.symlink(os.readlink(src),dst)
+            self.chown(dst,st,True)
+            self.record(rel,st)
+            return
+
+        if not stat.S_ISREG(st.st_mode):
+            # sockets, fifos and devices are not backed up
+            self.msgout('Skipping special file <%s>' % src)
+            return
+
+        if self.unchanged(st,rel):
+            if self.deltas and self.deltas.link(rel):
+                self.count(links=1)
+                self.record(rel,st)
+                return
+
+            try:
+                os.link(os.path.join(self.link_dest,rel),dst)
+                self.count(links=1)
+                self.record(rel,st)
+                return
+            except OSError:
+                pass    # too many links or a different device, so just copy it
+
+        if self.deltas:
+            stored = self.deltas.store(src,rel,st,self.hashing)
+            if stored is not None:
+                self.pace(st.st_size,stored[0])
+                self.count(files=1,nbytes=stored[0])
+                self.record(rel,st,stored[1])
+                return
+
+        nbytes, hash = self.copy_regular(src,dst,st)
+        self.count(files=1,nbytes=nbytes)
+        self.record(rel,st,hash)
+
+    def record(self,rel,st,hash=None):
+        """Add an item to the manifest, with its content 'hash' if we have
+        one. If the previous manifest says the item has not changed, carry its
+        content hash forward."""
+
+        if not self.manifest: return
+
+        if hash is None and self.prev and self.prev.unchanged(rel,st): hash = self.prev.get(rel).hash
+        self.manifest.add(rel,st,hash)
+
+    def copy_batch(self,root,dst_root,rel_root,names):
+        """Worker thread entry point. Copy a batch of files from one directory."""
+
+        for f in names:
+            src = os.path.join(root,f)
+            if self.throttle: self.throttle.files()
+            try:
+                rel = os.path.join(rel_root,f)
+                self.copy_file(src,os.path.join(dst_root,f),rel,self.lstat(src,rel))
+            except (OSError,IOError) as e:
+                self.msgout('Unable to copy <%s>: %s' % (src,e))
+                self.count(errors=1)
+
+    def chown(self,path,st,symlink=False):
+        """Preserve the ownership, like 'cp -p'. 'path' may also be an open
+        file handle. This only works if we are running with sufficient
+        privilege, so ignore any failure."""
+
+        if not hasattr(os,'lchown'): return
+
+        try:
+            if symlink:
+                os.lchown(path,st.st_uid,st.st_gid)
+            elif isinstance(path,int):
+                os.fchown(path,st.st_uid,st.st_gid)
+            else:
+                os.chown(path,st.st_uid,st.st_gid)
+        except OSError:
+            pass
+
+    def run(self):
+        """Copy src_dir to dest_dir, linking against link_dest where we can."""
+
+        from concurrent.futures import ThreadPoolExecutor
+
+        if not os.path.isdir(self.src_dir):
+            self.msgout('Directory <%s> does not exist' % self.src_dir)
+            return 1
+
+        if self.link_dest: self.msgout('Linking unchanged files against <%s>' % self.link_dest)
+
+        start = time.time()
+        dirs = []       # remember the directories, we set their times after the copy
+        pending = []    # the batches that have been handed to the pool
+
+        walker = C_walker(self.msgout,self.threads).walk(self.src_dir)
+        if self.journal: walker = self.journal.walk(self.src_dir)
+
+        with ThreadPoolExecutor(max_workers=self.threads) as pool:
+            for root, subdirs, files in walker:
+                rel_root = os.path.relpath(root,self.src_dir)
+                if rel_root == '.': rel_root = ''
+                dst_root = os.path.join(self.dest_dir,rel_root)
+
+                try:
+                    os.mkdir(dst_root)
+                    dirs.append((root,dst_root))
+                    self.record(rel_root or '.',self.lstat(root,rel_root or '.'))
+                except OSError:
+                    self.msgout('Unable to create directory <%s>' % dst_root)
+                    self.count(errors=1)
+                    subdirs[:] = []     # do not descend into it either
+                    continue
+
+                for i in range(0,len(files),BATCH_SIZE):
+                    pending.append(pool.submit(self.copy_batch,root,dst_root,rel_root,files[i:i + BATCH_SIZE]))
+
+                # do not let the queue of batches grow without bound on huge trees
+                if len(pending) > self.threads * 16:
+                    for job in pending: job.result()
+                    pending = []
+
+            for job in pending: job.result()
+
+        # Now that the directories are full, restore their modes and times (deepest first)
+        for src, dst in reversed(dirs):
+            try:
+                st = os.lstat(src)
+                shutil.copystat(src,dst)
+                self.chown(dst,st)
+            except OSError:
+                self.count(errors=1)
+
+        elapsed = max(time.time() - start,0.001)
+        self.msgout('Copied %d files (%d bytes), linked %d files, %d errors' % (self.files,self.nbytes,self.links,self.errors))
+        if self.strategies:
+            self.msgout('Copied with %s, cloned %d bytes, skipped %d bytes of holes' %
+                        (', '.join(['%s %d' % (k,v) for k, v in sorted(self.strategies.items())]),self.cloned,self.holes))
+        self.msgout('Copy rate %.1f files/sec, %.2f MB/sec over %.2f seconds using %d threads' %
+                    ((self.files + self.links) / elapsed, self.nbytes / elapsed / (1 << 20), elapsed, self.threads))
+
+        if self.errors: return 1
+        return 0
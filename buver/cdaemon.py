@@ -0,0 +1,373 @@
+import os
+import signal
+import socket
+import threading
+import time
+
+from buver.cbuver import C_buver
+from buver.cbuconfig import C_buconfig
+from buver.cversions import C_versions
+
+"""
+This module contains the code for the daemon class.
+
+Running 'buver -b tgt_loc' from cron for every job means that every run
+starts Python, imports all of buver, parses the buver.conf and reads the
+versions directory, and then throws all of that away. With thousands of
+small jobs a day, that is most of the work. The daemon ('buver --daemon')
+is started once and left running. It takes the backup requests over a Unix
+domain socket, runs them in-process, and keeps what it knows about each
+tgt_loc in memory (a C_cache) from one run to the next:
+
+    config   - the loaded and validated buver.conf
+    versions - the list of the versions on disk
+
+Before each run, the cache checks the buver.conf and the versions
+directory with a stat(). If either changed since the cache last saw it
+(someone edited the buver.conf, or a backup from outside the daemon ran),
+that part is read again. So is the buver.conf if its src_dir is gone, so
+that is reported as it would be without the cache. The daemon's own runs
+update the cache as they write the buver.conf, while they still hold the
+semaphore. A run that fails drops the cache of its tgt_loc, so the next
+one starts from the disk.
+
+The requests are one line of text, and each is answered with zero or more
+lines, and then 'rc <n>' (0 is success):
+
+    backup <tgt_loc>  - run a backup of tgt_loc, and wait for it to finish
+    status            - one line for each tgt_loc the daemon knows about
+    forget <tgt_loc>  - drop the cache of tgt_loc (once its backup is done)
+    stop              - stop the daemon, once the running backups are done
+
+'buver --submit tgt_loc' sends a backup request and exits with its rc,
+but anything that can talk to a Unix socket will do, for example:
+
+    echo "backup /home/ken/bu/job_a" | nc -U ~/.buver.sock
+
+Each request gets a thread, and at most 'workers' backups run at once.
+Backups of the same tgt_loc are run one at a time by the daemon, and the
+tgt_loc semaphore keeps them apart from backups run outside of it. The
+log of each run goes to the tgt_loc, as it does for 'buver -b'.
+
+The socket is created with mode 0600, since whoever can connect to it can
+run backups as the user the daemon runs as. The daemon runs until it is
+sent SIGTERM or SIGINT (or a 'stop' request).
+
+execute() - serve requests until we are told to stop
+"""
+
+# Where the socket is, unless we are told otherwise
+DEFAULT_SOCKET = os.path.join(os.path.expanduser('~'),'.buver.sock')
+
+# The longest request we read
+MAX_REQUEST = 65536
+
+def signature(path):
+    """Return what stat() says about 'path' that changes when it does, or
+    None if it is not there."""
+
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+
+    return (st.st_ino,st.st_size,st.st_mtime_ns,st.st_ctime_ns)
+
+class C_cache:
+    def __init__(self,tgt_loc):
+        """Constructor for the C_cache class. Initialize the
+        variables that we need to have in order for the class to
+        operate:
+
+        tgt_loc     - the tgt_loc this is the cache of
+        config      - the loaded C_buconfig (or None)
+        config_sig  - the signature of the buver.conf it was loaded from
+        dirlist     - the versions on disk (or None)
+        versions_sig - the signature of the versions directory they were read from
+        lock        - held while a backup of the tgt_loc runs
+        runs        - the number of backups run, and the rc of the last one
+        hits        - how many times the config and the versions came from the cache"""
+
+        self.tgt_loc = tgt_loc
+        self.config = None
+        self.config_sig = None
+        self.dirlist = None
+        self.versions_sig = None
+        self.lock = threading.Lock()
+        self.runs = 0
+        self.last_rc = None
+        self.hits = {'config':0,'versions':0}
+
+    def load_config(self,msg):
+        """Return the C_buconfig of the tgt_loc, and 0, or a config and
+        nonzero if it could not be loaded (see C_buconfig.load()). The
+        src_dir can go away without the buver.conf changing, so a cached
+        config is only used while it is still there."""
+
+        config_sig = signature(os.path.join(self.tgt_loc,'buver.conf'))
+        if self.config is not None and config_sig is not None and config_sig == self.config_sig and \
+           os.path.isdir(self.config.opt_src_dir()):
+            self.config.msgout = msg
+            self.hits['config'] = self.hits['config'] + 1
+            return self.config, 0
+
+        self.config = None
+        config = C_buconfig(msg,self.tgt_loc)
+        rc = config.load()
+        if rc == 0:
+            self.config = config
+            self.config_sig = config_sig
+
+        return config, rc
+
+    def load_versions(self,msg,verdir):
+        """Return the C_versions of the tgt_loc."""
+
+        versions_sig = signature(verdir)
+        if self.dirlist is not None and versions_sig is not None and versions_sig == self.versions_sig:
+            self.hits['versions'] = self.hits['versions'] + 1
+            return C_versions(msg,verdir,self.dirlist)
+
+        versions = C_versions(msg,verdir)
+        self.dirlist = None
+        if versions.pview:
+            self.dirlist = list(versions.dirlist)
+            self.versions_sig = versions_sig
+
+        return versions
+
+    def update(self,config,versions):
+        """Remember the config and the versions as a backup left them. Called
+        once the buver.conf is written, while the semaphore is still held."""
+
+        self.config = config
+        self.config_sig = signature(os.path.join(self.tgt_loc,'buver.conf'))
+
+        # the versions that were not kept are in the trash now, and the new one is there
+        self.dirlist = list(versions.new_ver_dirs())
+        self.versions_sig = signature(versions.verdir)
+
+    def forget(self):
+        """Drop everything, so the next run reads it all from the disk."""
+
+        self.config = None
+        self.dirlist = None
+
+class C_daemon:
+    def __init__(self,msg,socket_name=None,workers=4,lock='file',lock_timeout=120):
+        """Constructor for the C_daemon class. Initialize the
+        variables that we need to have in order for the class to
+        operate:
+
+        msgout      - the generic message handler for printing output
+        socket_name - where the Unix domain socket is
+        workers     - the number of backups that may run at the same time
+        lock        - how each tgt_loc is locked (see csemaphore.py)
+        lock_timeout - how many seconds each backup waits for its lock
+        caches      - the C_cache of each tgt_loc, by its absolute path
+        listening   - set once the socket takes connections
+        running     - False once we have been told to stop"""
+
+        self.msgout = msg
+        self.socket_name = os.path.abspath(socket_name or DEFAULT_SOCKET)
+        self.workers = max(1,int(workers))
+        self.lock = lock
+        self.lock_timeout = lock_timeout
+        self.caches = {}
+        self.caches_lock = threading.Lock()
+        self.slots = threading.Semaphore(self.workers)
+        self.listening = threading.Event()
+        self.running = True
+
+    def cache(self,tgt_loc):
+        """Return the C_cache of 'tgt_loc', making it if it is new."""
+
+        with self.caches_lock:
+            if tgt_loc not in self.caches: self.caches[tgt_loc] = C_cache(tgt_loc)
+            return self.caches[tgt_loc]
+
+    def backup(self,tgt_loc):
+        """Run a backup of 'tgt_loc'. Returns its rc."""
+
+        cache = self.cache(tgt_loc)
+        with self.slots:
+            with cache.lock:
+                start = time.time()
+                buver = None
+                try:
+                    buver = C_buver(1,tgt_loc,os.path.basename(tgt_loc),self.lock,self.lock_timeout,cache)
+                    rc = buver.execute() or 0
+                except Exception as e:
+                    self.msgout('Backup of <%s> failed: %s' % (tgt_loc,e))
+                    rc = -1
+                finally:
+                    # this process keeps running, so do not leave the log open until it exits
+                    if buver: buver.close()
+
+                if rc: cache.forget()
+                cache.runs = cache.runs + 1
+                cache.last_rc = rc
+
+        self.msgout('Backup of <%s> finished with rc %s in %.2f seconds' % (tgt_loc,rc,time.time() - start))
+        return rc
+
+    def request(self,line):
+        """Carry out one request. Returns the lines of the answer, and the rc."""
+
+        op, sep, arg = line.strip().partition(' ')
+        arg = arg.strip()
+
+        if op == 'backup' and arg:
+            return [], self.backup(os.path.abspath(arg))
+
+        if op == 'forget' and arg:
+            # the cache stays, with its lock, so a backup that is running keeps
+            # the next one of the same tgt_loc waiting. We wait for it as well.
+            with self.caches_lock:
+                cache = self.caches.get(os.path.abspath(arg))
+            if cache:
+                with cache.lock: cache.forget()
+            return [], 0
+
+        if op == 'status':
+            lines = []
+            with self.caches_lock:
+                caches = sorted(self.caches.values(),key=lambda cache: cache.tgt_loc)
+            for cache in caches:
+                lines.append('%s runs=%d last_rc=%s config_hits=%d versions_hits=%d' %
+                             (cache.tgt_loc,cache.runs,cache.last_rc,cache.hits['config'],cache.hits['versions']))
+            return lines, 0
+
+        if op == 'stop':
+            self.running = False
+            return [], 0
+
+        return ['error unknown request <%s>' % line.strip()], 1
+
+    def serve(self,conn):
+        """Thread entry point. Read one request from 'conn' and answer it."""
+
+        try:
+            f = conn.makefile('rwb')
+            try:
+                line = f.readline(MAX_REQUEST).decode('utf-8','surrogateescape')
+                lines, rc = self.request(line)
+                for out in lines + ['rc %d' % rc]:
+                    f.write(('%s\n' % out).encode('utf-8','surrogateescape'))
+                f.flush()
+            finally:
+                f.close()
+        except (IOError,OSError) as e:
+            self.msgout('Lost a client: %s' % e)
+        finally:
+            conn.close()
+
+    def listen(self):
+        """Return the listening socket, or None if we cannot have it."""
+
+        # a socket that is there, but that nobody answers on, is left over from a daemon that died
+        if os.path.exists(self.socket_name):
+            probe = socket.socket(socket.AF_UNIX,socket.SOCK_STREAM)
+            try:
+                probe.connect(self.socket_name)
+                self.msgout('Another daemon is already listening on <%s>' % self.socket_name)
+                return None
+            except (IOError,OSError):
+                os.remove(self.socket_name)
+            finally:
+                probe.close()
+
+        sock = socket.socket(socket.AF_UNIX,socket.SOCK_STREAM)
+        try:
+            # only we can connect, whoever can connect can run backups as us. The
+            # umask is shared with the backups running in our threads, so set the
+            # mode instead. Nobody can connect before listen(), so there is no window.
+            sock.bind(self.socket_name)
+            os.chmod(self.socket_name,0o600)
+            sock.listen(64)
+        except (IOError,OSError) as e:
+            self.msgout('Unable to listen on <%s>: %s' % (self.socket_name,e))
+            sock.close()
+            return None
+
+        return sock
+
+    def stop(self,signum,frame):
+        self.running = False
+
+    def execute(self):
+        """Serve requests until we get SIGTERM, SIGINT or a 'stop' request.
+        Returns 0 when we stopped because we were told to, or 1 if we could
+        not start."""
+
+        sock = self.listen()
+        if sock is None: return 1
+        self.listening.set()
+
+        # signal handlers can only be set from the main thread
+        if threading.current_thread() is threading.main_thread():
+            signal.signal(signal.SIGTERM,self.stop)
+            signal.signal(signal.SIGINT,self.stop)
+
+        self.msgout('Listening on <%s>, running up to %d backups at once' % (self.socket_name,self.workers))
+        threads = []
+        sock.settimeout(1.0)
+        try:
+            while self.running:
+                try:
+                    conn, addr = sock.accept()
+                except (socket.timeout,InterruptedError):
+                    continue
+                conn.settimeout(None)
+                t = threading.Thread(target=self.serve,args=(conn,))
+                t.start()
+                threads = [thread for thread in threads if thread.is_alive()] + [t]
+        finally:
+            sock.close()
+            os.remove(self.socket_name)
+
+        # let the backups that are running finish
+        for t in threads: t.join()
+
+        self.msgout('Stopped listening on <%s>' % self.socket_name)
+        return 0
+
+class C_client:
+    def __init__(self,msg,request,socket_name=None):
+        """Constructor for the C_client class. Initialize the
+        variables that we need to have in order for the class to
+        operate:
+
+        msgout      - the generic message handler for printing output
+        request     - the request to send (see above)
+        socket_name - where the daemon's socket is"""
+
+        self.msgout = msg
+        self.request = request
+        self.socket_name = os.path.abspath(socket_name or DEFAULT_SOCKET)
+
+    def execute(self):
+        """Send the request, print the answer, and return its rc (or 1 if
+        the daemon could not be reached)."""
+
+        sock = socket.socket(socket.AF_UNIX,socket.SOCK_STREAM)
+        try:
+            sock.connect(self.socket_name)
+            f = sock.makefile('rwb')
+            try:
+                f.write(('%s\n' % self.request).encode('utf-8','surrogateescape'))
+                f.flush()
+                for line in f:
+                    line = line.decode('utf-8','surrogateescape').rstrip('\n')
+                    if line.startswith('rc '): return int(line[3:])
+                    self.msgout(line)
+            finally:
+                f.close()
+        except (IOError,OSError,ValueError) as e:
+            self.msgout('Unable to talk to the daemon on <%s>: %s' % (self.socket_name,e))
+            return 1
+        finally:
+            sock.close()
+
+        self.msgout('The daemon on <%s> did not answer' % self.socket_name)
+        return 1
@@ -0,0 +1,514 @@
+import os
+import json
+import struct
+import hashlib
+import threading
+import zlib
+
+from buver.cmanifest import _escape, _unescape, _open, new_hash
+
+"""
+This module contains the code for the delta class.
+
+A 'link' version hard links every file that did not change since the
+previous version, but a file that did change is copied again in full, even
+if only a few blocks of a multi-GB database dump or VM image are different.
+With the 'delta_min_size' directive set (see cbuconfig.py), a changed file
+of at least that size is stored as a delta instead: the blocks it shares
+with the same file in the previous version are referred to, and only the
+blocks that changed are written.
+
+The deltas of a version are kept in its 'deltas' directory, three files
+per delta'd file, named by a hash of its path:
+
+    <id>.base  - a hard link to the full copy the delta is against
+    <id>.sig   - the signature of the base (see below)
+    <id>.delta - the delta itself
+    index      - the path of each delta'd file, and its id
+
+The file itself is not in the tree of the version, but it is in the
+manifest like any other file, and 'buver --restore' puts it back together
+(see crestore.py).
+
+Each delta is against a full copy, never against another delta, so putting
+a file back together only ever takes one delta. When the file changes again
+in the next version, the new delta is against the same full copy (the base
+of the previous delta), and so on, until 'delta_max_chain' deltas in a row
+have been made against it. Then the file is copied in full again, so the
+deltas do not keep growing as the changes pile up. Every version hard links
+the base it needs, so pruning the version that holds the full copy does not
+take the base away from the versions that still need it. The same goes for
+a file that has not changed since it was delta'd: its three files are
+hard linked into the new version.
+
+The delta is found the way rsync does it. The signature of the base has a
+weak (adler32) and a strong (BLAKE2b) checksum for each block. The new file
+is read a block at a time, and as long as the blocks follow on from the
+last match, only the strong checksum is needed (which is done in C). Where
+the file changed, a rolling weak checksum is slid over it a byte at a time
+until a block of the base turns up again, wherever it is, so data that was
+inserted or removed does not make the rest of the file look different.
+Only the changed regions are slid over, a byte at a time in Python, so the
+cost is in proportion to how much of the file changed. Once the changes add
+up to more than half of the file, or the checksum has slid over more than
+'DELTA_MAX_SLIDE' bytes without finding a block of the base (the file was
+rewritten, or compressed or encrypted again), the delta is given up on, and
+the file is copied in full instead.
+
+The new file is read in order, through a buffer, and not mapped: a file that
+is truncated while it is mapped kills the process. If the file does not have
+the size it had when we looked at it by the time we are done, it changed
+while we read it, and is copied instead, so the size in the delta is always
+what it puts back together.
+
+The signature is worked out from the base the first time a delta is made
+against it, and hard linked from version to version after that, so the base
+is not read again.
+
+The delta file is a line of JSON (the path, the size of the file and of the
+base, the block size and how many deltas in a row this is), followed by:
+
+    C <block> <count> - copy 'count' blocks of the base, from 'block'
+    L <length> <data> - the literal data
+    E                 - the end
+
+C_deltas.store() - store a changed file as a delta, if it is worth it
+C_deltas.link()  - hard link the delta of an unchanged file
+C_deltas.close() - write the index
+load_deltas()    - read the index of a version
+apply_delta()    - put a file back together
+"""
+
+DELTA_DIR = 'deltas'
+DELTA_INDEX_HEADER = '# buver deltas 1\n'
+
+# The block size of the signatures
+DELTA_BLOCK = 64 * 1024
+
+# A delta that would be more than this fraction of the file is not worth it
+DELTA_MAX_RATIO = 0.5
+
+# How far the rolling checksum slides without finding a block of the base
+# before the delta is given up on
+DELTA_MAX_SLIDE = 16 * DELTA_BLOCK
+
+# How much of the new file is read at a time
+READ_SIZE = 4 * 1024 * 1024
+
+# adler32 works modulo this
+ADLER_MOD = 65521
+
+SIG_MAGIC = b'buver sig 1\n'
+SIG_RECORD = struct.Struct('>I16s')
+COPY_OP = struct.Struct('>cII')
+LITERAL_OP = struct.Struct('>cI')
+
+def delta_id(rel):
+    """Return the name the deltas of the file at 'rel' are stored under."""
+
+    return hashlib.blake2b(rel.encode('utf-8','surrogateescape'),digest_size=16).hexdigest()
+
+def strong(data):
+    return hashlib.blake2b(data,digest_size=16).digest()
+
+def signature(path,block=DELTA_BLOCK):
+    """Return the signature of the file 'path': a list of (weak, strong)
+    checksums, one per block."""
+
+    sums = []
+    f = open(path,'rb')
+    try:
+        while True:
+            data = f.read(block)
+            if not data: break
+            sums.append((zlib.adler32(data),strong(data)))
+    finally:
+        f.close()
+
+    return sums
+
+def write_signature(name,sums,block,size):
+    f = open(name,'wb')
+    try:
+        f.write(SIG_MAGIC)
+        f.write(struct.pack('>IQ',block,size))
+        for weak, strong_sum in sums: f.write(SIG_RECORD.pack(weak,strong_sum))
+    finally:
+        f.close()
+
+def read_signature(name):
+    """Return the (sums, block, size) of the signature file 'name'."""
+
+    f = open(name,'rb')
+    try:
+        if f.readline() != SIG_MAGIC: raise IOError('<%s> is not a signature' % name)
+        block, size = struct.unpack('>IQ',f.read(12))
+        data = f.read()
+    finally:
+        f.close()
+
+    sums = [SIG_RECORD.unpack_from(data,i) for i in range(0,len(data),SIG_RECORD.size)]
+    return sums, block, size
+
+class C_differ:
+    """Works out the delta of one file against the signature of its base."""
+
+    def __init__(self,sums,block,base_size,out,limit):
+        self.sums = sums
+        self.block = block
+        self.base_size = base_size
+        self.out = out
+        self.literal = 0
+        self.limit = limit  # give up when there is more literal data than this
+        self.run = None     # the pending copy, [first block, count]
+
+        # the blocks by weak checksum, for the rolling search
+        self.weak = {}
+        for i, (weak, strong_sum) in enumerate(sums):
+            self.weak.setdefault(weak,[]).append(i)
+
+    def block_len(self,i):
+        return min(self.block,self.base_size - i * self.block)
+
+    def copy(self,i):
+        if self.run and self.run[0] + self.run[1] == i:
+            self.run[1] = self.run[1] + 1
+            return
+        self.flush()
+        self.run = [i,1]
+
+    def flush(self):
+        if self.run: self.out.write(COPY_OP.pack(b'C',self.run[0],self.run[1]))
+        self.run = None
+
+    def emit(self,data):
+        """Write literal data."""
+
+        if not data: return
+        self.flush()
+        for i in range(0,len(data),1 << 24):
+            piece = data[i:i + (1 << 24)]
+            self.out.write(LITERAL_OP.pack(b'L',len(piece)))
+            self.out.write(piece)
+        self.literal = self.literal + len(data)
+
+    def search(self,m,pos,end):
+        """Slide the rolling checksum from 'pos' until a block of the base
+        turns up. Returns (offset, block), or (None, offset) if none does
+        before 'end', the offset being the first one that was not tried."""
+
+        block = self.block
+        weak_index = self.weak
+        s = zlib.adler32(m[pos:pos + block])
+        a = s & 0xFFFF
+        b = s >> 16
+        p = pos
+        while True:
+            candidates = weak_index.get((b << 16) | a)
+            if candidates:
+                data_sum = strong(m[p:p + block])
+                for i in candidates:
+                    if self.sums[i][1] == data_sum and self.block_len(i) == block: return p, i
+
+            if p + block >= end: return None, p + 1
+
+            # roll one byte along
+            out_byte = m[p]
+            in_byte = m[p + block]
+            a = (a - out_byte + in_byte) % ADLER_MOD
+            b = (b - block * out_byte + a - 1) % ADLER_MOD
+            p = p + 1
+
+    def diff(self,f,h=None):
+        """Write the delta of the open file 'f', adding what is read to the
+        hash 'h' if one is given. Returns the number of bytes read, or None
+        if we gave up because the delta would be too big."""
+
+        block = self.block
+        buf = bytearray()
+        start = 0           # the offset in the file of buf[0]
+        pos = 0             # where the next block is looked for
+        literal_start = 0   # where the literal data that is not written yet starts
+        expect = 0          # the base block we expect next
+        slid = 0            # how far we slid since the last block we found
+        eof = False
+
+        while True:
+            if not eof and start + len(buf) - pos < 2 * block:
+                # what is before 'pos' is literal data or copied already, so drop it
+                self.emit(bytes(buf[literal_start - start:pos - start]))
+                literal_start = pos
+                del buf[:pos - start]
+                start = pos
+
+                data = f.read(READ_SIZE)
+                if not data: eof = True
+                buf.extend(data)
+                if h: h.update(data)
+                continue
+
+            end = start + len(buf)
+            if end - pos < block: break
+
+            at = pos - start
+            if expect < len(self.sums) and self.block_len(expect) == block and strong(buf[at:at + block]) == self.sums[expect][1]:
+                i = expect
+            else:
+                # do not slide further than the literal data we are willing to take
+                budget = min(DELTA_MAX_SLIDE - slid,self.limit - self.literal - (pos - literal_start))
+                if budget < 0: return None
+                p, i = self.search(buf,at,min(len(buf),at + budget + block))
+                if p is None:
+                    slid = slid + i - at
+                    pos = start + i
+                    continue
+                pos = start + p
+
+            self.emit(bytes(buf[literal_start - start:pos - start]))
+            self.copy(i)
+            pos = pos + block
+            literal_start = pos
+            expect = i + 1
+            slid = 0
+
+        # the last (short) block can only match the last block of the base
+        tail = bytes(buf[literal_start - start:])
+        last = len(self.sums) - 1
+        if tail and last >= 0 and self.block_len(last) == len(tail) and strong(tail) == self.sums[last][1]:
+            self.copy(last)
+        else:
+            self.emit(tail)
+
+        if self.literal > self.limit: return None
+
+        self.flush()
+        self.out.write(b'E')
+        return start + len(buf)
+
+def make_delta(src,sums,block,base_size,name,header,limit,h=None):
+    """Write the delta of the file 'src' to the file 'name', adding the
+    file to the hash 'h' if one is given. Returns the number of literal
+    bytes in it, or None if there would be more than 'limit' (the delta
+    file is then incomplete). Raises IOError if the file does not have the
+    size in the header any more."""
+
+    out = open(name,'wb')
+    try:
+        out.write(('%s\n' % json.dumps(header)).encode('utf-8'))
+        differ = C_differ(sums,block,base_size,out,limit)
+
+        f = open(src,'rb')
+        try:
+            size = differ.diff(f,h)
+        finally:
+            f.close()
+    finally:
+        out.close()
+
+    if size is None: return None
+    if size != header['size']: raise IOError('it changed from %d to %d bytes while it was read' % (header['size'],size))
+    return differ.literal
+
+def read_header(name):
+    f = open(name,'rb')
+    try:
+        return json.loads(f.readline().decode('utf-8'))
+    finally:
+        f.close()
+
+def apply_delta(delta,base,write):
+    """Put a file back together from the delta file 'delta' and the base
+    file 'base', handing the data to the function 'write'. Returns the
+    number of bytes written. Raises IOError if the delta is damaged."""
+
+    f = open(delta,'rb')
+    fbase = os.open(base,os.O_RDONLY)
+    try:
+        header = json.loads(f.readline().decode('utf-8'))
+        block = header['block']
+        done = 0
+        while True:
+            op = f.read(1)
+            if op == b'C':
+                first, count = struct.unpack('>II',f.read(8))
+                offset = first * block
+                remaining = min(count * block,header['base_size'] - offset)
+                while remaining > 0:
+                    data = os.pread(fbase,min(remaining,1 << 20),offset)
+                    if not data: raise IOError('the base of <%s> is too short' % header['path'])
+                    write(data)
+                    offset = offset + len(data)
+                    remaining = remaining - len(data)
+                    done = done + len(data)
+            elif op == b'L':
+                length = struct.unpack('>I',f.read(4))[0]
+                data = f.read(length)
+                if len(data) != length: raise IOError('the delta of <%s> is truncated' % header['path'])
+                write(data)
+                done = done + length
+            elif op == b'E':
+                break
+            else:
+                raise IOError('the delta of <%s> is damaged' % header['path'])
+    finally:
+        os.close(fbase)
+        f.close()
+
+    if done != header['size']: raise IOError('the delta of <%s> gives %d bytes, not %d' % (header['path'],done,header['size']))
+    return done
+
+def load_deltas(version):
+    """Return the delta index of 'version' as a dictionary of path to id,
+    or {} if the version has no deltas."""
+
+    deltas = {}
+    try:
+        f = _open(os.path.join(version,DELTA_DIR,'index'),'r')
+    except (IOError,OSError):
+        return deltas
+
+    try:
+        for line in f:
+            if line.startswith('#'): continue
+            x = line.rstrip('\n').split('\t',1)
+            if len(x) == 2: deltas[_unescape(x[1])] = x[0]
+    finally:
+        f.close()
+
+    return deltas
+
+class C_deltas:
+    def __init__(self,msg,version,prev_version,prev_tree,min_size,max_chain):
+        """Constructor for the C_deltas class. Initialize the
+        variables that we need to have in order for the class to
+        operate:
+
+        msgout    - the generic message handler for printing output
+        version   - the new version directory
+        prev_version - the previous version directory
+        prev_tree - the copy of the src_dir in the previous version
+        min_size  - the smallest file that is delta'd
+        max_chain - how many deltas in a row before a full copy
+        prev      - the delta index of the previous version
+        index     - the delta index of the new version
+        files     - the number of files stored as deltas
+        nbytes    - the number of bytes written for them"""
+
+        self.msgout = msg
+        self.dir = os.path.join(version,DELTA_DIR)
+        self.prev_dir = os.path.join(prev_version,DELTA_DIR)
+        self.prev_tree = prev_tree
+        self.min_size = min_size
+        self.max_chain = max_chain
+        self.prev = load_deltas(prev_version)
+        self.index = {}
+        self.files = 0
+        self.nbytes = 0
+        self.lock = threading.Lock()
+
+    def name(self,did,what,prev=False):
+        if prev: return os.path.join(self.prev_dir,'%s.%s' % (did,what))
+        return os.path.join(self.dir,'%s.%s' % (did,what))
+
+    def add(self,rel,did):
+        with self.lock:
+            if not os.path.isdir(self.dir): os.mkdir(self.dir)
+            self.index[rel] = did
+
+    def link(self,rel):
+        """The file at 'rel' has not changed. If the previous version has it
+        as a delta, hard link the delta into the new version and return True."""
+
+        did = self.prev.get(rel)
+        if did is None: return False
+
+        self.add(rel,did)
+        try:
+            for what in ['base','sig','delta']:
+                os.link(self.name(did,what,True),self.name(did,what))
+        except OSError:
+            self.remove(rel,did)    # too many links, so it gets copied instead
+            return False
+
+        return True
+
+    def store(self,src,rel,st,hashing=False):
+        """Store the changed file 'src' at 'rel' as a delta against its base
+        in the previous version. Returns the number of bytes written and the
+        hash of the file (None unless 'hashing'), or None if it should be
+        copied in full instead."""
+
+        if st.st_size < self.min_size: return None
+
+        did = delta_id(rel)
+        chain = 0
+        sig = None
+        if rel in self.prev:
+            # the previous version has a delta, so the new one is against the same base
+            base = self.name(did,'base',True)
+            sig = self.name(did,'sig',True)
+            try:
+                chain = read_header(self.name(did,'delta',True))['chain']
+            except (IOError,OSError,ValueError,KeyError,TypeError) as e:
+                self.msgout('Unable to read the delta of <%s>, copying it instead: %s' % (rel,e))
+                return None
+        else:
+            base = os.path.join(self.prev_tree,rel)
+            if not os.path.isfile(base) or os.path.islink(base): return None
+
+        if chain + 1 > self.max_chain: return None     # time for a full copy
+
+        self.add(rel,did)
+        try:
+            os.link(base,self.name(did,'base'))
+            if sig:
+                os.link(sig,self.name(did,'sig'))
+            else:
+                write_signature(self.name(did,'sig'),signature(base),DELTA_BLOCK,os.path.getsize(base))
+
+            sums, block, base_size = read_signature(self.name(did,'sig'))
+            header = {'path':rel,'size':st.st_size,'base_size':base_size,'block':block,'chain':chain + 1}
+            h = None
+            if hashing: h = new_hash()
+            literal = make_delta(src,sums,block,base_size,self.name(did,'delta'),header,int(st.st_size * DELTA_MAX_RATIO),h)
+        except (IOError,OSError) as e:
+            self.msgout('Unable to delta <%s>, copying it instead: %s' % (rel,e))
+            literal = None
+
+        if literal is None:
+            # not worth it (or it failed), take it back out
+            self.remove(rel,did)
+            return None
+
+        nbytes = os.path.getsize(self.name(did,'delta'))
+        with self.lock:
+            self.files = self.files + 1
+            self.nbytes = self.nbytes + nbytes
+
+        if h: return nbytes, h.hexdigest()
+        return nbytes, None
+
+    def remove(self,rel,did):
+        with self.lock:
+            del self.index[rel]
+        for what in ['base','sig','delta']:
+            try:
+                os.unlink(self.name(did,what))
+            except OSError:
+                pass
+
+    def close(self):
+        """Write the index of the deltas. Returns 0 on success or 1 otherwise."""
+
+        if not self.index: return 0
+
+        try:
+            f = _open(os.path.join(self.dir,'index'),'w')
+            f.write(DELTA_INDEX_HEADER)
+            for rel in sorted(self.index): f.write('%s\t%s\n' % (self.index[rel],_escape(rel)))
+            f.close()
+        except (IOError,OSError):
+            self.msgout('Unable to write the delta index <%s>' % os.path.join(self.dir,'index'))
+            return 1
+
+        return 0
@@ -0,0 +1,397 @@
+import os
+import time
+import heapq
+import collections
+
+from buver.cversions import C_versions
+from buver.cbuconfig import C_buconfig
+from buver.cmanifest import C_manifest, C_manifest_rec, file_type, merge_join, new_hash, _key, _dir_key
+from buver.cchunkstore import C_chunkstore, C_recipe
+from buver.cdelta import DELTA_DIR, load_deltas, apply_delta
+from buver.cthrottle import C_throttle
+from buver.cverify import hash_file
+from buver.cwalker import C_walker
+
+"""
+This module contains the code for the diff class.
+
+'buver --diff tgt_loc' shows what changed between two versions, or between
+a version and the src_dir as it is now, without restoring anything. It
+prints one line per entry that is different, as soon as it knows:
+
+    + path - the entry was added
+    - path - the entry was removed
+    M path - the content changed (or it is now a different type of entry)
+    m path - only the mode or the ownership changed
+
+The metadata is compared first. A version made by the builtin engines has a
+manifest (see cmanifest.py), so its metadata is read from there, not from
+the disk. A 'tree' version made by 'tree_cmd' has no manifest, so its copy
+of the src_dir is read instead, and so is the src_dir itself. Files with
+the same size and modification time are taken to be the same, and files
+with a different size are different. Only when the sizes agree but the
+times do not is the content looked at: a side that has a hash in its
+manifest uses that, and the other side is read and hashed, by a pool of
+threads, while the diff carries on with the rest of the tree. A 'tar',
+'gzip' or 'bgzf' version cannot be read at a single file, so if it has no
+hash the file is reported as changed.
+
+The two sides are merged in one pass (see merge_join() in cmanifest.py),
+in the order of the manifest. A tree on disk is read in that same order,
+a directory at a time. Only the directory at hand, the directories still
+to be read and the hashes that are still being worked out are held in
+memory, so a large tree takes no more memory than a small one. The
+manifests of archives do not record the directories, so directories are
+not compared with them, only what is in them.
+
+Like the restore and the verify, the diff only reads, and does not take the
+tgt_loc semaphore.
+
+execute() - do the diff, returns 0 on success or 1 otherwise
+"""
+
+# How many files may be waiting to be hashed, per thread, before the diff waits for them
+PENDING = 64
+
+class C_tree_side:
+    """One side of a diff that is read from a directory on disk: the
+    src_dir, or the copy of it in a 'tree' version without a manifest."""
+
+    def __init__(self,top,name):
+        self.top = top
+        self.name = name
+        self.dirs = True
+
+    def record(self,path,rel):
+        # Return the manifest record for the item at 'path', or None if we do not back it up
+        try:
+            st = os.lstat(path)
+        except OSError:
+            return None     # it went away while we were looking at it
+        t = file_type(st)
+        if t is None: return None
+        return C_manifest_rec(t,st.st_size,st.st_mtime_ns,st.st_ino,st.st_mode,st.st_uid,st.st_gid,None,rel)
+
+    def items(self):
+        """Return the (key, record) pairs of the tree, in the same order as
+        the manifest has them (see cmanifest.py). The directories still to
+        be read are kept in a heap, in the order their entries come in."""
+
+        walker = C_walker()
+        rec = self.record(self.top,'.')
+        if rec is None: return
+        yield _key('.'), rec
+
+        pending = [(_dir_key('.'),'.')]
+        while pending:
+            prefix, rel = heapq.heappop(pending)
+            path = os.path.normpath(os.path.join(self.top,rel))
+            try:
+                subdirs, files = walker.listdir(path)
+            except OSError:
+                continue    # it is gone, or cannot be read, like os.walk(), skip it
+
+            entries = []
+            for name in subdirs + files:
+                child = os.path.normpath(os.path.join(rel,name))
+                rec = self.record(os.path.join(path,name),child)
+                if rec is not None: entries.append((_key(child),rec))
+
+            for key, rec in sorted(entries,key=lambda entry: entry[0]):
+                yield key, rec
+                if rec.type == 'd': heapq.heappush(pending,(_dir_key(rec.path),rec.path))
+
+    def source(self,rel):
+        """Return where the content of the file 'rel' can be read from."""
+
+        return ('f',os.path.normpath(os.path.join(self.top,rel)))
+
+    def link(self,rel):
+        """Return the target of the symbolic link 'rel', or None."""
+
+        try:
+            return os.readlink(os.path.normpath(os.path.join(self.top,rel)))
+        except OSError:
+            return None
+
+class C_version_side:
+    """One side of a diff that is a version with a manifest."""
+
+    def __init__(self,msg,tgt_loc,version,manifest):
+        self.msgout = msg
+        self.tgt_loc = tgt_loc
+        self.version = version
+        self.manifest = manifest
+        self.name = 'version %s' % os.path.basename(version)
+        self.tree = None
+        self.deltas = {}
+        self.chunks = None
+        self.recipe = None
+        self.dirs = True
+
+        if os.path.isfile(os.path.join(version,'recipe')):
+            self.chunks = C_chunkstore(msg,tgt_loc)
+        elif [name for name, type in C_walker().read(version) if name.startswith('backup.tar')]:
+            # the archive engine records what is in the directories, but not the directories
+            self.dirs = False
+        else:
+            # a tree version holds one directory, the copy of the src_dir (and maybe the deltas)
+            trees = [d for d in C_walker().listdir(version)[0] if d != DELTA_DIR]
+            if len(trees) == 1:
+                self.tree = os.path.join(version,trees[0])
+                self.deltas = load_deltas(version)
+
+    def items(self):
+        """Return the (key, record) pairs of the version, from its manifest."""
+
+        return self.manifest.items()
+
+    def lookup(self,rel):
+        # Return the recipe record of 'rel' in a 'dedup' version. The recipe is only
+        # mapped the first time a file of the version has to be hashed
+        if self.recipe is None:
+            recipe = C_recipe(self.version)
+            recipe.load()
+            self.recipe = recipe
+        return self.recipe.get(rel)
+
+    def source(self,rel):
+        """Return where the content of the file 'rel' can be read from, or
+        None if it cannot be read by itself (it is in an archive)."""
+
+        if self.tree:
+            if rel in self.deltas:
+                name = os.path.join(self.version,DELTA_DIR,self.deltas[rel])
+                return ('delta',(name + '.delta',name + '.base'))
+            return ('f',os.path.normpath(os.path.join(self.tree,rel)))
+
+        if self.chunks:
+            rec = self.lookup(rel)
+            if rec is None or 'chunks' not in rec: return None
+            return ('chunks',[self.chunks.chunk_path(cid) for cid in rec['chunks']])
+
+        return None
+
+    def link(self,rel):
+        """Return the target of the symbolic link 'rel', or None if it cannot be read."""
+
+        try:
+            if self.tree: return os.readlink(os.path.normpath(os.path.join(self.tree,rel)))
+            if self.chunks:
+                rec = self.lookup(rel)
+                if rec is not None: return rec.get('target')
+        except OSError:
+            pass
+
+        return None
+
+def hash_source(source):
+    """Thread pool entry point. Return the content hash of the file at
+    'source' (see source() above), in hex."""
+
+    kind, where = source
+    h = new_hash()
+    if kind == 'f':
+        f = open(where,'rb')
+        try:
+            hash_file(f,h,C_throttle())
+        finally:
+            f.close()
+    elif kind == 'delta':
+        apply_delta(where[0],where[1],h.update)
+    else:
+        for path in where:
+            f = open(path,'rb')
+            try:
+                h.update(f.read())
+            finally:
+                f.close()
+
+    return h.hexdigest()
+
+class C_diff:
+    def __init__(self,msg,tgt_loc,version=None,to=None,threads=8):
+        """Constructor for the C_diff class. Initialize the
+        variables that we need to have in order for the class to
+        operate:
+
+        msgout   - the generic message handler for printing output
+        tgt_loc  - the tgt_loc whose versions we compare
+        version  - the version to compare from (None means the latest one,
+                   or the one before 'to' if 'to' is given)
+        to       - the version to compare to (None means the src_dir as it is now)
+        threads  - the number of threads hashing files
+        pending  - the files that are being hashed, in the order they were found
+        counts   - the number of entries with each kind of change
+        hashed   - the number of files that had to be read, and their bytes
+        errors   - the number of files we could not read"""
+
+        self.msgout = msg
+        self.tgt_loc = os.path.abspath(tgt_loc)
+        self.version = version
+        self.to = to
+        self.threads = max(1,int(threads))
+        self.pending = collections.deque()
+        self.counts = {'+':0,'-':0,'M':0,'m':0}
+        self.hashed = 0
+        self.hashed_bytes = 0
+        self.errors = 0
+
+    def find_versions(self):
+        """Return the paths of the versions to compare from and to (None for
+        the src_dir), or None if they do not exist."""
+
+        versions = C_versions(self.msgout,os.path.join(self.tgt_loc,'versions'))
+        numbers = sorted([int(v) for v in versions.dirlist if v.isdigit()])
+        if not numbers:
+            self.msgout('There are no versions in <%s>' % versions.verdir)
+            return None
+
+        old = self.version
+        if old is None:
+            old = numbers[-1]
+            if self.to is not None:
+                older = [n for n in numbers if n < int(self.to)]
+                if not older:
+                    self.msgout('There is no version before version <%s>' % self.to)
+                    return None
+                old = older[-1]
+
+        for n in [old,self.to]:
+            if n is not None and int(n) not in numbers:
+                self.msgout('Version <%s> does not exist, the versions are %s' % (n,numbers))
+                return None
+
+        new = None
+        if self.to is not None: new = os.path.join(versions.verdir,str(self.to))
+
+        return os.path.join(versions.verdir,str(old)), new
+
+    def side(self,version):
+        """Return the side of the diff for 'version', or None if it cannot be compared."""
+
+        manifest = C_manifest(version)
+        if not manifest.load(): return C_version_side(self.msgout,self.tgt_loc,version,manifest)
+
+        # no manifest, which is fine for a 'tree' version, its copy of the src_dir is read instead
+        trees = [d for d in C_walker().listdir(version)[0] if d != DELTA_DIR]
+        if len(trees) == 1:
+            return C_tree_side(os.path.join(version,trees[0]),'version %s' % os.path.basename(version))
+
+        self.msgout('Version <%s> has no manifest, so there is nothing to compare it with' % version)
+        return None
+
+    def report(self,what,rel):
+        """Count and print one change."""
+
+        self.counts[what] = self.counts[what] + 1
+        self.msgout('%s %s' % (what,rel))
+
+    def drain(self,limit):
+        """Finish the oldest hashes until no more than 'limit' are pending."""
+
+        while len(self.pending) > limit:
+            rel, a, b, ha, hb = self.pending.popleft()
+            try:
+                if ha is not None and not isinstance(ha,str): ha = ha.result()
+                if hb is not None and not isinstance(hb,str): hb = hb.result()
+            except (IOError,OSError,ValueError) as e:
+                self.msgout('Unable to read <%s>: %s' % (rel,e))
+                self.errors = self.errors + 1
+                continue
+
+            if ha != hb:
+                self.report('M',rel)
+            elif not self.same_attrs(a,b):
+                self.report('m',rel)
+
+    def same_attrs(self,a,b):
+        """Return True if the records 'a' and 'b' have the same mode and ownership."""
+
+        return a.mode == b.mode and a.uid == b.uid and a.gid == b.gid
+
+    def hash_of(self,pool,side,rec):
+        # Return the hash of the file 'rec' on 'side': the one in the manifest if there is
+        # one, otherwise a future for it. None means it cannot be read
+        if rec.hash: return rec.hash
+
+        source = side.source(rec.path)
+        if source is None: return None
+
+        self.hashed = self.hashed + 1
+        self.hashed_bytes = self.hashed_bytes + rec.size
+        return pool.submit(hash_source,source)
+
+    def compare(self,pool,old,new,rel,a,b):
+        """Compare the entry 'rel', which is 'a' on the 'old' side and 'b' on
+        the 'new' side (None where it is not there)."""
+
+        if a is None:
+            self.report('+',rel)
+        elif b is None:
+            self.report('-',rel)
+        elif a.type != b.type or (a.type != 'd' and a.size != b.size):
+            self.report('M',rel)
+        elif a.type == 'd' or a.mtime == b.mtime:
+            if not self.same_attrs(a,b): self.report('m',rel)
+        elif a.type == 'l':
+            ta = old.link(rel)
+            if ta is None or ta != new.link(rel):
+                self.report('M',rel)
+            elif not self.same_attrs(a,b):
+                self.report('m',rel)
+        else:
+            # same size, different times, so the content has to decide
+            ha = self.hash_of(pool,old,a)
+            hb = None
+            if ha is not None: hb = self.hash_of(pool,new,b)
+            if ha is None or hb is None:
+                self.report('M',rel)    # it cannot be read, so assume the worst
+                return
+            self.pending.append((rel,a,b,ha,hb))
+            self.drain(self.threads * PENDING)
+
+    def execute(self):
+        """Do the diff. Returns 0 on success or 1 otherwise."""
+
+        from concurrent.futures import ThreadPoolExecutor
+
+        found = self.find_versions()
+        if found is None: return 1
+        old_version, new_version = found
+
+        old = self.side(old_version)
+        if old is None: return 1
+
+        if new_version is None:
+            # compare with the src_dir, as it is now
+            config = C_buconfig(self.msgout,self.tgt_loc)
+            if config.load():
+                self.msgout('Unable to load the config in <%s>, needed for the src_dir' % self.tgt_loc)
+                return 1
+            new = C_tree_side(config.opt_src_dir(),'<%s>' % config.opt_src_dir())
+        else:
+            new = self.side(new_version)
+            if new is None: return 1
+
+        self.msgout('Comparing %s with %s' % (old.name,new.name))
+        start = time.time()
+        try:
+            with ThreadPoolExecutor(max_workers=self.threads) as pool:
+                for rel, a, b in merge_join(old,new):
+                    if rel == '.': continue
+                    # a directory cannot be missing from a side that does not record them
+                    if a is None and b.type == 'd' and not old.dirs: continue
+                    if b is None and a.type == 'd' and not new.dirs: continue
+                    self.compare(pool,old,new,rel,a,b)
+                self.drain(0)
+        except (IOError,OSError) as e:
+            self.msgout('Diff failed: %s' % e)
+            return 1
+
+        elapsed = max(time.time() - start,0.001)
+        self.msgout('%d added, %d removed, %d modified, %d with new attributes (%d files, %d bytes hashed) in %.2f seconds' %
+                    (self.counts['+'],self.counts['-'],self.counts['M'],self.counts['m'],self.hashed,self.hashed_bytes,elapsed))
+
+        if self.errors: return 1
+        return 0
@@ -2,6 +2,8 @@
 import os
 import string
 
+from buver.cwalker import C_walker
+
 """
 This module contains the code for the folders class.
 
@@ -46,15 +48,14 @@ class C_folders:
         # make sure the path exists, otherwise bail now ...
         if not os.path.isdir('%s' % self.verdir): return -1
         
-        # go process all the directories in the versions folder
-        for f in os.listdir(self.verdir):
-            # Only add directories, not files ...
-            if os.path.isdir(os.path.join(self.verdir,f)):
-                # do not add '.' or '..'
-                if f == '.' or f == '..': continue
-                
-                # add this directory to our physical versions view
-                dirlist.append(f)
+        # go process all the directories in the versions folder (only directories, not files ...)
+        try:
+            subdirs, files = C_walker().listdir(self.verdir,True)
+        except OSError:
+            return -1
+        
+        # add these directories to our physical versions view
+        dirlist.extend(subdirs)
 
         self.dirlist = dirlist  # remember our directory list
         self.pview = True       # set the object state so we know we are good
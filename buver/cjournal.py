@@ -0,0 +1,311 @@
+import os
+
+from buver.cmanifest import _escape, _unescape, _open
+from buver.cwalker import C_walker
+
+"""
+This module contains the code for the change journal class.
+
+Even when hardly anything changed, a backup has to walk the whole src_dir
+to find out what did, and on a tree with tens of millions of files the walk
+alone takes hours. The watcher (see cwatcher.py) avoids that. It watches
+the src_dir with inotify, and records every path that changes in a journal
+in the 'journal' directory of the tgt_loc:
+
+    tgt_loc/journal/watcher  - who the running watcher is (it holds an
+                               flock() on this file for as long as it runs)
+    tgt_loc/journal/journal  - the paths that changed since the last backup
+    tgt_loc/journal/state    - the watcher the last good backup was based on
+
+Each line of the journal is a flag and a path relative to the src_dir:
+
+    f <path>  - the item itself changed (written, created, removed, ...)
+    d <path>  - the directory gained or lost entries
+    t <path>  - the whole tree under the path is new (a directory was
+                created or moved in), or it cannot be trusted
+    ! <text>  - the journal lost events (the inotify queue overflowed,
+                or a directory could not be watched), so it is useless
+
+When a backup starts, claim() takes the journal (the watcher starts a new
+one) and decides whether it can be trusted. It can only be trusted if the
+watcher that wrote it is still running and is the same watcher that was
+running when the previous backup succeeded, so that no change can have
+happened without being recorded, and if nothing was lost. If it can be
+trusted, the backup engines (see ccopytree.py and cchunkstore.py) use
+walk() instead of os.walk(), and stat() instead of os.lstat(). These take
+everything that did not change from the manifest of the previous version,
+and only look at the src_dir for the paths in the journal. Otherwise, the
+backup scans the whole src_dir as usual. After a backup succeeds, commit()
+records which watcher it was based on, so the next backup can trust the
+journal. Until then, the state says that nothing can be trusted, so a
+backup that fails makes the next one do a full scan.
+
+exists() - whether there is a journal at all
+claim()  - take the journal, returns True if it can be trusted
+walk()   - an os.walk() of the src_dir that skips what did not change
+stat()   - an os.lstat() that skips what did not change
+commit() - record that the backup succeeded
+"""
+
+JOURNAL_DIR = 'journal'
+JOURNAL_HEADER = '# buver journal 1\n'
+
+def _lock(fd,shared=False,block=True):
+    """flock() the open file 'fd'. Returns True if we got the lock."""
+
+    import fcntl
+
+    op = fcntl.LOCK_EX
+    if shared: op = fcntl.LOCK_SH
+    if not block: op = op | fcntl.LOCK_NB
+    try:
+        fcntl.flock(fd,op)
+    except (IOError,OSError):
+        return False
+
+    return True
+
+def journal_append(name,lines):
+    """Append lines to the journal 'name'. This is how the watcher writes.
+    The file is locked while we write, and if a backup took the journal
+    while we waited for the lock, a new one is started."""
+
+    while True:
+        fd = os.open(name,os.O_WRONLY|os.O_APPEND|os.O_CREAT,0o644)
+        _lock(fd)
+        try:
+            st = os.fstat(fd)
+            try:
+                current = os.path.samestat(st,os.stat(name))
+            except OSError:
+                current = False
+            if not current: continue    # it was taken from under us, start again
+            f = os.fdopen(os.dup(fd),'a',encoding='utf-8',errors='surrogateescape')
+            if st.st_size == 0: f.write(JOURNAL_HEADER)
+            f.writelines(lines)
+            f.close()
+            return
+        finally:
+            os.close(fd)
+
+def journal_line(flag,rel):
+    return '%s\t%s\n' % (flag,_escape(rel))
+
+class C_journal:
+    def __init__(self,msg,tgt_loc):
+        """Constructor for the C_journal class. Initialize the
+        variables that we need to have in order for the class to
+        operate:
+
+        msgout   - the generic message handler for printing output
+        jdir     - the journal directory of the tgt_loc
+        valid    - whether the journal can be trusted (set by claim())
+        watcher  - the id of the running watcher, or None
+        entries  - the paths whose item changed
+        listings - the directories whose entries changed
+        trees    - the directories whose whole tree changed"""
+
+        self.msgout = msg
+        self.jdir = os.path.join(os.path.abspath(tgt_loc),JOURNAL_DIR)
+        self.valid = False
+        self.watcher = None
+        self.entries = set()
+        self.listings = set()
+        self.trees = set()
+        self.prev = None
+
+    def exists(self):
+        """Return True if a watcher has started a journal for this tgt_loc."""
+
+        return os.path.isdir(self.jdir)
+
+    def name(self,what):
+        return os.path.join(self.jdir,what)
+
+    def read_file(self,what):
+        """Return the first line of a small file in the journal directory, or ''."""
+
+        try:
+            f = open(self.name(what),'r')
+            try:
+                return f.readline().strip()
+            finally:
+                f.close()
+        except (IOError,OSError):
+            return ''
+
+    def write_state(self,state):
+        """Replace the state file. Returns 0 on success or 1 otherwise."""
+
+        try:
+            f = open(self.name('state.tmp'),'w')
+            f.write('%s\n' % state)
+            f.close()
+            os.rename(self.name('state.tmp'),self.name('state'))
+        except (IOError,OSError):
+            self.msgout('Unable to write the journal state <%s>' % self.name('state'))
+            return 1
+
+        return 0
+
+    def running_watcher(self,src_dir):
+        """Return the id of the watcher, if one is running on src_dir, or None."""
+
+        try:
+            fd = os.open(self.name('watcher'),os.O_RDONLY)
+        except OSError:
+            return None
+
+        try:
+            # the watcher holds an exclusive lock while it runs
+            if _lock(fd,True,False): return None
+        finally:
+            os.close(fd)
+
+        x = self.read_file('watcher').split('\t',1)
+        if len(x) != 2 or x[1] != os.path.abspath(src_dir): return None
+
+        return x[0]
+
+    def take(self):
+        """Take the journal, so the watcher starts a new one, and load it.
+        Returns False if the journal has lost events."""
+
+        name = self.name('journal')
+        claimed = self.name('journal.claimed')
+        good = True
+
+        try:
+            fd = os.open(name,os.O_RDONLY)
+        except OSError:
+            return True     # nothing changed since the last backup
+
+        try:
+            _lock(fd)
+            os.rename(name,claimed)
+        finally:
+            os.close(fd)
+
+        f = _open(claimed,'r')
+        try:
+            for line in f:
+                if line.startswith('#'): continue
+                x = line.rstrip('\n').split('\t',1)
+                if x[0] == '!':
+                    self.msgout('The journal lost events: %s' % x[-1])
+                    good = False
+                elif len(x) != 2:
+                    continue
+                elif x[0] == 'f':
+                    self.entries.add(_unescape(x[1]))
+                elif x[0] == 'd':
+                    self.listings.add(_unescape(x[1]))
+                elif x[0] == 't':
+                    self.trees.add(_unescape(x[1]))
+        finally:
+            f.close()
+            os.unlink(claimed)
+
+        return good
+
+    def claim(self,src_dir,prev):
+        """Take the journal at the start of a backup. 'prev' is the loaded
+        manifest of the previous version. Returns True if the journal can be
+        trusted, in which case walk() and stat() can be used."""
+
+        if not self.exists(): return False
+
+        self.prev = prev
+        self.watcher = self.running_watcher(src_dir)
+        last = self.read_file('state')
+
+        # until this backup succeeds, nothing can be trusted
+        if self.write_state('-'): return False
+
+        try:
+            good = self.take()
+        except (IOError,OSError) as e:
+            self.msgout('Unable to take the journal: %s' % e)
+            return False
+
+        if self.watcher is None:
+            self.msgout('No watcher is running on the src_dir, scanning everything ...')
+        elif self.watcher != last:
+            self.msgout('The journal does not go back to the previous version, scanning everything ...')
+        elif not good:
+            self.msgout('The journal is not complete, scanning everything ...')
+        elif prev is None:
+            self.msgout('There is no manifest for the previous version, scanning everything ...')
+        else:
+            self.valid = True
+            self.msgout('Using the journal: %d changed items, %d changed directories, %d new trees' %
+                        (len(self.entries),len(self.listings),len(self.trees)))
+
+        return self.valid
+
+    def commit(self):
+        """Record that the backup succeeded, so the next one can trust the journal."""
+
+        if self.watcher is None or not self.exists(): return 0
+
+        return self.write_state(self.watcher)
+
+    def in_tree(self,rel):
+        """Return True if 'rel' is in one of the trees that changed as a whole."""
+
+        if not self.trees: return False
+
+        while True:
+            if rel in self.trees: return True
+            if rel == '.': return False
+            rel = os.path.dirname(rel) or '.'
+
+    def clean(self,rel):
+        """Return True if nothing happened to the item at 'rel' since the previous
+        version. A directory that gained or lost entries changed as well, since
+        its modification time did, even though the watcher only reports it
+        with a 'd' line."""
+
+        return (self.valid and rel not in self.entries and rel not in self.listings and
+                not self.in_tree(rel))
+
+    def stat(self,path,rel):
+        """os.lstat() the item 'path' at 'rel', unless it did not change, in
+        which case the record from the previous manifest is good enough."""
+
+        if self.clean(rel):
+            rec = self.prev.get(rel)
+            if rec is not None: return rec.stat()
+
+        return os.lstat(path)
+
+    def walk(self,src_dir):
+        """Like os.walk(src_dir), but the entries of the directories that did
+        not change come from the previous manifest instead of the disk. As
+        with os.walk(), the subdirs list may be changed to prune the walk.
+        Unlike os.walk(), symbolic links to directories are listed with the
+        files, since that is how the backups treat them anyway."""
+
+        walker = C_walker()
+
+        stack = ['.']
+        while stack:
+            rel = stack.pop()
+            path = os.path.normpath(os.path.join(src_dir,rel))
+
+            if rel in self.listings or self.in_tree(rel) or self.prev.get(rel) is None:
+                # this one has to be read from the disk
+                try:
+                    subdirs, files = walker.listdir(path)
+                except OSError:
+                    continue    # it is gone, like os.walk(), skip it
+            else:
+                # the entries of the directory, from the manifest
+                children = self.prev.children(rel)
+                subdirs = [name for name, rec in children if rec.type == 'd']
+                files = [name for name, rec in children if rec.type != 'd']
+
+            yield path, subdirs, files
+
+            for name in reversed(subdirs):
+                stack.append(os.path.normpath(os.path.join(rel,name)))
@@ -1,5 +1,6 @@
 
 import os
+import threading
 
 """
 This module contains the code for the logger class.
@@ -8,16 +9,20 @@ The purpose of this module is to provide a logger class
 for reporting each run of the backup utility.
 """
 
+_console_lock = threading.Lock()
+
 class C_logger:
-    def __init__(self,log_path):
+    def __init__(self,log_path,tag=None):
         """Constructor for the C_logger class. Initialize the
         variables that we need to have in order for the class to
         operate:
         
         logpath - the absolute path of the log directory.
+        tag     - an optional name to show on the console messages
         ready   - if we have an open log file"""
         
         self.logpath = os.path.abspath(log_path)
+        self.tag = tag
         self.filename = ''
         self.ready = False
         
@@ -36,7 +41,14 @@ class C_logger:
             # Make the new filename using the PID, store it in the log directory
             if self.filename in ['',None]:
                 from time import strftime
-                self.filename = os.path.join(self.logpath,'%s.%s.log' % (strftime('%Y-%m-%d.%H-%M-%S'),str(os.getpid())))
+                name = '%s.%s' % (strftime('%Y-%m-%d.%H-%M-%S'),str(os.getpid()))
+                self.filename = os.path.join(self.logpath,'%s.log' % name)
+                
+                # a process that runs many jobs (see cdaemon.py) may start two in the same second
+                n = 1
+                while os.path.exists(self.filename):
+                    self.filename = os.path.join(self.logpath,'%s.%d.log' % (name,n))
+                    n = n + 1
                 
             self.outfile = open(self.filename, mode)
         except IOError:
@@ -65,5 +77,11 @@ class C_logger:
             self.outfile.write("buver: %s\n" % msgout)
             
         # Also print to the screen ...
-        if write_to_console: print('buver: %s' % msgout)
+        if write_to_console:
+            # several jobs can share the console, so keep their lines whole
+            with _console_lock:
+                if self.tag:
+                    print('buver: [%s] %s' % (self.tag,msgout))
+                else:
+                    print('buver: %s' % msgout)
         return 0
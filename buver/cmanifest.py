@@ -0,0 +1,449 @@
+import os
+import stat
+import hashlib
+import threading
+import struct
+import heapq
+import mmap
+
+"""
+This module contains the code for the manifest class.
+
+A manifest records what went into a version. It is written by the
+in-process backup engines while the backup runs, and is stored as
+'manifest' in the version directory. There is one record per directory,
+symbolic link or regular file that was backed up:
+
+    type size mtime_ns inode mode uid gid hash path
+
+'path' is relative to the src_dir. The type is 'd', 'l' or 'f'. The 'hash'
+is the content hash of the file, if it was computed.
+
+The manifest is a binary file, so that a tree with tens of millions of
+files can be used without reading it into memory. The records are sorted
+by directory, and then by name, so the entries of a directory sit next to
+each other. After the records comes a table with the offset of each one,
+which is what makes a lookup a binary search. load() memory-maps the file,
+so the operating system pages in only the parts that are used, and several
+jobs on one backup host do not each need the whole manifest in memory.
+
+    'BUVERMF3' record ... offset ... count table_offset 'BUVERMF3'
+
+A record is a fixed header (see REC below), followed by the raw hash and
+the sort key, which is the directory and the name with a NUL in between.
+Names that are not valid UTF-8 are kept as-is. A manifest that is not
+marked 'BUVERMF3' is not usable, and the next backup looks at every file.
+
+The backup engines add the records in whatever order they get to them, so
+the writer sorts them in runs of RUN_RECORDS, spills each run to a file
+next to the manifest, and merges the runs when the manifest is closed. It
+never holds more than one run in memory. Two manifests can be compared in
+one pass with merge_join(), which walks both in order, side by side.
+
+With the 'hash' directive set (see cbuconfig.py), the engines work out the
+hash (BLAKE2b-256) while the data goes through them on its way into the
+version, so it costs no extra read. A file that did not change keeps the
+hash from the previous manifest. 'buver --verify' checks the versions
+against the hashes (see cverify.py).
+
+The point of the manifest is change detection. When the next backup runs,
+it loads the manifest of the previous version, and for every file in the
+src_dir it compares the stat() results with the record from last time. If
+the size, modification time, inode, mode and ownership are all the same,
+the file is considered unchanged and its data does not need to be read
+again. This is what makes the cost of a backup depend on how much changed,
+rather than on how big the src_dir is.
+
+load()       - map an existing manifest, so it can be read
+get()        - return the record for a path from a loaded manifest
+unchanged()  - compare a stat() result against a loaded record
+records()    - return the records of a loaded manifest, in order
+children()   - return the entries of a directory from a loaded manifest
+create()     - start writing a new manifest
+add()        - record an entry (safe to call from several threads)
+close()      - finish writing the manifest
+merge_join() - compare two loaded manifests in one pass
+new_hash()   - start a content hash
+"""
+
+MANIFEST_NAME = 'manifest'
+MANIFEST_MAGIC = b'BUVERMF3'
+
+# The fixed part of a record: type, hash length, size, mtime_ns, inode, mode,
+# uid, gid and key length. The hash and the key follow it
+REC = struct.Struct('<cBQqQIIII')
+
+# An entry in the offset table, and the footer at the end of the file
+OFFSET = struct.Struct('<Q')
+FOOTER = struct.Struct('<QQ8s')
+
+# How many records the writer sorts in memory before it spills them to a file
+RUN_RECORDS = 100000
+
+def _key(path):
+    # The sort key of 'path': its directory and its name, with a NUL in between.
+    # The src_dir itself ('.') has the empty key, so it comes first, and the
+    # entries in it have an empty directory. As NUL sorts before everything,
+    # the entries of a directory sort after those of the directories above it
+    if path == '.': return b''
+    parent, name = os.path.split(path)
+    return ('%s\0%s' % (parent,name)).encode('utf-8','surrogateescape')
+
+def _path(key):
+    if key == b'': return '.'
+    parent, name = key.decode('utf-8','surrogateescape').split('\0',1)
+    if parent == '': return name
+    return os.path.join(parent,name)
+
+def _dir_key(path):
+    # Every entry in the directory 'path' has a key that starts with this
+    if path == '.': return b'\0'
+    return ('%s\0' % path).encode('utf-8','surrogateescape')
+
+def _escape(path):
+    return path.replace('\\','\\\\').replace('\t','\\t').replace('\n','\\n')
+
+def _unescape(path):
+    if '\\' not in path: return path
+    out = []
+    i = 0
+    while i < len(path):
+        c = path[i]
+        if c == '\\' and i + 1 < len(path):
+            i = i + 1
+            c = {'t':'\t','n':'\n'}.get(path[i],path[i])
+        out.append(c)
+        i = i + 1
+    return ''.join(out)
+
+# The content hashes we know how to compute, by the name used in the 'hash' directive
+HASHES = ['blake2b']
+
+def new_hash():
+    """Return a new content hash object."""
+
+    return hashlib.blake2b(digest_size=32)
+
+class C_hashing_file:
+    """A file object that adds whatever is read through it to a hash."""
+
+    def __init__(self,f,h):
+        self.f = f
+        self.h = h
+
+    def read(self,size=-1):
+        data = self.f.read(size)
+        self.h.update(data)
+        return data
+
+    def __getattr__(self,name):
+        return getattr(self.f,name)
+
+def _open(name,mode):
+    # paths are kept byte for byte, even when they are not valid UTF-8
+    return open(name,mode,encoding='utf-8',errors='surrogateescape')
+
+class C_manifest_rec:
+    """One manifest record. This is deliberately small, because a
+    manifest for a large tree holds a lot of them."""
+
+    __slots__ = ('type','size','mtime','ino','mode','uid','gid','hash','path')
+
+    def __init__(self,type,size,mtime,ino,mode,uid,gid,hash,path):
+        self.type = type
+        self.size = size
+        self.mtime = mtime
+        self.ino = ino
+        self.mode = mode
+        self.uid = uid
+        self.gid = gid
+        self.hash = hash
+        self.path = path
+
+    def stat(self):
+        """Return the record as an os.stat_result, for code that wants one
+        without going to the disk. The access and change times are not
+        recorded, so they are given as the modification time."""
+
+        mtime = self.mtime / 1e9
+        return os.stat_result((self.mode,self.ino,0,1,self.uid,self.gid,self.size,mtime,mtime,mtime),
+                              {'st_atime_ns':self.mtime,'st_mtime_ns':self.mtime,'st_ctime_ns':self.mtime})
+
+def file_type(st):
+    """Return the manifest type of a stat() result, or None if we do not back it up."""
+
+    if stat.S_ISDIR(st.st_mode): return 'd'
+    if stat.S_ISLNK(st.st_mode): return 'l'
+    if stat.S_ISREG(st.st_mode): return 'f'
+    return None
+
+def _read_run(name):
+    # Return the (key, record) pairs of a run that was spilled to the file 'name'
+    f = open(name,'rb')
+    try:
+        while True:
+            fixed = f.read(REC.size)
+            if not fixed: break
+            x = REC.unpack(fixed)
+            rest = f.read(x[1] + x[8])
+            yield rest[x[1]:], fixed + rest
+    finally:
+        f.close()
+
+def merge_join(old,new):
+    """Compare the loaded manifests 'old' and 'new' in one pass, in manifest
+    order. Yields (path, old_rec, new_rec) for every path in either of them,
+    with None for the side it is not on. Only the current record of each
+    manifest is held in memory."""
+
+    a = old.items()
+    b = new.items()
+    x = next(a,None)
+    y = next(b,None)
+    while x is not None or y is not None:
+        if y is None or (x is not None and x[0] < y[0]):
+            yield x[1].path, x[1], None
+            x = next(a,None)
+        elif x is None or y[0] < x[0]:
+            yield y[1].path, None, y[1]
+            y = next(b,None)
+        else:
+            yield x[1].path, x[1], y[1]
+            x = next(a,None)
+            y = next(b,None)
+
+class C_manifest:
+    def __init__(self,version):
+        """Constructor for the C_manifest class. Initialize the
+        variables that we need to have in order for the class to
+        operate:
+
+        name     - the name of the manifest in the 'version' directory
+        tmp_name - the name it is written under until close() is called,
+                   so a manifest that exists is always complete
+        map      - the memory-mapped manifest, once it is loaded
+        table    - where the offset table starts in the map
+        count    - the number of records written, or loaded
+        run      - the records added since the last spill, with their keys
+        runs     - the files the earlier runs were spilled to"""
+
+        self.name = os.path.join(version,MANIFEST_NAME)
+        self.tmp_name = '%s.tmp' % self.name
+        self.map = None
+        self.table = 0
+        self.count = 0
+        self.run = []
+        self.runs = []
+        self.lock = threading.Lock()
+        self.outfile = None
+
+    def exists(self):
+        """Return True if the version has a manifest."""
+
+        return os.path.isfile(self.name)
+
+    def load(self):
+        """Load the manifest. Returns 0 on success or 1 if there is no
+        usable manifest."""
+
+        try:
+            f = open(self.name,'rb')
+            try:
+                magic = f.read(len(MANIFEST_MAGIC))
+                if magic != MANIFEST_MAGIC: return 1
+                mapped = mmap.mmap(f.fileno(),0,access=mmap.ACCESS_READ)
+            finally:
+                f.close()
+            count, table, magic = FOOTER.unpack_from(mapped,len(mapped) - FOOTER.size)
+        except (IOError,OSError,ValueError,struct.error):
+            return 1
+
+        if magic != MANIFEST_MAGIC or table + count * OFFSET.size + FOOTER.size != len(mapped): return 1
+
+        self.map = mapped
+        self.table = table
+        self.count = count
+        return 0
+
+    def _rec_at(self,pos):
+        # Return the key of the record at 'pos' in the map, the record, and where the next one starts
+        x = REC.unpack_from(self.map,pos)
+        start = pos + REC.size
+        hash = None
+        if x[1]: hash = self.map[start:start + x[1]].hex()
+        key = self.map[start + x[1]:start + x[1] + x[8]]
+        rec = C_manifest_rec(x[0].decode(),x[2],x[3],x[4],x[5],x[6],x[7],hash,_path(key))
+        return key, rec, start + x[1] + x[8]
+
+    def _key_at(self,i):
+        # Return the key of record 'i', and where the record is
+        pos = OFFSET.unpack_from(self.map,self.table + i * OFFSET.size)[0]
+        x = REC.unpack_from(self.map,pos)
+        start = pos + REC.size + x[1]
+        return self.map[start:start + x[8]], pos
+
+    def _find(self,key):
+        # Return the number of the first record whose key is not below 'key'
+        lo = 0
+        hi = self.count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._key_at(mid)[0] < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def get(self,path):
+        """Return the record for 'path', or None if it is not in the manifest."""
+
+        if self.map is None: return None
+
+        key = _key(path)
+        i = self._find(key)
+        if i >= self.count: return None
+        found, pos = self._key_at(i)
+        if found != key: return None
+
+        return self._rec_at(pos)[1]
+
+    def items(self):
+        """Return the (key, record) pairs of a loaded manifest, in order."""
+
+        if self.map is None: return
+        pos = len(MANIFEST_MAGIC)
+        while pos < self.table:
+            key, rec, pos = self._rec_at(pos)
+            yield key, rec
+
+    def records(self):
+        """Return the records of a loaded manifest, in order."""
+
+        for key, rec in self.items(): yield rec
+
+    def children(self,path):
+        """Return the entries of the directory 'path' from a loaded manifest,
+        as (name, record) pairs. They are next to each other in the
+        manifest, so this only reads those."""
+
+        if self.map is None: return []
+
+        prefix = _dir_key(path)
+
+        entries = []
+        i = self._find(prefix)
+        while i < self.count:
+            key, pos = self._key_at(i)
+            if not key.startswith(prefix): break
+            rec = self._rec_at(pos)[1]
+            entries.append((os.path.basename(rec.path),rec))
+            i = i + 1
+
+        return entries
+
+    def unchanged(self,path,st):
+        """Return True if the stat() result 'st' for 'path' matches what
+        the manifest recorded, so the file does not need to be read again."""
+
+        rec = self.get(path)
+        return (rec is not None and
+                rec.size == st.st_size and
+                rec.mtime == st.st_mtime_ns and
+                rec.ino == st.st_ino and
+                rec.mode == st.st_mode and
+                rec.uid == st.st_uid and
+                rec.gid == st.st_gid)
+
+    def create(self):
+        """Start writing a new manifest. Returns 0 on success or 1 otherwise."""
+
+        try:
+            self.outfile = open(self.tmp_name,'wb')
+            self.outfile.write(MANIFEST_MAGIC)
+        except (IOError,OSError):
+            self.outfile = None
+            return 1
+
+        self.run = []
+        self.runs = []
+        return 0
+
+    def add(self,path,st,hash=None):
+        """Record the entry 'path' (relative to the src_dir) with stat() result 'st'."""
+
+        t = file_type(st)
+        if t is None or self.outfile is None: return
+
+        key = _key(path)
+        digest = b''
+        if hash: digest = bytes.fromhex(hash)
+        rec = REC.pack(t.encode(),len(digest),st.st_size,st.st_mtime_ns,st.st_ino,st.st_mode,
+                       st.st_uid,st.st_gid,len(key)) + digest + key
+        with self.lock:
+            self.run.append((key,rec))
+            self.count = self.count + 1
+            if len(self.run) >= RUN_RECORDS: self.spill()
+
+    def spill(self):
+        """Sort the records added since the last spill and write them to a file
+        of their own. Called with the lock held."""
+
+        name = '%s.%d' % (self.tmp_name,len(self.runs))
+        self.run.sort()
+        f = open(name,'wb')
+        try:
+            for key, rec in self.run: f.write(rec)
+        finally:
+            f.close()
+        self.runs.append(name)
+        self.run = []
+
+    def close(self):
+        """Finish the manifest: merge the runs into it, in order, and add the
+        offset table. Returns 0 on success or 1 otherwise."""
+
+        if self.outfile is None: return 1
+
+        # the offsets go to a file of their own while the records are written,
+        # and are copied onto the end of the manifest after them
+        offsets_name = '%s.offsets' % self.tmp_name
+        try:
+            offsets = open(offsets_name,'w+b')
+            try:
+                self.run.sort()
+                pos = len(MANIFEST_MAGIC)
+                count = 0
+                last = None
+                for key, rec in heapq.merge(*([_read_run(name) for name in self.runs] + [iter(self.run)])):
+                    if key == last: continue    # an entry that was recorded twice
+                    self.outfile.write(rec)
+                    offsets.write(OFFSET.pack(pos))
+                    pos = pos + len(rec)
+                    count = count + 1
+                    last = key
+
+                offsets.seek(0)
+                while True:
+                    data = offsets.read(1 << 20)
+                    if not data: break
+                    self.outfile.write(data)
+            finally:
+                offsets.close()
+            self.outfile.write(FOOTER.pack(count,pos,MANIFEST_MAGIC))
+            self.outfile.close()
+            os.rename(self.tmp_name,self.name)
+        except (IOError,OSError):
+            return 1
+        finally:
+            self.outfile.close()
+            self.outfile = None
+            self.run = []
+            for name in self.runs + [offsets_name]:
+                try:
+                    os.remove(name)
+                except OSError:
+                    pass
+            self.runs = []
+
+        self.count = count
+        return 0
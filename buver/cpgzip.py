@@ -0,0 +1,308 @@
+import bisect
+import struct
+import threading
+import zlib
+
+try:
+    import bz2
+except ImportError:
+    bz2 = None          # python was built without bz2
+try:
+    import lzma
+except ImportError:
+    lzma = None         # python was built without lzma
+
+"""
+This module contains the code for the parallel gzip writer class.
+
+C_pgzip is a file-like object that gzip compresses everything written to
+it, using several threads, and writes the result to another file object.
+It produces a single, ordinary gzip stream, which can be read by gzip,
+tar, and the Python gzip and tarfile modules.
+
+It works the same way as 'pigz'. The data is cut into fixed size blocks,
+and each block is deflated on its own by a worker thread. zlib releases
+the interpreter lock while it compresses, so the blocks really are
+compressed in parallel. Each block is primed with the last 32KB of the
+block before it (the deflate window), so the compression ratio is almost
+the same as compressing the whole stream at once. Every block but the last
+ends with a sync flush, which ends on a byte boundary, so the compressed
+blocks can simply be written out one after the other, in order. The
+CRC-32 and length in the gzip trailer are computed as the data goes by.
+
+With 'independent' set, the writer makes a BGZF style file instead (this
+is the 'bgzf' backup type). Every block is compressed without a priming
+window and written as a complete gzip member of its own, with its own
+header and trailer. A file made of several gzip members one after the
+other is still a valid gzip file, so gzip, tar and the Python modules
+read it the same as any other. But because no block depends on the ones
+before it, a reader that knows where the blocks start can begin at any
+one of them. The writer records, in 'blocks', the offset of each block in
+the compressed file along with the offset of its data in the uncompressed
+stream, and C_pgzip_reader uses that list to read the file at any offset
+while decompressing only the blocks it touches. The cost is a slightly
+lower compression ratio, since each block starts with an empty window.
+
+write() - add data to the stream
+close() - compress whatever is left and write the gzip trailer
+abort() - stop the threads without finishing the stream
+
+The 'codec' can also be 'bz2' or 'lzma' instead of 'zlib'. Those blocks
+are always independent: each one is compressed into a complete .bz2 or
+.xz stream, and the streams are written one after the other. bzip2, xz,
+tar and the Python modules all read a file of concatenated streams as
+one stream, so the result is an ordinary .tar.bz2 or .tar.xz.
+
+Media files (JPEG, video, zip, ...) do not compress, and compressing them
+anyway just burns CPU. With 'adaptive' set (the default), a few samples
+of each block are test compressed at the fastest zlib level first. If
+they do not shrink by at least a few percent, the block is compressed at
+the cheapest level the codec has instead: for zlib that is level 0, which
+just stores the data, and for bz2 and lzma it is their fastest preset
+(bzip2 has no way to store data as-is, so it gains the least from this).
+The blocks stay in the same stream, so nothing changes for the reader.
+The number of blocks treated this way is kept in 'stored_blocks'.
+
+C_pgzip_reader is a read-only, seekable file-like object over a file
+written with 'independent' set, given its list of blocks.
+"""
+
+# How much data each worker compresses at a time
+BLOCK_SIZE = 1024 * 1024
+
+# The size of the deflate window, which is also the priming dictionary
+WINDOW_SIZE = 32 * 1024
+
+# How much data goes in each independent block. This is also the most a
+# reader has to decompress to get at any byte in the file
+INDEPENDENT_BLOCK_SIZE = 256 * 1024
+
+# The codecs we know about, the file name suffix each one gets, and the
+# level used for the blocks that do not compress
+CODEC_SUFFIX = {'zlib':'.gz','bz2':'.bz2','lzma':'.xz'}
+CHEAPEST_LEVEL = {'zlib':0,'bz2':1,'lzma':0}
+
+# How the adaptive test works: SAMPLES pieces of SAMPLE_SIZE bytes from each
+# block are compressed, and the block counts as incompressible if the result
+# is still more than INCOMPRESSIBLE of the original size
+SAMPLES = 4
+SAMPLE_SIZE = 4096
+INCOMPRESSIBLE = 0.95
+
+# The gzip header: magic, deflate, no flags, no mtime, no extra flags, unix
+GZIP_HEADER = b'\x1f\x8b\x08\x00\x00\x00\x00\x00\x00\x03'
+
+class C_pgzip:
+    def __init__(self,fileobj,level=6,threads=4,block_size=BLOCK_SIZE,independent=False,codec='zlib',adaptive=True):
+        """Constructor for the C_pgzip class. Initialize the
+        variables that we need to have in order for the class to
+        operate:
+
+        fileobj    - where the compressed stream is written
+        level      - the compression level of the codec
+        threads    - the number of compression threads
+        block_size - the amount of data compressed by each job
+        independent - write each block as a gzip member of its own
+        codec      - 'zlib' (gzip), 'bz2' or 'lzma' (xz)
+        adaptive   - test each block, and do not try hard on data that does not compress
+        size       - the number of bytes written to us
+        out_size   - the number of compressed bytes written to fileobj
+        blocks     - with 'independent', the (compressed offset, uncompressed
+                     offset) of every block written so far
+        stored_blocks - the number of blocks found not to compress"""
+
+        from concurrent.futures import ThreadPoolExecutor
+
+        self.fileobj = fileobj
+        self.level = level
+        self.threads = max(1,int(threads))
+        self.block_size = block_size
+        self.pool = ThreadPoolExecutor(max_workers=self.threads)
+        self.pending = []
+        self.buf = bytearray()
+        self.window = b''
+        self.crc = 0
+        self.size = 0
+        self.out_size = 0
+        self.closed = False
+        self.codec = codec
+        self.adaptive = adaptive
+        self.independent = independent or codec != 'zlib'
+        self.blocks = []
+        self.submitted = 0
+        self.stored_blocks = 0
+        self.lock = threading.Lock()
+
+        if codec == 'bz2' and bz2 is None: raise ValueError('the bz2 codec is not available')
+        if codec == 'lzma' and lzma is None: raise ValueError('the lzma codec is not available')
+        if codec not in CODEC_SUFFIX: raise ValueError('unknown codec <%s>' % codec)
+
+        # independent blocks each carry their own header
+        if not self.independent: self.output(GZIP_HEADER)
+
+    def output(self,data):
+        self.fileobj.write(data)
+        self.out_size = self.out_size + len(data)
+
+    def incompressible(self,block):
+        """Return True if samples of the block do not compress. This costs
+        a fraction of compressing the block, and saves all of it for media."""
+
+        if len(block) < SAMPLES * SAMPLE_SIZE: return False
+
+        step = len(block) // SAMPLES
+        sample = b''.join([block[i * step:i * step + SAMPLE_SIZE] for i in range(SAMPLES)])
+        return len(zlib.compress(sample,1)) > len(sample) * INCOMPRESSIBLE
+
+    def compress(self,block,window,last):
+        """Worker thread entry point. Deflate one block, primed with the
+        window from the block before it."""
+
+        level = self.level
+        if self.adaptive and self.incompressible(block):
+            level = CHEAPEST_LEVEL[self.codec]
+            with self.lock:
+                self.stored_blocks = self.stored_blocks + 1
+
+        if self.codec == 'bz2': return bz2.compress(block,max(1,level))
+        if self.codec == 'lzma': return lzma.compress(block,format=lzma.FORMAT_XZ,preset=level)
+
+        if self.independent:
+            c = zlib.compressobj(level,zlib.DEFLATED,-zlib.MAX_WBITS,9)
+            trailer = struct.pack('<II',zlib.crc32(block) & 0xFFFFFFFF,len(block) & 0xFFFFFFFF)
+            return GZIP_HEADER + c.compress(block) + c.flush(zlib.Z_FINISH) + trailer
+
+        if window:
+            c = zlib.compressobj(level,zlib.DEFLATED,-zlib.MAX_WBITS,9,zlib.Z_DEFAULT_STRATEGY,window)
+        else:
+            c = zlib.compressobj(level,zlib.DEFLATED,-zlib.MAX_WBITS,9)
+
+        if last: return c.compress(block) + c.flush(zlib.Z_FINISH)
+        return c.compress(block) + c.flush(zlib.Z_SYNC_FLUSH)
+
+    def submit(self,block,last=False):
+        """Hand a block to the pool, then write out any blocks that are done."""
+
+        self.crc = zlib.crc32(block,self.crc)
+        self.pending.append((self.pool.submit(self.compress,block,self.window,last),self.submitted))
+        self.submitted = self.submitted + len(block)
+        if not self.independent: self.window = block[-WINDOW_SIZE:]
+
+        # write the finished blocks in order, and do not let too many pile up
+        while self.pending and (self.pending[0][0].done() or len(self.pending) > self.threads * 2):
+            self.output_block()
+
+    def output_block(self):
+        """Write out the oldest pending block, remembering where it went."""
+
+        job, offset = self.pending.pop(0)
+        data = job.result()
+        self.blocks.append((self.out_size,offset))
+        self.output(data)
+
+    def write(self,data):
+        """Add data to the stream."""
+
+        if self.closed: raise ValueError('write to a closed C_pgzip')
+
+        self.buf.extend(data)
+        self.size = self.size + len(data)
+
+        while len(self.buf) >= self.block_size:
+            self.submit(bytes(self.buf[:self.block_size]))
+            del self.buf[:self.block_size]
+
+        return len(data)
+
+    def flush(self):
+        pass    # blocks are only written once they are full
+
+    def close(self):
+        """Compress whatever is left, and finish the gzip stream. The
+        underlying fileobj is not closed."""
+
+        if self.closed: return
+        self.closed = True
+
+        # the last block may be empty, it still has to end the deflate stream.
+        # Independent blocks are complete already, but the file needs at least one
+        if self.buf or not self.independent or self.submitted == 0: self.submit(bytes(self.buf),True)
+        self.buf = bytearray()
+
+        while self.pending:
+            self.output_block()
+        self.pool.shutdown()
+
+        if not self.independent: self.output(struct.pack('<II',self.crc & 0xFFFFFFFF,self.size & 0xFFFFFFFF))
+
+    def abort(self):
+        """Throw away the blocks still being compressed and stop the threads,
+        for when the stream is not going to be finished. Harmless after
+        close(), even one that failed."""
+
+        self.closed = True
+
+        self.pending = []
+        self.pool.shutdown(wait=True,cancel_futures=True)
+
+class C_pgzip_reader:
+    def __init__(self,fileobj,blocks):
+        """Constructor for the C_pgzip_reader class. Initialize the
+        variables that we need to have in order for the class to
+        operate:
+
+        fileobj - the file written by C_pgzip with 'independent' set
+        blocks  - its list of (compressed offset, uncompressed offset)
+        pos     - the current offset in the uncompressed stream"""
+
+        self.fileobj = fileobj
+        self.blocks = blocks
+        self.starts = [b[1] for b in blocks]
+        self.pos = 0
+        self.current = -1
+        self.data = b''
+
+    def load(self,i):
+        """Decompress block 'i', which is a gzip member of its own."""
+
+        self.fileobj.seek(self.blocks[i][0])
+        if i + 1 < len(self.blocks):
+            raw = self.fileobj.read(self.blocks[i + 1][0] - self.blocks[i][0])
+        else:
+            raw = self.fileobj.read()
+
+        self.data = zlib.decompress(raw,16 + zlib.MAX_WBITS)
+        self.current = i
+
+    def seek(self,offset,whence=0):
+        if whence == 1: offset = self.pos + offset
+        self.pos = offset
+        return self.pos
+
+    def tell(self):
+        return self.pos
+
+    def read(self,size=-1):
+        """Read up to 'size' bytes (or everything) from the current offset."""
+
+        out = []
+        while size != 0:
+            i = bisect.bisect_right(self.starts,self.pos) - 1
+            if i < 0: break
+            if i != self.current: self.load(i)
+
+            start = self.pos - self.starts[i]
+            if start >= len(self.data): break   # the end of the stream
+
+            if size < 0:
+                chunk = self.data[start:]
+            else:
+                chunk = self.data[start:start + size]
+                size = size - len(chunk)
+            out.append(chunk)
+            self.pos = self.pos + len(chunk)
+
+        return b''.join(out)
+
+    def close(self):
+        self.fileobj.close()
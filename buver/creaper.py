@@ -0,0 +1,156 @@
+import os
+import stat
+import threading
+import time
+
+from buver.cwalker import C_walker
+
+"""
+This module contains the code for the reaper class.
+
+Removing an old version can take longer than making a new one, especially
+for 'tree' and 'link' versions with millions of files. So instead of
+removing expired versions while the job holds the tgt_loc semaphore, the
+prune process (see cversions.py) just renames them into the 'trash'
+directory of the tgt_loc, which is instant. The reaper then frees the
+space later, after the backup is done and the semaphore is released.
+
+The reaper walks each directory in the trash and hands the files in each
+directory to a pool of worker threads to unlink, then removes the empty
+directories, deepest first. If the process dies part way through, whatever
+is left in the trash is picked up by the next run.
+
+Only one reaper works on a trash directory at a time. It holds an flock()
+on 'trash/.reaper' while it works, and a second reaper that finds the lock
+taken just returns, leaving the work to the first one. The lock goes away
+if the process dies, so the trash can never be stuck.
+
+If a 'throttle' is given (see cthrottle.py), the unlinks are held to its
+files per second, since removing a file costs about as much as copying
+a small one.
+
+run() - empty the trash, returns 0 on success or 1 if anything failed
+"""
+
+# The number of files handed to a worker thread at a time
+BATCH_SIZE = 256
+
+class C_reaper:
+    def __init__(self,msg,trash_dir,threads=4,throttle=None):
+        """Constructor for the C_reaper class. Initialize the
+        variables that we need to have in order for the class to
+        operate:
+
+        msgout    - the generic message handler for printing output
+        trash_dir - the trash directory we are emptying
+        threads   - the number of worker threads doing the unlinks
+        throttle  - the C_throttle that limits the unlinks (or None)
+        files     - the number of files (and links) removed
+        freed     - the number of bytes freed (estimated from the blocks
+                    of files whose last link we removed)
+        errors    - the number of items we could not remove"""
+
+        self.msgout = msg
+        self.trash_dir = os.path.abspath(trash_dir)
+        self.threads = max(1,int(threads))
+        self.throttle = throttle
+        self.files = 0
+        self.freed = 0
+        self.errors = 0
+        self.lock = threading.Lock()
+
+    def pending(self):
+        """Return the list of items in the trash waiting to be removed."""
+
+        if not os.path.isdir(self.trash_dir): return []
+
+        return [name for name, type in C_walker().read(self.trash_dir) if name != '.reaper']
+
+    def unlink_batch(self,root,names):
+        """Worker thread entry point. Remove a batch of files from one directory."""
+
+        files = 0
+        freed = 0
+        errors = 0
+        for name in names:
+            path = os.path.join(root,name)
+            if self.throttle: self.throttle.files()
+            try:
+                st = os.lstat(path)
+                os.unlink(path)
+                files = files + 1
+                # a file only frees its space when the last link goes away
+                if st.st_nlink <= 1 and stat.S_ISREG(st.st_mode):
+                    if hasattr(st,'st_blocks'):
+                        freed = freed + st.st_blocks * 512
+                    else:
+                        freed = freed + st.st_size
+            except OSError:
+                if os.path.lexists(path): errors = errors + 1
+
+        with self.lock:
+            self.files = self.files + files
+            self.freed = self.freed + freed
+            self.errors = self.errors + errors
+
+    def remove(self,pool,top):
+        """Remove the tree 'top', using the pool for the file unlinks."""
+
+        if not os.path.isdir(top) or os.path.islink(top):
+            self.unlink_batch(os.path.dirname(top),[os.path.basename(top)])
+            return
+
+        dirs = []
+        jobs = []
+        # symbolic links to directories are listed with the names, so they are removed as files
+        for root, subdirs, names in C_walker(None,self.threads).walk(top):
+            dirs.append(root)
+
+            for i in range(0,len(names),BATCH_SIZE):
+                jobs.append(pool.submit(self.unlink_batch,root,names[i:i + BATCH_SIZE]))
+
+        for job in jobs: job.result()
+
+        # the directories are empty now, remove them deepest first
+        for d in reversed(dirs):
+            try:
+                os.rmdir(d)
+            except OSError:
+                if os.path.isdir(d): self.errors = self.errors + 1
+
+    def run(self):
+        """Empty the trash. Returns 0 on success or 1 if anything failed."""
+
+        from concurrent.futures import ThreadPoolExecutor
+
+        items = self.pending()
+        if not items: return 0
+
+        lock_fd = None
+        try:
+            import fcntl
+            lock_fd = os.open(os.path.join(self.trash_dir,'.reaper'),os.O_CREAT|os.O_RDWR,0o644)
+            fcntl.flock(lock_fd,fcntl.LOCK_EX|fcntl.LOCK_NB)
+        except ImportError:
+            pass    # no flock() on this platform, just go ahead
+        except (IOError,OSError):
+            if lock_fd is not None: os.close(lock_fd)
+            self.msgout('Another process is already emptying the trash <%s>' % self.trash_dir)
+            return 0
+
+        self.msgout('Emptying %d item(s) from the trash <%s> ...' % (len(items),self.trash_dir))
+
+        start = time.time()
+        try:
+            with ThreadPoolExecutor(max_workers=self.threads) as pool:
+                for item in self.pending():
+                    self.remove(pool,os.path.join(self.trash_dir,item))
+        finally:
+            if lock_fd is not None: os.close(lock_fd)
+
+        elapsed = max(time.time() - start,0.001)
+        self.msgout('Removed %d files, freed %d bytes in %.2f seconds (%.1f files/sec, %.2f MB/sec), %d errors' %
+                    (self.files,self.freed,elapsed,self.files / elapsed,self.freed / elapsed / (1 << 20),self.errors))
+
+        if self.errors: return 1
+        return 0
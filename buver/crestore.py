@@ -0,0 +1,448 @@
+import os
+import stat
+import tarfile
+import threading
+import time
+
+from buver.cversions import C_versions
+from buver.ccopytree import C_copytree
+from buver.cchunkstore import C_chunkstore
+from buver.carchive import load_members, load_blocks, open_archive
+from buver.cwalker import C_walker
+from buver.cdelta import DELTA_DIR, load_deltas, apply_delta
+from buver.cmanifest import C_manifest
+
+"""
+This module contains the code for the restore class.
+
+The restore class copies a version back out of a tgt_loc. It can restore
+the whole version, or just some paths from it (a path selects everything
+underneath it as well). The paths are relative to the src_dir, the same as
+in the manifest, and they are restored under the same relative path in the
+destination directory. Nothing that already exists in the destination is
+overwritten; those items are reported as errors.
+
+How the version is read depends on what kind of version it is:
+
+    tree, link - the files are copied back by the copy engine (see
+                 ccopytree.py), using a pool of worker threads. Files that
+                 were stored as deltas (see cdelta.py) are put back together
+                 from their delta and its base.
+    tar, gzip, bgzf - if the version has a member index (written by the
+                 builtin engine, see carchive.py), the archive is read only at
+                 the members that were asked for, in archive order. A 'tar'
+                 archive is seeked straight to them, and so is a 'bgzf' one,
+                 where only the blocks that hold them are decompressed. A
+                 compressed archive without a block index cannot seek without
+                 decompressing from the start again, so it is read once, from
+                 the start, and nothing past the last member asked for is
+                 read. Restoring everything reads the archive once as well.
+                 Archives made by 'tar_cmd' or 'gzip_cmd' have no index, and
+                 are scanned from start to end.
+    dedup      - the files are put back together from the chunk store,
+                 using the recipe of the version and a pool of worker threads
+
+The version is worked out from the versions directory (see cversions.py),
+so the buver.conf (and the src_dir) do not need to be there. This matters,
+because the src_dir may be the very thing that was lost.
+
+The restore does not take the tgt_loc semaphore, so that it never has to
+wait for a backup to finish. A backup that runs at the same time may prune
+the oldest version, so do not restore that one while a backup is running.
+
+execute() - do the restore, returns 0 on success or 1 if anything failed
+"""
+
+def extract_filter(member,dest_path):
+    """The tarfile extraction filter for restores. Refuses the members that
+    would land outside 'dest_path', and the hard links to files outside of it,
+    but keeps the rest as it was backed up. The 'tar' filter would clear the
+    setuid, setgid and sticky bits, and the group and other write bits."""
+
+    new = tarfile.tar_filter(member,dest_path)
+    if member.islnk():
+        dest_path = os.path.realpath(dest_path)
+        target = os.path.realpath(os.path.join(dest_path,member.linkname))
+        if os.path.commonpath([target,dest_path]) != dest_path:
+            raise tarfile.LinkOutsideDestinationError(member,target)
+    if member.mode is not None and new.mode != member.mode: new = new.replace(mode=member.mode,deep=False)
+    return new
+
+# tarfile got extraction filters in Python 3.12 (and some older maintenance
+# releases). Without them, nothing is refused or changed.
+EXTRACT_ARGS = {}
+if hasattr(tarfile,'tar_filter'): EXTRACT_ARGS = {'filter':extract_filter}
+
+class C_restore:
+    def __init__(self,msg,tgt_loc,dest_dir,version=None,paths=None,threads=8):
+        """Constructor for the C_restore class. Initialize the
+        variables that we need to have in order for the class to
+        operate:
+
+        msgout   - the generic message handler for printing output
+        tgt_loc  - the tgt_loc area we are restoring from
+        dest_dir - where the files are restored to
+        version  - the version to restore (None means the latest one)
+        paths    - the paths to restore (None or empty means everything)
+        threads  - the number of worker threads doing the copies
+        files    - the number of files restored
+        nbytes   - the number of bytes restored
+        errors   - the number of items we could not restore"""
+
+        self.msgout = msg
+        self.tgt_loc = os.path.abspath(tgt_loc)
+        self.dest_dir = os.path.abspath(dest_dir)
+        self.version = version
+        self.paths = [self.clean_path(p) for p in (paths or [])]
+        self.threads = max(1,int(threads))
+        self.files = 0
+        self.nbytes = 0
+        self.errors = 0
+        self.lock = threading.Lock()
+
+    def clean_path(self,path):
+        """Make a path from the command line relative to the src_dir."""
+
+        path = os.path.normpath(path.strip('/'))
+        if path == '': path = '.'
+        return path
+
+    def count(self,files=0,nbytes=0,errors=0):
+        """Update the statistics. This is called from the worker threads."""
+
+        with self.lock:
+            self.files = self.files + files
+            self.nbytes = self.nbytes + nbytes
+            self.errors = self.errors + errors
+
+    def selected(self,rel):
+        """Return True if the item at 'rel' is one of the ones to restore."""
+
+        if not self.paths or '.' in self.paths: return True
+
+        for path in self.paths:
+            if rel == path or rel.startswith(path + os.sep): return True
+
+        return False
+
+    def find_version(self):
+        """Return the path of the version to restore, or None."""
+
+        versions = C_versions(self.msgout,os.path.join(self.tgt_loc,'versions'))
+        numbers = sorted([int(v) for v in versions.dirlist if v.isdigit()])
+        if not numbers:
+            self.msgout('There are no versions in <%s>' % versions.verdir)
+            return None
+
+        version = self.version
+        if version is None: version = numbers[-1]
+        if int(version) not in numbers:
+            self.msgout('Version <%s> does not exist, the versions are %s' % (version,numbers))
+            return None
+
+        return os.path.join(versions.verdir,str(version))
+
+    def target(self,rel):
+        """Return where the item at 'rel' is restored to, making its parent directories."""
+
+        dst = os.path.normpath(os.path.join(self.dest_dir,rel))
+        parent = os.path.dirname(dst)
+        if not os.path.isdir(parent): os.makedirs(parent)
+
+        return dst
+
+    def restore_tree(self,tree,version):
+        """Restore from a 'tree' or 'link' version, 'tree' being the copy of the src_dir."""
+
+        from concurrent.futures import ThreadPoolExecutor
+
+        # restoring everything is the same as restoring every top level item
+        paths = self.paths
+        if not paths or '.' in paths:
+            subdirs, files = C_walker().listdir(tree)
+            paths = sorted(subdirs + files)
+
+        deltas = load_deltas(version)
+
+        copier = C_copytree(self.msgout,tree,self.dest_dir,threads=self.threads)
+        jobs = []
+
+        with ThreadPoolExecutor(max_workers=self.threads) as pool:
+            for rel in paths:
+                src = os.path.join(tree,rel)
+                if rel in deltas: continue      # put back together below
+                try:
+                    st = os.lstat(src)
+                    dst = self.target(rel)
+                except OSError:
+                    self.msgout('<%s> is not in the version' % rel)
+                    self.count(errors=1)
+                    continue
+
+                # a directory gets a copy engine of its own, which has its own pool
+                if stat.S_ISDIR(st.st_mode):
+                    subtree = C_copytree(self.msgout,src,dst,threads=self.threads)
+                    if subtree.run(): self.count(errors=1)
+                    self.count(files=subtree.files,nbytes=subtree.nbytes)
+                else:
+                    jobs.append(pool.submit(copier.copy_batch,os.path.dirname(src),os.path.dirname(dst),
+                                            os.path.dirname(rel),[os.path.basename(rel)]))
+
+            for job in jobs: job.result()
+
+        self.count(files=copier.files,nbytes=copier.nbytes,errors=copier.errors)
+
+        wanted = [rel for rel in sorted(deltas) if self.selected(rel)]
+        if wanted: self.restore_deltas(version,deltas,wanted)
+
+    def restore_deltas(self,version,deltas,wanted):
+        """Put the files in 'wanted', which were stored as deltas, back together."""
+
+        from concurrent.futures import ThreadPoolExecutor
+
+        manifest = C_manifest(version)
+        if manifest.load():
+            self.msgout('Unable to load the manifest of <%s>, needed for the delta files' % version)
+            self.count(errors=len(wanted))
+            return
+
+        self.msgout('Putting %d delta files back together ...' % len(wanted))
+        with ThreadPoolExecutor(max_workers=self.threads) as pool:
+            for job in [pool.submit(self.restore_delta,version,rel,deltas[rel],manifest.get(rel)) for rel in wanted]:
+                job.result()
+
+        # adding the files changed the times of their directories, so put them back
+        for parent in sorted(set([os.path.dirname(rel) for rel in wanted]),reverse=True):
+            rec = manifest.get(parent or '.')
+            if rec is None: continue
+            try:
+                os.utime(os.path.join(self.dest_dir,parent),ns=(rec.mtime,rec.mtime))
+            except OSError:
+                pass
+
+    def restore_delta(self,version,rel,did,rec):
+        """Worker thread entry point. Put one delta file back together."""
+
+        name = os.path.join(version,DELTA_DIR,did)
+        try:
+            if rec is None: raise IOError('it is not in the manifest')
+            dst = self.target(rel)
+            fout = os.open(dst,os.O_WRONLY|os.O_CREAT|os.O_EXCL|getattr(os,'O_BINARY',0),0o600)
+            try:
+                nbytes = apply_delta(name + '.delta',name + '.base',lambda data: os.write(fout,data))
+            finally:
+                os.close(fout)
+
+            try:
+                if hasattr(os,'chown'): os.chown(dst,rec.uid,rec.gid)
+            except OSError:
+                pass    # only works with sufficient privilege, like 'cp -p'
+            os.chmod(dst,stat.S_IMODE(rec.mode))
+            os.utime(dst,ns=(rec.mtime,rec.mtime))
+            self.count(files=1,nbytes=nbytes)
+        except (IOError,OSError,ValueError) as e:
+            self.msgout('Unable to restore <%s>: %s' % (rel,e))
+            self.count(errors=1)
+
+    def extract(self,tar,member,dirs):
+        """Extract one member from the open tarfile 'tar'."""
+
+        try:
+            # tarfile would replace it, the other kinds of version never do
+            if not member.isdir() and os.path.lexists(os.path.join(self.dest_dir,member.name)):
+                raise IOError('it already exists')
+            tar.extract(member,self.dest_dir,**EXTRACT_ARGS)
+            if member.isdir():
+                dirs.append(member)
+            else:
+                self.count(files=1,nbytes=member.size)
+        except (IOError,OSError,tarfile.TarError) as e:
+            self.msgout('Unable to restore <%s>: %s' % (member.name,e))
+            self.count(errors=1)
+
+    def restore_archive(self,archive,version):
+        """Restore from a 'tar', 'gzip' or 'bgzf' version."""
+
+        dirs = []
+        members = load_members(version)
+        blocks = load_blocks(version)
+
+        # only seek when it is cheap: in a plain tar, or in a 'bgzf' archive with its block index
+        if members is not None:
+            wanted = [m for m in members if self.selected(m[2])]
+            self.msgout('Restoring %d of the %d members of <%s> ...' % (len(wanted),len(members),archive))
+            seekable = blocks or os.path.splitext(archive)[1] not in ['.gz','.bz2','.xz']
+            if len(wanted) == len(members) or not seekable:
+                self.stream_archive(open_archive(archive),set([m[2] for m in wanted]),dirs)
+            else:
+                self.seek_archive(open_archive(archive,blocks),wanted,dirs)
+        else:
+            # no index, so read through the whole archive
+            self.msgout('No member index for <%s>, scanning the whole archive ...' % archive)
+            self.stream_archive(open_archive(archive),None,dirs)
+
+        # set the directory times last, extracting the files into them changed them
+        for member in reversed(dirs):
+            try:
+                os.utime(os.path.join(self.dest_dir,member.name),(member.mtime,member.mtime))
+            except OSError:
+                pass
+
+    def stream_archive(self,f,wanted,dirs):
+        """Read the archive in 'f' once, from the start, and extract the members
+        that are selected as they go by. If 'wanted' is the set of their paths,
+        stop once the last of them has been seen."""
+
+        try:
+            if wanted is not None and not wanted: return
+            tar = tarfile.open(fileobj=f,mode='r|')
+            for member in tar:
+                rel = os.path.normpath(member.name)
+                if wanted is None:
+                    if self.selected(rel): self.extract(tar,member,dirs)
+                elif rel in wanted:
+                    self.extract(tar,member,dirs)
+                    wanted.discard(rel)
+                    if not wanted: break
+            tar.close()
+        finally:
+            f.close()
+
+        if wanted:
+            self.msgout('%d members in the member index are not in the archive' % len(wanted))
+            self.count(errors=len(wanted))
+
+    def seek_archive(self,f,wanted,dirs):
+        """Extract the members in 'wanted', a list of (offset, size, path) from
+        the member index, by seeking 'f' straight to each of them."""
+
+        try:
+            for offset, size, rel in wanted:
+                f.seek(offset)
+                tar = tarfile.open(fileobj=f,mode='r|')
+                member = tar.next()
+                if member is None or os.path.normpath(member.name) != rel:
+                    self.msgout('The member index does not match the archive at <%s>' % rel)
+                    self.count(errors=1)
+                    continue
+                self.extract(tar,member,dirs)
+        finally:
+            f.close()
+
+    def restore_file(self,chunks,rec):
+        """Worker thread entry point. Put one file back together from its chunks."""
+
+        dst = self.target(rec['path'])
+        try:
+            fout = os.open(dst,os.O_WRONLY|os.O_CREAT|os.O_EXCL|getattr(os,'O_BINARY',0),0o600)
+            try:
+                nbytes = 0
+                for cid in rec['chunks']:
+                    data = chunks.get(cid)
+                    os.write(fout,data)
+                    nbytes = nbytes + len(data)
+            finally:
+                os.close(fout)
+            self.set_attrs(dst,rec)
+            self.count(files=1,nbytes=nbytes)
+        except (IOError,OSError) as e:
+            self.msgout('Unable to restore <%s>: %s' % (rec['path'],e))
+            self.count(errors=1)
+
+    def set_attrs(self,path,rec,symlink=False):
+        """Set the ownership, mode and modification time recorded in a recipe record."""
+
+        try:
+            if hasattr(os,'lchown'):
+                if symlink:
+                    os.lchown(path,rec['uid'],rec['gid'])
+                else:
+                    os.chown(path,rec['uid'],rec['gid'])
+        except OSError:
+            pass    # only works with sufficient privilege, like 'cp -p'
+
+        if symlink: return
+        os.chmod(path,stat.S_IMODE(rec['mode']))
+        os.utime(path,(rec['mtime'],rec['mtime']))
+
+    def restore_dedup(self,version):
+        """Restore from a 'dedup' version, using its recipe and the chunk store."""
+
+        from concurrent.futures import ThreadPoolExecutor
+
+        chunks = C_chunkstore(self.msgout,self.tgt_loc)
+        dirs = []
+        jobs = []
+
+        with ThreadPoolExecutor(max_workers=self.threads) as pool:
+            for rec in chunks.recipe(version):
+                if not self.selected(rec['path']): continue
+
+                try:
+                    if rec['type'] == 'd':
+                        dst = self.target(rec['path'])
+                        if not os.path.isdir(dst): os.mkdir(dst)
+                        dirs.append((dst,rec))
+                    elif rec['type'] == 'l':
+                        dst = self.target(rec['path'])
+                        os.symlink(rec['target'],dst)
+                        self.set_attrs(dst,rec,True)
+                    else:
+                        jobs.append(pool.submit(self.restore_file,chunks,rec))
+                except (IOError,OSError) as e:
+                    self.msgout('Unable to restore <%s>: %s' % (rec['path'],e))
+                    self.count(errors=1)
+
+            for job in jobs: job.result()
+
+        # the directories are full now, set their modes and times (deepest first)
+        for dst, rec in reversed(dirs):
+            try:
+                self.set_attrs(dst,rec)
+            except OSError:
+                self.count(errors=1)
+
+    def find_archive(self,version):
+        """Return the archive in a 'tar', 'gzip' or 'bgzf' version, or None."""
+
+        for suffix in ['','.gz','.bz2','.xz']:
+            archive = os.path.join(version,'backup.tar%s' % suffix)
+            if os.path.isfile(archive): return archive
+
+        return None
+
+    def execute(self):
+        """Restore the version. Returns 0 on success or 1 if anything failed."""
+
+        version = self.find_version()
+        if version is None: return 1
+
+        what = 'everything'
+        if self.paths: what = ', '.join(self.paths)
+        self.msgout('Restoring %s from <%s> to <%s>' % (what,version,self.dest_dir))
+
+        start = time.time()
+        try:
+            if not os.path.isdir(self.dest_dir): os.makedirs(self.dest_dir)
+
+            if os.path.isfile(os.path.join(version,'recipe')):
+                self.restore_dedup(version)
+            elif self.find_archive(version):
+                self.restore_archive(self.find_archive(version),version)
+            else:
+                # a tree version holds one directory, the copy of the src_dir (and maybe the deltas)
+                trees = [d for d in C_walker().listdir(version)[0] if d != DELTA_DIR]
+                if len(trees) != 1:
+                    self.msgout('Unable to tell what kind of version <%s> is' % version)
+                    return 1
+                self.restore_tree(os.path.join(version,trees[0]),version)
+        except (IOError,OSError,tarfile.TarError) as e:
+            self.msgout('Restore from <%s> failed: %s' % (version,e))
+            return 1
+
+        elapsed = max(time.time() - start,0.001)
+        self.msgout('Restored %d files (%d bytes) in %.2f seconds (%.1f files/sec, %.2f MB/sec), %d errors' %
+                    (self.files,self.nbytes,elapsed,self.files / elapsed,self.nbytes / elapsed / (1 << 20),self.errors))
+
+        if self.errors: return 1
+        return 0
@@ -0,0 +1,209 @@
+import os
+import threading
+import time
+
+from buver.cbuver import C_buver
+from buver.cbuconfig import C_buconfig
+
+"""
+This module contains the code for the scheduler class.
+
+The scheduler runs the backups for many tgt_locs from one process, instead
+of starting a separate 'buver -b tgt_loc' for each of them. It reads a
+jobs file, builds a C_buver object for each job, and runs them on a pool
+of worker threads.
+
+The jobs file has one job per line. Blank lines and lines that start with
+'#' are ignored:
+
+    tgt_loc [priority=<n>] [device=<name>]
+
+    priority - jobs with a higher priority are started first (default 0).
+               Jobs with the same priority start in the order listed.
+    device   - the name of the storage the job uses. By default, this is
+               worked out from the devices that hold the tgt_loc and the
+               src_dir (from its buver.conf).
+
+Two limits control how hard the storage is pushed. At most 'workers' jobs
+run at the same time, and at most 'per_device' jobs that use the same
+device run at the same time. When a job finishes, the highest priority
+job that fits within both limits is started next.
+
+When everything is done, a table with the result of every job is printed.
+
+execute() - run all the jobs, returns the number of jobs that failed
+"""
+
+class C_job:
+    """The state of one job in the jobs file."""
+
+    def __init__(self,order,tgt_loc,priority=0,devices=None):
+        self.order = order
+        self.tgt_loc = os.path.abspath(tgt_loc)
+        self.priority = priority
+        self.devices = devices or []
+        self.rc = None
+        self.elapsed = 0.0
+
+class C_scheduler:
+    def __init__(self,msg,jobs_file,workers=4,per_device=1,lock='file',lock_timeout=120):
+        """Constructor for the C_scheduler class. Initialize the
+        variables that we need to have in order for the class to
+        operate:
+
+        msgout     - the generic message handler for printing output
+        jobs_file  - the file that lists the jobs
+        workers    - the number of jobs that may run at the same time
+        per_device - the number of jobs that may use one device at a time
+        lock       - how each tgt_loc is locked (see csemaphore.py)
+        lock_timeout - how many seconds each job waits for its lock
+        jobs       - the list of C_job objects"""
+
+        self.msgout = msg
+        self.jobs_file = jobs_file
+        self.workers = max(1,int(workers))
+        self.per_device = max(1,int(per_device))
+        self.lock = lock
+        self.lock_timeout = lock_timeout
+        self.jobs = []
+        self.busy = {}      # device -> number of running jobs using it
+        self.running = 0
+        self.cv = threading.Condition()
+
+    def job_devices(self,tgt_loc):
+        """Work out the devices a job uses: the one holding the tgt_loc,
+        and the one holding the src_dir in its buver.conf."""
+
+        devices = []
+        for path in [tgt_loc,self.src_dir(tgt_loc)]:
+            try:
+                dev = 'dev:%d' % os.stat(path).st_dev
+                if dev not in devices: devices.append(dev)
+            except (OSError,TypeError):
+                pass
+
+        return devices
+
+    def src_dir(self,tgt_loc):
+        """Return the src_dir from the buver.conf of tgt_loc, or None."""
+
+        config = C_buconfig(lambda msg: 0,tgt_loc)
+        if config.load(): return None
+
+        return config.opt_src_dir()
+
+    def load(self):
+        """Read the jobs file. Returns 0 on success or 1 otherwise."""
+
+        try:
+            lines = open(self.jobs_file,'r').readlines()
+        except IOError:
+            self.msgout('Unable to read the jobs file <%s>' % self.jobs_file)
+            return 1
+
+        for line in lines:
+            x = line.split()
+            if not x or x[0][0] == '#': continue
+
+            job = C_job(len(self.jobs),x[0])
+            for opt in x[1:]:
+                key, sep, val = opt.partition('=')
+                try:
+                    if key == 'priority':
+                        job.priority = int(val)
+                    elif key == 'device':
+                        job.devices = [val]
+                    else:
+                        self.msgout('Unknown job option <%s> for <%s>. Ignoring ...' % (opt,x[0]))
+                except ValueError:
+                    self.msgout('Invalid job option <%s> for <%s>. Ignoring ...' % (opt,x[0]))
+
+            if not job.devices: job.devices = self.job_devices(job.tgt_loc)
+            self.jobs.append(job)
+
+        return 0
+
+    def fits(self,job):
+        """Return True if 'job' can start now without going over the limits."""
+
+        if self.running >= self.workers: return False
+
+        for dev in job.devices:
+            if self.busy.get(dev,0) >= self.per_device: return False
+
+        return True
+
+    def run_job(self,job):
+        """Worker thread entry point. Run one backup job."""
+
+        start = time.time()
+        buver = None
+        try:
+            buver = C_buver(1,job.tgt_loc,os.path.basename(job.tgt_loc),self.lock,self.lock_timeout)
+            job.rc = buver.execute() or 0
+        except Exception as e:
+            self.msgout('Job <%s> failed: %s' % (job.tgt_loc,e))
+            job.rc = -1
+        finally:
+            # a run can have hundreds of jobs, so do not keep their log files open until we exit
+            if buver: buver.close()
+        job.elapsed = time.time() - start
+
+        with self.cv:
+            self.running = self.running - 1
+            for dev in job.devices:
+                self.busy[dev] = self.busy[dev] - 1
+            self.cv.notify()
+
+    def execute(self):
+        """Run all the jobs, then print the results.
+        Returns the number of jobs that failed (see report())."""
+
+        if self.load(): return 1
+
+        self.msgout('Running %d jobs, %d at a time, %d per device' % (len(self.jobs),self.workers,self.per_device))
+
+        pending = sorted(self.jobs,key=lambda job: (-job.priority,job.order))
+        threads = []
+        start = time.time()
+
+        with self.cv:
+            while pending:
+                job = None
+                for candidate in pending:
+                    if self.fits(candidate):
+                        job = candidate
+                        break
+
+                # nothing can start right now, wait for a job to finish
+                if job is None:
+                    self.cv.wait()
+                    continue
+
+                pending.remove(job)
+                self.running = self.running + 1
+                for dev in job.devices:
+                    self.busy[dev] = self.busy.get(dev,0) + 1
+
+                t = threading.Thread(target=self.run_job,args=(job,))
+                t.start()
+                threads.append(t)
+
+        for t in threads: t.join()
+
+        return self.report(time.time() - start)
+
+    def report(self,elapsed):
+        """Print the results table. Returns the number of jobs that failed,
+        but at most 255, since it is the exit code and 256 would be 0."""
+
+        failed = len([job for job in self.jobs if job.rc])
+
+        self.msgout('%-6s %-5s %9s  %s' % ('RESULT','RC','SECONDS','TGT_LOC'))
+        for job in self.jobs:
+            status = 'OK'
+            if job.rc: status = 'FAILED'
+            self.msgout('%-6s %-5s %9.2f  %s' % (status,job.rc,job.elapsed,job.tgt_loc))
+
+        self.msgout('%d jobs, %d failed, %.2f seconds' % (len(self.jobs),failed,elapsed))
+        return min(failed,255)
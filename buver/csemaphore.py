@@ -1,112 +1,347 @@
-import os
-import time
-
-"""
-This module implements the semaphore class which is used by buver.py.
-
-These semaphores are implemented via the operating system's well known
-file IO interfaces. In our case, we use the OS open() API along with
-the O_CREAT flag, which guarantees that only one process or thread will
-ever succeed.
-
-The file is kept open during the entire duration of the process, and
-is closed and then removed when the application is ready to give up the
-semaphore.
-
-wait() - create a new file in the target directory. keep it open ...
-signal() - close the file created during wait(), then remove it
-got_sem() - this API is used to return the current lock state
-
-NOTE:
-
-This implementation could cause starvation amongst processes, if
-enough processes are simultaneously trying to access the same target
-directory. However, this should not be the case in our situation, so
-we are not handling that case at this time.
-"""
-
-class C_semaphore:
-    def __init__(self,path,filename='csemaphore.lock'):
-        """Initialize the object by establishing a name for the mutex,
-        the path we want to apply the mutex to, and a flag that is
-        used to provide a quick state of the object."""
-        
-        self.sem_name = os.path.abspath(os.path.join(path,filename))
-        self.sem_path = path
-        self.sem_locked = False
-        
-    def got_sem(self):
-        """This will return the state of the sem_locked flag."""
-        
-        return self.sem_locked
-        
-    def wait(self, maxtries = 120):
-        """This is the method that obtains the mutex. It will
-        keep trying for 'maxtries' seconds, at which point it
-        gives up and returns a failure condition.
-        
-        Returns:
-            0 - The semaphore was acquired
-            1 - Unable to acquire the semaphore
-        """
-        
-        attempt = 1
-        got_it = 0
-        
-        # If the directory is invalid, then just give up now.
-        if not os.path.isdir(self.sem_path): return True
-
-        # Try until we get it or we exceed the max tries ...
-        while got_it == 0 and attempt < maxtries:
-            try:
-                # This will throw an OSError exception when it fails
-                self.fd = os.open(self.sem_name,os.O_CREAT|os.O_EXCL)
-                
-            except OSError:
-                # We didn't get it. Increment the number of tries and sleep for 1 second
-                attempt = attempt + 1
-                time.sleep(1)
-                continue
-                
-            # Woo Hoo! We acquired the semaphore, set our flag so we'll exit
-            got_it = 1
-            
-        if not got_it: return True
-
-        # Record the object state to reflect we own the semaphore
-        self.sem_locked = True
-        
-        return False
-
-    def signal(self):
-        """This is the method that releases the mutex.
-        
-        Returns:
-            0 - The semaphore was released
-            1 - Unable to release the semaphore
-        """
-        
-        # if the object doesn't reflect that we have the semaphore, bail
-        if self.sem_locked == False: return True
-        
-        # Close the open file handle, catch any exceptions, but basically
-        # just print an error and keep going.
-        try:
-            os.close(self.fd)
-        except OSError:
-            print('Internal failure during semaphore release - close')
-            
-        # Remove the file. This will allow the next call to wait() to succeed
-        # since the file will no longer exist. Catch any exceptions, but
-        # basically ignore them. If we cannot delete it, then that means some
-        # manual clean up is going to be required.
-        try:
-            os.remove(self.sem_name)
-        except OSError:
-            print('Internal failure during semaphore release - remove')
-
-        # Reflect that we have released our semaphore. This is here so that if
-        # the atexit() routine runs and attempts to release the semaphore, we
-        # will ignore the request. It isn't useful for anything else.
-        self.sem_locked = False
-        return False
+
+import os
+import time
+
+from buver.cwalker import C_walker
+
+"""
+This module implements the semaphore class which is used by buver.py.
+
+These semaphores are implemented via the operating system's well known
+file IO interfaces. There are two ways the lock can be taken, selected
+with the 'mode' argument of the constructor:
+
+'file' (the default, and the original implementation)
+
+    We use the OS open() API along with the O_CREAT|O_EXCL flags, which
+    guarantees that only one process or thread will ever succeed. The file
+    is kept open during the entire duration of the process, and is closed
+    and then removed when the application is ready to give up the
+    semaphore. Waiters retry once a second.
+
+'flock'
+
+    The lock is an flock() on '<filename>.flock', which the kernel hands
+    to the next waiter as soon as it is released (or the holder dies), so
+    nobody sits idle waiting for their next retry. flock() itself is not
+    fair, so the waiters line up in a queue first: each one takes a ticket
+    from '<filename>.queue/tail', creates and locks its own node file
+    '<filename>.queue/<ticket>', and then blocks on the node of the waiter
+    ahead of it. When that node is released, it is this waiter's turn, and
+    it goes on to take the real lock. That gives first come, first served
+    ordering, with each handoff costing only a couple of system calls. If
+    a waiter gives up, or dies, its node is released as well, and the
+    flock() on the real lock still guarantees mutual exclusion.
+
+    Each waiter removes the node of the one ahead of it once it has its
+    turn. When the holder releases the lock with nobody queued behind it,
+    it removes its own node, the tail and the queue directory, so an idle
+    tgt_loc keeps nothing but '<filename>.flock'. It does that while it
+    holds the tail lock, and a waiter that took the tail lock on a file
+    that has since been removed starts again with a new one.
+
+    flock() has no timeout, so each one blocks in a helper thread, which
+    the waiter waits for with its timeout. That works the same from any
+    thread, including the worker threads of 'buver --jobs' and the daemon.
+
+    The two modes use different files, so every job that shares a tgt_loc
+    must use the same mode.
+
+wait() - acquire the lock, giving up after 'maxtries' seconds
+signal() - release the lock
+got_sem() - this API is used to return the current lock state
+
+NOTE:
+
+In 'file' mode, this implementation could cause starvation amongst
+processes, if enough processes are simultaneously trying to access the
+same target directory. Use 'flock' mode when many jobs queue on the same
+target.
+"""
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None    # no flock() on this platform, only 'file' mode is available
+
+class C_semaphore:
+    def __init__(self,path,filename='csemaphore.lock',mode='file'):
+        """Initialize the object by establishing a name for the mutex,
+        the path we want to apply the mutex to, and a flag that is
+        used to provide a quick state of the object. 'mode' is 'file'
+        or 'flock' (see above); 'flock' falls back to 'file' on
+        platforms that do not have it."""
+        
+        self.sem_name = os.path.abspath(os.path.join(path,filename))
+        self.sem_path = path
+        self.sem_locked = False
+        
+        self.mode = mode
+        if mode != 'flock' or fcntl is None: self.mode = 'file'
+        self.flock_name = '%s.flock' % self.sem_name
+        self.queue_dir = '%s.queue' % self.sem_name
+        self.ticket = None
+        
+    def got_sem(self):
+        """This will return the state of the sem_locked flag."""
+        
+        return self.sem_locked
+        
+    def wait(self, maxtries = 120):
+        """This is the method that obtains the mutex. It will
+        keep trying for 'maxtries' seconds, at which point it
+        gives up and returns a failure condition.
+        
+        Returns:
+            0 - The semaphore was acquired
+            1 - Unable to acquire the semaphore
+        """
+        
+        # If the directory is invalid, then just give up now.
+        if not os.path.isdir(self.sem_path): return True
+
+        if self.mode == 'flock': return self.wait_flock(maxtries)
+        
+        attempt = 1
+        got_it = 0
+        
+        # Try until we get it or we exceed the max tries ...
+        while got_it == 0 and attempt < maxtries:
+            try:
+                # This will throw an OSError exception when it fails
+                self.fd = os.open(self.sem_name,os.O_CREAT|os.O_EXCL)
+                
+            except OSError:
+                # We didn't get it. Increment the number of tries and sleep for 1 second
+                attempt = attempt + 1
+                time.sleep(1)
+                continue
+                
+            # Woo Hoo! We acquired the semaphore, set our flag so we'll exit
+            got_it = 1
+            
+        if not got_it: return True
+
+        # Record the object state to reflect we own the semaphore
+        self.sem_locked = True
+        
+        return False
+
+    def flock(self,fd,deadline):
+        """Take an exclusive flock() on 'fd', blocking until it is ours or
+        the 'deadline' (a time.time() value) passes. Returns True if we got it."""
+        
+        import threading
+        
+        # no need for a helper if nobody holds it
+        try:
+            fcntl.flock(fd,fcntl.LOCK_EX|fcntl.LOCK_NB)
+            return True
+        except (IOError,OSError):
+            pass
+        
+        timeout = deadline - time.time()
+        if timeout <= 0: return False
+        
+        # The helper blocks on a dup() of 'fd', which shares its lock, so it
+        # gets the lock for us the moment it is released. If we stop waiting
+        # first, the helper drops the lock as soon as it gets it.
+        helper_fd = os.dup(fd)
+        state = {'got':False,'abandoned':False}
+        mutex = threading.Lock()
+        
+        def take():
+            try:
+                fcntl.flock(helper_fd,fcntl.LOCK_EX)
+                with mutex:
+                    if not state['abandoned']:
+                        state['got'] = True
+                        return
+                fcntl.flock(helper_fd,fcntl.LOCK_UN)
+            except (IOError,OSError):
+                pass
+            finally:
+                os.close(helper_fd)
+        
+        helper = threading.Thread(target=take,daemon=True)
+        helper.start()
+        helper.join(timeout)
+        
+        with mutex:
+            if not state['got']: state['abandoned'] = True
+            return state['got']
+        
+    def take_ticket(self):
+        """Join the end of the queue. Returns our ticket number and the
+        open, locked handle of our node file."""
+        
+        tail_name = os.path.join(self.queue_dir,'tail')
+        while True:
+            try:
+                os.mkdir(self.queue_dir)
+            except OSError:
+                pass    # somebody else already made it
+            
+            try:
+                tail_fd = os.open(tail_name,os.O_RDWR|os.O_CREAT,0o644)
+            except FileNotFoundError:
+                continue    # the last holder just removed the queue, make it again
+            
+            # the tail lock is only held for a moment, while we take a ticket
+            fcntl.flock(tail_fd,fcntl.LOCK_EX)
+            if self.current(tail_fd,tail_name): break
+            os.close(tail_fd)   # it was removed while we waited for it, start again
+        
+        try:
+            data = os.read(tail_fd,32).strip()
+            ticket = int(data or 0) + 1
+            
+            # create and lock our node before anyone can see our ticket
+            node_fd = os.open(os.path.join(self.queue_dir,str(ticket)),os.O_RDWR|os.O_CREAT,0o644)
+            fcntl.flock(node_fd,fcntl.LOCK_EX)
+            
+            os.lseek(tail_fd,0,os.SEEK_SET)
+            os.ftruncate(tail_fd,0)
+            os.write(tail_fd,str(ticket).encode())
+        finally:
+            os.close(tail_fd)
+            
+        return ticket, node_fd
+        
+    def current(self,fd,name):
+        """Return True if the open file 'fd' is still the file called 'name'."""
+        
+        try:
+            return os.path.samestat(os.fstat(fd),os.stat(name))
+        except OSError:
+            return False
+        
+    def wait_flock(self, timeout):
+        """Acquire the mutex in 'flock' mode, waiting our turn in the queue."""
+        
+        deadline = time.time() + timeout
+        
+        try:
+            self.ticket, self.node_fd = self.take_ticket()
+        except (IOError,OSError,ValueError):
+            return True
+        
+        got_it = False
+        try:
+            # wait for the waiter ahead of us to be done. If its node is already
+            # gone, it finished (or gave up) before we got here.
+            pred_name = os.path.join(self.queue_dir,str(self.ticket - 1))
+            try:
+                pred_fd = os.open(pred_name,os.O_RDWR)
+            except OSError:
+                pred_fd = None
+                
+            if pred_fd is not None:
+                try:
+                    if not self.flock(pred_fd,deadline): return True
+                    try:
+                        os.remove(pred_name)    # nobody else will ever look at it
+                    except OSError:
+                        pass
+                finally:
+                    os.close(pred_fd)
+            
+            # It's our turn. Take the real lock; this only waits if a waiter
+            # ahead of us gave up early, and the holder is still working.
+            self.fd = os.open(self.flock_name,os.O_RDWR|os.O_CREAT,0o644)
+            if not self.flock(self.fd,deadline):
+                os.close(self.fd)
+                return True
+            
+            os.ftruncate(self.fd,0)
+            os.write(self.fd,str(os.getpid()).encode())
+            got_it = True
+            
+        finally:
+            # if we did not get it, get out of the line so the next one can go
+            if not got_it: self.leave_queue()
+        
+        # Record the object state to reflect we own the semaphore
+        self.sem_locked = True
+        
+        return False
+        
+    def remove_queue(self):
+        """If nobody is queued behind us, remove our node, the tail and the
+        queue directory. Called with the real lock still held."""
+        
+        tail_name = os.path.join(self.queue_dir,'tail')
+        try:
+            tail_fd = os.open(tail_name,os.O_RDWR)
+        except OSError:
+            return
+        
+        try:
+            fcntl.flock(tail_fd,fcntl.LOCK_EX)
+            if not self.current(tail_fd,tail_name): return
+            if int(os.read(tail_fd,32).strip() or 0) != self.ticket: return
+            
+            # Everyone ahead of us is done, so any other node is left over from a
+            # waiter that gave up or died. A waiter that opens the tail after
+            # this makes a new one
+            for name, type in C_walker().read(self.queue_dir):
+                if name != 'tail': os.remove(os.path.join(self.queue_dir,name))
+            os.remove(tail_name)
+            os.rmdir(self.queue_dir)
+        except (IOError,OSError,ValueError):
+            pass    # somebody left something in there, it is only cleanup
+        finally:
+            os.close(tail_fd)
+        
+    def leave_queue(self):
+        """Release our node in the queue, which lets the next waiter go."""
+        
+        try:
+            os.close(self.node_fd)
+        except OSError:
+            pass
+        
+    def signal(self):
+        """This is the method that releases the mutex.
+        
+        Returns:
+            0 - The semaphore was released
+            1 - Unable to release the semaphore
+        """
+        
+        # if the object doesn't reflect that we have the semaphore, bail
+        if self.sem_locked == False: return True
+        
+        if self.mode == 'flock':
+            # Clean up the queue if we are the last one in it, then release
+            # the real lock, then our node, which wakes the next waiter.
+            self.remove_queue()
+            try:
+                os.close(self.fd)
+            except OSError:
+                print('Internal failure during semaphore release - close')
+            self.leave_queue()
+            self.sem_locked = False
+            return False
+        
+        # Close the open file handle, catch any exceptions, but basically
+        # just print an error and keep going.
+        try:
+            os.close(self.fd)
+        except OSError:
+            print('Internal failure during semaphore release - close')
+            
+        # Remove the file. This will allow the next call to wait() to succeed
+        # since the file will no longer exist. Catch any exceptions, but
+        # basically ignore them. If we cannot delete it, then that means some
+        # manual clean up is going to be required.
+        try:
+            os.remove(self.sem_name)
+        except OSError:
+            print('Internal failure during semaphore release - remove')
+
+        # Reflect that we have released our semaphore. This is here so that if
+        # the atexit() routine runs and attempts to release the semaphore, we
+        # will ignore the request. It isn't useful for anything else.
+        self.sem_locked = False
+        return False
@@ -0,0 +1,194 @@
+import os
+import json
+import time
+import uuid
+
+"""
+This module contains the code for the statistics class.
+
+The purpose of this module is to measure where the time of a buver run
+goes. C_buver wraps each phase of a run (taking the lock, loading the
+config, sanify, prune, the backup itself, saving the config, emptying the
+trash and sending the mail) in phase(), which records for that phase:
+
+    wall         - the elapsed time, in seconds
+    cpu          - the CPU time used by this process, in seconds
+    child_cpu    - the CPU time used by commands we ran (tree_cmd, mailto, ...)
+    read_bytes   - the bytes this process read from storage
+    write_bytes  - the bytes this process wrote to storage
+    child_inblock, child_oublock - the blocks read and written by commands
+
+The I/O counters come from /proc/self/io, and are only available on Linux.
+The process figures cover the whole process, so when several jobs run in
+one process (see cscheduler.py), the phases of jobs that overlap include
+each other's work. The backup engines also record counters (files, bytes,
+links, chunks, ...) with count().
+
+At the end of a run, emit() appends everything as one JSON record to
+'stats.jsonl' in the logs directory of the tgt_loc, and if a Prometheus
+textfile collector file was given, writes the same numbers there as
+metrics. That file is replaced atomically, as the collector requires.
+
+phase()  - a context manager that measures one phase of the run
+count()  - add to a counter
+emit()   - write the JSON record (and the Prometheus file)
+"""
+
+try:
+    import resource
+except ImportError:
+    resource = None     # no rusage on this platform, the child figures will be zero
+
+def _proc_io():
+    """Return the read_bytes/write_bytes counters of this process, or zeros."""
+
+    io = {'read_bytes':0,'write_bytes':0}
+    try:
+        f = open('/proc/self/io','r')
+        for line in f:
+            key, sep, val = line.partition(':')
+            if key in io: io[key] = int(val)
+        f.close()
+    except (IOError,OSError,ValueError):
+        pass
+
+    return io
+
+def _child_usage():
+    """Return the CPU time and block counts of our finished child processes."""
+
+    if resource is None: return (0.0,0,0)
+
+    ru = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return (ru.ru_utime + ru.ru_stime,ru.ru_inblock,ru.ru_oublock)
+
+class C_phase:
+    """The context manager returned by C_stats.phase()."""
+
+    def __init__(self,stats,name):
+        self.stats = stats
+        self.name = name
+
+    def __enter__(self):
+        self.wall = time.time()
+        self.cpu = time.process_time()
+        self.io = _proc_io()
+        self.child = _child_usage()
+        return self
+
+    def __exit__(self,exc_type,exc_value,tb):
+        io = _proc_io()
+        child = _child_usage()
+
+        rec = self.stats.phases.setdefault(self.name,{'wall':0.0,'cpu':0.0,'child_cpu':0.0,
+                                                      'read_bytes':0,'write_bytes':0,
+                                                      'child_inblock':0,'child_oublock':0})
+        rec['wall'] = rec['wall'] + time.time() - self.wall
+        rec['cpu'] = rec['cpu'] + time.process_time() - self.cpu
+        rec['child_cpu'] = rec['child_cpu'] + child[0] - self.child[0]
+        rec['read_bytes'] = rec['read_bytes'] + io['read_bytes'] - self.io['read_bytes']
+        rec['write_bytes'] = rec['write_bytes'] + io['write_bytes'] - self.io['write_bytes']
+        rec['child_inblock'] = rec['child_inblock'] + child[1] - self.child[1]
+        rec['child_oublock'] = rec['child_oublock'] + child[2] - self.child[2]
+        return False
+
+class C_stats:
+    def __init__(self,tgt_loc,mode):
+        """Constructor for the C_stats class. Initialize the
+        variables that we need to have in order for the class to
+        operate:
+
+        tgt_loc  - the tgt_loc the run is for
+        mode     - the kind of run (initialize, backup)
+        phases   - the measurements of each phase, keyed by name
+        counters - the counters recorded by the engines"""
+
+        self.tgt_loc = tgt_loc
+        self.mode = mode
+        self.phases = {}
+        self.counters = {}
+        self.start = time.time()
+        self.start_cpu = time.process_time()
+
+    def phase(self,name):
+        """Return a context manager that measures the phase 'name'. If the
+        same phase is measured more than once, the figures are added up."""
+
+        return C_phase(self,name)
+
+    def count(self,name,value=1):
+        """Add 'value' to the counter 'name'."""
+
+        self.counters[name] = self.counters.get(name,0) + value
+
+    def record(self,rc,backup_type=''):
+        """Return the JSON record for the run."""
+
+        return {'tgt_loc':self.tgt_loc,
+                'pid':os.getpid(),
+                'mode':self.mode,
+                'type':backup_type,
+                'start':time.strftime('%Y-%m-%dT%H:%M:%S',time.localtime(self.start)),
+                'timestamp':self.start,
+                'rc':rc,
+                'wall':time.time() - self.start,
+                'cpu':time.process_time() - self.start_cpu,
+                'phases':self.phases,
+                'counters':self.counters}
+
+    def prometheus(self,rec):
+        """Return the record formatted as Prometheus text exposition metrics."""
+
+        label = 'tgt_loc="%s"' % rec['tgt_loc'].replace('\\','\\\\').replace('"','\\"')
+        lines = []
+
+        def metric(name,help,mtype,values):
+            lines.append('# HELP %s %s' % (name,help))
+            lines.append('# TYPE %s %s' % (name,mtype))
+            for labels, value in values:
+                lines.append('%s{%s} %s' % (name,labels,repr(float(value))))
+
+        metric('buver_run_timestamp_seconds','When the last run started.','gauge',[(label,rec['timestamp'])])
+        metric('buver_run_seconds','The wall time of the last run.','gauge',[(label,rec['wall'])])
+        metric('buver_run_cpu_seconds','The CPU time of the last run.','gauge',[(label,rec['cpu'])])
+        metric('buver_run_rc','The return code of the last run.','gauge',[(label,rec['rc'] or 0)])
+
+        for key in ['wall','cpu','child_cpu','read_bytes','write_bytes','child_inblock','child_oublock']:
+            name = 'buver_phase_%s' % key
+            if key in ['wall','cpu','child_cpu']: name = '%s_seconds' % name
+            metric(name,'The %s of each phase of the last run.' % key,'gauge',
+                   [('%s,phase="%s"' % (label,phase),self.phases[phase][key]) for phase in sorted(self.phases)])
+
+        for name in sorted(self.counters):
+            metric('buver_%s' % name,'The %s counter of the last run.' % name,'gauge',[(label,self.counters[name])])
+
+        return '\n'.join(lines) + '\n'
+
+    def emit(self,log_dir,rc,backup_type='',prom_file=''):
+        """Append the JSON record for the run to 'stats.jsonl' in log_dir,
+        and write the Prometheus file if one was given.
+        Returns 0 on success or 1 otherwise."""
+
+        rec = self.record(rc,backup_type)
+        rc = 0
+
+        try:
+            out = open(os.path.join(log_dir,'stats.jsonl'),'a')
+            out.write('%s\n' % json.dumps(rec,sort_keys=True))
+            out.close()
+        except (IOError,OSError):
+            rc = 1
+
+        if prom_file:
+            # the daemon's threads write it too, so the name has to be our own
+            tmp_name = '%s.%s.tmp' % (prom_file,uuid.uuid4().hex)
+            try:
+                out = open(tmp_name,'w')
+                out.write(self.prometheus(rec))
+                out.close()
+                os.rename(tmp_name,prom_file)
+            except (IOError,OSError):
+                if os.path.exists(tmp_name): os.unlink(tmp_name)
+                rc = 1
+
+        return rc
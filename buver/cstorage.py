@@ -0,0 +1,373 @@
+import os
+import re
+import shutil
+import hashlib
+import uuid
+
+from buver.cwalker import C_walker
+
+"""
+This module contains the code for the storage backend classes.
+
+A tgt_loc is a local directory, and everything in it is reached through the
+os module. To get the versions off the machine, they can be pushed to a
+storage backend as well, which is set with the 'storage' directive in
+buver.conf (see cbuconfig.py). After each backup, the files of the new
+version are pushed under 'versions/<n>/', and the versions that have been
+pruned are deleted from the backend too, so it holds the same versions as
+the tgt_loc.
+
+The interface (C_storage) is modeled on an object store. There are no
+directories, only objects with a key (a '/' separated path), and the only
+operations are:
+
+    put(key,data)     - store an object
+    get(key,offset,size) - read an object (or a range of it)
+    stat(key)         - the size of an object, or None if it does not exist
+    list(prefix)      - the keys of the objects under a prefix
+    delete(key)       - remove an object
+    copy(key,new_key) - copy an object within the storage, without sending it again
+
+and a multipart upload, for objects too big to send in one request:
+
+    create_upload(key)            - start an upload, returns its id
+    upload_part(id,number,data)   - send one part, returns its tag
+    complete_upload(id,parts)     - join the parts into the object
+    abort_upload(id)              - throw the parts away
+
+The parts can be sent in any order, and at the same time, so upload_file()
+reads a big file (an archive, usually) in parts and sends them from a pool
+of threads, instead of pushing it as one sequential stream. Nothing of the
+object is visible until complete_upload() succeeds.
+
+A 'link' version hard links the files that did not change to the previous
+version, and most of a version is usually such files. push_tree() is given
+the previous version too, and when a file is the same inode as the one at
+the same path there, and that one was pushed, it copies the object within
+the storage instead of sending the file again.
+
+C_localstorage implements the interface on a local (or mounted) directory.
+It is what 'file://' URLs (or plain paths) use, and it is what the rest of
+the code can be tried against without a real object store. Other backends
+are added to BACKENDS under their URL scheme; open_storage() picks the
+backend from the URL.
+
+Only regular files are pushed. Symbolic links and special files have no
+place in an object store, and are skipped (they, and the modes, times and
+owners of everything, are still recorded in the manifest of the version,
+which is pushed along with it). The chunk store of the 'dedup' type is not
+pushed.
+"""
+
+# The size of each part of a multipart upload, and the size from which
+# upload_file() uses one instead of a single put()
+PART_SIZE = 16 * 1024 * 1024
+
+# The temporary files C_localstorage writes objects to, '<name>.<uuid>.tmp'
+TMP_NAME = re.compile(r'\.[0-9a-f]{32}\.tmp$')
+
+class C_storage:
+    """The storage backend interface. The methods that touch the storage
+    are implemented by each backend; the ones built on top of them here
+    work with any backend."""
+
+    def __init__(self,msg,url):
+        """Constructor for the C_storage class. Initialize the
+        variables that we need to have in order for the class to
+        operate:
+
+        msgout - the generic message handler for printing output
+        url    - where the storage is"""
+
+        self.msgout = msg
+        self.url = url
+
+    def put(self,key,data):
+        raise NotImplementedError
+
+    def get(self,key,offset=0,size=-1):
+        raise NotImplementedError
+
+    def stat(self,key):
+        raise NotImplementedError
+
+    def list(self,prefix=''):
+        raise NotImplementedError
+
+    def delete(self,key):
+        raise NotImplementedError
+
+    def copy(self,key,new_key):
+        raise NotImplementedError
+
+    def create_upload(self,key):
+        raise NotImplementedError
+
+    def upload_part(self,upload_id,number,data):
+        raise NotImplementedError
+
+    def complete_upload(self,upload_id,parts):
+        raise NotImplementedError
+
+    def abort_upload(self,upload_id):
+        raise NotImplementedError
+
+    def upload_file(self,key,path,threads=4,part_size=PART_SIZE):
+        """Store the file 'path' as 'key'. A file bigger than a part is sent
+        as a multipart upload, with 'threads' parts in flight at once.
+        Returns the number of bytes sent. Raises IOError or OSError."""
+
+        from concurrent.futures import ThreadPoolExecutor
+
+        fd = os.open(path,os.O_RDONLY|getattr(os,'O_BINARY',0))
+        try:
+            size = os.fstat(fd).st_size
+            if size <= part_size:
+                self.put(key,os.read(fd,size) if size else b'')
+                return size
+
+            def send(number):
+                # each worker reads its own part, so the reads overlap as well
+                data = os.pread(fd,part_size,(number - 1) * part_size)
+                return number, self.upload_part(upload_id,number,data)
+
+            upload_id = self.create_upload(key)
+            try:
+                with ThreadPoolExecutor(max_workers=max(1,int(threads))) as pool:
+                    parts = list(pool.map(send,range(1,(size + part_size - 1) // part_size + 1)))
+                self.complete_upload(upload_id,parts)
+            except BaseException:
+                self.abort_upload(upload_id)
+                raise
+
+            return size
+        finally:
+            os.close(fd)
+
+    def push_tree(self,prefix,top,threads=4,part_size=PART_SIZE,prev_prefix=None,prev_top=None):
+        """Store every regular file under the directory 'top' as an object
+        under 'prefix'. Small files are sent 'threads' at a time, big ones
+        one at a time with 'threads' parts at a time. If 'prev_top' was
+        pushed under 'prev_prefix', the files that are hard links to the
+        same file there are copied from its objects instead. Returns the
+        number of objects and bytes sent. Raises IOError or OSError."""
+
+        from concurrent.futures import ThreadPoolExecutor
+
+        objects = 0
+        nbytes = 0
+        jobs = []
+
+        # one listing, rather than a stat() of every object we might copy
+        prev_keys = set()
+        if prev_prefix and prev_top: prev_keys = set(self.list(prev_prefix + '/'))
+
+        with ThreadPoolExecutor(max_workers=max(1,int(threads))) as pool:
+            for entry in C_walker(self.msgout).scan(top):
+                if entry.type == 'd': continue
+                if entry.type != 'f':
+                    self.msgout('Not pushing <%s>, only regular files are pushed' % entry.path)
+                    continue
+
+                rel = entry.rel.replace(os.sep,'/')
+                key = '%s/%s' % (prefix,rel)
+                if '%s/%s' % (prev_prefix,rel) in prev_keys and self.same_file(entry.path,os.path.join(prev_top,entry.rel)):
+                    jobs.append(pool.submit(self.copy,'%s/%s' % (prev_prefix,rel),key))
+                elif os.path.getsize(entry.path) > part_size:
+                    nbytes = nbytes + self.upload_file(key,entry.path,threads,part_size)
+                else:
+                    jobs.append(pool.submit(self.upload_file,key,entry.path,1,part_size))
+                objects = objects + 1
+
+            for job in jobs: nbytes = nbytes + (job.result() or 0)
+
+        return objects, nbytes
+
+    def same_file(self,path,prev_path):
+        """Return True if 'path' and 'prev_path' are the same file (hard links)."""
+
+        try:
+            return os.path.samestat(os.lstat(path),os.lstat(prev_path))
+        except OSError:
+            return False
+
+    def delete_prefix(self,prefix):
+        """Delete every object under 'prefix'. Returns how many there were."""
+
+        keys = self.list(prefix)
+        for key in keys: self.delete(key)
+
+        return len(keys)
+
+class C_localstorage(C_storage):
+    """The storage backend interface on a local directory. Each object is a
+    file under the directory, named by its key. The parts of an upload are
+    kept in '.uploads/<id>/' until the upload is completed or aborted."""
+
+    def __init__(self,msg,url):
+        C_storage.__init__(self,msg,url)
+
+        root = url
+        if root.startswith('file://'): root = root[len('file://'):]
+        self.root = os.path.abspath(os.path.expanduser(root))
+        self.uploads = os.path.join(self.root,'.uploads')
+
+    def path(self,key):
+        """Return the file of the object 'key', refusing keys that would escape the root."""
+
+        parts = key.split('/')
+        if not key or key.startswith('/') or '..' in parts or '' in parts or parts[0] == '.uploads':
+            raise IOError('invalid key <%s>' % key)
+
+        return os.path.join(self.root,*parts)
+
+    def write_file(self,name,data):
+        """Write 'data' to the file 'name' so it appears all at once."""
+
+        if not os.path.isdir(os.path.dirname(name)): os.makedirs(os.path.dirname(name),exist_ok=True)
+
+        tmp_name = '%s.%s.tmp' % (name,uuid.uuid4().hex)
+        try:
+            f = open(tmp_name,'wb')
+            try:
+                f.write(data)
+            finally:
+                f.close()
+            os.rename(tmp_name,name)
+        except BaseException:
+            if os.path.exists(tmp_name): os.unlink(tmp_name)
+            raise
+
+    def put(self,key,data):
+        self.write_file(self.path(key),data)
+
+    def get(self,key,offset=0,size=-1):
+        f = open(self.path(key),'rb')
+        try:
+            f.seek(offset)
+            return f.read(size)
+        finally:
+            f.close()
+
+    def stat(self,key):
+        try:
+            return os.path.getsize(self.path(key))
+        except OSError:
+            return None
+
+    def list(self,prefix=''):
+        """Return the keys under 'prefix', sorted, like an object store listing."""
+
+        top = self.root
+        parent = prefix.rsplit('/',1)[0] if '/' in prefix else ''
+        if parent: top = os.path.join(self.root,*parent.split('/'))
+        if not os.path.isdir(top): return []
+
+        keys = []
+        for entry in C_walker().scan(top):
+            if entry.type != 'f' or TMP_NAME.search(entry.name): continue
+            key = os.path.relpath(entry.path,self.root).replace(os.sep,'/')
+            if key.startswith('.uploads/'): continue
+            if key.startswith(prefix): keys.append(key)
+
+        return sorted(keys)
+
+    def delete(self,key):
+        name = self.path(key)
+        try:
+            os.unlink(name)
+        except FileNotFoundError:
+            return      # deleting what is not there is not an error in an object store
+
+        # like an object store, do not leave empty 'directories' behind
+        parent = os.path.dirname(name)
+        while parent != self.root:
+            try:
+                os.rmdir(parent)
+            except OSError:
+                break
+            parent = os.path.dirname(parent)
+
+    def copy(self,key,new_key):
+        """Copy the object 'key' to 'new_key'. The objects are never written
+        in place (see write_file()), so a hard link is as good as a copy."""
+
+        name = self.path(key)
+        new_name = self.path(new_key)
+        if not os.path.isdir(os.path.dirname(new_name)): os.makedirs(os.path.dirname(new_name),exist_ok=True)
+
+        tmp_name = '%s.%s.tmp' % (new_name,uuid.uuid4().hex)
+        try:
+            try:
+                os.link(name,tmp_name)
+            except OSError:
+                shutil.copyfile(name,tmp_name)
+            os.rename(tmp_name,new_name)
+        except BaseException:
+            if os.path.exists(tmp_name): os.unlink(tmp_name)
+            raise
+
+    def create_upload(self,key):
+        self.path(key)      # make sure it is a valid key before we start
+        upload_id = uuid.uuid4().hex
+        os.makedirs(os.path.join(self.uploads,upload_id))
+        self.write_file(os.path.join(self.uploads,upload_id,'key'),key.encode('utf-8'))
+        return upload_id
+
+    def upload_part(self,upload_id,number,data):
+        """Store part 'number' (from 1) of the upload. Returns the tag of the part,
+        which is a hash of its data, as object stores do."""
+
+        self.write_file(os.path.join(self.uploads,upload_id,'%06d' % number),data)
+        return hashlib.blake2b(data,digest_size=16).hexdigest()
+
+    def complete_upload(self,upload_id,parts):
+        """Join the parts, a list of (number, tag) in any order, into the object."""
+
+        upload = os.path.join(self.uploads,upload_id)
+        key = open(os.path.join(upload,'key'),'rb').read().decode('utf-8')
+        name = self.path(key)
+        if not os.path.isdir(os.path.dirname(name)): os.makedirs(os.path.dirname(name),exist_ok=True)
+
+        tmp_name = '%s.%s.tmp' % (name,upload_id)
+        out = open(tmp_name,'wb')
+        try:
+            for number, tag in sorted(parts):
+                f = open(os.path.join(upload,'%06d' % number),'rb')
+                try:
+                    data = f.read()
+                finally:
+                    f.close()
+                if hashlib.blake2b(data,digest_size=16).hexdigest() != tag:
+                    raise IOError('part %d of the upload of <%s> does not match its tag' % (number,key))
+                out.write(data)
+            out.close()
+            os.rename(tmp_name,name)
+        except BaseException:
+            out.close()
+            if os.path.exists(tmp_name): os.unlink(tmp_name)
+            raise
+
+        shutil.rmtree(upload,ignore_errors=True)
+
+    def abort_upload(self,upload_id):
+        shutil.rmtree(os.path.join(self.uploads,upload_id),ignore_errors=True)
+
+# The backends, by the scheme of their URL
+BACKENDS = {'file':C_localstorage}
+
+def storage_scheme(url):
+    """Return the scheme of a storage URL ('file' for a plain path)."""
+
+    if '://' in url: return url.split('://',1)[0].lower()
+    return 'file'
+
+def open_storage(msg,url):
+    """Return the backend for the storage URL 'url', or None if there is no backend for it."""
+
+    backend = BACKENDS.get(storage_scheme(url))
+    if backend is None:
+        msg('There is no storage backend for <%s>' % url)
+        return None
+
+    return backend(msg,url)
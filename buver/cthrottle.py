@@ -0,0 +1,224 @@
+import os
+import threading
+import time
+
+"""
+This module contains the code for the throttle class.
+
+A backup reads the whole src_dir as fast as the disks allow, which is
+exactly what the production workload on the same disks does not want.
+'nice' only lowers the CPU priority, so the throttle limits the I/O itself.
+It is set up from the 'max_read_bps', 'max_write_bps' and 'max_files_ps'
+directives (see cbuconfig.py), and is handed to the builtin engines (see
+ccopytree.py, carchive.py and cchunkstore.py) and the reaper, which call:
+
+    read(n)  - before reading n bytes from the src_dir
+    write(n) - before writing n bytes to the tgt_loc
+    files(n) - before working on n files (each one costs several IOPS)
+
+Each limit is a token bucket. The bucket holds up to one second of tokens
+and fills at the configured rate. A caller takes the tokens it needs, and if
+there are not enough, the bucket goes into debt and the caller sleeps until
+the debt is paid. The worker threads share the buckets, so the rates are
+for the whole backup, however many threads it runs. A rate of 0 is no limit,
+and costs nothing beyond a test.
+
+So that a single call cannot take many seconds of tokens at once (and then
+sleep for them), the engines size their reads and writes with chunk().
+
+The I/O scheduling class is set separately, by 'ionice' (see ionice_args()).
+The commands of the 'cmd' engine are run under the ionice command, and the
+builtin engines set the class of the thread that runs the job. Linux keeps
+the class per thread, and a thread starts with the class of the thread that
+started it, so the engine's worker threads get it too, while the other jobs
+of 'buver --jobs' or the daemon (which are started by the main thread) do
+not.
+
+read() / write() / files() - take tokens, sleeping if the rate is exceeded
+reader() / writer() - wrap a file object so its reads or writes are throttled
+chunk()   - how many bytes to move at once, given the limits
+ionice()  - set the I/O scheduling class of a thread
+ionice_command() - the command line prefix that runs a command under ionice
+"""
+
+# The smallest chunk that chunk() gives out, so we never make tiny system calls
+MIN_CHUNK = 64 * 1024
+
+# The I/O scheduling classes of ionice(1)
+IONICE_CLASSES = {'realtime':1,'best-effort':2,'idle':3}
+
+def parse_rate(val):
+    """Return the rate 'val' from the buver.conf as a number, or None if it
+    is not valid. Blank or 0 is no limit, and a K, M or G suffix multiplies
+    by 1024, 1024*1024 or 1024*1024*1024."""
+
+    val = val.strip().upper()
+    if val == '': return 0
+
+    scale = 1
+    if val[-1] in 'KMG':
+        scale = 1 << (10 * ('KMG'.index(val[-1]) + 1))
+        val = val[:-1]
+
+    if not val.isdigit(): return None
+    return int(val) * scale
+
+def ionice_args(val):
+    """Return the arguments for ionice(1) that select the I/O scheduling
+    class 'val' from the buver.conf ('idle', 'best-effort' or 'realtime',
+    optionally followed by ':' and a level from 0 to 7), or None if 'val'
+    is not valid. Blank means leave the class alone, and gives []."""
+
+    if val.strip() == '': return []
+
+    name, sep, level = val.strip().lower().partition(':')
+    if name not in IONICE_CLASSES: return None
+
+    args = ['-c','%d' % IONICE_CLASSES[name]]
+    if sep:
+        if name == 'idle' or not level.isdigit() or int(level) > 7: return None
+        args = args + ['-n',level]
+
+    return args
+
+def ionice_command(args):
+    """Return the start of a command line that runs a command under ionice(1)
+    with the arguments 'args' from ionice_args(), or [] if there are no
+    arguments or this platform does not have ionice."""
+
+    import shutil
+
+    if not args or os.name != 'posix' or shutil.which('ionice') is None: return []
+
+    return ['ionice'] + args
+
+def ionice(args,pid=None):
+    """Set the I/O scheduling class of the thread 'pid' (default the one
+    calling us) with the ionice(1) arguments 'args' from ionice_args().
+    Returns 0 on success or 1 otherwise. The threads it starts after this
+    inherit the class, the rest of the process keeps the one it has."""
+
+    import subprocess
+
+    if not args: return 0
+    cmd = ionice_command(args)
+    if not cmd: return 1
+
+    # ionice -p takes a thread id as well, and only changes that thread
+    if pid is None: pid = threading.get_native_id()
+    try:
+        return subprocess.call(cmd + ['-p','%d' % pid],stdout=subprocess.DEVNULL,stderr=subprocess.DEVNULL) and 1
+    except OSError:
+        return 1
+
+class C_bucket:
+    def __init__(self,rate):
+        """Constructor for the C_bucket class. Initialize the
+        variables that we need to have in order for the class to
+        operate:
+
+        rate   - the tokens added per second (0 means no limit)
+        tokens - the tokens in the bucket (negative when in debt)
+        waited - the total time callers have slept"""
+
+        self.rate = max(0,int(rate))
+        self.tokens = self.rate
+        self.last = time.monotonic()
+        self.waited = 0.0
+        self.lock = threading.Lock()
+
+    def take(self,n):
+        """Take n tokens, sleeping until they are paid for. Returns how long we slept."""
+
+        if not self.rate: return 0
+
+        with self.lock:
+            now = time.monotonic()
+            # refill for the time since the last call, the bucket holds one second
+            self.tokens = min(self.rate,self.tokens + (now - self.last) * self.rate)
+            self.last = now
+            self.tokens = self.tokens - n
+            wait = 0.0
+            if self.tokens < 0: wait = -self.tokens / self.rate
+            self.waited = self.waited + wait
+
+        # sleep outside the lock, so the other threads can queue up their debt
+        if wait: time.sleep(wait)
+        return wait
+
+class C_throttled_file:
+    """A file object whose reads (or writes) take tokens from a bucket first."""
+
+    def __init__(self,f,bucket,chunk):
+        self.f = f
+        self.bucket = bucket
+        self.chunk = chunk
+
+    def read(self,size=-1):
+        if size is None or size < 0 or size > self.chunk: size = self.chunk
+        data = self.f.read(size)
+        self.bucket.take(len(data))     # only what we got, a short read at the end is cheap
+        return data
+
+    def write(self,data):
+        for i in range(0,len(data),self.chunk):
+            self.bucket.take(min(self.chunk,len(data) - i))
+        return self.f.write(data)
+
+    def __getattr__(self,name):
+        return getattr(self.f,name)
+
+class C_throttle:
+    def __init__(self,read_bps=0,write_bps=0,files_ps=0):
+        """Constructor for the C_throttle class. Initialize the
+        variables that we need to have in order for the class to
+        operate:
+
+        reads  - the bucket of the bytes read from the src_dir
+        writes - the bucket of the bytes written to the tgt_loc
+        items  - the bucket of the files worked on"""
+
+        self.reads = C_bucket(read_bps)
+        self.writes = C_bucket(write_bps)
+        self.items = C_bucket(files_ps)
+
+    def active(self):
+        """Return True if any limit is set."""
+
+        return bool(self.reads.rate or self.writes.rate or self.items.rate)
+
+    def read(self,n):
+        return self.reads.take(n)
+
+    def write(self,n):
+        return self.writes.take(n)
+
+    def files(self,n=1):
+        return self.items.take(n)
+
+    def waited(self):
+        """Return the total time (in seconds) the callers have been held back."""
+
+        return self.reads.waited + self.writes.waited + self.items.waited
+
+    def chunk(self,size):
+        """Return how many bytes to move at once, at most 'size'. With a
+        byte limit set, this is a tenth of a second's worth, so the rate
+        stays smooth instead of going in one second bursts."""
+
+        for rate in [self.reads.rate,self.writes.rate]:
+            if rate: size = min(size,max(MIN_CHUNK,rate // 10))
+
+        return size
+
+    def reader(self,f):
+        """Return the file object 'f', with its reads throttled if there is a read limit."""
+
+        if not self.reads.rate: return f
+        return C_throttled_file(f,self.reads,self.chunk(1 << 20))
+
+    def writer(self,f):
+        """Return the file object 'f', with its writes throttled if there is a write limit."""
+
+        if not self.writes.rate: return f
+        return C_throttled_file(f,self.writes,self.chunk(1 << 20))
@@ -0,0 +1,355 @@
+import os
+import hashlib
+import lzma
+import tarfile
+import time
+import zlib
+
+from buver.cversions import C_versions
+from buver.cmanifest import C_manifest, new_hash
+from buver.cchunkstore import C_chunkstore
+from buver.cdelta import DELTA_DIR, load_deltas, apply_delta
+from buver.carchive import open_archive
+from buver.cthrottle import C_throttle
+from buver.cwalker import C_walker
+
+"""
+This module contains the code for the verify class.
+
+'buver --verify tgt_loc' checks that the versions in a tgt_loc are still
+intact, without restoring them. The backups record the content hash of
+every file in the manifest of the version as they back it up (see the
+'hash' directive in cbuconfig.py, and cmanifest.py), so all the verify has
+to do is read the versions back and hash them again. A file whose hash (or
+size) no longer matches is reported as corrupt, and one that is in the
+manifest but not in the version is reported as missing.
+
+What is read depends on what kind of version it is:
+
+    tree, link - every file in the copy of the src_dir, and the files that
+                 are stored as deltas (see cdelta.py) are put back together
+                 from the delta and its base as they are hashed
+    tar, gzip, bgzf - the archive, from start to end, hashing each member
+    dedup      - the chunks of each file, from the chunk store. The id of a
+                 chunk is the hash of its data, so a damaged chunk is found
+                 even in a version that has no file hashes
+
+Files from versions made without the 'hash' directive (or by the 'cmd'
+engine, which has no manifest at all) can only be checked for being there,
+with the right size. They are counted as not hashed.
+
+The files are hashed by a pool of processes, not threads, so the hashing
+uses every core instead of waiting for the interpreter lock. The files are
+handed out in batches, and an archive is one batch of its own. The verify
+only reads, and does not take the tgt_loc semaphore, so it can run while a
+backup is running (but a backup may prune the oldest version under it).
+
+So that a scrub can run alongside production, '--max-read-bps' limits how
+fast the versions are read (see cthrottle.py). The limit is shared out
+evenly between the processes. To also lower its I/O priority, run the
+verify under ionice(1).
+
+execute() - verify the versions, returns 0 if they are intact or 1 otherwise
+"""
+
+# How many files, or how many bytes of them, make a batch for a process
+BATCH_FILES = 256
+BATCH_BYTES = 256 * 1024 * 1024
+
+# How much is read at once
+READ_SIZE = 1 << 20
+
+def check(rel,hash,size,h,nbytes):
+    """Return the result for a file that should have 'hash' and 'size',
+    and that read back as the hash object 'h' and 'nbytes' bytes."""
+
+    if nbytes != size: return (rel,'corrupt',nbytes,'the size is %d, not %d' % (nbytes,size))
+    if hash is None: return (rel,'unhashed',nbytes,None)
+    if h.hexdigest() != hash: return (rel,'corrupt',nbytes,'the hash does not match')
+
+    return (rel,'ok',nbytes,None)
+
+def hash_file(f,h,throttle):
+    """Add what is left of the open file 'f' to the hash 'h'. Returns the number of bytes read."""
+
+    nbytes = 0
+    f = throttle.reader(f)
+    while True:
+        data = f.read(READ_SIZE)
+        if not data: break
+        h.update(data)
+        nbytes = nbytes + len(data)
+
+    return nbytes
+
+def verify_job(job,throttle):
+    """Verify one file. Returns a list with its result."""
+
+    kind, rel, where, size, hash = job
+    h = new_hash()
+    try:
+        if kind == 'f':
+            f = open(where,'rb')
+            try:
+                nbytes = hash_file(f,h,throttle)
+            finally:
+                f.close()
+        elif kind == 'delta':
+            def write(data):
+                throttle.read(len(data))
+                h.update(data)
+            nbytes = apply_delta(where[0],where[1],write)
+        else:
+            # the chunks of a 'dedup' file, each of which is named by the hash of its data
+            nbytes = 0
+            for cid, path in where:
+                f = open(path,'rb')
+                try:
+                    data = f.read()
+                finally:
+                    f.close()
+                throttle.read(len(data))
+                if hashlib.blake2b(data,digest_size=20).hexdigest() != cid:
+                    return [(rel,'corrupt',nbytes,'chunk %s is damaged' % cid)]
+                h.update(data)
+                nbytes = nbytes + len(data)
+    except FileNotFoundError as e:
+        return [(rel,'missing',0,str(e))]
+    except (IOError,OSError,ValueError) as e:
+        return [(rel,'corrupt',0,str(e))]
+
+    return [check(rel,hash,size,h,nbytes)]
+
+def verify_archive(archive,expected,throttle):
+    """Verify the members of an archive against 'expected', a dictionary of
+    path to (size, hash). Returns a list with a result for each of them."""
+
+    results = []
+    seen = set()
+    try:
+        # the gzip, bz2 and lzma modules read the archives written in blocks, tarfile alone does not
+        f = open_archive(archive)
+    except (IOError,OSError) as e:
+        return [(os.path.basename(archive),'corrupt',0,'the archive cannot be opened: %s' % e)]
+    try:
+        tar = tarfile.open(fileobj=f,mode='r|')
+        for member in tar:
+            rel = os.path.normpath(member.name)
+            if not member.isreg() or rel not in expected: continue
+            seen.add(rel)
+            size, hash = expected[rel]
+            h = new_hash()
+            nbytes = hash_file(tar.extractfile(member),h,throttle)
+            results.append(check(rel,hash,size,h,nbytes))
+        tar.close()
+    except (IOError,OSError,EOFError,tarfile.TarError,zlib.error,lzma.LZMAError) as e:
+        results.append((os.path.basename(archive),'corrupt',0,'the archive cannot be read: %s' % e))
+    finally:
+        f.close()
+
+    for rel in sorted(expected):
+        if rel not in seen: results.append((rel,'missing',0,'it is not in the archive'))
+
+    return results
+
+# The throttle of a worker process, set up by init_worker()
+_throttle = None
+
+def init_worker(read_bps):
+    """Process pool initializer. Give the process the throttle that all of its
+    batches share, reading at most 'read_bps' bytes per second (0 is no limit).
+    A throttle for each batch would start each one with a full bucket, so a
+    tree of small files would never be held back."""
+
+    global _throttle
+    _throttle = C_throttle(read_bps)
+
+def verify_batch(batch):
+    """Process pool entry point. Verify a batch of jobs. Returns the results."""
+
+    throttle = _throttle or C_throttle()
+    results = []
+    for job in batch:
+        if job[0] == 'archive':
+            results.extend(verify_archive(job[2],job[4],throttle))
+        else:
+            results.extend(verify_job(job,throttle))
+
+    return results
+
+class C_verify:
+    def __init__(self,msg,tgt_loc,version=None,threads=8,read_bps=0):
+        """Constructor for the C_verify class. Initialize the
+        variables that we need to have in order for the class to
+        operate:
+
+        msgout   - the generic message handler for printing output
+        tgt_loc  - the tgt_loc whose versions we verify
+        version  - the version to verify (None means all of them)
+        threads  - the number of processes doing the hashing
+        read_bps - the most bytes per second to read (0 is no limit)
+        counts   - the number of files with each result
+        nbytes   - the number of bytes read back"""
+
+        self.msgout = msg
+        self.tgt_loc = os.path.abspath(tgt_loc)
+        self.version = version
+        self.threads = max(1,int(threads))
+        self.read_bps = read_bps
+        self.counts = {'ok':0,'unhashed':0,'missing':0,'corrupt':0}
+        self.nbytes = 0
+
+    def find_versions(self):
+        """Return the paths of the versions to verify."""
+
+        versions = C_versions(self.msgout,os.path.join(self.tgt_loc,'versions'))
+        numbers = sorted([int(v) for v in versions.dirlist if v.isdigit()])
+        if self.version is not None:
+            if int(self.version) not in numbers:
+                self.msgout('Version <%s> does not exist, the versions are %s' % (self.version,numbers))
+                return []
+            numbers = [int(self.version)]
+
+        return [os.path.join(versions.verdir,str(n)) for n in numbers]
+
+    def tree_jobs(self,version,manifest):
+        """Return the jobs for a 'tree' or 'link' version."""
+
+        trees = [d for d in C_walker().listdir(version)[0] if d != DELTA_DIR]
+        if len(trees) != 1:
+            self.msgout('Unable to tell what kind of version <%s> is' % version)
+            return None
+
+        tree = os.path.join(version,trees[0])
+        deltas = load_deltas(version)
+        jobs = []
+        for rec in manifest.records():
+            rel = rec.path
+            if rec.type == 'f':
+                if rel in deltas:
+                    name = os.path.join(version,DELTA_DIR,deltas[rel])
+                    jobs.append(('delta',rel,(name + '.delta',name + '.base'),rec.size,rec.hash))
+                else:
+                    jobs.append(('f',rel,os.path.normpath(os.path.join(tree,rel)),rec.size,rec.hash))
+            elif not os.path.lexists(os.path.normpath(os.path.join(tree,rel))):
+                # directories and symbolic links only have to be there
+                self.result(version,(rel,'missing',0,None))
+
+        return jobs
+
+    def dedup_jobs(self,version,manifest):
+        """Return the jobs for a 'dedup' version."""
+
+        chunks = C_chunkstore(self.msgout,self.tgt_loc)
+        jobs = []
+        for rec in chunks.recipe(version):
+            if 'chunks' not in rec: continue
+            hash = None
+            if manifest and manifest.get(rec['path']): hash = manifest.get(rec['path']).hash
+            jobs.append(('chunks',rec['path'],[(cid,chunks.chunk_path(cid)) for cid in rec['chunks']],rec['size'],hash))
+
+        return jobs
+
+    def archive_jobs(self,version,manifest):
+        """Return the job for a 'tar', 'gzip' or 'bgzf' version."""
+
+        for suffix in ['','.gz','.bz2','.xz']:
+            archive = os.path.join(version,'backup.tar%s' % suffix)
+            if os.path.isfile(archive): break
+        else:
+            return None
+
+        expected = {}
+        if manifest:
+            for rec in manifest.records():
+                if rec.type == 'f': expected[rec.path] = (rec.size,rec.hash)
+
+        return [('archive',version,archive,0,expected)]
+
+    def version_jobs(self,version):
+        """Return the jobs for verifying 'version', or None if it cannot be verified."""
+
+        manifest = C_manifest(version)
+        if manifest.load(): manifest = None
+
+        if os.path.isfile(os.path.join(version,'recipe')): return self.dedup_jobs(version,manifest)
+
+        jobs = self.archive_jobs(version,manifest)
+        if jobs is not None: return jobs
+
+        if manifest is None:
+            self.msgout('Version <%s> has no manifest, so there is nothing to check it against' % version)
+            return None
+
+        return self.tree_jobs(version,manifest)
+
+    def result(self,version,result):
+        """Count (and report, if it is a problem) the result for one file."""
+
+        rel, status, nbytes, why = result
+        self.counts[status] = self.counts[status] + 1
+        self.nbytes = self.nbytes + nbytes
+        if status in ['missing','corrupt']:
+            if why:
+                self.msgout('%s <%s> in version %s: %s' % (status.upper(),rel,os.path.basename(version),why))
+            else:
+                self.msgout('%s <%s> in version %s' % (status.upper(),rel,os.path.basename(version)))
+
+    def batches(self,jobs):
+        """Group the jobs into batches of about BATCH_FILES files or BATCH_BYTES bytes."""
+
+        batch = []
+        size = 0
+        for job in jobs:
+            if job[0] == 'archive':
+                yield [job]
+                continue
+            batch.append(job)
+            size = size + job[3]
+            if len(batch) >= BATCH_FILES or size >= BATCH_BYTES:
+                yield batch
+                batch = []
+                size = 0
+
+        if batch: yield batch
+
+    def execute(self):
+        """Verify the versions. Returns 0 if they are intact or 1 otherwise."""
+
+        from concurrent.futures import ProcessPoolExecutor
+
+        versions = self.find_versions()
+        if not versions: return 1
+
+        start = time.time()
+        skipped = 0
+
+        batches = []
+        for version in versions:
+            try:
+                jobs = self.version_jobs(version)
+            except (IOError,OSError,ValueError) as e:
+                self.msgout('Unable to read version <%s>: %s' % (version,e))
+                jobs = None
+            if jobs is None:
+                skipped = skipped + 1
+                continue
+
+            for batch in self.batches(jobs): batches.append((version,batch))
+
+        # the processes that will be busy share the read limit
+        processes = max(1,min(self.threads,len(batches)))
+        self.msgout('Verifying %d versions in <%s> using %d processes' % (len(versions),self.tgt_loc,processes))
+        with ProcessPoolExecutor(max_workers=processes,initializer=init_worker,initargs=(self.read_bps // processes,)) as pool:
+            pending = [(version,pool.submit(verify_batch,batch)) for version, batch in batches]
+            for version, job in pending:
+                for result in job.result(): self.result(version,result)
+
+        elapsed = max(time.time() - start,0.001)
+        self.msgout('Verified %d files (%d bytes) in %.2f seconds (%.2f MB/sec): %d ok, %d not hashed, %d missing, %d corrupt' %
+                    (sum(self.counts.values()),self.nbytes,elapsed,self.nbytes / elapsed / (1 << 20),self.counts['ok'],
+                     self.counts['unhashed'],self.counts['missing'],self.counts['corrupt']))
+        if skipped: self.msgout('%d versions could not be verified' % skipped)
+
+        if self.counts['missing'] or self.counts['corrupt'] or skipped: return 1
+        return 0
@@ -1,5 +1,10 @@
 
 import os
+import time
+import datetime
+
+from buver.cmanifest import C_manifest
+from buver.cwalker import C_walker
 
 """
 This module contains the code for the versions class.
@@ -10,30 +15,119 @@ on disk. Using this information, several items are then derived:
 1. What the next revision is going to be (numerically)
 2. Which versions need to be groomed in order to adhere to policy
 3. Any inconsistencies in the physical v. logial view of the versions
+
+Versions that are pruned are not removed here. They are renamed into the
+'trash' directory next to the versions folder, which is instant, and the
+space is freed later by the reaper (see creaper.py), after the backup is
+done and the semaphore has been released.
+
+Which versions are kept is decided by the retention policy (see
+keep_versions() below, and the 'keep_*' directives in cbuconfig.py). With
+no 'keep_*' directives set, it is the newest 'num_versions', as it always
+was. The policy looks at when each version was made, which is recorded in
+'ver_times' in the buver.conf. Versions from before 'ver_times' existed
+get the modification time of their directory, once.
+
+The physical and logical views are compared as sets, and the policy sorts
+the versions once and then makes one pass over them for each rule, so a
+tgt_loc can hold thousands of versions (from frequent backups) without the
+bookkeeping showing up in the run time.
 """
 
+# The most versions a tgt_loc may be set to keep with 'num_versions'
+MAX_VERSIONS = 100000
+
+# The 'keep_*' rules that keep the newest version of each period, and how a
+# time is turned into its period
+PERIODS = [('hourly',lambda t: time.localtime(t)[:4]),
+           ('daily',lambda t: time.localtime(t)[:3]),
+           ('weekly',lambda t: datetime.date.fromtimestamp(t).isocalendar()[:2]),
+           ('monthly',lambda t: time.localtime(t)[:2])]
+
+# The units of 'keep_within', in seconds
+AGE_UNITS = {'h':3600,'d':86400,'w':7 * 86400,'m':30 * 86400,'y':365 * 86400}
+
+def parse_age(val):
+    """Return the age 'val' from the buver.conf (a number followed by h, d,
+    w, m or y) in seconds, or None if it is not valid. Blank gives 0."""
+
+    val = val.strip().lower()
+    if val == '': return 0
+    if len(val) < 2 or val[-1] not in AGE_UNITS or not val[:-1].isdigit(): return None
+
+    return int(val[:-1]) * AGE_UNITS[val[-1]]
+
+def keep_versions(times,policy,now=None):
+    """Return the set of the versions to keep. 'times' is a dictionary of
+    version to the time it was made, and 'policy' a dictionary with:
+
+        last    - keep the newest 'last' versions
+        within  - keep every version made in the last 'within' seconds
+        hourly, daily, weekly, monthly - keep the newest version of each of
+                  the newest that many hours, days, weeks and months that
+                  have a version
+
+    A version is kept if any rule keeps it. The versions are sorted once
+    (newest first), and each rule is one pass over them."""
+
+    if now is None: now = time.time()
+
+    newest = sorted(times,key=int,reverse=True)
+    keep = set(newest[:max(0,policy.get('last',0))])
+
+    within = policy.get('within',0)
+    if within:
+        for version in newest:
+            if now - times[version] > within: break
+            keep.add(version)
+
+    for name, period in PERIODS:
+        count = policy.get(name,0)
+        last = None
+        for version in newest:
+            if count <= 0: break
+            key = period(times[version])
+            if key != last:
+                # the first (newest) version we see of a period is the one it keeps
+                keep.add(version)
+                last = key
+                count = count - 1
+
+    return keep
+
 class C_versions:
-    def __init__(self,msg,tgt_path):
+    def __init__(self,msg,tgt_path,dirlist=None):
         """Constructor for the C_versions class. Initialize the
         variables that we need to have in order for the class to
         operate:
         
         verdir  - the absolute path of the versions folder.
+        trash   - where pruned versions go until the reaper removes them
         msgout  - the generic message handler for printing output
         pview   - whether the physical view was created OK
         sane    - whether the logical vs. physical views are sane
         pruned  - whether we ran a prune yet.
-        dirlist - list of versions we found on disk"""
+        moved   - the versions prune() moved to the trash, even if it failed later
+        dirlist - list of versions we found on disk (or that the caller already
+                  knows are there, in which case the disk is not read)
+        times   - when each version we keep was made (after sanify())"""
         
         self.verdir = os.path.abspath(tgt_path)
+        self.trash = os.path.join(os.path.dirname(self.verdir),'trash')
         self.msgout = msg
         self.pview = False
         self.sane = False
         self.pruned = False
+        self.moved = []
         self.dirlist = []
+        self.times = {}
         
         # Go ahead and initialize the 'dirlist'. This holds the physical view of versions.
-        self.load_disk_versions()
+        if dirlist is not None and os.path.isdir(self.verdir):
+            self.dirlist = list(dirlist)
+            self.pview = True
+        else:
+            self.load_disk_versions()
         
     def load_disk_versions(self):
         """Create a view of what the physical disk looks like."""
@@ -43,47 +137,47 @@ class C_versions:
         # make sure the path exists, otherwise bail now ...
         if not os.path.isdir('%s' % self.verdir): return -1
         
-        # go process all the directories in the versions folder
-        for f in os.listdir(self.verdir):
-            # Only add directories, not files ...
-            if os.path.isdir(os.path.join(self.verdir,f)):
-                # do not add '.' or '..'
-                if f == '.' or f == '..': continue
-                
-                # add this directory to our physical versions view
-                dirlist.append(f)
+        # go process all the directories in the versions folder (only directories, not files ...)
+        try:
+            subdirs, files = C_walker().listdir(self.verdir,True)
+        except OSError:
+            return -1
+        
+        # add these directories to our physical versions view
+        dirlist.extend(subdirs)
 
         self.dirlist = dirlist  # remember our directory list
         self.pview = True       # set the object state so we know we are good
         
         return 0
 
-    def sanify(self, num_versions, logical_versions):
+    def sanify(self, num_versions, logical_versions, policy=None, ver_times=None):
         """The purpose of sanify is to validate that the physical versions
         on disk match up to the logical view that the config file says we
         should have. If we don't have that, then we do not want to allow a
-        backup job to run."""
+        backup job to run. 'policy' holds the 'keep_*' rules (see
+        keep_versions()), on top of keeping the newest 'num_versions', and
+        'ver_times' when each version was made."""
         
         if not self.pview:
             self.msgout('No physical view for <%s> was found.' % self.verdir)
             return 1
         
-        c0 = 0
-        c1 = 0
+        # Compare the views as sets, so this stays fast with thousands of versions
+        physical = set(self.dirlist)
+        logical = set(logical_versions)
 
         # The first thing we are going to do is see if any physical directories are
         # present on disk, but were not listed in the buver.conf logical view.
-        for version in self.dirlist:
-            if version not in logical_versions:
-                self.msgout('Found <%s> on disk, but not in config file' % version)
-                c0 = c0 + 1
+        c0 = sorted(physical - logical)
+        for version in c0:
+            self.msgout('Found <%s> on disk, but not in config file' % version)
                 
         # Now, let's do the opposite. Look for versions that are in the logical view
         # but do not exist on the physical disk ...
-        for version in logical_versions:
-            if version not in self.dirlist:
-                self.msgout('Found <%s> in config file, but not on disk' % version)
-                c1 = c1 + 1
+        c1 = sorted(logical - physical)
+        for version in c1:
+            self.msgout('Found <%s> in config file, but not on disk' % version)
 
         # if the physical vs. logical views are inconsistent, bail. The administrator
         # will have to clean this up so that we do not do bad things ...
@@ -92,28 +186,31 @@ class C_versions:
             return 2
         
         # Ok, now let's do a few other things to help the prune and backup processes.
-        # determine how many versions we want to keep in our versions folder ...
-        keep = num_versions - 1
-        
-        # if the user wants more than 1 version, then take the number they want - 1.
-        # - 1, because we are going to add a new version during this backup run ...
-        if keep > 0:
-            # this handles the admin changing the number of versions to keep
-            # between runs ... in other words, it doesn't just eliminate the oldest
-            # version, it eliminates the oldest 'n' versions...
-            self.keepers = logical_versions[-keep:]
-        else:
-            # ok, they only want to keep one version, so empty the list
-            self.keepers = []
-
-        # Ok, now if the number of logical versions is > 0 (always true unless
-        # this is the first time we are running ...)
-        if len(logical_versions) > 0:
-            # pick up the ending version number from the keepers list and add 1
-            self.keepers.append(str(int(logical_versions[-1]) + 1))
-        else:
-            # this is the first run, so just put a '1' in the list
-            self.keepers.append('1')
+        # The new version is the one after the highest we have (or '1' the first time)
+        next_version = '1'
+        if logical: next_version = str(max([int(v) for v in logical]) + 1)
+
+        # Work out when each version was made. Versions from before we recorded
+        # that get the time of their directory, which is the best we have
+        now = time.time()
+        times = {}
+        for version in logical:
+            if ver_times and version in ver_times:
+                times[version] = float(ver_times[version])
+            else:
+                try:
+                    times[version] = os.stat(os.path.join(self.verdir,version)).st_mtime
+                except OSError:
+                    times[version] = 0.0
+        times[next_version] = now
+
+        # The new version counts as one of the 'num_versions', and takes part in the
+        # rest of the policy as the newest version. It is always kept. Changing the
+        # policy between runs is fine, everything it no longer keeps is pruned at once
+        rules = dict(policy or {})
+        rules['last'] = max(1,num_versions)
+        self.keepers = sorted(keep_versions(times,rules,now) | set([next_version]),key=int)
+        self.times = dict([(version,times[version]) for version in self.keepers])
         
         # form the directory path where the next version needs to go. This is conveniently
         # stored in self.keepers as the last element. Join the versions path to this, and you
@@ -140,6 +237,21 @@ class C_versions:
         
         return []   # Yikes! This should never happen, but let's be safe ...
         
+    def new_ver_times(self):
+        """Return when each of the versions we keep was made, for the config."""
+        
+        if self.sane: return self.times
+        
+        return {}
+        
+    def unmoved(self,versions):
+        """Return the versions in the list 'versions' that prune() has not
+        moved to the trash. If the prune fails part of the way through, the
+        config has to forget the ones that are gone, or every later run
+        finds them in ver_dirs but not on disk."""
+        
+        return [version for version in versions if version not in self.moved]
+        
     def new_version(self):
         """Return the path where the next version is to be stored."""
         
@@ -148,9 +260,36 @@ class C_versions:
         # this should never happen, unless the program has a logic error ...
         return os.path.join(self.verdir,'INVALID_STATE')
     
-    def prune(self):
+    def prev_version(self):
+        """Return the path of the most recent version that will survive
+        the prune, or None if there isn't one. The 'link' backup type
+        uses this as the base to hard link unchanged files against."""
+        
+        if not self.sane or len(self.keepers) < 2: return None
+        
+        return os.path.join(self.verdir,self.keepers[-2])
+    
+    def prev_manifest(self):
+        """Return the manifest of the previous version (see prev_version()),
+        loaded and ready for change detection, or None if there isn't one."""
+        
+        prev_ver = self.prev_version()
+        if not prev_ver: return None
+        
+        manifest = C_manifest(prev_ver)
+        if manifest.load(): return None
+        
+        return manifest
+    
+    def prune(self, chunks=None, catalog=None):
         """Ok, now let's go remove the old version(s), based on
-        the results from the sanify() method."""
+        the results from the sanify() method. The versions are moved
+        to the trash, the reaper removes them later. If the tgt_loc has
+        a chunk store ('dedup' versions), pass it in 'chunks' so the
+        references held by the removed versions are dropped, and
+        the chunks nobody uses any more are removed as well. If there
+        is a catalog (see ccatalog.py), the removed versions are queued
+        to be marked as pruned in it."""
         
         if not self.sane:
             self.msgout('The prune() method was invoked in an invalid state.')
@@ -160,15 +299,42 @@ class C_versions:
             self.msgout('The prune() method was invoked multiple times...')
             return 2
             
-        # For each version on the physical disk ...
-        for version in self.dirlist:
+        # Make sure there is a trash to move the old versions to
+        if not os.path.isdir(self.trash):
+            try:
+                os.mkdir(self.trash)
+            except OSError:
+                self.msgout('Unable to create the trash directory <%s>' % self.trash)
+                return 5
+                
+        # For each version on the physical disk (oldest first) ...
+        keepers = set(self.keepers)
+        for version in sorted(self.dirlist,key=lambda v: (not v.isdigit(),int(v) if v.isdigit() else 0,v)):
             # If we are not supposed to keep it ...
-            if version not in self.keepers:
-                # Then issue the 'rm -rf ..." command to get rid of it
-                command = 'rm -rf "%s"' % os.path.join(self.verdir,version)
-                self.msgout(command)
-                os.system(command)
+            if version not in keepers:
+                # Move it to the trash. The name is made unique, in case an
+                # earlier version with the same number is still waiting there
+                trash_name = os.path.join(self.trash,'%s.%d.%d' % (version,os.getpid(),int(time.time())))
+                self.msgout('Moving version <%s> to the trash' % version)
+                try:
+                    os.rename(os.path.join(self.verdir,version),trash_name)
+                except OSError:
+                    self.msgout('Unable to move version <%s> to <%s>' % (version,trash_name))
+                    return 6
+                self.moved.append(version)
+                if catalog: catalog.prune(version)
                 
+                # Only then give back the chunks it uses, from the trash (the reaper
+                # runs after us). A version that could not be moved keeps them.
+                if chunks and chunks.release(trash_name):
+                    self.msgout('Unable to release the chunks of version <%s>' % version)
+                    return 3
+                
+        # Now remove the chunks that are no longer referenced
+        if chunks and chunks.collect():
+            self.msgout('Unable to collect the unreferenced chunks')
+            return 4
+            
         # Denote the object state.
         self.pruned = True
         return 0
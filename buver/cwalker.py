@@ -0,0 +1,153 @@
+import os
+from collections import namedtuple
+
+"""
+This module contains the code for the tree walker class.
+
+Everything in buver that looks at directories goes through here: the
+backup engines walking the src_dir, the reaper walking the trash, and the
+code that lists the versions directory or checks a new tgt_loc.
+
+The walker reads directories with os.scandir(), which gets the type of
+each entry from the directory itself (d_type) on the platforms that have
+it, so telling the directories from the files costs no stat() at all. The
+os.listdir() and os.path.isdir() it replaces cost a stat() per entry.
+
+walk() is a replacement for os.walk(). While the caller works on one
+directory, a pool of threads is already reading the next ones, so on
+storage where every directory read is a network round trip (NFS, SMB),
+the round trips overlap instead of adding up. The directories are still
+yielded in the same (top down, depth first) order as os.walk(), and the
+caller can still prune the walk by changing the subdirs list. The one
+difference is that symbolic links to directories are listed with the
+files, not the subdirs, since that is how buver treats them everywhere.
+
+scan() walks a tree in the same way, but yields one small record per entry
+(its path, its path relative to the top, its name and its type), for code
+that does not care about the directory structure.
+
+Directories that cannot be read are skipped, as os.walk() does, but if a
+message handler was given they are reported, and they are counted in
+'errors' either way.
+
+listdir() - read one directory, returns the subdirs and the files
+walk()    - os.walk() with the directories read ahead by the thread pool
+scan()    - walk a tree, yielding a record for every entry
+"""
+
+# The number of threads reading directories at once
+THREADS = 8
+
+# How many directories are read ahead of the caller, per thread
+READ_AHEAD = 4
+
+# What scan() yields for each entry. The type is the same as in the
+# manifest ('d', 'f' or 'l'), or 'o' for anything else (devices, fifos, ...)
+walk_entry = namedtuple('walk_entry',['path','rel','name','type'])
+
+def entry_type(entry,follow_links=False):
+    """Return the type of the os.DirEntry 'entry', without a stat() where the platform allows it."""
+
+    try:
+        if entry.is_dir(follow_symlinks=follow_links): return 'd'
+        if entry.is_symlink(): return 'l'
+        if entry.is_file(follow_symlinks=False): return 'f'
+    except OSError:
+        pass    # it went away while we were looking at it
+
+    return 'o'
+
+class C_walker:
+    def __init__(self,msg=None,threads=THREADS):
+        """Constructor for the C_walker class. Initialize the
+        variables that we need to have in order for the class to
+        operate:
+
+        msgout  - the generic message handler for printing output (or None)
+        threads - the number of threads reading directories
+        errors  - the number of directories we could not read"""
+
+        self.msgout = msg
+        self.threads = max(1,int(threads))
+        self.errors = 0
+
+    def read(self,path,follow_links=False):
+        """Return the (name, type) of every entry in the directory 'path'."""
+
+        with os.scandir(path) as it:
+            return [(entry.name,entry_type(entry,follow_links)) for entry in it]
+
+    def listdir(self,path,follow_links=False):
+        """Return the names of the subdirectories and of everything else in
+        the directory 'path'. Symbolic links to directories count as
+        directories only if 'follow_links' is True, like os.path.isdir().
+        Raises OSError if the directory cannot be read."""
+
+        subdirs = []
+        files = []
+        for name, type in self.read(path,follow_links):
+            if type == 'd':
+                subdirs.append(name)
+            else:
+                files.append(name)
+
+        return subdirs, files
+
+    def failed(self,path,e):
+        self.errors = self.errors + 1
+        if self.msgout: self.msgout('Unable to read directory <%s>: %s' % (path,e))
+
+    def tree(self,top):
+        """The walk itself. Yields (root, entries, subdirs) for each directory
+        under top, where subdirs may be changed by the caller to prune the walk."""
+
+        from concurrent.futures import ThreadPoolExecutor
+
+        pool = None
+        if self.threads > 1: pool = ThreadPoolExecutor(max_workers=self.threads)
+
+        # each item is [path, the read of it (or None if it has not been started)]
+        stack = [[top,None]]
+        try:
+            while stack:
+                # start reading the directories we will get to next
+                if pool:
+                    for item in stack[-self.threads * READ_AHEAD:]:
+                        if item[1] is None: item[1] = pool.submit(self.read,item[0])
+
+                root, job = stack.pop()
+                try:
+                    if job is None:
+                        entries = self.read(root)
+                    else:
+                        entries = job.result()
+                except OSError as e:
+                    self.failed(root,e)
+                    continue
+
+                subdirs = [name for name, type in entries if type == 'd']
+                yield root, entries, subdirs
+
+                for name in reversed(subdirs):
+                    stack.append([os.path.join(root,name),None])
+        finally:
+            # the caller may have stopped early, so do not read any further
+            if pool: pool.shutdown(wait=True,cancel_futures=True)
+
+    def walk(self,top):
+        """Like os.walk(top), but with the directories read ahead by the pool
+        of threads. Yields (root, subdirs, files) for each directory, top
+        down, and subdirs may be changed to prune the walk."""
+
+        for root, entries, subdirs in self.tree(top):
+            yield root, subdirs, [name for name, type in entries if type != 'd']
+
+    def scan(self,top):
+        """Yield a walk_entry for everything under top (but not top itself)."""
+
+        for root, entries, subdirs in self.tree(top):
+            rel_root = os.path.relpath(root,top)
+            for name, type in entries:
+                rel = name
+                if rel_root != '.': rel = os.path.join(rel_root,name)
+                yield walk_entry(os.path.join(root,name),rel,name,type)
@@ -0,0 +1,281 @@
+import os
+import select
+import signal
+import struct
+import time
+
+from buver.cbuconfig import C_buconfig
+from buver.cjournal import JOURNAL_DIR, journal_append, journal_line, _lock
+from buver.cwalker import C_walker
+
+"""
+This module contains the code for the watcher class.
+
+The watcher runs alongside the backups ('buver --watch tgt_loc', started
+at boot or by hand, and left running). It reads the src_dir from the
+buver.conf of the tgt_loc, puts an inotify watch on every directory in it,
+and records each path that changes in the journal of the tgt_loc. The
+next backup uses the journal to look only at those paths, instead of
+walking the whole src_dir (see cjournal.py for the journal and for when
+a backup trusts it).
+
+inotify is Linux only, and is reached through ctypes, so there is nothing
+to install. Things to know about it:
+
+  - Each directory takes one watch. The number of watches is limited by
+    /proc/sys/fs/inotify/max_user_watches, which may need to be raised for
+    big trees. If a directory cannot be watched, the journal is marked as
+    having lost events, and the backups go back to full scans.
+  - If the watcher falls too far behind, the kernel drops events. This also
+    marks the journal as having lost events.
+  - Changes made through mmap() are not reported.
+
+The changes are collected in memory and appended to the journal about
+once a second, so a file that is written over and over only shows up once
+a second. The watcher runs until it is sent SIGTERM or SIGINT.
+
+execute() - watch the src_dir until we are told to stop
+"""
+
+# The inotify constants we use, from <sys/inotify.h>
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_DONT_FOLLOW = 0x02000000
+IN_EXCL_UNLINK = 0x04000000
+IN_ISDIR = 0x40000000
+IN_CLOEXEC = 0o2000000
+
+WATCH_MASK = (IN_MODIFY|IN_ATTRIB|IN_CLOSE_WRITE|IN_MOVED_FROM|IN_MOVED_TO|IN_CREATE|IN_DELETE|
+              IN_DELETE_SELF|IN_MOVE_SELF|IN_ONLYDIR|IN_DONT_FOLLOW|IN_EXCL_UNLINK)
+
+# struct inotify_event: wd, mask, cookie, len, then the name
+EVENT = struct.Struct('iIII')
+
+def _libc():
+    """Return libc with the inotify functions, or None if there is no inotify."""
+
+    import ctypes
+    import ctypes.util
+
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6',use_errno=True)
+        libc.inotify_init1.argtypes = [ctypes.c_int]
+        libc.inotify_add_watch.argtypes = [ctypes.c_int,ctypes.c_char_p,ctypes.c_uint32]
+        libc.inotify_rm_watch.argtypes = [ctypes.c_int,ctypes.c_int]
+    except (OSError,AttributeError):
+        return None
+
+    return libc
+
+class C_watcher:
+    def __init__(self,msg,tgt_loc,interval=1.0):
+        """Constructor for the C_watcher class. Initialize the
+        variables that we need to have in order for the class to
+        operate:
+
+        msgout   - the generic message handler for printing output
+        tgt_loc  - the tgt_loc whose src_dir we watch
+        interval - how often (in seconds) the changes are written out
+        wds      - the relative path of the directory of each watch
+        changes  - the journal lines waiting to be written out"""
+
+        self.msgout = msg
+        self.tgt_loc = os.path.abspath(tgt_loc)
+        self.jdir = os.path.join(self.tgt_loc,JOURNAL_DIR)
+        self.interval = interval
+        self.wds = {}
+        self.changes = {}
+        self.running = True
+        self.ifd = None
+        self.libc = None
+
+    def change(self,flag,rel):
+        """Remember a change, it is written out with the next batch."""
+
+        self.changes[journal_line(flag,rel)] = True
+
+    def lost(self,why):
+        self.msgout('Events were lost: %s' % why)
+        self.changes[journal_line('!',why)] = True
+
+    def add_watch(self,rel):
+        """Watch the directory at 'rel'. Returns 0 on success or 1 otherwise."""
+
+        import ctypes
+
+        path = os.path.normpath(os.path.join(self.src_dir,rel))
+        wd = self.libc.inotify_add_watch(self.ifd,os.fsencode(path),WATCH_MASK)
+        if wd < 0:
+            err = ctypes.get_errno()
+            if err in [2,20]: return 0      # ENOENT, ENOTDIR: it went away before we got to it
+            self.lost('unable to watch <%s>: %s' % (rel,os.strerror(err)))
+            return 1
+
+        self.wds[wd] = rel
+        return 0
+
+    def add_tree(self,rel):
+        """Watch the directory at 'rel' and everything under it."""
+
+        top = os.path.normpath(os.path.join(self.src_dir,rel))
+        for root, subdirs, files in C_walker().walk(top):
+            if self.add_watch(os.path.relpath(root,self.src_dir)): return 1
+
+        return 0
+
+    def remove_tree(self,rel):
+        """Stop watching the directory at 'rel' and everything under it.
+        This is for directories that were moved; their watches would go on
+        reporting events under the old path."""
+
+        for wd, wrel in list(self.wds.items()):
+            if wrel == rel or wrel.startswith(rel + os.sep):
+                self.libc.inotify_rm_watch(self.ifd,wd)
+                del self.wds[wd]
+
+    def event(self,wd,mask,name):
+        """Turn one inotify event into journal entries."""
+
+        if mask & IN_Q_OVERFLOW:
+            self.lost('the inotify queue overflowed')
+            return
+
+        if wd not in self.wds: return
+        dir_rel = self.wds[wd]
+
+        if mask & IN_IGNORED:
+            del self.wds[wd]
+            return
+
+        if mask & (IN_DELETE_SELF|IN_MOVE_SELF):
+            if dir_rel == '.': self.lost('the src_dir was removed or moved')
+            return
+
+        if not name:
+            self.change('f',dir_rel)
+            return
+
+        rel = os.path.normpath(os.path.join(dir_rel,name))
+        self.change('f',rel)
+
+        if mask & (IN_CREATE|IN_DELETE|IN_MOVED_FROM|IN_MOVED_TO):
+            self.change('d',dir_rel)
+
+        if mask & IN_ISDIR:
+            if mask & IN_MOVED_FROM:
+                self.remove_tree(rel)
+            if mask & (IN_CREATE|IN_MOVED_TO):
+                # anything could have happened in it before the watch was there
+                self.change('t',rel)
+                self.add_tree(rel)
+
+    def read_events(self):
+        """Read and handle whatever events the kernel has for us."""
+
+        try:
+            buf = os.read(self.ifd,1 << 16)
+        except BlockingIOError:
+            return
+
+        offset = 0
+        while offset + EVENT.size <= len(buf):
+            wd, mask, cookie, length = EVENT.unpack_from(buf,offset)
+            offset = offset + EVENT.size
+            name = os.fsdecode(buf[offset:offset + length].rstrip(b'\0'))
+            offset = offset + length
+            self.event(wd,mask,name)
+
+    def flush(self):
+        """Append the changes collected so far to the journal."""
+
+        if not self.changes: return
+
+        try:
+            journal_append(os.path.join(self.jdir,'journal'),list(self.changes.keys()))
+            self.changes = {}
+        except (IOError,OSError) as e:
+            self.msgout('Unable to write the journal: %s' % e)
+
+    def stop(self,signum,frame):
+        self.running = False
+
+    def execute(self):
+        """Watch the src_dir until we get SIGTERM or SIGINT. Returns 0 when
+        we stopped because we were told to, or 1 if we could not start."""
+
+        self.libc = _libc()
+        if self.libc is None or not hasattr(self.libc,'inotify_init1'):
+            self.msgout('inotify is not available on this platform')
+            return 1
+
+        config = C_buconfig(self.msgout,self.tgt_loc)
+        if config.load():
+            self.msgout('Failed loading the configuration file <%s> ... exiting ...' % config.name())
+            return 1
+        self.src_dir = os.path.abspath(config.opt_src_dir())
+
+        if not os.path.isdir(self.jdir):
+            try:
+                os.mkdir(self.jdir)
+            except OSError:
+                self.msgout('Unable to create the journal directory <%s>' % self.jdir)
+                return 1
+
+        # only one watcher per tgt_loc. The lock is held for as long as we run
+        lock_fd = os.open(os.path.join(self.jdir,'watcher'),os.O_RDWR|os.O_CREAT,0o644)
+        if not _lock(lock_fd,False,False):
+            self.msgout('Another watcher is already running for <%s>' % self.tgt_loc)
+            os.close(lock_fd)
+            return 1
+
+        # The id in there is from a watcher that is gone, and it missed whatever changed
+        # since it died. Drop it now, or a backup that runs while we add the watches
+        # would take it for ours, and trust a journal that has a hole in it
+        os.ftruncate(lock_fd,0)
+
+        self.ifd = self.libc.inotify_init1(IN_CLOEXEC|os.O_NONBLOCK)
+        if self.ifd < 0:
+            self.msgout('Unable to start inotify')
+            return 1
+
+        signal.signal(signal.SIGTERM,self.stop)
+        signal.signal(signal.SIGINT,self.stop)
+
+        start = time.time()
+        self.add_tree('.')
+        self.msgout('Watching %d directories in <%s> (took %.2f seconds)' % (len(self.wds),self.src_dir,time.time() - start))
+
+        # Only now that every directory is watched can a backup start to trust the journal
+        watcher_id = '%d.%d' % (os.getpid(),int(time.time() * 1000))
+        os.ftruncate(lock_fd,0)
+        os.write(lock_fd,('%s\t%s\n' % (watcher_id,self.src_dir)).encode('utf-8','surrogateescape'))
+
+        last = time.time()
+        try:
+            while self.running:
+                try:
+                    ready = select.select([self.ifd],[],[],self.interval)[0]
+                except InterruptedError:
+                    continue
+                if ready: self.read_events()
+
+                if time.time() - last >= self.interval:
+                    self.flush()
+                    last = time.time()
+        finally:
+            self.flush()
+            os.close(self.ifd)
+            os.close(lock_fd)
+
+        self.msgout('Stopped watching <%s>' % self.src_dir)
+        return 0
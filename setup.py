@@ -10,9 +10,11 @@ setup(name='buver',
       license='Apache',
       packages=['buver'],
       install_requires=['kenl380.pylib'],
+      extras_require={'dedup':['numpy']},
       entry_points = {
         'console_scripts': ['buver=buver.buver:buver_entry',
-                            'buver{}=buver.buver:buver_entry'.format(version_info.major)
+                            'buver{}=buver.buver:buver_entry'.format(version_info.major),
+                            'buver-bench=buver.cbench:bench_entry'
                            ],
       },
       zip_safe=False)
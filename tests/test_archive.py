@@ -0,0 +1,76 @@
+import os
+import shutil
+import tarfile
+import tempfile
+import unittest
+
+from buver.carchive import C_archive, load_members, open_archive
+
+"""
+Tests for the builtin engine's archives, with files that change while
+they are being archived.
+"""
+
+def message(msgstr): pass
+
+class T_archive(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.src = os.path.join(self.tmp,'src')
+        self.version = os.path.join(self.tmp,'version')
+        os.makedirs(self.src)
+        os.makedirs(self.version)
+        for name in ['a','b','c']:
+            f = open(os.path.join(self.src,name),'wb')
+            f.write(name.encode('utf-8') * 100000)
+            f.close()
+
+        self.gettarinfo = tarfile.TarFile.gettarinfo
+
+    def tearDown(self):
+        tarfile.TarFile.gettarinfo = self.gettarinfo
+        shutil.rmtree(self.tmp)
+
+    def shrink(self,name,size):
+        """Truncate 'name' to 'size' bytes just after its header has been made."""
+
+        gettarinfo = self.gettarinfo
+        def shrinking(tar,path,arcname):
+            tarinfo = gettarinfo(tar,path,arcname)
+            if arcname == name: os.truncate(path,size)
+            return tarinfo
+        tarfile.TarFile.gettarinfo = shrinking
+
+    def check(self,compress,suffix):
+        archive = os.path.join(self.version,'backup.tar%s' % suffix)
+        self.shrink('b',1000)
+        archiver = C_archive(message,self.src,archive,compress,2)
+        self.assertEqual(archiver.run(),1)
+        self.assertEqual(archiver.errors,1)
+        self.assertEqual(archiver.files,3)
+
+        # the shrunk member is padded, and the ones after it are intact
+        f = open_archive(archive)
+        tar = tarfile.open(fileobj=f,mode='r|')
+        members = {}
+        offsets = []
+        for tarinfo in tar:
+            offsets.append((tarinfo.offset,tarinfo.name))
+            if tarinfo.isreg(): members[tarinfo.name] = tar.extractfile(tarinfo).read()
+        tar.close()
+        f.close()
+        self.assertEqual(members['a'],b'a' * 100000)
+        self.assertEqual(members['b'],b'b' * 1000 + bytes(99000))
+        self.assertEqual(members['c'],b'c' * 100000)
+
+        # and so is the member index
+        self.assertEqual([(offset,name) for offset, size, name in load_members(self.version)],offsets)
+
+    def test_tar(self):
+        self.check(False,'')
+
+    def test_gzip(self):
+        self.check(True,'.gz')
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,151 @@
+import json
+import os
+import shutil
+import sqlite3
+import tempfile
+import unittest
+
+from buver.cbuver import C_buver
+from buver.ccatalog import C_catalog
+from tgtloc import init_tgt_loc, set_conf
+
+"""
+Tests for the catalog: what the backups record in it, writing it in one
+transaction, bringing it back in line with ver_dirs, and 'buver --list'.
+"""
+
+def message(msgstr): pass
+
+class C_fake_config:
+    """What commit() needs from a C_buconfig."""
+
+    def __init__(self,tgt_loc,versions):
+        self.tgt_loc = tgt_loc
+        self.logical_versions = versions
+
+    def opt_src_dir(self): return '/src'
+    def opt_type(self): return 'tree'
+    def opt_num_versions(self): return '3'
+
+class T_catalog(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.src = os.path.join(self.tmp,'src')
+        self.tgt = os.path.join(self.tmp,'tgt')
+        self.db = os.path.join(self.tmp,'catalog.db')
+        os.makedirs(self.src)
+        open(os.path.join(self.src,'file'),'w').write('0123456789')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def backup(self):
+        buver = C_buver(1,self.tgt)
+        try:
+            self.assertEqual(buver.execute(),0)
+        finally:
+            buver.close()
+
+    def query(self,sql,params=()):
+        conn = sqlite3.connect(self.db)
+        try:
+            return conn.execute(sql,params).fetchall()
+        finally:
+            conn.close()
+
+    def versions(self):
+        """Return the versions in the catalog that are still there, and the ones that were pruned."""
+
+        rows = self.query('SELECT version, pruned FROM versions ORDER BY version')
+        return [v for v, pruned in rows if pruned is None], [v for v, pruned in rows if pruned is not None]
+
+    def test_backups(self):
+        init_tgt_loc(self.tgt,src_dir=self.src,engine='builtin',num_versions='2',mailto='',catalog=self.db)
+        for n in range(3): self.backup()
+
+        self.assertEqual(self.versions(),([2,3],[1]))
+        self.assertEqual(self.query('SELECT size, files FROM versions WHERE version=3'),[(10,1)])
+        self.assertEqual(self.query('SELECT version, rc FROM runs ORDER BY id'),[(1,0),(2,0),(3,0)])
+        jobs = self.query('SELECT tgt_loc, src_dir, num_versions, ver_dirs FROM jobs')
+        self.assertEqual(jobs,[(self.tgt,self.src,2,json.dumps(['2','3']))])
+
+    def test_commit(self):
+        catalog = C_catalog(message,self.db)
+        self.assertEqual(catalog.open(),0)
+        version = os.path.join(self.tmp,'versions','1')
+        os.makedirs(version)
+        catalog.add_version(version,1000.0)
+        catalog.add_run(version,1000.0,5.0,0)
+
+        # nothing is written until the commit
+        self.assertEqual(self.query('SELECT * FROM versions'),[])
+        self.assertEqual(catalog.commit(C_fake_config(self.tgt,['1'])),0)
+        self.assertEqual(catalog.pending,[])
+        self.assertEqual(self.versions(),([1],[]))
+        self.assertEqual(self.query('SELECT version, wall FROM runs'),[(1,5.0)])
+
+        # and a commit that fails writes none of it, not even the job
+        catalog.prune(version)
+        catalog.add_run(version,2000.0,5.0,0)
+        catalog.queue('INSERT INTO nowhere VALUES (:job)',{})
+        self.assertEqual(catalog.commit(C_fake_config(self.tgt,[])),1)
+        self.assertEqual(len(catalog.pending),3)
+        self.assertEqual(self.versions(),([1],[]))
+        self.assertEqual(len(self.query('SELECT * FROM runs')),1)
+        self.assertEqual(self.query('SELECT ver_dirs FROM jobs'),[(json.dumps(['1']),)])
+        catalog.close()
+
+    def test_check(self):
+        init_tgt_loc(self.tgt,src_dir=self.src,engine='builtin',num_versions='2',mailto='',catalog=self.db)
+        self.backup()
+        self.backup()
+
+        # two backups that did not write the catalog, which prune the versions it knows of
+        set_conf(self.tgt,catalog='')
+        self.backup()
+        self.backup()
+        self.assertEqual(self.versions(),([1,2],[]))
+
+        # the next one that does finds out, and brings it up to date
+        catalog = C_catalog(message,self.db)
+        self.assertEqual(catalog.open(),0)
+        self.assertEqual(catalog.check(self.tgt,['3','4'],os.path.join(self.tgt,'versions')),4)
+        catalog.close()
+
+        set_conf(self.tgt,catalog=self.db)
+        self.backup()
+        self.assertEqual(self.versions(),([4,5],[1,2,3]))
+        self.assertEqual(self.query('SELECT version FROM runs ORDER BY id'),[(1,),(2,),(5,)])
+
+        catalog = C_catalog(message,self.db)
+        self.assertEqual(catalog.open(),0)
+        self.assertEqual(catalog.check(self.tgt,['4','5'],os.path.join(self.tgt,'versions')),0)
+        self.assertEqual(catalog.pending,[])
+        catalog.close()
+
+    def test_list(self):
+        init_tgt_loc(self.tgt,src_dir=self.src,engine='builtin',num_versions='2',mailto='',catalog=self.db)
+        self.backup()
+        self.backup()
+
+        lines = []
+        self.assertEqual(C_catalog(lines.append,self.db).execute(),0)
+        self.assertEqual(lines[0].split(),['VERSION','CREATED','SIZE','FILES','TGT_LOC'])
+        rows = [line.split() for line in lines[1:-1]]
+        self.assertEqual([(row[0],row[3],row[4],row[5]) for row in rows],[('1','10','1',self.tgt),('2','10','1',self.tgt)])
+        self.assertEqual(lines[-1],'1 jobs, 2 versions, 20 bytes')
+
+        # a catalog that does not agree with ver_dirs is pointed out
+        conn = sqlite3.connect(self.db)
+        conn.execute('UPDATE jobs SET ver_dirs=?',(json.dumps(['2']),))
+        conn.commit()
+        conn.close()
+        lines = []
+        self.assertEqual(C_catalog(lines.append,self.db).execute(),0)
+        self.assertTrue(lines[-2].startswith('WARNING: the versions of <%s>' % self.tgt))
+
+        # and there is nothing to list without a catalog
+        self.assertEqual(C_catalog(message,os.path.join(self.tmp,'missing.db')).execute(),1)
+
+if __name__ == '__main__':
+    unittest.main()
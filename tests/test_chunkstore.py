@@ -0,0 +1,172 @@
+import os
+import random
+import shutil
+import tempfile
+import unittest
+
+import buver.cchunkstore as cchunkstore
+from buver.cchunkstore import C_chunkstore, MIN_CHUNK, MAX_CHUNK
+
+"""
+Tests for the chunk store of the 'dedup' type: where the chunks are cut,
+storing and deduplicating them, the reference counts, and putting the
+files back together from a recipe.
+"""
+
+def message(msgstr): pass
+
+class T_chunkstore(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.src = os.path.join(self.tmp,'src')
+        self.tgt = os.path.join(self.tmp,'tgt')
+        os.makedirs(os.path.join(self.src,'sub'))
+        os.makedirs(os.path.join(self.tgt,'versions'))
+        self.rnd = random.Random(1)
+        self.numpy = cchunkstore.numpy
+
+    def tearDown(self):
+        cchunkstore.numpy = self.numpy
+        shutil.rmtree(self.tmp)
+
+    def random_bytes(self,n):
+        return bytes(self.rnd.getrandbits(8) for i in range(n))
+
+    def write(self,name,data):
+        f = open(os.path.join(self.src,name),'wb')
+        f.write(data)
+        f.close()
+
+    def backup(self,n):
+        """Store the src_dir as version 'n', and return the chunk store."""
+
+        version = os.path.join(self.tgt,'versions',str(n))
+        os.makedirs(version)
+        chunks = C_chunkstore(message,self.tgt)
+        self.assertEqual(chunks.backup(self.src,version),0)
+        return chunks
+
+    def recipe(self,n):
+        chunks = C_chunkstore(message,self.tgt)
+        return dict((rec['path'],rec) for rec in chunks.recipe(os.path.join(self.tgt,'versions',str(n))))
+
+    def refs(self):
+        chunks = C_chunkstore(message,self.tgt)
+        self.assertEqual(chunks.load(),0)
+        return chunks.refs
+
+    def chunk_files(self):
+        found = set()
+        for root, subdirs, files in os.walk(os.path.join(self.tgt,'chunks')):
+            if root != os.path.join(self.tgt,'chunks'): found.update(files)
+        return found
+
+    @unittest.skipIf(cchunkstore.numpy is None,'numpy is not installed')
+    def test_cut_numpy(self):
+        # the chunks must be cut in the same places with or without numpy, or nothing dedups
+        chunks = C_chunkstore(message,self.tgt)
+        data = self.random_bytes(3 * MAX_CHUNK)
+        cuts = 0
+        for offset in [0,1,1000,MIN_CHUNK,MAX_CHUNK - 5]:
+            for size in [MIN_CHUNK + 1,MIN_CHUNK + 100,MAX_CHUNK // 2,MAX_CHUNK,2 * MAX_CHUNK]:
+                buf = memoryview(data)[offset:offset + size]
+                n = chunks.cut(buf)
+                self.assertEqual(n,chunks.cut_python(buf,min(len(buf),MAX_CHUNK)),(offset,size))
+                if n < min(len(buf),MAX_CHUNK): cuts = cuts + 1
+        self.assertGreater(cuts,0)
+
+        # and a whole file splits the same way
+        self.write('big',data)
+        f = open(os.path.join(self.src,'big'),'rb')
+        with_numpy = [len(chunk) for chunk in chunks.split(f)]
+        f.close()
+        cchunkstore.numpy = None
+        f = open(os.path.join(self.src,'big'),'rb')
+        without = [len(chunk) for chunk in chunks.split(f)]
+        f.close()
+        self.assertEqual(with_numpy,without)
+        self.assertGreater(len(with_numpy),3)
+
+    def test_dedup(self):
+        data = self.random_bytes(2 * MAX_CHUNK)
+        self.write('a',data)
+        self.write('sub/copy',data)
+        self.write('small',b'small')
+        chunks = self.backup(1)
+
+        recipe = self.recipe(1)
+        self.assertEqual(recipe['a']['chunks'],recipe['sub/copy']['chunks'])
+        self.assertEqual(chunks.dup_bytes,len(data))
+        self.assertEqual(len(self.chunk_files()),len(set(recipe['a']['chunks'])) + 1)
+        for cid in recipe['a']['chunks']: self.assertEqual(self.refs()[cid],2)
+
+        # a few bytes put in the middle only change the chunks around them
+        self.write('a',data[:MAX_CHUNK] + b'inserted' + data[MAX_CHUNK:])
+        chunks = self.backup(2)
+        old = set(recipe['a']['chunks'])
+        new = self.recipe(2)['a']['chunks']
+        self.assertLessEqual(len([cid for cid in new if cid not in old]),2)
+        self.assertGreater(chunks.dup_bytes,len(data))
+
+    def test_restore(self):
+        data = self.random_bytes(MAX_CHUNK + MIN_CHUNK) + b'buver' * 100000
+        self.write('a',data)
+        self.write('sub/empty',b'')
+        os.symlink('a',os.path.join(self.src,'link'))
+        chunks = self.backup(1)
+
+        recipe = self.recipe(1)
+        self.assertEqual(b''.join(chunks.get(cid) for cid in recipe['a']['chunks']),data)
+        self.assertEqual(recipe['sub/empty']['chunks'],[])
+        self.assertEqual(recipe['link']['target'],'a')
+        self.assertEqual(recipe['sub']['type'],'d')
+
+    def test_release_collect(self):
+        self.write('kept',self.random_bytes(MIN_CHUNK))
+        self.write('gone',self.random_bytes(MIN_CHUNK))
+        self.backup(1)
+        os.remove(os.path.join(self.src,'gone'))
+        self.write('new',self.random_bytes(MIN_CHUNK))
+        self.backup(2)
+
+        kept = self.recipe(1)['kept']['chunks'][0]
+        gone = self.recipe(1)['gone']['chunks'][0]
+        new = self.recipe(2)['new']['chunks'][0]
+        self.assertEqual(self.refs(),{kept:2,gone:1,new:1})
+
+        # prune version 1, as the prune does
+        chunks = C_chunkstore(message,self.tgt)
+        self.assertEqual(chunks.release(os.path.join(self.tgt,'versions','1')),0)
+        self.assertTrue(os.path.isfile(chunks.dirty_name))
+        self.assertEqual(chunks.collect(),0)
+        self.assertFalse(os.path.isfile(chunks.dirty_name))
+        self.assertEqual(self.refs(),{kept:1,new:1})
+        self.assertEqual(self.chunk_files(),set([kept,new]))
+
+    def test_rebuild(self):
+        self.write('a',self.random_bytes(MIN_CHUNK))
+        self.backup(1)
+        self.backup(2)
+        cid = self.recipe(1)['a']['chunks'][0]
+
+        # a run that died after writing a chunk, but before it saved the counts
+        chunks = C_chunkstore(message,self.tgt)
+        orphan = chunks.chunk_path('ff' + cid[2:])
+        os.makedirs(os.path.dirname(orphan))
+        open(orphan,'wb').write(b'orphan')
+        open(chunks.chunk_path(cid) + '.%d' % os.getpid(),'wb').write(b'partial')
+        open(chunks.dirty_name,'w').close()
+
+        # the next load sees the mark, and counts again from the recipes
+        self.assertEqual(chunks.load(),0)
+        self.assertEqual(chunks.refs,{cid:2,os.path.basename(orphan):0})
+        self.assertEqual(chunks.collect(),0)
+        self.assertFalse(os.path.exists(orphan))
+        self.assertEqual(self.refs(),{cid:2})
+
+        # and so does a load with no refs file at all
+        os.remove(chunks.refs_name)
+        self.assertEqual(self.refs(),{cid:2})
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,143 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from buver.ccopytree import C_copytree
+from buver.cmanifest import C_manifest, new_hash
+
+"""
+Tests for the copy engine of the 'tree' and 'link' types.
+"""
+
+def message(msgstr): pass
+
+class T_change_detection(unittest.TestCase):
+    """The manifest of the previous version decides what changed, by stat()."""
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.src = os.path.join(self.tmp,'src')
+        os.makedirs(os.path.join(self.src,'sub'))
+        for name in ['same','grown','touched','sub/rewritten']: self.write(name,'%s\n' % name)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def write(self,name,data):
+        f = open(os.path.join(self.src,name),'r+' if os.path.exists(os.path.join(self.src,name)) else 'w')
+        f.write(data)
+        f.truncate()
+        f.close()
+
+    def copy(self,n,prev=None):
+        """Copy the src_dir into version 'n', linked to version n-1 if there is a 'prev' manifest."""
+
+        version = os.path.join(self.tmp,str(n))
+        os.makedirs(version)
+        manifest = C_manifest(version)
+        self.assertEqual(manifest.create(),0)
+        link_dest = os.path.join(self.tmp,str(n - 1),'src') if prev else None
+        copier = C_copytree(message,self.src,os.path.join(version,'src'),link_dest,2,manifest,prev,hashing=True)
+        self.assertEqual(copier.run(),0)
+        self.assertEqual(manifest.close(),0)
+
+        loaded = C_manifest(version)
+        self.assertEqual(loaded.load(),0)
+        return copier, loaded
+
+    def test_detection(self):
+        copier, first = self.copy(1)
+        self.assertEqual(copier.files,4)
+        self.assertEqual(sorted(rec.path for rec in first.records()),['.','grown','same','sub','sub/rewritten','touched'])
+        h = new_hash()
+        h.update(b'same\n')
+        self.assertEqual(first.get('same').hash,h.hexdigest())
+
+        self.write('grown','grown some more\n')
+        path = os.path.join(self.src,'touched')
+        os.utime(path,ns=(0,os.stat(path).st_mtime_ns + 10 ** 9))
+
+        # a rewrite that keeps the size and the mtime is not seen, the stat() is all that is looked at
+        path = os.path.join(self.src,'sub','rewritten')
+        st = os.stat(path)
+        self.write('sub/rewritten','SUB/REWRITTEN\n')
+        os.utime(path,ns=(st.st_atime_ns,st.st_mtime_ns))
+
+        copier, second = self.copy(2,first)
+        self.assertEqual((copier.files,copier.links),(2,2))
+        for name in ['same','sub/rewritten']:
+            self.assertEqual(os.stat(os.path.join(self.tmp,'1','src',name)).st_ino,
+                             os.stat(os.path.join(self.tmp,'2','src',name)).st_ino)
+            # and the hash of a linked file is carried forward, not worked out again
+            self.assertEqual(second.get(name).hash,first.get(name).hash)
+
+        self.assertEqual(second.get('grown').size,len('grown some more\n'))
+        self.assertNotEqual(second.get('touched').mtime,first.get('touched').mtime)
+        self.assertTrue(second.unchanged('grown',os.stat(os.path.join(self.src,'grown'))))
+
+class T_strategies(unittest.TestCase):
+    """How the data is copied: holes stay holes, and hashing reads the data."""
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.src = os.path.join(self.tmp,'src')
+        os.makedirs(self.src)
+
+        # a file of 8 MB with two blocks of data, one of them at the very end
+        self.size = 8 << 20
+        f = open(os.path.join(self.src,'sparse'),'wb')
+        f.truncate(self.size)
+        f.seek(1 << 20)
+        f.write(b'x' * 4096)
+        f.seek(self.size - 4096)
+        f.write(b'y' * 4096)
+        f.close()
+
+        f = open(os.path.join(self.src,'dense'),'wb')
+        f.write(os.urandom(1 << 20))
+        f.close()
+
+        if os.stat(os.path.join(self.src,'sparse')).st_blocks * 512 >= self.size:
+            self.skipTest('the filesystem of %s does not keep holes' % self.tmp)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def copy(self,hashing):
+        dst = os.path.join(self.tmp,'dst%d' % hashing)
+        manifest = C_manifest(self.tmp)
+        self.assertEqual(manifest.create(),0)
+        copier = C_copytree(message,self.src,dst,threads=2,manifest=manifest,hashing=hashing)
+        self.assertEqual(copier.run(),0)
+        manifest.close()
+        manifest.load()
+
+        for name in ['sparse','dense']:
+            self.assertEqual(open(os.path.join(dst,name),'rb').read(),open(os.path.join(self.src,name),'rb').read())
+        self.assertEqual(sum(copier.strategies.values()),2)
+        return copier, dst, manifest
+
+    def test_sparse(self):
+        copier, dst, manifest = self.copy(False)
+        st = os.stat(os.path.join(dst,'sparse'))
+        self.assertEqual(st.st_size,self.size)
+        self.assertLess(st.st_blocks * 512,self.size // 2)
+        if 'clone' not in copier.strategies:
+            self.assertEqual(copier.strategies.get('sparse'),1)
+            self.assertGreaterEqual(copier.holes,self.size - 2 * 4096 - (1 << 20))
+
+    def test_hashing(self):
+        # the data has to go through us, so nothing is cloned, but the holes stay holes
+        copier, dst, manifest = self.copy(True)
+        self.assertNotIn('clone',copier.strategies)
+        self.assertEqual(copier.strategies.get('sparse'),1)
+        self.assertLess(os.stat(os.path.join(dst,'sparse')).st_blocks * 512,self.size // 2)
+
+        for name in ['sparse','dense']:
+            h = new_hash()
+            h.update(open(os.path.join(self.src,name),'rb').read())
+            self.assertEqual(manifest.get(name).hash,h.hexdigest())
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,120 @@
+import os
+import shutil
+import stat
+import tempfile
+import threading
+import time
+import unittest
+
+import buver.cdaemon as cdaemon
+from buver.cdaemon import C_daemon, C_client
+from tgtloc import init_tgt_loc
+
+"""
+Tests for the daemon and its request protocol, over a real socket.
+"""
+
+def message(msgstr): pass
+
+def C_broken_buver(*args):
+    """Takes the place of C_buver in the daemon, and fails to construct."""
+
+    raise IOError('no such tgt_loc')
+
+class T_daemon(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.src = os.path.join(self.tmp,'src')
+        self.tgt = os.path.join(self.tmp,'tgt')
+        os.makedirs(self.src)
+        open(os.path.join(self.src,'a'),'w').write('a')
+
+        init_tgt_loc(self.tgt,src_dir=self.src,engine='builtin')
+
+        self.daemon = C_daemon(message,os.path.join(self.tmp,'sock'),workers=2)
+        self.thread = threading.Thread(target=self.daemon.execute)
+        self.thread.start()
+        # the socket is there from bind(), but only takes connections after listen()
+        if not self.daemon.listening.wait(10):
+            self.tearDown()
+            self.fail('the daemon did not start listening')
+
+    def tearDown(self):
+        self.daemon.running = False
+        self.thread.join()
+        shutil.rmtree(self.tmp)
+
+    def send(self,request):
+        lines = []
+        rc = C_client(lines.append,request,self.daemon.socket_name).execute()
+        return rc, lines
+
+    def test_backup(self):
+        self.assertEqual(self.send('backup %s' % self.tgt),(0,[]))
+        self.assertEqual(self.send('backup %s' % self.tgt),(0,[]))
+        self.assertEqual(sorted(os.listdir(os.path.join(self.tgt,'versions'))),['1','2'])
+
+        rc, lines = self.send('status')
+        self.assertEqual(rc,0)
+        self.assertEqual(lines,['%s runs=2 last_rc=0 config_hits=1 versions_hits=1' % self.tgt])
+
+    def test_unknown(self):
+        rc, lines = self.send('restore %s' % self.tgt)
+        self.assertEqual(rc,1)
+        self.assertTrue(lines[0].startswith('error unknown request'))
+
+    def test_src_dir_gone(self):
+        self.assertEqual(self.send('backup %s' % self.tgt)[0],0)
+
+        # the buver.conf did not change, but the cached config is not used
+        shutil.rmtree(self.src)
+        self.assertNotEqual(self.send('backup %s' % self.tgt)[0],0)
+        self.assertEqual(sorted(os.listdir(os.path.join(self.tgt,'versions'))),['1'])
+
+    def test_forget_while_running(self):
+        self.assertEqual(self.send('backup %s' % self.tgt)[0],0)
+        cache = self.daemon.cache(self.tgt)
+        self.assertIsNotNone(cache.config)
+
+        # hold the lock, as a backup that is running does
+        results = []
+        with cache.lock:
+            forget = threading.Thread(target=lambda: results.append(self.send('forget %s' % self.tgt)))
+            forget.start()
+            time.sleep(0.2)
+            self.assertEqual(results,[])
+
+            # and a backup sent meanwhile waits for the same lock
+            backup = threading.Thread(target=lambda: results.append(self.send('backup %s' % self.tgt)))
+            backup.start()
+            time.sleep(0.2)
+            self.assertEqual(results,[])
+            self.assertIs(self.daemon.cache(self.tgt),cache)
+
+        forget.join()
+        backup.join()
+        self.assertEqual(results,[(0,[]),(0,[])])
+        self.assertEqual(cache.runs,2)
+
+    def test_socket_mode(self):
+        self.assertEqual(stat.S_IMODE(os.stat(self.daemon.socket_name).st_mode),0o600)
+
+    def test_construct_fails(self):
+        saved = cdaemon.C_buver
+        cdaemon.C_buver = C_broken_buver
+        try:
+            self.assertEqual(self.send('backup %s' % self.tgt)[0],-1)
+        finally:
+            cdaemon.C_buver = saved
+
+        # and the daemon is still serving
+        self.assertEqual(self.send('backup %s' % self.tgt),(0,[]))
+        self.assertEqual(self.daemon.cache(self.tgt).runs,2)
+
+    def test_stop(self):
+        self.assertEqual(self.send('stop'),(0,[]))
+        self.thread.join()
+        self.assertFalse(os.path.exists(self.daemon.socket_name))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,108 @@
+import os
+import random
+import shutil
+import tempfile
+import unittest
+
+from buver.cbuver import C_buver
+from tgtloc import init_tgt_loc
+from buver.cdelta import DELTA_DIR, apply_delta, load_deltas, read_header
+
+"""
+Tests for the deltas of the 'link' type, made by running backups.
+"""
+
+class T_delta(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.src = os.path.join(self.tmp,'src')
+        self.tgt = os.path.join(self.tmp,'tgt')
+        self.big = os.path.join(self.src,'big')
+        os.makedirs(self.src)
+        self.rnd = random.Random(1)
+        self.data = bytearray(self.rnd.getrandbits(8) for n in range(1 << 20))
+        self.write()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def write(self):
+        f = open(self.big,'wb')
+        f.write(self.data)
+        f.close()
+
+    def configure(self,**values):
+        values.update(src_dir=self.src,type='link',engine='builtin',num_versions='10',mailto='')
+        init_tgt_loc(self.tgt,**values)
+
+    def backup(self):
+        buver = C_buver(1,self.tgt)
+        try:
+            self.assertEqual(buver.execute(),0)
+        finally:
+            buver.close()
+
+    def version(self,n):
+        return os.path.join(self.tgt,'versions',str(n))
+
+    def chain(self,n):
+        """Return how many deltas in a row the big file is at in version 'n' (0 is a full copy)."""
+
+        deltas = load_deltas(self.version(n))
+        if 'big' not in deltas: return 0
+        return read_header(os.path.join(self.version(n),DELTA_DIR,deltas['big'] + '.delta'))['chain']
+
+    def change(self):
+        offset = self.rnd.randrange(len(self.data) - 100)
+        self.data[offset:offset + 100] = bytes(self.rnd.getrandbits(8) for n in range(100))
+        self.write()
+
+    def test_chain(self):
+        self.configure(delta_min_size='256K',delta_max_chain='2',delta_partial_tree='yes')
+        self.backup()
+        for n in range(2,8):
+            self.change()
+            self.backup()
+
+            # the last version's delta puts back what we backed up
+            deltas = load_deltas(self.version(n))
+            if 'big' in deltas:
+                name = os.path.join(self.version(n),DELTA_DIR,deltas['big'])
+                out = []
+                apply_delta(name + '.delta',name + '.base',out.append)
+                self.assertEqual(b''.join(out),bytes(self.data))
+                self.assertFalse(os.path.exists(os.path.join(self.version(n),'src','big')))
+            else:
+                self.assertEqual(open(os.path.join(self.version(n),'src','big'),'rb').read(),bytes(self.data))
+
+        # after delta_max_chain deltas in a row, the file is copied in full again
+        self.assertEqual([self.chain(n) for n in range(1,8)],[0,1,2,0,1,2,0])
+
+    def test_not_accepted(self):
+        # without delta_partial_tree, every version is a full tree
+        self.configure(delta_min_size='256K',delta_max_chain='2')
+        self.backup()
+        self.change()
+        self.backup()
+        self.assertEqual(load_deltas(self.version(2)),{})
+        self.assertEqual(open(os.path.join(self.version(2),'src','big'),'rb').read(),bytes(self.data))
+
+    def test_damaged_header(self):
+        self.configure(delta_min_size='256K',delta_max_chain='2',delta_partial_tree='yes')
+        self.backup()
+        self.change()
+        self.backup()
+        self.assertEqual(self.chain(2),1)
+
+        # a delta we cannot read the chain from is not built upon, the file is copied in full
+        name = os.path.join(self.version(2),DELTA_DIR,load_deltas(self.version(2))['big'] + '.delta')
+        data = open(name,'rb').read()
+        os.remove(name)
+        open(name,'wb').write(b'{"path": "big"' + data[data.index(b'\n'):])
+        self.change()
+        self.backup()
+        self.assertEqual(self.chain(3),0)
+        self.assertEqual(open(os.path.join(self.version(3),'src','big'),'rb').read(),bytes(self.data))
+
+if __name__ == '__main__':
+    unittest.main()
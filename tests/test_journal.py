@@ -0,0 +1,244 @@
+import fcntl
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+from buver.cbuver import C_buver
+from buver.cjournal import C_journal, JOURNAL_DIR, JOURNAL_HEADER, journal_append, journal_line
+from buver.cmanifest import C_manifest
+from tgtloc import init_tgt_loc
+
+"""
+Tests for the change journal: when claim() trusts it, taking it while the
+watcher writes, and walk() and stat() against a real tree. The watcher is
+played by the test, which holds the lock on the watcher file as it would.
+"""
+
+def message(msgstr): pass
+
+class T_journal(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.src = os.path.join(self.tmp,'src')
+        self.tgt = os.path.join(self.tmp,'tgt')
+        self.jdir = os.path.join(self.tgt,JOURNAL_DIR)
+        for name in ['a/x','b/y','c/z/deep','top']: self.write(name)
+        os.makedirs(self.jdir)
+        self.watcher_fd = None
+
+    def tearDown(self):
+        if self.watcher_fd is not None: os.close(self.watcher_fd)
+        shutil.rmtree(self.tmp)
+
+    def write(self,name,data='data'):
+        path = os.path.join(self.src,name)
+        if not os.path.isdir(os.path.dirname(path)): os.makedirs(os.path.dirname(path))
+        f = open(path,'w')
+        f.write(data)
+        f.close()
+
+    def start_watcher(self,watcher_id='1.1',src_dir=None):
+        """Do what a watcher does once it watches everything: hold the lock and write its id."""
+
+        self.watcher_fd = os.open(os.path.join(self.jdir,'watcher'),os.O_RDWR|os.O_CREAT,0o644)
+        fcntl.flock(self.watcher_fd,fcntl.LOCK_EX)
+        os.write(self.watcher_fd,('%s\t%s\n' % (watcher_id,src_dir or self.src)).encode())
+
+    def set_state(self,state):
+        f = open(os.path.join(self.jdir,'state'),'w')
+        f.write('%s\n' % state)
+        f.close()
+
+    def journal(self,*lines):
+        journal_append(os.path.join(self.jdir,'journal'),[journal_line(flag,rel) for flag, rel in lines])
+
+    def manifest(self):
+        """Return a loaded manifest of the src_dir as it is now."""
+
+        version = os.path.join(self.tmp,'version')
+        os.makedirs(version)
+        manifest = C_manifest(version)
+        self.assertEqual(manifest.create(),0)
+        for root, subdirs, files in os.walk(self.src):
+            for name in ['.'] + subdirs + files:
+                path = os.path.normpath(os.path.join(root,name))
+                manifest.add(os.path.relpath(path,self.src),os.lstat(path))
+        self.assertEqual(manifest.close(),0)
+
+        loaded = C_manifest(version)
+        self.assertEqual(loaded.load(),0)
+        return loaded
+
+    def claim(self,prev='manifest'):
+        if prev == 'manifest': prev = self.manifest()
+        journal = C_journal(message,self.tgt)
+        return journal, journal.claim(self.src,prev)
+
+    def test_claim(self):
+        self.start_watcher()
+        self.set_state('1.1')
+        self.journal(('f','top'))
+        journal, valid = self.claim()
+        self.assertTrue(valid)
+        self.assertEqual(journal.entries,set(['top']))
+
+        # the journal was taken, and until the backup commits nothing can be trusted
+        self.assertFalse(os.path.exists(os.path.join(self.jdir,'journal')))
+        self.assertEqual(journal.read_file('state'),'-')
+        self.assertEqual(journal.commit(),0)
+        self.assertEqual(journal.read_file('state'),'1.1')
+
+    def test_no_watcher(self):
+        # the id is there, but nobody holds the lock
+        f = open(os.path.join(self.jdir,'watcher'),'w')
+        f.write('1.1\t%s\n' % self.src)
+        f.close()
+        self.set_state('1.1')
+        journal, valid = self.claim()
+        self.assertFalse(valid)
+        self.assertIsNone(journal.watcher)
+
+        # and the next backup does not trust it either
+        self.assertEqual(journal.commit(),0)
+        self.assertEqual(journal.read_file('state'),'-')
+
+    def test_wrong_watcher(self):
+        # the watcher that is running started after the last backup
+        self.start_watcher('2.2')
+        self.set_state('1.1')
+        self.assertFalse(self.claim()[1])
+
+    def test_other_src_dir(self):
+        self.start_watcher('1.1',os.path.join(self.tmp,'other'))
+        self.set_state('1.1')
+        self.assertFalse(self.claim()[1])
+
+    def test_lost_events(self):
+        self.start_watcher()
+        self.set_state('1.1')
+        self.journal(('f','top'),('!','the inotify queue overflowed'))
+        self.assertFalse(self.claim()[1])
+
+    def test_no_prev(self):
+        self.start_watcher()
+        self.set_state('1.1')
+        self.assertFalse(self.claim(None)[1])
+
+    def test_no_journal(self):
+        shutil.rmtree(self.jdir)
+        journal, valid = self.claim()
+        self.assertFalse(valid)
+        self.assertFalse(os.path.exists(self.jdir))
+
+    def test_take(self):
+        self.journal(('f','a/x'),('d','a'),('t','c/n'))
+        journal = C_journal(message,self.tgt)
+        self.assertTrue(journal.take())
+        self.assertEqual((journal.entries,journal.listings,journal.trees),(set(['a/x']),set(['a']),set(['c/n'])))
+        self.assertEqual(os.listdir(self.jdir),[])
+
+        # what the watcher writes next goes into a new journal
+        self.journal(('f','b/y'))
+        self.assertEqual(open(os.path.join(self.jdir,'journal')).read(),JOURNAL_HEADER + journal_line('f','b/y'))
+
+    def test_take_while_writing(self):
+        name = os.path.join(self.jdir,'journal')
+        self.journal(('f','a/x'))
+
+        # the backup holds the journal while the watcher goes to append to it
+        fd = os.open(name,os.O_RDONLY)
+        fcntl.flock(fd,fcntl.LOCK_EX)
+        writer = threading.Thread(target=self.journal,args=(('f','b/y'),))
+        writer.start()
+        time.sleep(0.1)
+        os.rename(name,name + '.claimed')
+        os.close(fd)
+        writer.join()
+
+        # the line was not lost in the journal that was taken, it started a new one
+        self.assertEqual(open(name + '.claimed').read(),JOURNAL_HEADER + journal_line('f','a/x'))
+        self.assertEqual(open(name).read(),JOURNAL_HEADER + journal_line('f','b/y'))
+
+    def walk(self,journal):
+        found = set()
+        for root, subdirs, files in journal.walk(self.src):
+            for name in subdirs + files: found.add(os.path.relpath(os.path.join(root,name),self.src))
+        return found
+
+    def test_walk(self):
+        self.start_watcher()
+        self.set_state('1.1')
+        prev = self.manifest()
+
+        self.write('a/new')
+        self.write('b/unseen')
+        self.write('c/n/m/deep')
+        self.journal(('f','a/new'),('d','a'),('f','c/n'),('d','c'),('t','c/n'))
+        journal = C_journal(message,self.tgt)
+        self.assertTrue(journal.claim(self.src,prev))
+
+        # 'b' did not change as far as the journal knows, so it is not read again
+        self.assertEqual(self.walk(journal),set(['a','a/x','a/new','b','b/y','c','c/z','c/z/deep',
+                                                   'c/n','c/n/m','c/n/m/deep','top']))
+
+        # the subdirs can be pruned, as with os.walk()
+        for root, subdirs, files in journal.walk(self.src):
+            if 'c' in subdirs: subdirs.remove('c')
+            self.assertFalse(root.startswith(os.path.join(self.src,'c')))
+
+    def test_stat(self):
+        self.start_watcher()
+        self.set_state('1.1')
+        prev = self.manifest()
+        st_b = os.lstat(os.path.join(self.src,'b'))
+
+        # the directories that gained an entry have a new mtime
+        self.write('a/new')
+        self.write('b/unseen')
+        for name in ['a','b','top']:
+            path = os.path.join(self.src,name)
+            os.utime(path,ns=(0,os.lstat(path).st_mtime_ns + 10 ** 9))
+        self.journal(('f','a/new'),('d','a'),('f','top'))
+        journal = C_journal(message,self.tgt)
+        self.assertTrue(journal.claim(self.src,prev))
+
+        for name in ['a','a/new','top']:
+            self.assertFalse(journal.clean(name),name)
+            path = os.path.join(self.src,name)
+            self.assertEqual(journal.stat(path,name).st_mtime_ns,os.lstat(path).st_mtime_ns,name)
+        self.assertTrue(journal.clean('b'))
+        self.assertEqual(journal.stat(os.path.join(self.src,'b'),'b').st_mtime_ns,st_b.st_mtime_ns)
+
+    def test_backup(self):
+        # a backup with a directory that gained an entry records its new mtime
+        shutil.rmtree(self.tgt)
+        init_tgt_loc(self.tgt,src_dir=self.src,type='link',engine='builtin',mailto='')
+        os.makedirs(self.jdir)
+        self.start_watcher()
+        self.backup()
+        self.assertEqual(C_journal(message,self.tgt).read_file('state'),'1.1')
+
+        self.write('a/new')
+        a = os.path.join(self.src,'a')
+        os.utime(a,ns=(0,os.lstat(a).st_mtime_ns + 10 ** 9))
+        self.journal(('f','a/new'),('d','a'))
+        self.backup()
+
+        manifest = C_manifest(os.path.join(self.tgt,'versions','2'))
+        self.assertEqual(manifest.load(),0)
+        self.assertEqual(manifest.get('a').mtime,os.lstat(a).st_mtime_ns)
+        self.assertIsNotNone(manifest.get('a/new'))
+        self.assertEqual(manifest.get('b').mtime,os.lstat(os.path.join(self.src,'b')).st_mtime_ns)
+
+    def backup(self):
+        buver = C_buver(1,self.tgt)
+        try:
+            self.assertEqual(buver.execute(),0)
+        finally:
+            buver.close()
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,89 @@
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+from buver.cbuver import C_buver
+from tgtloc import init_tgt_loc
+
+"""
+Tests for the 'link' backup type, which hard links the files that did not
+change to the previous version.
+"""
+
+class T_link(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.src = os.path.join(self.tmp,'src')
+        self.tgt = os.path.join(self.tmp,'tgt')
+        os.makedirs(os.path.join(self.src,'sub'))
+        for name in ['same','changed','chmod','sub/deep']: self.write(name,name)
+        os.symlink('same',os.path.join(self.src,'link'))
+
+        init_tgt_loc(self.tgt,src_dir=self.src,type='link',num_versions='3',mailto='')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def write(self,name,data):
+        f = open(os.path.join(self.src,name),'w')
+        f.write(data)
+        f.close()
+
+    def backup(self):
+        buver = C_buver(1,self.tgt)
+        try:
+            self.assertEqual(buver.execute(),0)
+        finally:
+            buver.close()
+
+    def path(self,version,name):
+        return os.path.join(self.tgt,'versions',str(version),'src',name)
+
+    def ino(self,version,name):
+        return os.lstat(self.path(version,name)).st_ino
+
+    def test_link(self):
+        self.backup()
+
+        # a different size, and the same size with a later mtime, are both changes
+        self.write('changed','changed again')
+        self.write('sub/deep','DEEP')
+        st = os.stat(os.path.join(self.src,'sub','deep'))
+        os.utime(os.path.join(self.src,'sub','deep'),ns=(st.st_atime_ns,st.st_mtime_ns + 10 ** 9))
+        os.chmod(os.path.join(self.src,'chmod'),0o600)
+        self.write('added','added')
+        time.sleep(0.01)
+        self.backup()
+
+        self.assertEqual(self.ino(1,'same'),self.ino(2,'same'))
+        self.assertEqual(os.lstat(self.path(2,'same')).st_nlink,2)
+        for name in ['changed','chmod','sub/deep']:
+            self.assertNotEqual(self.ino(1,name),self.ino(2,name),name)
+        self.assertEqual(open(self.path(2,'changed')).read(),'changed again')
+        self.assertEqual(open(self.path(2,'sub/deep')).read(),'DEEP')
+        self.assertEqual(os.stat(self.path(2,'chmod')).st_mode & 0o777,0o600)
+        self.assertEqual(open(self.path(2,'added')).read(),'added')
+
+        # symbolic links and directories are made again, not linked
+        self.assertEqual(os.readlink(self.path(2,'link')),'same')
+        self.assertNotEqual(self.ino(1,'sub'),self.ino(2,'sub'))
+
+        # the old version holds nothing the new one needs
+        shutil.rmtree(os.path.join(self.tgt,'versions','1'))
+        self.assertEqual(open(self.path(2,'same')).read(),'same')
+        self.assertEqual(os.lstat(self.path(2,'same')).st_nlink,1)
+
+    def test_chain(self):
+        # an unchanged file is the same inode in every version, not just the last two
+        self.backup()
+        self.backup()
+        self.write('changed','once more')
+        self.backup()
+        self.assertEqual(len(set([self.ino(n,'same') for n in [1,2,3]])),1)
+        self.assertEqual(self.ino(1,'changed'),self.ino(2,'changed'))
+        self.assertNotEqual(self.ino(2,'changed'),self.ino(3,'changed'))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,99 @@
+import os
+import random
+import shutil
+import tempfile
+import unittest
+
+import buver.cmanifest as cmanifest
+from buver.cmanifest import C_manifest, merge_join, _key
+
+"""
+Tests for the manifests: the order they are written in, and comparing one
+with merge_join().
+"""
+
+# a tree with entries at the top, names that sort differently from their
+# paths ('a' and 'a.b' and 'a/x'), and a name that is not valid UTF-8
+PATHS = ['.','a','a.b','b','a/x','a/y','a/x/deep','a.b/z','b/\udcff','c']
+
+def stat_of(path,n):
+    """A made up stat() result for 'path'."""
+
+    mode = 0o40755 if path in ['.','a','a.b','b','a/x'] else 0o100644
+    return os.stat_result((mode,1000 + n,0,1,0,0,n * 10,0,0,0),{'st_mtime_ns':n * 10 ** 9})
+
+class T_manifest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.run_records = cmanifest.RUN_RECORDS
+
+    def tearDown(self):
+        cmanifest.RUN_RECORDS = self.run_records
+        shutil.rmtree(self.tmp)
+
+    def version(self,name):
+        path = os.path.join(self.tmp,name)
+        os.makedirs(path)
+        return path
+
+    def write(self,name,paths,hashes=None):
+        """Write a manifest of 'paths', added in a random order, and return it loaded."""
+
+        manifest = C_manifest(self.version(name))
+        self.assertEqual(manifest.create(),0)
+        order = list(enumerate(paths))
+        random.Random(name).shuffle(order)
+        for n, path in order: manifest.add(path,stat_of(path,n),(hashes or {}).get(path))
+        self.assertEqual(manifest.close(),0)
+
+        loaded = C_manifest(os.path.join(self.tmp,name))
+        self.assertEqual(loaded.load(),0)
+        return loaded
+
+    def test_order(self):
+        # spill to several runs, so the merge of the runs is tested too
+        cmanifest.RUN_RECORDS = 3
+        manifest = self.write('1',PATHS,{'c':'ab' * 32})
+
+        keys = [key for key, rec in manifest.items()]
+        self.assertEqual(keys,sorted(keys))
+        self.assertEqual(sorted(rec.path for rec in manifest.records()),sorted(PATHS))
+        self.assertEqual(manifest.count,len(PATHS))
+
+        self.assertEqual(manifest.get('c').hash,'ab' * 32)
+        self.assertEqual(manifest.get('a/x/deep').size,60)
+        self.assertIsNone(manifest.get('a/z'))
+        self.assertEqual([name for name, rec in manifest.children('.')],['a','a.b','b','c'])
+        self.assertEqual([name for name, rec in manifest.children('a')],['x','y'])
+        self.assertEqual([name for name, rec in manifest.children('b')],['\udcff'])
+
+    def test_merge_join(self):
+        old = self.write('1',PATHS[:-1])
+        new = self.write('2',PATHS[1:])
+
+        joined = list(merge_join(old,new))
+        self.assertEqual([_key(path) for path, a, b in joined],sorted(_key(path) for path in PATHS))
+        sides = dict([(path,(a is not None,b is not None)) for path, a, b in joined])
+        self.assertEqual(sides['.'],(True,False))
+        self.assertEqual(sides['c'],(False,True))
+        self.assertEqual(sides['a/x/deep'],(True,True))
+
+    def test_other_magic(self):
+        # anything that is not a 'BUVERMF3' manifest is not used, so the backup looks at every file
+        manifest = self.write('1',PATHS)
+        data = open(manifest.name,'rb').read()
+        for magic in [b'BUVERMF2',b'# buver']:
+            f = open(manifest.name,'wb')
+            f.write(magic + data[len(magic):])
+            f.close()
+            self.assertEqual(C_manifest(os.path.dirname(manifest.name)).load(),1)
+
+    def test_unchanged(self):
+        manifest = self.write('1',PATHS)
+        n = PATHS.index('a/y')
+        self.assertTrue(manifest.unchanged('a/y',stat_of('a/y',n)))
+        self.assertFalse(manifest.unchanged('a/y',stat_of('a/y',n + 1)))
+        self.assertFalse(manifest.unchanged('a/z',stat_of('a/y',n)))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,166 @@
+import bz2
+import gzip
+import io
+import lzma
+import os
+import random
+import shutil
+import tarfile
+import tempfile
+import unittest
+import zlib
+
+from buver.cpgzip import C_pgzip, C_pgzip_reader
+from buver.cbuconfig import C_buconfig
+from buver.carchive import BLOCKS_NAME, C_archive, load_blocks, load_members, open_archive
+from tgtloc import init_tgt_loc, set_conf
+
+"""
+Tests for the parallel gzip writer and its codecs, and for reading the 'bgzf'
+archives it writes in independent blocks at any offset.
+"""
+
+def message(msgstr): pass
+
+def sample(size,seed=1):
+    """Data that partly compresses, and partly does not."""
+
+    rnd = random.Random(seed)
+    out = bytearray()
+    while len(out) < size:
+        if rnd.random() < 0.5:
+            out.extend(bytes(rnd.getrandbits(8) for n in range(5000)))
+        else:
+            out.extend(b'buver %d ' % rnd.randrange(100) * 500)
+    return bytes(out[:size])
+
+class T_pgzip(unittest.TestCase):
+    def write(self,data,independent,block_size=64 * 1024,threads=3):
+        out = io.BytesIO()
+        writer = C_pgzip(out,6,threads,block_size,independent)
+        # in pieces that do not line up with the blocks
+        for i in range(0,len(data),7777): writer.write(data[i:i + 7777])
+        writer.close()
+        return out.getvalue(), writer
+
+    def test_stream(self):
+        data = sample(1 << 20)
+        for independent in [False,True]:
+            compressed, writer = self.write(data,independent)
+            self.assertEqual(gzip.decompress(compressed),data)
+            self.assertEqual(writer.size,len(data))
+
+    def test_empty(self):
+        for independent in [False,True]:
+            compressed, writer = self.write(b'',independent)
+            self.assertEqual(gzip.decompress(compressed),b'')
+
+    def test_blocks(self):
+        data = sample(1 << 20)
+        compressed, writer = self.write(data,True)
+
+        # each block is a gzip member of its own, that starts where the index says
+        blocks = writer.blocks
+        self.assertEqual(len(blocks),16)
+        self.assertEqual(blocks[0],(0,0))
+        for i, (offset, start) in enumerate(blocks):
+            end = blocks[i + 1][0] if i + 1 < len(blocks) else len(compressed)
+            self.assertEqual(zlib.decompress(compressed[offset:end],16 + zlib.MAX_WBITS),data[start:start + 64 * 1024])
+
+    def test_adaptive(self):
+        # blocks of noise, text and noise again
+        rnd = random.Random(2)
+        noise = bytes(rnd.getrandbits(8) for n in range(64 * 1024))
+        data = noise + (b'buver ' * 20000)[:64 * 1024] + noise
+        for codec, decompress in [('zlib',gzip.decompress),('bz2',bz2.decompress),('lzma',lzma.decompress)]:
+            for adaptive in [True,False]:
+                out = io.BytesIO()
+                writer = C_pgzip(out,9,3,64 * 1024,False,codec,adaptive)
+                writer.write(data)
+                writer.close()
+                self.assertEqual(decompress(out.getvalue()),data,codec)
+                self.assertEqual(writer.stored_blocks,2 if adaptive else 0,codec)
+
+                # bz2 has the level in the header of each stream, the noise got the cheapest one
+                if codec == 'bz2':
+                    heads = [out.getvalue()[offset:offset + 4] for offset, start in writer.blocks]
+                    if adaptive: self.assertEqual(heads,[b'BZh1',b'BZh9',b'BZh1'])
+                    else: self.assertEqual(heads,[b'BZh9'] * 3)
+
+    def test_codec_level(self):
+        # a new buver.conf leaves the level blank, so each codec gets its own default
+        tmp = tempfile.mkdtemp()
+        try:
+            tgt = os.path.join(tmp,'tgt')
+            os.makedirs(os.path.join(tmp,'src'))
+            init_tgt_loc(tgt,src_dir=os.path.join(tmp,'src'))
+            for codec, level in [('zlib',6),('bz2',9),('lzma',6)]:
+                set_conf(tgt,codec=codec)
+                config = C_buconfig(message,tgt)
+                self.assertEqual(config.load(),0)
+                self.assertEqual(config.opt_codec_level(),level,codec)
+        finally:
+            shutil.rmtree(tmp)
+
+    def test_reader(self):
+        data = sample(1 << 20)
+        compressed, writer = self.write(data,True)
+        reader = C_pgzip_reader(io.BytesIO(compressed),writer.blocks)
+
+        rnd = random.Random(2)
+        for n in range(200):
+            offset = rnd.randrange(len(data) + 10)
+            size = rnd.choice([0,1,100,64 * 1024,200000])
+            self.assertEqual(reader.seek(offset),offset)
+            self.assertEqual(reader.read(size),data[offset:offset + size])
+            self.assertEqual(reader.tell(),min(offset + size,max(offset,len(data))))
+
+        reader.seek(len(data) - 10)
+        self.assertEqual(reader.read(),data[-10:])
+        self.assertEqual(reader.read(),b'')
+
+class T_bgzf_archive(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.src = os.path.join(self.tmp,'src')
+        self.version = os.path.join(self.tmp,'version')
+        os.makedirs(self.src)
+        os.makedirs(self.version)
+        for n in range(20):
+            f = open(os.path.join(self.src,'f%02d' % n),'wb')
+            f.write(sample(50000 * (n % 3 + 1),n))
+            f.close()
+
+        self.archive = os.path.join(self.version,'backup.tar.gz')
+        self.assertEqual(C_archive(message,self.src,self.archive,True,3,None,True).run(),0)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def test_members(self):
+        # every member can be read from the block index, without the ones before it
+        members = load_members(self.version)
+        self.assertEqual(len(members),20)
+        for offset, size, rel in reversed(members):
+            f = open_archive(self.archive,load_blocks(self.version))
+            f.seek(offset)
+            tar = tarfile.open(fileobj=f,mode='r|')
+            member = tar.next()
+            self.assertEqual(member.name,rel)
+            self.assertEqual(tar.extractfile(member).read(),open(os.path.join(self.src,rel),'rb').read())
+            f.close()
+
+    def test_plain_gzip(self):
+        # it is still an ordinary .tar.gz
+        tar = tarfile.open(self.archive,'r:gz')
+        self.assertEqual(sorted(tar.getnames()),['f%02d' % n for n in range(20)])
+        tar.close()
+
+    def test_bad_index(self):
+        f = open(os.path.join(self.version,BLOCKS_NAME),'w')
+        f.write('# not a block index\n')
+        f.close()
+        self.assertIsNone(load_blocks(self.version))
+
+if __name__ == '__main__':
+    unittest.main()
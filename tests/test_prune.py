@@ -0,0 +1,195 @@
+import fcntl
+import os
+import shutil
+import tempfile
+import unittest
+
+from buver.cbuver import C_buver
+from buver.cbuconfig import C_buconfig
+from buver.creaper import C_reaper
+from buver.cversions import C_versions
+from tgtloc import init_tgt_loc, set_conf
+
+"""
+Tests for pruning: the expired versions are moved to the trash, their chunks
+are given back from there, and the reaper empties the trash later.
+"""
+
+def message(msgstr): pass
+
+class C_chunks_stub:
+    """Records what prune() asks of the chunk store, and where the version was then."""
+
+    def __init__(self,verdir,fail=None):
+        self.verdir = verdir
+        self.fail = fail
+        self.released = []
+        self.collected = False
+
+    def release(self,path):
+        self.released.append((path,os.path.isdir(path),os.listdir(self.verdir)))
+        return len(self.released) == self.fail
+
+    def collect(self):
+        self.collected = True
+        return 0
+
+class T_prune(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.verdir = os.path.join(self.tmp,'versions')
+        for n in range(1,6):
+            os.makedirs(os.path.join(self.verdir,str(n),'sub'))
+            open(os.path.join(self.verdir,str(n),'sub','file'),'w').write('%d\n' % n)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def test_sanify(self):
+        versions = C_versions(message,self.verdir)
+        self.assertEqual(versions.sanify(3,['1','2','3','4','5']),0)
+        self.assertEqual(versions.new_ver_dirs(),['4','5','6'])
+        self.assertEqual(versions.prev_version(),os.path.join(self.verdir,'5'))
+        self.assertEqual(versions.new_version(),os.path.join(self.verdir,'6'))
+
+        # the config and the disk have to agree
+        self.assertEqual(C_versions(message,self.verdir).sanify(3,['1','2','3','4']),2)
+        self.assertEqual(C_versions(message,self.verdir).sanify(3,['1','2','3','4','5','7']),2)
+
+    def test_prune(self):
+        versions = C_versions(message,self.verdir)
+        self.assertEqual(versions.sanify(2,['1','2','3','4','5']),0)
+        chunks = C_chunks_stub(self.verdir)
+        self.assertEqual(versions.prune(chunks),0)
+        self.assertEqual(versions.prune(chunks),2)
+
+        self.assertEqual(sorted(os.listdir(self.verdir)),['5'])
+        trash = os.path.join(self.tmp,'trash')
+        self.assertEqual(len(os.listdir(trash)),4)
+
+        # the chunks of each version are released oldest first, once it is already in the trash
+        self.assertEqual([os.path.basename(path).split('.')[0] for path, isdir, left in chunks.released],['1','2','3','4'])
+        for path, isdir, left in chunks.released:
+            self.assertEqual(os.path.dirname(path),trash)
+            self.assertTrue(isdir)
+            self.assertNotIn(os.path.basename(path).split('.')[0],left)
+        self.assertTrue(chunks.collected)
+
+    def test_partial(self):
+        # the chunks of the second version cannot be released, so prune stops there
+        versions = C_versions(message,self.verdir)
+        self.assertEqual(versions.sanify(2,['1','2','3','4','5']),0)
+        self.assertEqual(versions.prune(C_chunks_stub(self.verdir,fail=2)),3)
+        self.assertEqual(versions.moved,['1','2'])
+        self.assertFalse(versions.pruned)
+
+        # what is left is what the config has to say, or the next run is not sane
+        self.assertEqual(versions.unmoved(['1','2','3','4','5']),['3','4','5'])
+        self.assertEqual(C_versions(message,self.verdir).sanify(2,['1','2','3','4','5']),2)
+        self.assertEqual(C_versions(message,self.verdir).sanify(2,['3','4','5']),0)
+
+    def test_unsane(self):
+        versions = C_versions(message,self.verdir)
+        self.assertEqual(versions.prune(),1)
+        self.assertFalse(os.path.exists(os.path.join(self.tmp,'trash')))
+
+class T_prune_backup(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.src = os.path.join(self.tmp,'src')
+        self.tgt = os.path.join(self.tmp,'tgt')
+        os.makedirs(self.src)
+        open(os.path.join(self.src,'file'),'w').write('0123456789')
+        self.rename = os.rename
+
+    def tearDown(self):
+        os.rename = self.rename
+        shutil.rmtree(self.tmp)
+
+    def backup(self):
+        buver = C_buver(1,self.tgt)
+        try:
+            return buver.execute()
+        finally:
+            buver.close()
+
+    def test_partial(self):
+        init_tgt_loc(self.tgt,src_dir=self.src,engine='builtin',num_versions='4',mailto='')
+        for n in range(4): self.assertEqual(self.backup(),0)
+
+        # the second version going to the trash fails, after the first one is gone
+        trash = os.path.join(self.tgt,'trash')
+        moves = []
+        def rename(src,dst):
+            if os.path.dirname(dst) == trash:
+                moves.append(src)
+                if len(moves) == 2: raise OSError('rename failed')
+            return self.rename(src,dst)
+        os.rename = rename
+        set_conf(self.tgt,num_versions='2')
+        self.assertEqual(self.backup(),4)
+        os.rename = self.rename
+
+        config = C_buconfig(message,self.tgt)
+        self.assertEqual(config.load(),0)
+        self.assertEqual(config.logical_versions,['2','3','4'])
+        self.assertEqual(sorted(config.version_times),['2','3','4'])
+
+        # and the next run is sane, and finishes the job
+        self.assertEqual(self.backup(),0)
+        self.assertEqual(sorted(os.listdir(os.path.join(self.tgt,'versions'))),['4','5'])
+
+class T_reaper(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.trash = os.path.join(self.tmp,'trash')
+        self.outside = os.path.join(self.tmp,'outside')
+        os.makedirs(self.outside)
+        open(os.path.join(self.outside,'keep'),'w').write('keep\n')
+
+        # a version with enough files for several batches, a hard link to a file
+        # that is still used elsewhere, and a symbolic link out of the trash
+        top = os.path.join(self.trash,'1.100.1000')
+        for d in range(3):
+            os.makedirs(os.path.join(top,'d%d' % d,'deeper'))
+            for n in range(300):
+                open(os.path.join(top,'d%d' % d,'f%d' % n),'w').write('x')
+        os.link(os.path.join(self.outside,'keep'),os.path.join(top,'linked'))
+        os.symlink(self.outside,os.path.join(top,'d0','deeper','out'))
+        open(os.path.join(self.trash,'2.100.1000'),'w').write('a version that is just a file\n')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def test_reap(self):
+        reaper = C_reaper(message,self.trash,3)
+        self.assertEqual(len(reaper.pending()),2)
+        self.assertEqual(reaper.run(),0)
+        self.assertEqual(reaper.pending(),[])
+        self.assertEqual(reaper.files,3 * 300 + 3)
+        self.assertEqual(reaper.errors,0)
+
+        # nothing it links to is touched
+        self.assertEqual(sorted(os.listdir(self.outside)),['keep'])
+        self.assertEqual(os.stat(os.path.join(self.outside,'keep')).st_nlink,1)
+
+        # an empty trash is nothing to do
+        self.assertEqual(C_reaper(message,self.trash).run(),0)
+        self.assertEqual(C_reaper(message,os.path.join(self.tmp,'missing')).run(),0)
+
+    def test_locked(self):
+        # a second reaper leaves the trash to the one that has it
+        fd = os.open(os.path.join(self.trash,'.reaper'),os.O_CREAT|os.O_RDWR,0o644)
+        try:
+            fcntl.flock(fd,fcntl.LOCK_EX)
+            reaper = C_reaper(message,self.trash)
+            self.assertEqual(reaper.run(),0)
+            self.assertEqual(reaper.files,0)
+            self.assertEqual(len(reaper.pending()),2)
+        finally:
+            os.close(fd)
+        self.assertEqual(C_reaper(message,self.trash).run(),0)
+        self.assertEqual(C_reaper(message,self.trash).pending(),[])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,119 @@
+import os
+import random
+import shutil
+import tempfile
+import unittest
+
+from buver.cbuver import C_buver
+from buver.crestore import C_restore
+from tgtloc import init_tgt_loc
+
+"""
+Tests for 'buver --restore', of every backup type, whole and in part.
+"""
+
+def message(msgstr): pass
+
+class T_restore(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.src = os.path.join(self.tmp,'src')
+        self.tgt = os.path.join(self.tmp,'tgt')
+
+        # enough files that a partial restore skips some, and one big enough for several blocks
+        rnd = random.Random(1)
+        for n in range(60):
+            name = os.path.join(self.src,'d%d' % (n % 4),'f%d' % n)
+            if not os.path.isdir(os.path.dirname(name)): os.makedirs(os.path.dirname(name))
+            f = open(name,'wb')
+            f.write(bytes(rnd.getrandbits(8) for i in range(rnd.randrange(1,3000))))
+            f.close()
+        f = open(os.path.join(self.src,'d1','big'),'wb')
+        f.write(bytes(rnd.getrandbits(8) for i in range(600000)) + b'big' * 200000)
+        f.close()
+        os.symlink('d1/big',os.path.join(self.src,'link'))
+        os.chmod(os.path.join(self.src,'d2','f2'),0o600)
+
+        # the modes come back as they were, the special and group/other write bits too
+        os.chmod(os.path.join(self.src,'d1','f1'),0o4775)
+        os.chmod(os.path.join(self.src,'d1','f5'),0o2666)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def backup(self,type,codec='zlib'):
+        init_tgt_loc(self.tgt,src_dir=self.src,type=type,engine='builtin',codec=codec,mailto='')
+
+        for n in range(2):
+            buver = C_buver(1,self.tgt)
+            try:
+                self.assertEqual(buver.execute(),0)
+            finally:
+                buver.close()
+
+    def restore(self,paths=None,version=None):
+        dest = tempfile.mkdtemp(dir=self.tmp)
+        restore = C_restore(message,self.tgt,dest,version,paths,threads=3)
+        self.assertEqual(restore.execute(),0)
+        return dest
+
+    def tree(self,top):
+        """Return what is under 'top': the content of each file, the target
+        of each symbolic link and the mode of everything."""
+
+        items = {}
+        for root, subdirs, files in os.walk(top):
+            for name in subdirs + files:
+                path = os.path.join(root,name)
+                rel = os.path.relpath(path,top)
+                st = os.lstat(path)
+                if os.path.islink(path):
+                    items[rel] = ('l',os.readlink(path))
+                elif os.path.isdir(path):
+                    items[rel] = ('d',st.st_mode)
+                else:
+                    items[rel] = ('f',st.st_mode,st.st_mtime_ns // 10 ** 9,open(path,'rb').read())
+        return items
+
+    def check(self,type,codec='zlib'):
+        self.backup(type,codec)
+        expected = self.tree(self.src)
+
+        self.assertEqual(self.tree(self.restore()),expected)
+        self.assertEqual(self.tree(self.restore(version=1)),expected)
+
+        # a directory and a single file
+        partial = self.tree(self.restore(['d1','/d3/f7','link']))
+        wanted = dict([(rel,item) for rel, item in expected.items()
+                       if rel.startswith('d1') or rel in ['d3','d3/f7','link']])
+        self.assertEqual(partial,wanted)
+
+        # nothing that is already there is overwritten
+        dest = self.restore(['d0/f0'])
+        restore = C_restore(message,self.tgt,dest,paths=['d0'])
+        self.assertNotEqual(restore.execute(),0)
+        self.assertEqual(self.tree(dest)['d0/f0'],expected['d0/f0'])
+
+    def test_tree(self):
+        self.check('tree')
+
+    def test_link(self):
+        self.check('link')
+
+    def test_dedup(self):
+        self.check('dedup')
+
+    def test_tar(self):
+        self.check('tar')
+
+    def test_gzip(self):
+        self.check('gzip')
+
+    def test_gzip_bz2(self):
+        self.check('gzip','bz2')
+
+    def test_bgzf(self):
+        self.check('bgzf')
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,74 @@
+import datetime
+import unittest
+
+from buver.cversions import keep_versions, parse_age
+
+"""
+Tests for the retention policy, keep_versions(), at the edges of its periods.
+"""
+
+def at(*when):
+    """The time of a local date and time, as the versions record it."""
+
+    return datetime.datetime(*when).timestamp()
+
+class T_keep_versions(unittest.TestCase):
+    def test_last(self):
+        times = dict([(str(n),at(2024,1,n)) for n in range(1,21)])
+        self.assertEqual(keep_versions(times,{'last':3}),set(['18','19','20']))
+        self.assertEqual(keep_versions(times,{'last':0}),set())
+        self.assertEqual(len(keep_versions(times,{'last':100})),20)
+
+        # it goes by the version number, which is the order they were made in
+        times['100'] = at(2023,1,1)
+        self.assertEqual(keep_versions(times,{'last':1}),set(['100']))
+
+    def test_within(self):
+        now = at(2024,6,15,12)
+        times = {'1':now - 86400 - 1,'2':now - 86400,'3':now - 60}
+        self.assertEqual(keep_versions(times,{'within':86400},now),set(['2','3']))
+
+    def test_daily(self):
+        times = {'1':at(2024,3,1,8),'2':at(2024,3,1,23,59,59),
+                 '3':at(2024,3,2,0,0,0),'4':at(2024,3,2,12),
+                 '5':at(2024,3,5,9)}
+        # the newest of each day, and days without a version do not count
+        self.assertEqual(keep_versions(times,{'daily':3}),set(['2','4','5']))
+        self.assertEqual(keep_versions(times,{'daily':2}),set(['4','5']))
+
+    def test_hourly(self):
+        times = {'1':at(2024,3,1,8,0),'2':at(2024,3,1,8,59),'3':at(2024,3,1,9,0)}
+        self.assertEqual(keep_versions(times,{'hourly':2}),set(['2','3']))
+
+    def test_weekly(self):
+        # 2024-03-03 is a Sunday, the last day of its ISO week
+        times = {'1':at(2024,2,26),'2':at(2024,3,3,23),'3':at(2024,3,4,1),'4':at(2024,3,10)}
+        self.assertEqual(keep_versions(times,{'weekly':2}),set(['2','4']))
+
+    def test_weekly_new_year(self):
+        # 2024-12-30 is in week 1 of 2025, with 2025-01-02
+        times = {'1':at(2024,12,29),'2':at(2024,12,30),'3':at(2025,1,2)}
+        self.assertEqual(keep_versions(times,{'weekly':5}),set(['1','3']))
+
+    def test_monthly(self):
+        times = {'1':at(2024,1,31,23,59),'2':at(2024,2,1),'3':at(2024,2,29,12),'4':at(2024,4,1)}
+        self.assertEqual(keep_versions(times,{'monthly':12}),set(['1','3','4']))
+        self.assertEqual(keep_versions(times,{'monthly':1}),set(['4']))
+
+    def test_union(self):
+        # a version is kept if any rule keeps it
+        times = dict([(str(n),at(2024,1,1) + n * 6 * 3600) for n in range(1,41)])
+        times['0'] = at(2023,12,31,12)
+        keep = keep_versions(times,{'last':2,'daily':3,'monthly':2})
+        self.assertEqual(keep,set(['40','39','35','0']))
+
+    def test_parse_age(self):
+        self.assertEqual(parse_age(''),0)
+        self.assertEqual(parse_age('36h'),36 * 3600)
+        self.assertEqual(parse_age('2W'),14 * 86400)
+        self.assertEqual(parse_age('1y'),365 * 86400)
+        for val in ['h','12','1.5d','-1d','3x']:
+            self.assertIsNone(parse_age(val),val)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,120 @@
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+import buver.cscheduler as cscheduler
+from buver.cscheduler import C_scheduler, C_job
+
+"""
+Tests for 'buver --jobs': the order the jobs start in, the limits on how
+many run at once, and the results table. The backups are stand-ins that
+record when they run.
+"""
+
+class C_fake_buver:
+    """Takes the place of C_buver in the scheduler. Each run records when it
+    started and how many others were running alongside it."""
+
+    lock = threading.Lock()
+    started = []
+    running = {}
+    most = {}
+    rcs = {}
+    duration = 0.05
+
+    def __init__(self,action,tgt_loc,name=None,lock=None,lock_timeout=None):
+        self.name = os.path.basename(tgt_loc)
+
+    def execute(self):
+        cls = C_fake_buver
+        device = self.name.split('_')[0]
+        with cls.lock:
+            cls.started.append(self.name)
+            for key in ['all',device]:
+                cls.running[key] = cls.running.get(key,0) + 1
+                cls.most[key] = max(cls.most.get(key,0),cls.running[key])
+        time.sleep(cls.duration)
+        with cls.lock:
+            for key in ['all',device]: cls.running[key] = cls.running[key] - 1
+
+        rc = cls.rcs.get(self.name,0)
+        if isinstance(rc,Exception): raise rc
+        return rc
+
+    def close(self):
+        pass
+
+class T_scheduler(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.messages = []
+        self.buver = cscheduler.C_buver
+        cscheduler.C_buver = C_fake_buver
+        C_fake_buver.started = []
+        C_fake_buver.running = {}
+        C_fake_buver.most = {}
+        C_fake_buver.rcs = {}
+
+    def tearDown(self):
+        cscheduler.C_buver = self.buver
+        shutil.rmtree(self.tmp)
+
+    def run_jobs(self,lines,workers=4,per_device=1):
+        """Run the jobs file made of 'lines'. The jobs are named <device>_<n>,
+        and use that device. Returns the rc."""
+
+        name = os.path.join(self.tmp,'jobs')
+        f = open(name,'w')
+        f.write('# the jobs\n\n')
+        for line in lines:
+            x = line.split()
+            f.write('%s device=%s %s\n' % (os.path.join(self.tmp,x[0]),x[0].split('_')[0],' '.join(x[1:])))
+        f.close()
+
+        scheduler = C_scheduler(self.messages.append,name,workers,per_device)
+        return scheduler.execute()
+
+    def test_priority(self):
+        self.assertEqual(self.run_jobs(['a_1','a_2 priority=5','a_3 priority=-1','a_4 priority=5','a_5'],workers=1),0)
+        self.assertEqual(C_fake_buver.started,['a_2','a_4','a_1','a_5','a_3'])
+
+    def test_per_device(self):
+        jobs = ['a_%d' % n for n in range(4)] + ['b_%d' % n for n in range(4)] + ['c_%d' % n for n in range(4)]
+        self.assertEqual(self.run_jobs(jobs,workers=8,per_device=1),0)
+        self.assertEqual((C_fake_buver.most['a'],C_fake_buver.most['b'],C_fake_buver.most['c']),(1,1,1))
+        self.assertGreater(C_fake_buver.most['all'],1)
+        self.assertLessEqual(C_fake_buver.most['all'],3)
+        self.assertEqual(len(C_fake_buver.started),12)
+
+        # with two per device, the workers are the limit
+        C_fake_buver.most = {}
+        self.assertEqual(self.run_jobs(jobs,workers=4,per_device=2),0)
+        self.assertGreater(C_fake_buver.most['all'],3)
+        self.assertLessEqual(C_fake_buver.most['all'],4)
+        for device in 'abc': self.assertLessEqual(C_fake_buver.most[device],2)
+
+    def test_report(self):
+        C_fake_buver.rcs = {'a_2':2,'b_1':RuntimeError('broken')}
+        self.assertEqual(self.run_jobs(['a_1','a_2','b_1','b_2']),2)
+
+        table = self.messages[self.messages.index('%-6s %-5s %9s  %s' % ('RESULT','RC','SECONDS','TGT_LOC')):]
+        rows = [line.split() for line in table[1:5]]
+        self.assertEqual([(row[0],row[1],os.path.basename(row[3])) for row in rows],
+                         [('OK','0','a_1'),('FAILED','2','a_2'),('FAILED','-1','b_1'),('OK','0','b_2')])
+        self.assertTrue(table[5].startswith('4 jobs, 2 failed'))
+
+    def test_rc_clamp(self):
+        # the rc is the exit code, and 256 failures must not exit with 0
+        scheduler = C_scheduler(self.messages.append,os.path.join(self.tmp,'jobs'))
+        for n in range(256):
+            job = C_job(n,os.path.join(self.tmp,'job%d' % n))
+            job.rc = 1
+            scheduler.jobs.append(job)
+        self.assertEqual(scheduler.report(0.0),255)
+        self.assertEqual(self.messages[-1],'256 jobs, 256 failed, 0.00 seconds')
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,137 @@
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+from buver.csemaphore import C_semaphore
+
+"""
+Tests for the 'flock' mode of C_semaphore, from threads other than the
+main one, as 'buver --jobs' and the daemon use it.
+"""
+
+class T_flock_queue(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.queue = os.path.join(self.tmp,'csemaphore.lock.queue')
+        self.tail = os.path.join(self.queue,'tail')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def ticket(self):
+        try:
+            return int(open(self.tail).read() or 0)
+        except (IOError,ValueError):
+            return 0
+
+    def waiter(self,order,timeout=10):
+        """Start a thread that waits for the lock, notes when it got it, and
+        releases it. Returns once the thread is in the queue, which is when
+        the tail has its ticket (the holder has the first one). The tail is
+        empty for a moment while it is written, so it is not enough that it
+        changed."""
+
+        ticket = len(self.threads) + 2
+        def run():
+            sem = C_semaphore(self.tmp,mode='flock')
+            if sem.wait(timeout):
+                order.append(('timeout',time.time()))
+                return
+            order.append((name,time.time()))
+            time.sleep(0.05)
+            sem.signal()
+
+        name = 'waiter%d' % len(self.threads)
+        thread = threading.Thread(target=run)
+        thread.start()
+        self.threads.append(thread)
+        while self.ticket() < ticket: time.sleep(0.001)
+
+    def test_fifo(self):
+        holder = C_semaphore(self.tmp,mode='flock')
+        self.assertFalse(holder.wait(5))
+
+        order = []
+        self.threads = []
+        for i in range(5): self.waiter(order)
+        time.sleep(0.1)
+        self.assertEqual(order,[])
+
+        released = time.time()
+        holder.signal()
+        for thread in self.threads: thread.join()
+
+        self.assertEqual([name for name, when in order],['waiter%d' % i for i in range(5)])
+        # each one goes as soon as the one ahead of it is done, not at its next poll
+        self.assertLess(order[0][1] - released,0.03)
+        for (a, t1), (b, t2) in zip(order,order[1:]): self.assertLess(t2 - t1,0.05 + 0.03)
+
+        # the last one out removed the queue
+        self.assertEqual(os.listdir(self.tmp),['csemaphore.lock.flock'])
+
+    def test_timeout(self):
+        holder = C_semaphore(self.tmp,mode='flock')
+        self.assertFalse(holder.wait(5))
+
+        order = []
+        self.threads = []
+        start = time.time()
+        self.waiter(order,0.3)
+        self.waiter(order)
+        self.threads[0].join()
+        self.assertEqual(order[0][0],'timeout')
+        self.assertTrue(0.25 < order[0][1] - start < 1)
+
+        # the one that gave up is out of the way of the one behind it
+        holder.signal()
+        self.threads[1].join()
+        self.assertEqual(order[1][0],'waiter1')
+        self.assertFalse(os.path.exists(self.queue))
+
+    def test_cleanup(self):
+        # nobody behind us, so the queue goes
+        holder = C_semaphore(self.tmp,mode='flock')
+        self.assertFalse(holder.wait(5))
+        self.assertTrue(os.path.isdir(self.queue))
+        self.assertFalse(holder.signal())
+        self.assertFalse(os.path.exists(self.queue))
+
+        # with a waiter behind us that gave up, the nodes stay until the next one is last
+        self.assertFalse(holder.wait(5))
+        order = []
+        self.threads = []
+        self.waiter(order,0.1)
+        self.threads[0].join()
+        self.assertFalse(holder.signal())
+        self.assertEqual(sorted(os.listdir(self.queue)),['1','2','tail'])
+        self.assertFalse(holder.wait(5))
+        self.assertFalse(holder.signal())
+        self.assertFalse(os.path.exists(self.queue))
+
+    def test_busy(self):
+        # many threads coming and going, while the queue is removed and made again
+        inside = []
+        errors = []
+        def run():
+            for i in range(30):
+                sem = C_semaphore(self.tmp,mode='flock')
+                if sem.wait(10):
+                    errors.append('timeout')
+                    return
+                inside.append(1)
+                if len(inside) != 1: errors.append('two holders')
+                inside.pop()
+                sem.signal()
+                time.sleep(0.001 * (i % 3))
+
+        threads = [threading.Thread(target=run) for i in range(6)]
+        for thread in threads: thread.start()
+        for thread in threads: thread.join()
+        self.assertEqual(errors,[])
+        self.assertFalse(os.path.exists(self.queue))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,114 @@
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+from buver.cbuver import C_buver
+from buver.cstats import C_stats
+from tgtloc import init_tgt_loc
+
+"""
+Tests for the statistics of a run: the phases, the counters, and the
+stats.jsonl record and Prometheus file they are written to.
+"""
+
+class T_stats(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def test_phases(self):
+        stats = C_stats(self.tmp,'backup')
+        with stats.phase('sleep'):
+            time.sleep(0.05)
+        with stats.phase('sleep'):
+            time.sleep(0.05)
+        with stats.phase('child'):
+            os.system('i=0; while [ $i -lt 20000 ]; do i=$((i+1)); done')
+
+        # the same phase twice is added up
+        self.assertGreaterEqual(stats.phases['sleep']['wall'],0.1)
+        self.assertLess(stats.phases['sleep']['cpu'],0.1)
+        self.assertGreater(stats.phases['child']['child_cpu'],0.0)
+        for rec in stats.phases.values():
+            for key in ['read_bytes','write_bytes','child_inblock','child_oublock']:
+                self.assertGreaterEqual(rec[key],0)
+
+        # and so does a phase that raises
+        try:
+            with stats.phase('failed'):
+                raise ValueError('failed')
+        except ValueError:
+            pass
+        self.assertIn('failed',stats.phases)
+
+        stats.count('files')
+        stats.count('files',2)
+        stats.count('bytes',100)
+        self.assertEqual(stats.counters,{'files':3,'bytes':100})
+
+    def test_emit(self):
+        stats = C_stats('/tgt "loc"','backup')
+        with stats.phase('backup'): pass
+        stats.count('files',3)
+        prom_file = os.path.join(self.tmp,'buver.prom')
+        self.assertEqual(stats.emit(self.tmp,0,'link',prom_file),0)
+        self.assertEqual(stats.emit(self.tmp,2,'link'),0)
+
+        recs = [json.loads(line) for line in open(os.path.join(self.tmp,'stats.jsonl'))]
+        self.assertEqual([rec['rc'] for rec in recs],[0,2])
+        self.assertEqual(recs[0]['type'],'link')
+        self.assertEqual(recs[0]['counters'],{'files':3})
+        self.assertEqual(sorted(recs[0]['phases']),['backup'])
+
+        prom = open(prom_file).read()
+        self.assertIn('buver_files{tgt_loc="/tgt \\"loc\\""} 3.0\n',prom)
+        self.assertIn('buver_phase_wall_seconds{tgt_loc="/tgt \\"loc\\"",phase="backup"}',prom)
+        # the temporary file it was written to is gone
+        self.assertEqual(sorted(os.listdir(self.tmp)),['buver.prom','stats.jsonl'])
+
+        # a log directory that is not there is reported, but nothing else
+        self.assertEqual(stats.emit(os.path.join(self.tmp,'missing'),0),1)
+
+    def test_emit_threads(self):
+        # the daemon's backups run in threads of one process, and share the Prometheus file
+        prom_file = os.path.join(self.tmp,'buver.prom')
+        results = []
+        def emit(n):
+            stats = C_stats('/tgt/%d' % n,'backup')
+            for i in range(20): results.append(stats.emit(self.tmp,0,'tree',prom_file))
+        threads = [threading.Thread(target=emit,args=(n,)) for n in range(8)]
+        for t in threads: t.start()
+        for t in threads: t.join()
+
+        self.assertEqual(results,[0] * 160)
+        self.assertIn('buver_run_rc{tgt_loc="/tgt/',open(prom_file).read())
+        self.assertEqual(sorted(os.listdir(self.tmp)),['buver.prom','stats.jsonl'])
+
+    def test_run(self):
+        src = os.path.join(self.tmp,'src')
+        tgt = os.path.join(self.tmp,'tgt')
+        os.makedirs(src)
+        open(os.path.join(src,'file'),'w').write('file\n')
+
+        init_tgt_loc(tgt,src_dir=src,type='link',engine='builtin',mailto='')
+
+        buver = C_buver(1,tgt)
+        try:
+            self.assertEqual(buver.execute(),0)
+        finally:
+            buver.close()
+
+        recs = [json.loads(line) for line in open(os.path.join(tgt,'logs','stats.jsonl'))]
+        self.assertEqual(recs[-1]['type'],'link')
+        self.assertEqual(recs[-1]['rc'],0)
+        for phase in ['lock','config','sanify','backup','mailer']:
+            self.assertIn(phase,recs[-1]['phases'])
+
+if __name__ == '__main__':
+    unittest.main()
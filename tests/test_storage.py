@@ -0,0 +1,99 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from buver.cstorage import C_localstorage, open_storage
+
+"""
+Tests for the storage backend interface, on the local backend.
+"""
+
+def message(msgstr): pass
+
+class T_localstorage(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.storage = open_storage(message,'file://%s' % os.path.join(self.tmp,'storage'))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def make_tree(self,top,files):
+        for name, data in files.items():
+            path = os.path.join(top,*name.split('/'))
+            os.makedirs(os.path.dirname(path),exist_ok=True)
+            f = open(path,'wb')
+            f.write(data)
+            f.close()
+
+    def test_backend(self):
+        self.assertIsInstance(self.storage,C_localstorage)
+        self.assertIsNone(open_storage(message,'s4://bucket'))
+
+    def test_objects(self):
+        self.storage.put('a/b/c',b'hello')
+        self.assertEqual(self.storage.get('a/b/c'),b'hello')
+        self.assertEqual(self.storage.get('a/b/c',1,3),b'ell')
+        self.assertEqual(self.storage.stat('a/b/c'),5)
+        self.assertIsNone(self.storage.stat('a/b/d'))
+
+        self.storage.copy('a/b/c','a/d')
+        self.assertEqual(self.storage.get('a/d'),b'hello')
+        self.assertEqual(self.storage.list('a/'),['a/b/c','a/d'])
+
+        self.storage.delete('a/b/c')
+        self.storage.delete('a/b/c')
+        self.assertEqual(self.storage.list(),['a/d'])
+        self.assertFalse(os.path.exists(os.path.join(self.storage.root,'a','b')))
+
+    def test_invalid_keys(self):
+        for key in ['','/a','a/../b','a//b','.uploads/x']:
+            self.assertRaises(IOError,self.storage.put,key,b'')
+
+    def test_list_tmp(self):
+        # a user's own '.tmp' file is an object, the writer's temporary files are not
+        self.storage.put('v/1/notes.tmp',b'x')
+        self.make_tree(self.storage.root,{'v/1/f.%s.tmp' % ('0' * 32):b'partial'})
+        self.assertEqual(self.storage.list('v/'),['v/1/notes.tmp'])
+        self.assertEqual(self.storage.delete_prefix('v/1/'),1)
+
+    def test_multipart(self):
+        data = os.urandom(10000)
+        path = os.path.join(self.tmp,'big')
+        self.make_tree(self.tmp,{'big':data})
+
+        self.assertEqual(self.storage.upload_file('big',path,threads=3,part_size=1024),len(data))
+        self.assertEqual(self.storage.get('big'),data)
+        self.assertEqual(os.listdir(self.storage.uploads),[])
+
+        upload_id = self.storage.create_upload('bad')
+        self.storage.upload_part(upload_id,1,b'one')
+        self.assertRaises(IOError,self.storage.complete_upload,upload_id,[(1,'not the tag')])
+        self.storage.abort_upload(upload_id)
+        self.assertIsNone(self.storage.stat('bad'))
+        self.assertEqual(os.listdir(self.storage.uploads),[])
+
+    def test_push_tree(self):
+        v1 = os.path.join(self.tmp,'versions','1')
+        v2 = os.path.join(self.tmp,'versions','2')
+        self.make_tree(v1,{'same':b'unchanged','sub/changed':b'old','big':b'b' * 5000})
+        self.make_tree(v2,{'sub/changed':b'new','added':b'added'})
+        os.link(os.path.join(v1,'same'),os.path.join(v2,'same'))
+        os.link(os.path.join(v1,'big'),os.path.join(v2,'big'))
+        os.symlink('same',os.path.join(v2,'link'))
+
+        self.assertEqual(self.storage.push_tree('versions/1',v1,part_size=1024),(3,5012))
+
+        # the hard linked files are copied in the storage, not sent again
+        self.assertEqual(self.storage.push_tree('versions/2',v2,part_size=1024,prev_prefix='versions/1',prev_top=v1),(4,8))
+        self.assertEqual(self.storage.list('versions/2/'),['versions/2/added','versions/2/big','versions/2/same','versions/2/sub/changed'])
+        self.assertEqual(self.storage.get('versions/2/big'),b'b' * 5000)
+        self.assertEqual(self.storage.get('versions/2/sub/changed'),b'new')
+
+        # what was never pushed is sent, even if it is linked
+        self.storage.delete_prefix('versions/1/')
+        self.assertEqual(self.storage.push_tree('versions/2',v2,part_size=1024,prev_prefix='versions/1',prev_top=v1),(4,5017))
+
+if __name__ == '__main__':
+    unittest.main()
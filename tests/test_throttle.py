@@ -0,0 +1,79 @@
+import io
+import time
+import unittest
+
+from buver.cthrottle import C_bucket, C_throttle, MIN_CHUNK, parse_rate, ionice_args
+
+"""
+Tests for the throttle: the rates and ionice classes from the buver.conf,
+and how long the token buckets hold their callers back.
+"""
+
+class T_throttle(unittest.TestCase):
+    def test_parse_rate(self):
+        for val, rate in [('',0),('  ',0),('0',0),('100',100),('1k',1024),(' 2M ',2 * 1024 ** 2),('3G',3 * 1024 ** 3)]:
+            self.assertEqual(parse_rate(val),rate,val)
+        for val in ['x','K','1.5M','-1','10 M','1T','1KB']:
+            self.assertIsNone(parse_rate(val),val)
+
+    def test_ionice_args(self):
+        self.assertEqual(ionice_args(''),[])
+        self.assertEqual(ionice_args('idle'),['-c','3'])
+        self.assertEqual(ionice_args('Best-Effort:4'),['-c','2','-n','4'])
+        self.assertEqual(ionice_args('realtime:0'),['-c','1','-n','0'])
+        self.assertEqual(ionice_args(' realtime '),['-c','1'])
+        for val in ['fast','idle:3','best-effort:8','best-effort:','best-effort:x','best-effort:-1']:
+            self.assertIsNone(ionice_args(val),val)
+
+    def test_no_limit(self):
+        bucket = C_bucket(0)
+        self.assertEqual(bucket.take(1 << 40),0)
+        throttle = C_throttle()
+        self.assertFalse(throttle.active())
+        f = io.BytesIO(b'data')
+        self.assertIs(throttle.reader(f),f)
+        self.assertEqual(throttle.chunk(1 << 20),1 << 20)
+
+    def test_take(self):
+        # the bucket starts with one second's worth, after that the callers wait
+        bucket = C_bucket(100000)
+        start = time.monotonic()
+        self.assertEqual(bucket.take(100000),0)
+        self.assertLess(time.monotonic() - start,0.1)
+
+        # the debt is paid by sleeping, and the next caller pays for it too
+        wait = bucket.take(20000)
+        self.assertAlmostEqual(wait,0.2,delta=0.05)
+        wait = bucket.take(20000)
+        self.assertAlmostEqual(wait,0.2,delta=0.05)
+        self.assertGreaterEqual(time.monotonic() - start,0.35)
+        self.assertAlmostEqual(bucket.waited,0.4,delta=0.1)
+
+        # it fills up again, but never with more than a second's worth
+        time.sleep(0.3)
+        self.assertEqual(bucket.take(20000),0)
+        bucket.last = bucket.last - 10
+        self.assertEqual(bucket.take(100000),0)
+        self.assertGreater(bucket.take(10000),0)
+
+    def test_reader(self):
+        throttle = C_throttle(read_bps=MIN_CHUNK * 10)
+        self.assertTrue(throttle.active())
+        self.assertEqual(throttle.chunk(1 << 20),MIN_CHUNK)
+        self.assertEqual(C_throttle(write_bps=10 << 20).chunk(1 << 30),1 << 20)
+
+        # a second's worth is free, the other one is not
+        f = throttle.reader(io.BytesIO(b'x' * MIN_CHUNK * 20))
+        start = time.monotonic()
+        nbytes = 0
+        while True:
+            data = f.read()
+            if not data: break
+            self.assertLessEqual(len(data),MIN_CHUNK)
+            nbytes = nbytes + len(data)
+        self.assertEqual(nbytes,MIN_CHUNK * 20)
+        self.assertGreaterEqual(time.monotonic() - start,0.9)
+        self.assertGreaterEqual(throttle.waited(),0.9)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,123 @@
+import os
+import random
+import shutil
+import tempfile
+import time
+import unittest
+
+from buver.carchive import C_archive
+from buver.cmanifest import C_manifest
+from buver.cverify import C_verify
+
+"""
+Tests for 'buver --verify' on the archive versions, and for how fast it
+reads with '--max-read-bps'.
+
+The archives are big enough to be written as several blocks, which the
+'bgzf' type, and the 'gzip' type with the bz2 and lzma codecs, write as
+separate gzip members or compressed streams one after the other.
+"""
+
+def message(msgstr): pass
+
+class T_verify_archive(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.src = os.path.join(self.tmp,'src')
+        self.tgt = os.path.join(self.tmp,'tgt')
+        self.version = os.path.join(self.tgt,'versions','1')
+        os.makedirs(os.path.join(self.src,'sub'))
+        os.makedirs(self.version)
+
+        # some of it compresses and some does not, and there is more than a few blocks of it
+        rnd = random.Random(1)
+        for i in range(6):
+            f = open(os.path.join(self.src,'sub' if i % 2 else '','f%d' % i),'wb')
+            f.write(bytes(rnd.getrandbits(8) for n in range(256 * 1024)))
+            f.write(b'buver ' * 60000)
+            f.close()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def backup(self,compress,independent,codec,suffix):
+        """Make version 1 of the tgt_loc as an archive, and return the archive's name."""
+
+        archive = os.path.join(self.version,'backup.tar%s' % suffix)
+        manifest = C_manifest(self.version)
+        self.assertEqual(manifest.create(),0)
+        archiver = C_archive(message,self.src,archive,compress,4,manifest,independent,codec,hashing=True)
+        self.assertEqual(archiver.run(),0)
+        self.assertEqual(manifest.close(),0)
+
+        return archive
+
+    def verify(self):
+        verify = C_verify(message,self.tgt,threads=1)
+        return verify.execute(), verify.counts
+
+    def check_codec(self,compress,independent,codec,suffix):
+        archive = self.backup(compress,independent,codec,suffix)
+
+        rc, counts = self.verify()
+        self.assertEqual(rc,0)
+        self.assertEqual(counts['ok'],6)
+        self.assertEqual(counts['missing'] + counts['corrupt'],0)
+
+        # damage the middle of the archive, which must be noticed
+        f = open(archive,'r+b')
+        f.seek(os.path.getsize(archive) // 2)
+        f.write(b'\xff' * 100)
+        f.close()
+
+        rc, counts = self.verify()
+        self.assertNotEqual(rc,0)
+        self.assertNotEqual(counts['missing'] + counts['corrupt'],0)
+
+    def test_tar(self):
+        self.check_codec(False,False,'zlib','')
+
+    def test_gzip(self):
+        self.check_codec(True,False,'zlib','.gz')
+
+    def test_bgzf(self):
+        self.check_codec(True,True,'zlib','.gz')
+
+    def test_bz2(self):
+        self.check_codec(True,False,'bz2','.bz2')
+
+    def test_lzma(self):
+        self.check_codec(True,False,'lzma','.xz')
+
+class T_verify_throttle(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.tgt = os.path.join(self.tmp,'tgt')
+        version = os.path.join(self.tgt,'versions','1')
+        tree = os.path.join(version,'src')
+        os.makedirs(tree)
+
+        # many small files, so each batch of them is less than a second's worth
+        manifest = C_manifest(version)
+        self.assertEqual(manifest.create(),0)
+        for n in range(600):
+            name = os.path.join(tree,'f%d' % n)
+            f = open(name,'wb')
+            f.write(b'x' * 512)
+            f.close()
+            manifest.add('f%d' % n,os.lstat(name))
+        self.assertEqual(manifest.close(),0)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def test_throttle(self):
+        # 300K at 100K a second, of which the first second's worth is free
+        start = time.time()
+        verify = C_verify(message,self.tgt,threads=1,read_bps=100 * 1024)
+        self.assertEqual(verify.execute(),0)
+        self.assertEqual(verify.counts['unhashed'],600)
+        self.assertGreaterEqual(time.time() - start,1.8)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,99 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from buver.cwalker import C_walker
+
+"""
+Tests for the tree walker, against os.walk().
+"""
+
+class T_walker(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.top = os.path.join(self.tmp,'top')
+
+        # wide and deep enough that the threads read ahead of the caller
+        for a in range(6):
+            for b in range(5):
+                path = os.path.join(self.top,'a%d' % a,'b%d' % b,'c')
+                os.makedirs(path)
+                for n in range(3): open(os.path.join(path,'f%d' % n),'w').close()
+                open(os.path.join(self.top,'a%d' % a,'f%d' % b),'w').close()
+        os.makedirs(os.path.join(self.top,'empty'))
+        os.symlink('a0',os.path.join(self.top,'dirlink'))
+        os.symlink('a0/f0',os.path.join(self.top,'filelink'))
+        os.symlink('nowhere',os.path.join(self.top,'dangling'))
+        os.mkfifo(os.path.join(self.top,'fifo'))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def expected(self):
+        """os.walk(), with the symbolic links to directories moved to the files
+        (which are sorted, since they are listed in a different order)."""
+
+        out = []
+        for root, subdirs, files in os.walk(self.top):
+            links = [name for name in subdirs if os.path.islink(os.path.join(root,name))]
+            out.append((root,[name for name in subdirs if name not in links],sorted(files + links)))
+        return out
+
+    def test_walk(self):
+        for threads in [1,4]:
+            walker = C_walker(None,threads)
+            got = [(root,list(subdirs),sorted(files)) for root, subdirs, files in walker.walk(self.top)]
+            self.assertEqual(got,self.expected())
+            self.assertEqual(walker.errors,0)
+
+    def test_prune(self):
+        # the caller can still change subdirs to skip parts of the tree
+        roots = []
+        for root, subdirs, files in C_walker(None,4).walk(self.top):
+            roots.append(os.path.relpath(root,self.top))
+            subdirs[:] = [name for name in subdirs if name not in ['a1','b2']]
+        self.assertEqual(len(roots),1 + 1 + 5 * (1 + 4 * 2))
+        self.assertFalse([rel for rel in roots if rel.startswith('a1') or 'b2' in rel])
+
+    def test_stop_early(self):
+        walk = C_walker(None,4).walk(self.top)
+        self.assertEqual(next(walk)[0],self.top)
+        walk.close()
+
+    def test_scan(self):
+        entries = dict([(e.rel,e) for e in C_walker(None,4).scan(self.top)])
+        self.assertEqual(len(entries),sum([len(subdirs) + len(files) for root, subdirs, files in self.expected()]))
+        self.assertEqual(entries['a3/b4/c/f2'].type,'f')
+        self.assertEqual(entries['a3/b4/c/f2'].path,os.path.join(self.top,'a3','b4','c','f2'))
+        self.assertEqual(entries['a3/b4'].type,'d')
+        self.assertEqual(entries['empty'].name,'empty')
+        for name in ['dirlink','filelink','dangling']: self.assertEqual(entries[name].type,'l')
+        self.assertEqual(entries['fifo'].type,'o')
+
+    def test_listdir(self):
+        walker = C_walker()
+        subdirs, files = walker.listdir(self.top)
+        self.assertEqual(sorted(subdirs),['a%d' % a for a in range(6)] + ['empty'])
+        self.assertEqual(sorted(files),['dangling','dirlink','fifo','filelink'])
+
+        # like os.path.isdir(), if asked to
+        subdirs, files = walker.listdir(self.top,True)
+        self.assertIn('dirlink',subdirs)
+        self.assertRaises(OSError,walker.listdir,os.path.join(self.top,'missing'))
+
+    def test_errors(self):
+        # a directory that goes away before it is read is skipped, and reported
+        messages = []
+        walker = C_walker(messages.append,1)
+        roots = []
+        for root, subdirs, files in walker.walk(self.top):
+            roots.append(root)
+            if root == self.top: shutil.rmtree(os.path.join(self.top,'a2'))
+        self.assertNotIn(os.path.join(self.top,'a2'),roots)
+        self.assertEqual(walker.errors,1)
+        self.assertEqual(len(messages),1)
+        self.assertIn('a2',messages[0])
+
+if __name__ == '__main__':
+    unittest.main()
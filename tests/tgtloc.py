@@ -0,0 +1,35 @@
+import os
+
+from buver.cbuver import C_buver
+
+"""
+Helpers for the tests that run backups: make a tgt_loc and set what
+they need in its buver.conf.
+"""
+
+def init_tgt_loc(tgt,**values):
+    """Initialize a tgt_loc at 'tgt', then set each key in 'values' in its
+    buver.conf, adding the keys that are not there yet."""
+
+    buver = C_buver(0,tgt)
+    try:
+        rc = buver.execute()
+    finally:
+        buver.close()
+    if rc != 0: raise AssertionError('initializing %s returned %d' % (tgt,rc))
+
+    set_conf(tgt,**values)
+
+def set_conf(tgt,**values):
+    """Set each key in 'values' in the buver.conf of the tgt_loc 'tgt',
+    adding the keys that are not there yet."""
+
+    conf = os.path.join(tgt,'buver.conf')
+    lines = []
+    for line in open(conf).read().splitlines():
+        key = line.split('=',1)[0]
+        if key in values: line = '%s=%s' % (key,values.pop(key))
+        lines.append(line)
+    f = open(conf,'w')
+    f.write('\n'.join(lines + ['%s=%s' % item for item in sorted(values.items())]) + '\n')
+    f.close()